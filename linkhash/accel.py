@@ -0,0 +1,195 @@
+"""
+Linker acceleration policy, applied to the misses which linkcache executes.
+With `--accelerate`, a link made through a compiler driver (gcc, clang, ...)
+is rewritten to use the fastest linker the driver can run (mold, then lld,
+then gold) with a thread for each CPU which is idle at the time, and with
+`--accelerate-gdb-index`, to build a `.gdb_index` so that the debugger
+doesn't have to index the (possibly split) DWARF of the output when it loads
+it. Commands which choose their own linker, direct invocations of a linker,
+and outputs matching a glob of `--accelerate-deny` are left alone.
+
+The linkers each driver can run are detected once, by asking the driver for
+the version of each with `-fuse-ld=<linker> -Wl,--version`, and the result is
+cached in `accel/linkers.json` of the cache directory until the driver or
+the linker it found changes.
+
+The rewrite is recorded in the cacheinfo of the output, and a hit requires
+that the policy would make the same choice today, so that an output linked
+by mold isn't reused once the policy is disabled or the target is denied.
+The number of threads doesn't affect the output and isn't compared.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+import json
+import logging
+import os
+
+from linkhash import linkcache
+from linkhash import toolchain
+
+logger = logging.getLogger(__name__)
+
+# Linkers in order of preference, with the options that set their number of
+# threads
+LINKERS = [
+    ("mold", ["-Wl,--thread-count={}"]),
+    ("lld", ["-Wl,--threads={}"]),
+    ("gold", ["-Wl,--threads", "-Wl,--thread-count={}"]),
+]
+
+# Options with which a link command chooses it's own linker
+LINKER_OPTIONS = ("-fuse-ld=", "--ld-path=", "-B")
+
+# Seconds to wait for the driver to report the version of a linker
+DETECT_TIMEOUT = 10
+
+
+def is_denied(outfile, options):
+  """Return true if `outfile` matches a glob of --accelerate-deny."""
+  if not options.accelerate_deny:
+    return False
+  import fnmatch
+  candidates = (outfile, os.path.basename(outfile))
+  return any(
+      fnmatch.fnmatchcase(candidate, pattern)
+      for pattern in options.accelerate_deny for candidate in candidates)
+
+
+def get_program_id(path):
+  statbuf = linkcache.stat_or_none(path)
+  if statbuf is None:
+    return None
+  return [statbuf.st_size, statbuf.st_mtime_ns]
+
+
+def get_detection_path(options):
+  return os.path.join(linkcache.get_cachedir(options), "accel", "linkers.json")
+
+
+def probe_linkers(driverpath):
+  """Return the names of the LINKERS which `driverpath` can run."""
+  import subprocess
+  found = []
+  for name, _ in LINKERS:
+    try:
+      returncode = subprocess.call(
+          [driverpath, "-fuse-ld=" + name, "-Wl,--version"],
+          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL, timeout=DETECT_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+      continue
+    if returncode == 0:
+      found.append(name)
+  logger.debug("%s can run linkers: %s", driverpath, found)
+  return found
+
+
+def detect_linkers(driver, options):
+  """
+  Return the names of the LINKERS which the compiler `driver` can run, from
+  the cache of detections if it is still valid.
+  """
+  driverpath = toolchain.find_program(driver)
+  if driverpath is None:
+    return []
+  driverpath = os.path.realpath(driverpath)
+  driver_id = get_program_id(driverpath)
+  searchpath = os.environ.get("PATH", "")
+
+  detectionpath = get_detection_path(options)
+  detections = {}
+  try:
+    with io.open(detectionpath, "r", encoding="utf-8") as infile:
+      detections = json.load(infile)
+  except (IOError, OSError, ValueError):
+    pass
+  entry = detections.get(driverpath)
+  if (isinstance(entry, dict) and entry.get("id") == driver_id
+      and entry.get("path") == searchpath):
+    return entry.get("linkers", [])
+
+  linkers = probe_linkers(driverpath)
+  detections[driverpath] = {
+      "id": driver_id,
+      "path": searchpath,
+      "linkers": linkers,
+  }
+  try:
+    if not os.path.isdir(os.path.dirname(detectionpath)):
+      os.makedirs(os.path.dirname(detectionpath))
+    content = json.dumps(detections, indent=2, sort_keys=True)
+    linkcache.write_atomic(detectionpath, content.encode("utf-8") + b"\n")
+  except OSError:
+    logger.warning("failed to cache linker detection in %s", detectionpath)
+  return linkers
+
+
+def get_thread_count():
+  """Return the number of CPUs available to us which are currently idle."""
+  try:
+    ncpu = len(os.sched_getaffinity(0))
+  except AttributeError:
+    ncpu = os.cpu_count() or 1
+  try:
+    load = os.getloadavg()[0]
+  except OSError:
+    load = 0.0
+  return max(1, min(ncpu, int(round(ncpu - load))))
+
+
+def get_rewrite(subcommand, outfile, options):
+  """
+  Return the rewrite of the link command `subcommand`, which writes
+  `outfile`, as a json object with the name of the "linker", whether it
+  builds a "gdb_index", the number of "threads" and the "args" to append.
+  Return None if the policy doesn't apply to this link.
+  """
+  if not toolchain.is_driver(subcommand[0]):
+    return None
+  if any(arg.startswith(LINKER_OPTIONS) for arg in subcommand[1:]):
+    logger.debug("The link command chooses it's own linker")
+    return None
+  if is_denied(outfile, options):
+    logger.debug("%s is denied acceleration", outfile)
+    return None
+  linkers = detect_linkers(subcommand[0], options)
+  if not linkers:
+    return None
+
+  name = linkers[0]
+  threads = get_thread_count()
+  return {
+      "linker": name,
+      "gdb_index": options.accelerate_gdb_index,
+      "threads": threads,
+      "args": get_linker_args(name, threads, options.accelerate_gdb_index),
+  }
+
+
+def get_linker_args(name, threads, gdb_index):
+  """
+  Return the arguments which select the linker `name`, running `threads`
+  threads, and building a `.gdb_index` if `gdb_index` is true.
+  """
+  args = ["-fuse-ld=" + name]
+  args.extend(
+      arg.format(threads) for linker, thread_args in LINKERS
+      if linker == name for arg in thread_args)
+  if gdb_index:
+    args.append("-Wl,--gdb-index")
+  return args
+
+
+def limit_threads(rewrite, threads):
+  """
+  Return `rewrite` (see `get_rewrite()`) limited to at most `threads`
+  threads, e.g. the number of job slots available to the link.
+  """
+  if threads is None or rewrite["threads"] <= threads:
+    return rewrite
+  out = dict(rewrite)
+  out["threads"] = max(1, threads)
+  out["args"] = get_linker_args(out["linker"], out["threads"], out["gdb_index"])
+  return out
@@ -0,0 +1,329 @@
+"""
+Cache the result of any deterministic command with declared inputs and
+outputs, e.g. the `strip` or `objcopy --only-keep-debug` which a build runs
+after a link. `linkcache exec` evaluates the command just like a link: if the
+execspec (arguments, working directory, environment, and the declared inputs
+and outputs) is unchanged and no input is newer than the outputs, then the
+command is skipped and the outputs are touched. Otherwise the command is
+executed and the cacheinfo of the first output (`<output>.exec.cacheinfo`,
+or `<output>.<name>.cacheinfo` with `--name`) records it.
+
+  linkcache exec --in prog --out prog.debug -- \\
+    objcopy --only-keep-debug prog prog.debug
+
+The inputs and outputs may instead be declared in a json spec file, which may
+also contain the command:
+
+  {"inputs": ["prog"], "outputs": ["prog.debug"],
+   "command": ["objcopy", "--only-keep-debug", "prog", "prog.debug"]}
+
+A path which is both an input and an output is modified in place (e.g.
+`strip -g prog`), so it is newer than itself. It's size, mtime and a digest
+of it's content are recorded in the cacheinfo after the command, and the
+command is skipped if they are unchanged. The content is digested again only
+if the file was touched (same size, new mtime), in which case a hit records
+the new mtime. In-place outputs aren't touched on a hit.
+
+Unlike a link, every input is compared by it's timestamp (there are no API
+digests) and the arguments aren't canonicalized, since the argument rules
+for link commands don't apply to other programs.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+
+class ActionContext(linkcache.Context):
+  """
+  A `linkcache.Context` for a command whose inputs and outputs are declared
+  rather than found in a link command line.
+  """
+
+  def __init__(self, subcommand, inputs, outputs, options=None, cwd=None,
+               statcache=None, name="exec"):
+    super(ActionContext, self).__init__(subcommand, options, cwd, statcache)
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.name = name
+    self.inplace = set(self.inputs) & set(self.outputs)
+    # Fingerprints of files modified in place which were touched, but whose
+    # content is unchanged, to be recorded after a hit
+    self.touched = {}
+
+  def compute_execspec(self):
+    toolchain = self.get_recorded_toolchain()
+    spec = linkcache.get_execspec(
+        self.subcommand, self.options, self.cwd, canonicalize=False,
+        toolchain=toolchain, toolchain_ids=self.toolchain_ids)
+    normalize = linkcache.get_path_normalizer(
+        linkcache.get_path_prefixes(self.options, self.cwd))
+    del spec["hash"]
+    spec["inputs"] = [normalize(path) for path in self.inputs]
+    spec["outputs"] = [normalize(path) for path in self.outputs]
+    spec["hash"] = linkcache.get_spechash(spec)
+    return spec
+
+  def get_output(self):
+    return self.outputs[0]
+
+  def get_outputs(self):
+    return self.outputs
+
+  def get_input_args(self):
+    return self.inputs
+
+  def get_cacheinfopath(self):
+    return "{}.{}.cacheinfo".format(self.outfile, self.name)
+
+  def check_input(self, arg, outfile_mtime, depth=0):
+    """Return true if the declared input `arg` does not invalidate the cache."""
+    arg_stat = self.statcache.stat(self.resolve(arg))
+    if arg_stat is None:
+      logger.debug("Input file doesn't exist %s", arg)
+      return self.record_miss("input-changed", arg)
+    recorded = self.cacheinfo.get("fingerprints", {})
+    if arg in self.inplace:
+      if self.check_fingerprint(arg, arg_stat, recorded.get(arg)):
+        return True
+      logger.debug("File modified in place has changed %s", arg)
+      return self.record_miss("input-changed", arg)
+    # NOTE(josh): a file modified in place may have been touched since the
+    # command, so other inputs are compared to it's mtime at that time.
+    for path in self.inplace:
+      fingerprint = recorded.get(path)
+      if isinstance(fingerprint, list) and len(fingerprint) > 1:
+        outfile_mtime = min(outfile_mtime, fingerprint[1] * 1e-9)
+    if arg_stat.st_mtime < outfile_mtime:
+      return True
+    logger.debug("Input file has changed %s", arg)
+    return self.record_miss("input-changed", arg)
+
+  def check_fingerprint(self, path, statbuf, recorded):
+    """
+    Return true if the file modified in place at `path` is the one which
+    was `recorded` in the cacheinfo. If only it's mtime has changed then
+    it's content is compared.
+    """
+    if not isinstance(recorded, list) or len(recorded) != 3:
+      return False
+    size, mtime_ns, digest = recorded
+    if statbuf.st_size != size:
+      return False
+    if statbuf.st_mtime_ns == mtime_ns:
+      return True
+    try:
+      if get_file_digest(self.resolve(path)) != digest:
+        return False
+    except (IOError, OSError):
+      return False
+    logger.debug("File modified in place was touched %s", path)
+    self.touched[path] = [statbuf.st_size, statbuf.st_mtime_ns, digest]
+    return True
+
+  def refresh_cacheinfo(self):
+    """
+    In addition to `linkcache.Context.refresh_cacheinfo()`, record the mtime
+    of files modified in place which were touched, so that they aren't
+    digested again by the next check.
+    """
+    if self.touched and self.cacheinfo is not None:
+      cacheinfo = dict(self.cacheinfo)
+      fingerprints = dict(cacheinfo.get("fingerprints", {}))
+      fingerprints.update(self.touched)
+      cacheinfo["fingerprints"] = fingerprints
+      self.replace_cacheinfo(cacheinfo)
+      self.cacheinfo = cacheinfo
+    super(ActionContext, self).refresh_cacheinfo()
+
+  def is_shared_output(self):
+    return False
+
+  def get_input_apids(self):
+    return {}
+
+  def get_accel(self):
+    return None
+
+  def get_link_command(self):
+    return self.subcommand
+
+  def get_extra_cacheinfo(self):
+    fingerprints = {}
+    for path in sorted(self.inplace):
+      try:
+        fingerprints[path] = get_fingerprint(self.resolve(path))
+      except (IOError, OSError):
+        continue
+    return {"fingerprints": fingerprints} if fingerprints else {}
+
+  def touch_outputs(self):
+    for output in self.outputs:
+      if output not in self.inplace:
+        os.utime(self.resolve(output), None)
+
+
+def get_file_digest(path):
+  """Return the sha1 of the content of the file at `path`."""
+  import hashlib
+  digest = hashlib.sha1()
+  with open(path, "rb") as infile:
+    for chunk in iter(lambda: infile.read(1 << 20), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def get_fingerprint(path):
+  """
+  Return the fingerprint of a file modified in place: it's size, mtime and
+  the digest of it's content.
+  """
+  statbuf = os.stat(path)
+  return [statbuf.st_size, statbuf.st_mtime_ns, get_file_digest(path)]
+
+
+def read_spec(specpath):
+  """Return the json object of the spec file at `specpath`."""
+  with io.open(specpath, "r", encoding="utf-8") as infile:
+    spec = json.load(infile)
+  if not isinstance(spec, dict):
+    raise ValueError("expected a json object")
+  for key in ("inputs", "outputs", "command"):
+    value = spec.get(key, [])
+    if not isinstance(value, list) or not all(
+        isinstance(item, str) for item in value):
+      raise ValueError("{} must be a list of strings".format(key))
+  return spec
+
+
+def execute(ctx):
+  """
+  Evaluate the cache of `ctx` and execute the command if it misses. Return
+  the exit status.
+  """
+  if ctx.cache_hit():
+    logger.debug("Cache hit, touching %s", ", ".join(ctx.outputs))
+    ctx.touch_outputs()
+    ctx.refresh_cacheinfo()
+    ctx.record_decision("hit")
+    return 0
+
+  if ctx.miss_reason == "bypass":
+    ctx.record_decision("bypass")
+    ctx.exec_bypass()
+    return 1
+
+  with ctx.lock():
+    if ctx.cacheinfo_changed():
+      ctx.statcache.clear()
+      if ctx.cache_hit():
+        # Another process executed the same command between our evaluation
+        # of the cache and acquiring the lock
+        ctx.touch_outputs()
+        ctx.record_decision("hit")
+        return 0
+
+    ctx.recompute_execspec()
+    ctx.remove_cacheinfo()
+    logger.debug("Cache miss, executing subcommand")
+    tstart = linkcache.get_children_cpu_time()
+    twall = time.time()
+    result = subprocess.call(ctx.subcommand)
+    ctx.link_wall_time = time.time() - twall
+    ctx.link_time = linkcache.get_children_cpu_time() - tstart
+    ctx.peak_rss = linkcache.get_children_peak_rss()
+    if result == 0:
+      ctx.write_cacheinfo()
+  ctx.record_decision("miss")
+  return result
+
+
+def setup_argparser(argparser):
+  argparser.add_argument(
+      "--in", dest="inputs", action="append", default=[], metavar="PATH",
+      help="Input of the command. May be given multiple times")
+  argparser.add_argument(
+      "--out", dest="outputs", action="append", default=[], metavar="PATH",
+      help="Output of the command. May be given multiple times")
+  argparser.add_argument(
+      "--spec", metavar="PATH",
+      help="json file declaring the inputs, outputs and (optionally) the"
+           " command, in addition to those given on the command line")
+  argparser.add_argument(
+      "--name", default="exec",
+      help="Name of the cacheinfo sidecar, to tell apart several commands"
+           " which modify the same file in place. Default: exec")
+  argparser.add_argument(
+      "command", nargs=argparse.REMAINDER,
+      help="The command to execute, after `--`")
+
+
+def get_argparser():
+  argparser = argparse.ArgumentParser(
+      prog="linkcache exec", description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  setup_argparser(argparser)
+  return argparser
+
+
+def get_declaration(args, cwd=None):
+  """
+  Return the `(command, inputs, outputs)` declared by the parsed arguments
+  `args` of `linkcache exec`, including those of it's spec file, which is
+  relative to `cwd` if given. Raises IOError, OSError or ValueError if the
+  spec file can't be read.
+  """
+  inputs = list(args.inputs)
+  outputs = list(args.outputs)
+  command = list(args.command)
+  if command[:1] == ["--"]:
+    command = command[1:]
+  if args.spec is not None:
+    specpath = args.spec
+    if cwd is not None:
+      specpath = os.path.join(cwd, specpath)
+    spec = read_spec(specpath)
+    inputs.extend(spec.get("inputs", []))
+    outputs.extend(spec.get("outputs", []))
+    if not command:
+      command = spec.get("command", [])
+  return command, inputs, outputs
+
+
+def main(argv, options=None):
+  argparser = get_argparser()
+  args = argparser.parse_args(argv)
+  if options is None:
+    options = linkcache.Options(**linkcache.get_default_options())
+  linkcache.logger.set_level(options.log_level)
+  linkcache.logger.get_logger()
+
+  try:
+    command, inputs, outputs = get_declaration(args)
+  except (IOError, OSError, ValueError) as ex:
+    logger.error("Failed to read spec %s: %s", args.spec, ex)
+    return 1
+
+  if not command:
+    argparser.error("no command to execute")
+  if not outputs:
+    argparser.error("the command must declare at least one output")
+
+  return execute(ActionContext(command, inputs, outputs, options,
+                               name=args.name))
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
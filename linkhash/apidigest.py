@@ -0,0 +1,237 @@
+"""
+Maintain the API digest of a shared object after linkcache links it. The
+digest is computed by a `linkhash --serve` coprocess (or in-process, see
+`linkhash.elfapi`, if linkhash isn't installed) unless it is memoized by the
+build-id of the shared object. When the API changes, the new symbol list is
+snapshotted and the change appended to the history of the library (see
+`linkhash.churn`) before the apid sidecar is replaced.
+
+All of this happens only on a miss, which is why it isn't part of linkcache
+itself.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+import logging
+import os
+import subprocess
+
+from linkhash import elfnote
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+
+class LinkhashCoprocess(object):
+  """
+  Client of a `linkhash --serve` coprocess, which is started on first use and
+  kept open so that digesting many shared objects costs a single exec.
+  """
+
+  def __init__(self, linkhash_path, options=None):
+    self.linkhash_path = linkhash_path
+    self.options = options
+    self.proc = None
+
+  def start(self):
+    self.proc = subprocess.Popen(
+        ["linkhash", "--serve"] + linkcache.get_linkhash_args(self.options),
+        executable=self.linkhash_path, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+
+  def get_apid(self, sopath):
+    """
+    Return the API digest of the shared object at `sopath`, or None if it
+    can't be computed.
+    """
+    if "\n" in sopath:
+      # Can't be expressed in the line-oriented protocol
+      return None
+
+    try:
+      if self.proc is None:
+        self.start()
+      self.proc.stdin.write((sopath + "\n").encode("utf-8"))
+      self.proc.stdin.flush()
+      line = self.proc.stdout.readline().decode("utf-8")
+    except (IOError, OSError):
+      line = ""
+
+    if not line:
+      # The coprocess has exited, it will be restarted on the next request
+      logger.warning("linkhash coprocess exited unexpectedly")
+      self.close()
+      return None
+
+    path, _, apid = line.rstrip("\n").rpartition(" ")
+    if path != sopath or apid == "-":
+      return None
+    return apid
+
+  def dump_api(self, sopath):
+    """Return the symbol list (`linkhash --dump-api`) of a shared object."""
+    try:
+      return subprocess.check_output(
+          ["linkhash", "--dump-api"]
+          + linkcache.get_linkhash_args(self.options) + [sopath],
+          executable=self.linkhash_path)
+    except subprocess.CalledProcessError as ex:
+      raise OSError("linkhash exited with status {}".format(ex.returncode))
+
+  def close(self):
+    if self.proc is None:
+      return
+    try:
+      self.proc.stdin.close()
+    except (IOError, OSError):
+      pass
+    self.proc.wait()
+    self.proc.stdout.close()
+    self.proc = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+def get_digester(linkhash_path, options):
+  """
+  Return an object which computes API digests (`get_apid()`) and symbol lists
+  (`dump_api()`) of shared objects for the selected API model. This is a
+  linkhash coprocess if `linkhash_path` is given. Otherwise the digests are
+  computed in-process (see `linkhash.elfapi`), which is much slower, if that
+  implements the selected model. Returns None if neither can be used.
+  """
+  if linkhash_path is not None:
+    return LinkhashCoprocess(linkhash_path, options)
+  from linkhash import elfapi
+  api_version = linkcache.get_api_version(options)
+  if api_version not in elfapi.API_VERSIONS:
+    return None
+  logger.debug("linkhash not found, computing API digests in-process")
+  return elfapi.Digester(api_version)
+
+
+def get_build_id_memo_path(options, build_id):
+  """
+  Return the path of the file memoizing the API digest of the shared object
+  with the given build-id. Digests depend on the API model, so each version
+  has it's own table, and the default shares the table of the version it
+  resolves to.
+  """
+  version = "v{}".format(linkcache.get_api_version(options))
+  return os.path.join(
+      linkcache.get_cachedir(options), "buildid", version, build_id[:2],
+      build_id)
+
+
+def get_api_snapshot_path(options, apid):
+  # NOTE(josh): digests other than version 1 are prefixed by the API model
+  # version (e.g. "v2-"), which is skipped when fanning out directories
+  hexdigest = apid.rpartition("-")[2]
+  return os.path.join(
+      linkcache.get_cachedir(options), "api", hexdigest[:2], apid)
+
+
+def write_api_snapshot(options, linkhash, sopath, apid):
+  """
+  Store the symbol list (`linkhash --dump-api`) of a shared object, keyed by
+  it's API digest, so that a later change in API can be explained.
+  """
+  snapshotpath = get_api_snapshot_path(options, apid)
+  if os.path.exists(snapshotpath):
+    return
+
+  try:
+    content = linkhash.dump_api(sopath)
+    snapshotdir = os.path.dirname(snapshotpath)
+    if not os.path.isdir(snapshotdir):
+      os.makedirs(snapshotdir)
+    linkcache.write_atomic(snapshotpath, content)
+  except (IOError, OSError, ValueError):
+    logger.warning("failed to write API snapshot for %s", sopath)
+
+
+def read_api_snapshot(options, apid):
+  """
+  Return the set of symbols in the API snapshot with the given digest, or
+  None if there is no such snapshot.
+  """
+  try:
+    with io.open(
+        get_api_snapshot_path(options, apid), "r", encoding="utf-8") as infile:
+      return set(line.strip() for line in infile if line.strip())
+  except (IOError, OSError):
+    return None
+
+
+def record_api_change(options, sopath, apid):
+  """
+  Append the change in API of the shared object at `sopath` to it's history,
+  from the snapshot of it's new API. See `linkhash.churn`.
+  """
+  from linkhash import churn
+  symbols = read_api_snapshot(options, apid)
+  if symbols is None:
+    return
+  try:
+    churn.record_change(options, os.path.realpath(sopath), apid, symbols)
+  except (IOError, OSError):
+    logger.warning("failed to record API history of %s", sopath)
+
+
+def write_apid(ctx, linkhash):
+  """
+  Digest the output of the link of `ctx` (a `linkcache.Context`) with
+  `linkhash` (see `get_digester()`) and update it's apid sidecar if the API
+  has changed. If requested, also embed the digest in the output.
+  """
+  options = ctx.options
+  outpath = ctx.resolve(ctx.outfile)
+  new_apid = None
+
+  # NOTE(josh): the build-id identifies the content of the output, so if
+  # we have digested a library with the same build-id (a byte-identical
+  # relink, a restored artifact, another build tree) then we already know
+  # it's API digest and don't need to scan the symbol table.
+  build_id = elfnote.read_build_id(outpath)
+  if build_id is not None:
+    memopath = get_build_id_memo_path(options, build_id)
+    new_apid = linkcache.read_apid(memopath)
+    if new_apid:
+      logger.debug("API digest memoized by build-id %s", build_id)
+    else:
+      new_apid = None
+
+  if new_apid is None:
+    new_apid = linkhash.get_apid(outpath)
+    if new_apid is None:
+      logger.warning("failed to linkhash")
+      return
+    if build_id is not None:
+      try:
+        memodir = os.path.dirname(memopath)
+        if not os.path.isdir(memodir):
+          os.makedirs(memodir)
+        linkcache.write_atomic(memopath, (new_apid + "\n").encode("utf-8"))
+      except (IOError, OSError):
+        logger.warning("failed to memoize API digest of %s", outpath)
+
+  if options.embed_apid:
+    # NOTE(josh): the sidecar is still written since it is cheaper to check,
+    # but consumers can fall back to the embedded digest if it is lost.
+    if not elfnote.embed_apid(options.objcopy, outpath, new_apid):
+      logger.warning("failed to embed API digest in %s", outpath)
+
+  apidpath = ctx.get_apidpath()
+  old_apid = linkcache.read_apid(apidpath)
+  if old_apid == new_apid:
+    # The shared-object API has not changed. No need to update the apid
+    # file.
+    return
+  write_api_snapshot(options, linkhash, outpath, new_apid)
+  record_api_change(options, outpath, new_apid)
+  linkcache.write_atomic(apidpath, (new_apid + "\n").encode("utf-8"))
@@ -0,0 +1,240 @@
+"""
+Rules which canonicalize the arguments of a link command before they are
+hashed, so that cosmetic changes to the command (verbosity, diagnostics,
+warnings, the order of global flags) don't invalidate the cache.
+
+Each rule has a name, an action and a list of glob patterns. A pattern must
+match the whole of an argument, or of a flag and it's value joined by a space
+for flags in SEPARATE_VALUE_FLAGS (e.g. `-Xlinker --verbose`). The first rule
+to match an argument applies:
+
+  drop: the argument is removed
+  sort: each run of consecutive arguments matching the rule is sorted, so they
+    must be insensitive to order among themselves. Runs are broken by any
+    other argument, so the position of inputs, libraries and positional flags
+    (`--as-needed`, `--start-group`, `-Bstatic`, ...) is preserved.
+  keep: the argument is left in place, and isn't subject to later rules
+
+Rules are amended by the json files given with `linkcache --arg-rules`.
+
+NOTE(josh): this module is imported on every invocation of linkcache, so it
+only imports what the interpreter has already loaded, just like linkcache.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+
+# Built-in rules. Each entry is (name, action, patterns, enabled by default).
+ARG_RULES = [
+    # Output which only goes to the terminal
+    ("verbose", "drop", [
+        "-v", "--verbose", "-t", "--trace", "--stats", "--print-memory-usage",
+        "-Wl,-v", "-Wl,--verbose", "-Wl,-t", "-Wl,--trace", "-Wl,--stats",
+        "-Wl,--print-memory-usage", "-Xlinker -v", "-Xlinker --verbose",
+        "-Xlinker --stats", "-Xlinker --print-memory-usage",
+    ], True),
+    ("diagnostics", "drop", [
+        "-fdiagnostics-*", "-fno-diagnostics-*", "-fcolor-diagnostics",
+        "-fno-color-diagnostics", "-fansi-escape-codes",
+        "-fno-ansi-escape-codes", "-fmessage-length=*", "--color-diagnostics*",
+        "--no-color-diagnostics", "--error-limit=*",
+        "-Wl,--color-diagnostics*", "-Wl,--no-color-diagnostics",
+        "-Wl,--error-limit=*",
+    ], True),
+    ("timing", "drop", [
+        "-ftime-report*", "-ftime-trace*", "--time-trace*",
+        "-Wl,--time-trace*",
+    ], True),
+    ("pipe", "drop", ["-pipe"], True),
+    # Global settings of the driver and linker. None of them conflicts with
+    # another in the list, so their order doesn't matter.
+    ("global-flags", "sort", [
+        "-pthread", "-rdynamic", "-fPIC", "-Wl,--gc-sections",
+        "-Wl,--build-id", "-Wl,-O1", "-Wl,--sort-common",
+        "-Wl,--enable-new-dtags", "-Wl,--hash-style=gnu", "-Wl,--no-undefined",
+        "-Wl,--icf=all", "-Wl,-z,relro", "-Wl,-z,now", "-Wl,-z,noexecstack",
+        "-Wl,-z,defs",
+    ], True),
+    # Flags passed through to the linker, assembler and preprocessor, which
+    # aren't warnings
+    ("tool-flags", "keep", ["-Wl,*", "-Wa,*", "-Wp,*"], True),
+    ("warnings", "drop", ["-W*", "-w", "-pedantic", "-pedantic-errors"], True),
+    # NOTE(josh): every -L applies to every -l regardless of position, but the
+    # order of the directories decides which of two libraries with the same
+    # name is found, so this is only safe for builds where names are unique.
+    ("library-dirs", "sort", ["-L*"], False),
+]
+
+ACTIONS = ("drop", "sort", "keep")
+
+# Flags (of gcc, clang or ld) which take their value as the next argument. A
+# flag and it's value are matched, dropped and sorted together.
+SEPARATE_VALUE_FLAGS = frozenset([
+    "-o", "-x", "-L", "-l", "-T", "-e", "-u", "-z", "-m", "-h", "-R", "-y",
+    "-Y", "-f", "-F", "-I", "-D", "-U", "-MF", "-MT", "-MQ", "-include",
+    "-imacros", "-isystem", "-idirafter", "-iquote", "-isysroot", "-target",
+    "-arch", "-Xlinker", "-Xassembler", "-Xpreprocessor", "-Xclang",
+    "--param", "--sysroot", "-soname", "--soname", "-rpath", "-rpath-link",
+    "-dynamic-linker", "--dynamic-linker", "--version-script", "--script",
+    "--entry", "--undefined", "--library", "--library-path", "--output",
+    "-Map", "--out-implib", "-plugin", "-plugin-opt", "--plugin",
+    "--plugin-opt",
+])
+
+_NORMALIZERS = {}
+
+
+def warn(msg, *args):
+  import logging
+  logging.getLogger(__name__).warning(msg, *args)
+
+
+class Normalizer(object):
+  """
+  Applies a list of (name, action, patterns) rules to the arguments of a link
+  command. The patterns are compiled into a table of exact matches, a table
+  of prefixes, and a regular expression for any other glob, so that most
+  arguments are matched against every rule with a lookup or two.
+  """
+
+  def __init__(self, rules):
+    self.rules = list(rules)
+    # Map an argument, or a prefix, to the index of the first rule which
+    # matches it exactly, or as a prefix
+    self.exact = {}
+    self.prefixes = {}
+    globs = []
+    for idx, (_, _, patterns) in enumerate(self.rules):
+      for pattern in patterns:
+        if not any(char in pattern for char in "*?["):
+          self.exact.setdefault(pattern, idx)
+        elif (pattern.endswith("*")
+              and not any(char in pattern[:-1] for char in "*?[")):
+          self.prefixes.setdefault(pattern[:-1], idx)
+        else:
+          globs.append((idx, pattern))
+    self.prefix_tuple = tuple(self.prefixes)
+
+    # NOTE(josh): the built-in rules don't need a regular expression, which
+    # is expensive to compile on every invocation
+    self.pattern = None
+    if globs:
+      import fnmatch
+      import re
+      self.pattern = re.compile("|".join(
+          "(?P<_rule{}>{})".format(idx, fnmatch.translate(pattern))
+          for idx, pattern in globs))
+
+  def get_units(self, args):
+    """Split `args` into tuples of a flag and it's separate value, if any."""
+    units = []
+    idx = 0
+    while idx < len(args):
+      if args[idx] in SEPARATE_VALUE_FLAGS and idx + 1 < len(args):
+        units.append((args[idx], args[idx + 1]))
+        idx += 2
+      else:
+        units.append((args[idx],))
+        idx += 1
+    return units
+
+  def match(self, unit):
+    """Return the (name, action, patterns) of the rule for `unit`, or None."""
+    text = " ".join(unit)
+    candidates = []
+    idx = self.exact.get(text)
+    if idx is not None:
+      candidates.append(idx)
+    if self.prefix_tuple and text.startswith(self.prefix_tuple):
+      candidates.extend(
+          idx for prefix, idx in self.prefixes.items()
+          if text.startswith(prefix))
+    if self.pattern is not None:
+      match = self.pattern.match(text)
+      if match is not None:
+        candidates.append(int(match.lastgroup[len("_rule"):]))
+    if not candidates:
+      return None
+    return self.rules[min(candidates)]
+
+  def __call__(self, args):
+    """Return the canonical form of `args`, a list of arguments."""
+    out = []
+    run = []
+    run_rule = None
+    for unit in self.get_units(args):
+      rule = self.match(unit)
+      if rule is not None and rule[1] == "drop":
+        continue
+      if run and rule is not run_rule:
+        for item in sorted(run):
+          out.extend(item)
+        run = []
+      if rule is not None and rule[1] == "sort":
+        run.append(unit)
+        run_rule = rule
+      else:
+        out.extend(unit)
+    for item in sorted(run):
+      out.extend(item)
+    return out
+
+
+def load_rules(rulespaths):
+  """
+  Return the list of (name, action, patterns) rules in effect: the built-in
+  rules which are enabled, amended by each of the json files `rulespaths`.
+  A file may contain "rules" (a list of objects with a "name", "action" and a
+  list of glob "patterns"), which take precedence over the built-in rules, and
+  lists of the names of built-in rules to "enable" and "disable".
+  """
+  import json
+
+  enabled = {name: default for name, _, _, default in ARG_RULES}
+  user_rules = []
+  for rulespath in rulespaths:
+    try:
+      with io.open(rulespath, "r", encoding="utf-8") as infile:
+        content = json.load(infile)
+      for name in content.get("enable", []):
+        enabled[name] = True
+      for name in content.get("disable", []):
+        enabled[name] = False
+      rules = content.get("rules", [])
+    except (IOError, OSError, ValueError, AttributeError) as ex:
+      warn("Ignoring argument rules %s: %s", rulespath, ex)
+      continue
+    for rule in rules:
+      try:
+        name, action, patterns = (
+            rule["name"], rule["action"], rule["patterns"])
+        if action not in ACTIONS:
+          raise ValueError("unknown action {}".format(action))
+        if not isinstance(patterns, list) or not all(
+            isinstance(pattern, str) for pattern in patterns):
+          raise ValueError("patterns must be a list of strings")
+      except (KeyError, TypeError, ValueError) as ex:
+        warn("Ignoring malformed argument rule %s in %s: %s", rule, rulespath,
+             ex)
+        continue
+      user_rules.append((name, action, patterns))
+
+  return user_rules + [
+      (name, action, patterns) for name, action, patterns, _ in ARG_RULES
+      if enabled[name]]
+
+
+def get_normalizer(options):
+  """
+  Return the `Normalizer` for the rules selected by `options`. It is
+  memoized for the life of the process, so that evaluating many links (e.g.
+  `linkcache plan`) compiles the rules once.
+  """
+  rulespaths = tuple(options.arg_rules) if options is not None else ()
+  try:
+    return _NORMALIZERS[rulespaths]
+  except KeyError:
+    pass
+  _NORMALIZERS[rulespaths] = normalizer = Normalizer(load_rules(rulespaths))
+  return normalizer
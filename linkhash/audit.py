@@ -0,0 +1,333 @@
+"""
+Verify a cache hit by linking again. The link command is executed with it's
+output redirected to a temporary file, and the result is compared with the
+output that linkcache reused, ignoring the parts of an ELF file which are not
+expected to be reproducible. The result is appended to a report file as one
+json object per line. Mismatches include the state of every input, so that an
+unsafe hit can be diagnosed after the fact.
+
+`linkcache --audit-rate` starts this in the background for a fraction of
+hits, at low priority, so it is not on the critical path of the build and
+does not affect it's exit status. It can also be run by hand as
+`linkcache audit <link command>`.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import errno
+import fcntl
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import subprocess
+import time
+
+from linkhash import elfapi
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# Sections whose content is not expected to be reproduced by an identical
+# link: the build-id (which may be random, e.g. --build-id=uuid), the API
+# digest note which linkcache adds after the link, and the debuglink, which
+# includes a checksum of a separately stripped file.
+IGNORED_SECTIONS = (
+    ".note.gnu.build-id",
+    ".note.linkhash.apid",
+    ".gnu_debuglink",
+)
+
+# Linker flags which cause files other than the output to be written. An audit
+# of a command with one of these is skipped, since it would overwrite them.
+UNSAFE_FLAGS = (
+    "-save-temps",
+    "-Wl,-Map",
+    "-Wl,--Map",
+    "-Wl,--out-implib",
+    "-Wl,--dependency-file",
+    "-Wl,--print-map",
+)
+
+# Maximum number of differing sections to include in a report entry
+MAX_SECTION_DIFFS = 32
+
+
+def get_layout(image):
+  """
+  Return a tuple of (header, sections) describing the ELF file mapped at
+  `image` in a way that doesn't depend on the layout of the file. `header`
+  is a tuple of the fields of the ELF header other than offsets and counts of
+  headers. `sections` is a dictionary mapping section name to a tuple of
+  (header fields, content).
+  """
+  endian = "<" if image[5:6] == b"\x01" else ">"
+  fmt = elfapi.ElfFormat(image[4:5] == b"\x02", endian)
+  ehdr = fmt.ehdr.unpack_from(image, 0)
+  # type, machine, version, entry, flags
+  header = (image[:16],) + ehdr[0:4] + (ehdr[6],)
+  e_shoff, e_shentsize, e_shnum, e_shstrndx = (
+      ehdr[5], ehdr[10], ehdr[11], ehdr[12])
+  sections = [
+      elfapi.Section(fmt.shdr.unpack_from(image, e_shoff + idx * e_shentsize))
+      for idx in range(e_shnum)]
+  names = sections[e_shstrndx] if e_shstrndx < len(sections) else None
+
+  out = {}
+  for section in sections:
+    name = "<unnamed>"
+    if names is not None:
+      name = elfapi.read_cstring(
+          image, names.offset + section.name).decode("utf-8", "replace")
+    # NOTE(josh): NOBITS sections (e.g. .bss) have no content in the file
+    content = b"" if section.type == 8 else bytes(
+        image[section.offset:section.offset + section.size])
+    # NOTE(josh): the file offset is not compared since it changes whenever a
+    # section is added (e.g. by objcopy) without any change to the program.
+    out[name] = ((section.type, section.flags, section.addr, section.size,
+                  section.entsize), content)
+  return header, out
+
+
+def diff_elf(expect, actual):
+  """
+  Return a list of human readable strings describing how the ELF files mapped
+  at `expect` and `actual` differ, other than in IGNORED_SECTIONS.
+  """
+  out = []
+  expect_header, expect_sections = get_layout(expect)
+  actual_header, actual_sections = get_layout(actual)
+  if expect_header != actual_header:
+    out.append("ELF header differs")
+
+  for name in sorted(set(expect_sections).union(actual_sections)):
+    if name in IGNORED_SECTIONS:
+      continue
+    if name not in actual_sections:
+      out.append("section {} is missing".format(name))
+    elif name not in expect_sections:
+      out.append("section {} is unexpected".format(name))
+    elif expect_sections[name][0] != actual_sections[name][0]:
+      out.append("section {} header differs".format(name))
+    elif expect_sections[name][1] != actual_sections[name][1]:
+      out.append("section {} content differs".format(name))
+  return out
+
+
+def diff_outputs(expectpath, actualpath):
+  """
+  Return a list of human readable strings describing how the file at
+  `actualpath` differs from the one at `expectpath`. The list is empty if
+  they match.
+  """
+  with io.open(expectpath, "rb") as expectfile:
+    with io.open(actualpath, "rb") as actualfile:
+      if os.fstat(expectfile.fileno()).st_size == 0:
+        return [] if not actualfile.read(1) else ["content differs"]
+      expect = mmap.mmap(expectfile.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        if os.fstat(actualfile.fileno()).st_size == 0:
+          return ["content differs"]
+        actual = mmap.mmap(actualfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          if expect[:4] == actual[:4] == elfapi.ELF_MAGIC:
+            try:
+              return diff_elf(expect, actual)[:MAX_SECTION_DIFFS]
+            except (struct.error, IndexError):
+              pass
+          return [] if expect[:] == actual[:] else ["content differs"]
+        finally:
+          actual.close()
+      finally:
+        expect.close()
+
+
+def get_input_states(ctx, outfile_mtime):
+  """
+  Return a list describing the current state of every input of the link,
+  relative to the output: whether it is newer, and for shared objects it's
+  current API digest and the one recorded when the output was linked.
+  """
+  recorded_apids = {}
+  if ctx.cacheinfo is not None:
+    recorded_apids = ctx.cacheinfo.get("input_apids", {})
+  shared = set(ctx.iter_shared_inputs())
+
+  out = []
+  for arg in ctx.subcommand:
+    if arg is ctx.outfile or arg.startswith("-"):
+      continue
+    statbuf = linkcache.stat_or_none(ctx.resolve(arg))
+    if statbuf is None:
+      continue
+    state = {
+        "input": arg,
+        "newer": statbuf.st_mtime >= outfile_mtime,
+        "mtime": statbuf.st_mtime,
+        "size": statbuf.st_size,
+    }
+    if arg in shared:
+      state["apid"] = ctx.get_input_apid(arg)
+      state["recorded_apid"] = recorded_apids.get(arg)
+    out.append(state)
+  return out
+
+
+def append_report(reportpath, entry):
+  reportdir = os.path.dirname(reportpath)
+  if reportdir and not os.path.isdir(reportdir):
+    try:
+      os.makedirs(reportdir)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+  content = (json.dumps(entry, sort_keys=True) + "\n").encode("utf-8")
+  fd = os.open(reportpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.write(fd, content)
+  finally:
+    os.close(fd)
+
+
+def acquire_slot(statedir, njobs):
+  """
+  Return an open (and locked) file descriptor for one of `njobs` audit
+  slots, or None if they are all in use.
+  """
+  if not os.path.isdir(statedir):
+    try:
+      os.makedirs(statedir)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+  for idx in range(max(1, njobs)):
+    fd = os.open(
+        os.path.join(statedir, "slot{}.lock".format(idx)),
+        os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return fd
+    except (IOError, OSError):
+      os.close(fd)
+  return None
+
+
+def audit(ctx, options):
+  """
+  Link again and compare with the existing output. Return a report entry.
+  """
+  entry = {
+      "time": time.time(),
+      "cwd": os.getcwd(),
+      "output": ctx.get_output(),
+      "command": ctx.subcommand,
+  }
+
+  unsafe = [
+      arg for arg in ctx.subcommand if arg.startswith(UNSAFE_FLAGS)]
+  if ctx.outfile is None or unsafe:
+    entry["result"] = "skipped"
+    entry["details"] = unsafe or ["no output"]
+    return entry
+
+  outpath = ctx.resolve(ctx.outfile)
+  before = os.stat(outpath)
+  auditpath = os.path.join(
+      os.path.dirname(outpath),
+      ".{}.audit{}".format(os.path.basename(outpath), os.getpid()))
+  # NOTE(josh): link the way the miss was linked (e.g. by the acceleration
+  # policy), which the hit has verified is still the case
+  command = list(ctx.get_link_command())
+  command[command.index("-o") + 1] = auditpath
+
+  try:
+    proc = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    stdout, _ = proc.communicate()
+    if proc.returncode != 0:
+      entry["result"] = "link-failed"
+      entry["details"] = stdout.decode("utf-8", "replace").splitlines()
+      return entry
+
+    # NOTE(josh): if the output was relinked while we were linking then we
+    # can't tell what we should have matched.
+    after = linkcache.stat_or_none(outpath)
+    if after is None or linkcache.get_file_id(after) != linkcache.get_file_id(
+        before) or after.st_mtime != before.st_mtime:
+      entry["result"] = "output-changed"
+      return entry
+
+    details = diff_outputs(outpath, auditpath)
+  finally:
+    if os.path.exists(auditpath):
+      os.unlink(auditpath)
+
+  if not details:
+    entry["result"] = "match"
+    return entry
+
+  entry["result"] = "mismatch"
+  entry["details"] = details
+  entry["cacheinfo"] = ctx.cacheinfo
+  entry["inputs"] = get_input_states(ctx, before.st_mtime)
+  return entry
+
+
+def get_report_path(options):
+  if options is not None and options.audit_report:
+    return options.audit_report
+  return os.path.join(linkcache.get_cachedir(options), "audit", "report.jsonl")
+
+
+def main(argv, options=None):
+  if not argv:
+    logger.error("usage: linkcache audit <link command>")
+    return 1
+
+  statedir = os.path.join(linkcache.get_cachedir(options), "audit")
+  slot = acquire_slot(
+      statedir, options.audit_jobs if options is not None else 1)
+  if slot is None:
+    logger.debug("All audit slots are busy, skipping")
+    return 0
+
+  try:
+    try:
+      os.nice(19)
+    except OSError:
+      pass
+
+    # NOTE(josh): the hit being audited was checked, so the cache must be
+    # checked again rather than bypassed.
+    if options is not None:
+      options.no_bypass = True
+    ctx = linkcache.Context(argv, options)
+    if not ctx.cache_hit():
+      # Something changed between the hit and now (e.g. a later step of the
+      # build). Only hits are audited.
+      logger.debug("No longer a cache hit, skipping")
+      return 0
+
+    try:
+      entry = audit(ctx, options)
+    except (IOError, OSError) as ex:
+      entry = {
+          "time": time.time(),
+          "cwd": os.getcwd(),
+          "output": ctx.outfile,
+          "command": argv,
+          "result": "error",
+          "details": [str(ex)],
+      }
+    append_report(get_report_path(options), entry)
+    if entry["result"] == "mismatch":
+      logger.warning(
+          "Audit of %s found a mismatch: %s", ctx.outfile,
+          ", ".join(entry["details"]))
+      return 1
+    return 0
+  finally:
+    os.close(slot)
@@ -0,0 +1,398 @@
+"""
+Report which shared objects, and which of their symbols, change API most
+often and cause the most relinks of their consumers. A few libraries whose
+exported symbols churn (e.g. template instantiations, or internals exported by
+accident) often account for most of the relinks of a build, and are the best
+candidates for `-fvisibility=hidden` or an export map.
+
+Whenever linkcache finds that the API of a shared object has changed it
+appends the change to the history of that library, and whenever a consumer is
+relinked because of it (an "api-changed" miss) it appends that too. Each
+history is a json object per line, in `churn/` of the cache directory. A
+change records only the symbols added and removed, with a complete snapshot
+(a keyframe) at the start of the history and every KEYFRAME_INTERVAL changes
+thereafter, so that the history stays compact and any snapshot can be
+reconstructed from the nearest keyframe.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# Number of changes recorded as deltas between complete snapshots
+KEYFRAME_INTERVAL = 32
+
+
+def get_history_dir(options):
+  return os.path.join(linkcache.get_cachedir(options), "churn")
+
+
+def get_history_path(options, libpath):
+  """Return the path of the history of the shared object at `libpath`."""
+  digest = hashlib.sha1(libpath.encode("utf-8")).hexdigest()
+  return os.path.join(get_history_dir(options), digest + ".jsonl")
+
+
+class History(object):
+  """
+  The history of one shared object, locked (as a context manager) while it is
+  read and appended to.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+
+  def __enter__(self):
+    historydir = os.path.dirname(self.path)
+    if not os.path.isdir(historydir):
+      try:
+        os.makedirs(historydir)
+      except OSError as ex:
+        if ex.errno != errno.EEXIST:
+          raise
+    self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+    os.close(self.fd)
+    self.fd = None
+
+  def read(self):
+    return parse_entries(read_all(self.fd))
+
+  def append(self, entry):
+    content = json.dumps(entry, sort_keys=True) + "\n"
+    os.write(self.fd, content.encode("utf-8"))
+
+
+def read_all(fd):
+  chunks = []
+  offset = 0
+  while True:
+    chunk = os.pread(fd, 1 << 16, offset)
+    if not chunk:
+      return b"".join(chunks)
+    chunks.append(chunk)
+    offset += len(chunk)
+
+
+def parse_entries(content):
+  """
+  Return the entries of a history. A line which is truncated (e.g. the writer
+  was killed) is skipped.
+  """
+  out = []
+  for line in content.decode("utf-8", "replace").splitlines():
+    try:
+      out.append(json.loads(line))
+    except ValueError:
+      continue
+  return out
+
+
+def read_history(path):
+  try:
+    with io.open(path, "rb") as infile:
+      return parse_entries(infile.read())
+  except (IOError, OSError):
+    return []
+
+
+def replay(entries):
+  """
+  Yield a tuple of (entry, symbols) for each change in `entries`, where
+  `symbols` is the set of symbols exported after the change.
+  """
+  symbols = None
+  for entry in entries:
+    if entry.get("type") != "change":
+      continue
+    if "symbols" in entry:
+      symbols = set(entry["symbols"])
+    elif symbols is None:
+      # NOTE(josh): a delta without a preceding keyframe can't be applied
+      continue
+    else:
+      symbols = symbols.difference(entry["removed"]).union(entry["added"])
+    yield entry, symbols
+
+
+def record_change(options, libpath, apid, symbols):
+  """
+  Append a change in API of the shared object at `libpath` to it's history.
+  `symbols` is the collection of symbols it now exports.
+  """
+  symbols = set(symbols)
+  with History(get_history_path(options, libpath)) as history:
+    previous = None
+    since_keyframe = 0
+    for entry, state in replay(history.read()):
+      previous = (entry, state)
+      since_keyframe = 0 if "symbols" in entry else since_keyframe + 1
+
+    entry = {
+        "type": "change",
+        "time": time.time(),
+        "path": libpath,
+        "apid": apid,
+        "parent": None,
+    }
+    if previous is not None:
+      entry["parent"] = previous[0]["apid"]
+    if previous is None or since_keyframe + 1 >= KEYFRAME_INTERVAL:
+      entry["symbols"] = sorted(symbols)
+    else:
+      entry["added"] = sorted(symbols - previous[1])
+      entry["removed"] = sorted(previous[1] - symbols)
+    history.append(entry)
+
+
+def record_relink(options, libpath, apid, consumer):
+  """
+  Append to the history of the shared object at `libpath` that `consumer`
+  was relinked because it's API changed to `apid`.
+  """
+  with History(get_history_path(options, libpath)) as history:
+    history.append({
+        "type": "relink",
+        "time": time.time(),
+        "path": libpath,
+        "apid": apid,
+        "consumer": consumer,
+    })
+
+
+def iter_histories(options):
+  """Yield the entries of every history in the cache directory."""
+  historydir = get_history_dir(options)
+  try:
+    names = sorted(os.listdir(historydir))
+  except OSError:
+    return
+  for name in names:
+    if name.endswith(".jsonl"):
+      entries = read_history(os.path.join(historydir, name))
+      if entries:
+        yield entries
+
+
+def analyze(entries):
+  """
+  Return a tuple of (library, symbols) summarizing one history. `library` is
+  a dictionary of counts for the library as a whole, and `symbols` maps each
+  symbol which changed to it's counts. Each relink is attributed to the most
+  recent change to the API digest it was relinked against.
+  """
+  libpath = entries[0]["path"]
+  changes = []
+  latest_by_apid = {}
+  unattributed = 0
+  for entry in entries:
+    if entry.get("type") == "change":
+      entry["relinks"] = 0
+      latest_by_apid[entry["apid"]] = entry
+      changes.append(entry)
+    elif entry.get("type") == "relink":
+      change = latest_by_apid.get(entry["apid"])
+      if change is None:
+        unattributed += 1
+      else:
+        change["relinks"] += 1
+
+  symbols = {}
+  previous = None
+  for entry, state in replay(changes):
+    if previous is not None and entry["parent"] is not None:
+      for symbol in state.symmetric_difference(previous):
+        counts = symbols.setdefault(symbol, {"changes": 0, "relinks": 0})
+        counts["changes"] += 1
+        counts["relinks"] += entry["relinks"]
+    previous = state
+
+  library = {
+      "library": libpath,
+      "changes": sum(1 for entry in changes if entry["parent"] is not None),
+      "relinks": sum(entry["relinks"] for entry in changes) + unattributed,
+      "consumers": len(set(
+          entry["consumer"] for entry in entries
+          if entry.get("type") == "relink")),
+  }
+  return library, symbols
+
+
+def get_report(options, top):
+  libraries = []
+  symbols = []
+  for entries in iter_histories(options):
+    library, library_symbols = analyze(entries)
+    libraries.append(library)
+    for symbol, counts in library_symbols.items():
+      row = {"library": library["library"], "symbol": symbol}
+      row.update(counts)
+      symbols.append(row)
+
+  def rank(row):
+    return (-row["relinks"], -row["changes"], row["library"])
+
+  libraries.sort(key=rank)
+  symbols.sort(key=lambda row: rank(row) + (row["symbol"],))
+  return {"libraries": libraries[:top], "symbols": symbols[:top]}
+
+
+def format_rows(headers, rows, outfile):
+  widths = [
+      max([len(header)] + [len(row[idx]) for row in rows])
+      for idx, header in enumerate(headers)]
+  fmt = "  ".join("{:<%d}" % width for width in widths[:-1]) + "  {}"
+  outfile.write(fmt.format(*headers).rstrip() + "\n")
+  for row in rows:
+    outfile.write(fmt.format(*row).rstrip() + "\n")
+
+
+def find_history(options, library):
+  """
+  Return the entries of the history of `library`: the path of a shared
+  object, or a suffix of it (e.g. it's file name) if that is unambiguous.
+  """
+  realpath = os.path.realpath(library)
+  entries = read_history(get_history_path(options, realpath))
+  if entries:
+    return entries
+
+  matches = [
+      entries for entries in iter_histories(options)
+      if entries[0]["path"].endswith(os.sep + library.lstrip(os.sep))]
+  if len(matches) > 1:
+    raise ValueError("{} matches {} libraries: {}".format(
+        library, len(matches),
+        ", ".join(entries[0]["path"] for entries in matches)))
+  if not matches:
+    raise ValueError("No API history for {}".format(library))
+  return matches[0]
+
+
+def select_snapshot(snapshots, revision):
+  """
+  Return the (entry, symbols) of `snapshots` selected by `revision`: an index
+  (negative indices count from the latest) or a prefix of an API digest.
+  """
+  try:
+    return snapshots[int(revision)]
+  except ValueError:
+    pass
+  except IndexError:
+    raise ValueError("No revision {} among {} snapshots".format(
+        revision, len(snapshots)))
+  matches = [
+      snapshot for snapshot in snapshots
+      if snapshot[0]["apid"].startswith(revision)]
+  if not matches:
+    raise ValueError("No snapshot with API digest {}".format(revision))
+  return matches[-1]
+
+
+def format_snapshot(snapshot):
+  entry = snapshot[0]
+  return "{} ({})".format(
+      entry["apid"],
+      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])))
+
+
+def diff_main(args, options):
+  try:
+    snapshots = list(replay(find_history(options, args.library)))
+    old = select_snapshot(snapshots, args.old)
+    new = select_snapshot(snapshots, args.new)
+  except ValueError as ex:
+    logger.error("%s", ex)
+    return 1
+
+  sys.stdout.write("--- {}\n+++ {}\n".format(
+      format_snapshot(old), format_snapshot(new)))
+  for symbol in sorted(old[1] - new[1]):
+    sys.stdout.write("- {}\n".format(symbol))
+  for symbol in sorted(new[1] - old[1]):
+    sys.stdout.write("+ {}\n".format(symbol))
+  return 0
+
+
+def report_main(args, options):
+  report = get_report(options, args.top)
+  if args.json:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    return 0
+
+  format_rows(
+      ("RELINKS", "CHANGES", "CONSUMERS", "LIBRARY"),
+      [(str(row["relinks"]), str(row["changes"]), str(row["consumers"]),
+        row["library"]) for row in report["libraries"]], sys.stdout)
+  sys.stdout.write("\n")
+  format_rows(
+      ("RELINKS", "CHANGES", "SYMBOL", "LIBRARY"),
+      [(str(row["relinks"]), str(row["changes"]), row["symbol"],
+        os.path.basename(row["library"])) for row in report["symbols"]],
+      sys.stdout)
+  return 0
+
+
+def setup_argparser(argparser):
+  subparsers = argparser.add_subparsers(dest="command")
+  report = subparsers.add_parser(
+      "report", help="Rank libraries and symbols by the relinks they caused")
+  report.add_argument(
+      "--top", type=int, default=20,
+      help="Number of libraries and of symbols to report")
+  report.add_argument(
+      "--json", action="store_true",
+      help="Write a machine readable report instead of tables")
+
+  diff = subparsers.add_parser(
+      "diff", help="Show the symbols which differ between two snapshots of"
+                   " the API of a library")
+  diff.add_argument(
+      "library",
+      help="Path of the library, or a suffix of it (e.g. it's file name)")
+  diff.add_argument(
+      "old", nargs="?", default="-2",
+      help="Index (negative counts from the latest) or API digest prefix of"
+           " the older snapshot. Default: the one before the latest")
+  diff.add_argument(
+      "new", nargs="?", default="-1",
+      help="Index or API digest prefix of the newer snapshot. Default: the"
+           " latest")
+
+
+def main(argv, options=None):
+  argparser = argparse.ArgumentParser(
+      prog="linkcache churn", description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  setup_argparser(argparser)
+  # NOTE(josh): the report is the default command
+  if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+    argv = ["report"] + list(argv)
+  args = argparser.parse_args(argv)
+  if args.command == "diff":
+    return diff_main(args, options)
+  return report_main(args, options)
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,279 @@
+"""
+Compute the API digest of a shared object in-process, without executing
+linkhash. This implements versions 2 and 3 of the API model of linkhash (see
+linkhash.cc) and produces identical digests.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import io
+import mmap
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+ET_DYN = 3
+
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+SHT_GNU_VERDEF = 0x6ffffffd
+SHT_GNU_VERSYM = 0x6fffffff
+
+SHN_UNDEF = 0
+STV_INTERNAL = 1
+STV_HIDDEN = 2
+VER_FLG_BASE = 0x1
+VERSYM_HIDDEN = 0x8000
+
+BIND_NAMES = {
+    1: "GLOBAL",
+    2: "WEAK",
+    10: "UNIQUE",
+}
+
+TYPE_NAMES = {
+    0: "NOTYPE",
+    1: "OBJECT",
+    2: "FUNC",
+    5: "COMMON",
+    6: "TLS",
+    10: "IFUNC",
+}
+
+# Map st_info (binding and type) to the "BIND,TYPE," prefix of the record of
+# an exported symbol
+RECORD_PREFIXES = dict(
+    ((bind << 4) | symtype,
+     "{},{},".format(bindname, typename).encode("utf-8"))
+    for bind, bindname in BIND_NAMES.items()
+    for symtype, typename in TYPE_NAMES.items())
+
+# Symbol types for which the size is part of the API
+SIZED_TYPES = (1, 5, 6)
+
+# API model versions which can be computed in-process
+API_VERSIONS = (2, 3)
+
+NUM_LANES = 5
+LANE_MASK = (1 << 64) - 1
+PAD32 = b"\x00" * 4
+
+
+class ElfFormat(object):
+  """Struct formats of the headers of one ELF class and byte order."""
+
+  def __init__(self, is64, endian):
+    if is64:
+      self.ehdr = struct.Struct(endian + "16xHHIQQQIHHHHHH")
+      # name, type, flags, addr, offset, size, link, info, addralign, entsize
+      self.shdr = struct.Struct(endian + "IIQQQQIIQQ")
+      # name, info, other, shndx, value, size
+      self.sym = struct.Struct(endian + "IBBHQQ")
+    else:
+      self.ehdr = struct.Struct(endian + "16xHHIIIIIHHHHHH")
+      self.shdr = struct.Struct(endian + "IIIIIIIIII")
+      # name, value, size, info, other, shndx
+      self.sym = struct.Struct(endian + "IIIBBH")
+    self.is64 = is64
+    self.half = struct.Struct(endian + "H")
+    self.verdef = struct.Struct(endian + "HHHHIII")
+    self.verdaux = struct.Struct(endian + "II")
+
+
+class Section(object):
+  def __init__(self, fields):
+    (self.name, self.type, self.flags, self.addr, self.offset, self.size,
+     self.link, self.info, self.addralign, self.entsize) = fields
+
+
+def read_cstring(image, offset):
+  end = image.find(b"\x00", offset)
+  return image[offset:end]
+
+
+def get_version_names(image, fmt, verdef, strtab):
+  """
+  Return a map from version index to version name (bytes) for each version
+  defined in the SHT_GNU_verdef section `verdef`.
+  """
+  out = {}
+  offset = verdef.offset
+  end = verdef.offset + verdef.size
+  while offset < end:
+    (_, flags, ndx, cnt, _, aux, nextoff) = fmt.verdef.unpack_from(
+        image, offset)
+    if not flags & VER_FLG_BASE and cnt > 0:
+      vda_name, _ = fmt.verdaux.unpack_from(image, offset + aux)
+      out[ndx] = read_cstring(image, strtab.offset + vda_name)
+    if nextoff == 0:
+      break
+    offset += nextoff
+  return out
+
+
+def iter_exports(image):
+  """
+  Yield the canonical record (bytes) of each symbol exported by the shared
+  object mapped at `image`, in symbol table order. See linkhash.cc for the
+  definition of which symbols are exported and of the record format.
+  """
+  if image[:4] != ELF_MAGIC:
+    raise ValueError("File has wrong magic")
+  endian = "<" if image[5:6] == b"\x01" else ">"
+  fmt = ElfFormat(image[4:5] == b"\x02", endian)
+
+  ehdr = fmt.ehdr.unpack_from(image, 0)
+  e_type, e_shoff, e_shentsize, e_shnum = ehdr[0], ehdr[5], ehdr[10], ehdr[11]
+  if e_type != ET_DYN:
+    raise ValueError(
+        "Input file is not a shared object ({}), e_type={}".format(
+            ET_DYN, e_type))
+
+  sections = [
+      Section(fmt.shdr.unpack_from(image, e_shoff + idx * e_shentsize))
+      for idx in range(e_shnum)]
+  bytype = {}
+  for section in sections:
+    bytype.setdefault(section.type, section)
+
+  symtab = bytype.get(SHT_DYNSYM)
+  versym = bytype.get(SHT_GNU_VERSYM)
+  version_names = {}
+  if symtab is None:
+    # Unusual, but fall back to the full symbol table without versions
+    symtab = bytype.get(SHT_SYMTAB)
+    versym = None
+  elif SHT_GNU_VERDEF in bytype:
+    verdef = bytype[SHT_GNU_VERDEF]
+    version_names = get_version_names(
+        image, fmt, verdef, sections[verdef.link])
+  if symtab is None:
+    raise ValueError("Shared object contains no symbol table section")
+
+  strtab_offset = sections[symtab.link].offset
+  nsyms = symtab.size // symtab.entsize
+  symview = memoryview(image)[
+      symtab.offset:symtab.offset + nsyms * symtab.entsize]
+
+  try:
+    for idx, fields in enumerate(fmt.sym.iter_unpack(symview)):
+      if fmt.is64:
+        st_name, st_info, st_other, st_shndx, _, st_size = fields
+      else:
+        st_name, _, st_size, st_info, st_other, st_shndx = fields
+      if (st_shndx == SHN_UNDEF
+          or (st_other & 0x3) in (STV_INTERNAL, STV_HIDDEN)):
+        continue
+      prefix = RECORD_PREFIXES.get(st_info)
+      if prefix is None:
+        continue
+
+      namestart = strtab_offset + st_name
+      record = prefix + image[namestart:image.find(b"\x00", namestart)]
+      if versym is not None:
+        value, = fmt.half.unpack_from(image, versym.offset + 2 * idx)
+        version = version_names.get(value & ~VERSYM_HIDDEN)
+        if version is not None:
+          record += (b"@" if value & VERSYM_HIDDEN else b"@@") + version
+      if st_info & 0xf in SIZED_TYPES:
+        record += ",{}".format(st_size).encode("utf-8")
+      yield record
+  finally:
+    # NOTE(josh): the mapping can't be closed while a view of it exists
+    symview.release()
+
+
+class MultisetHash(object):
+  """
+  Order-independent accumulator of record digests, identical to the one in
+  linkhash.cc.
+  """
+
+  def __init__(self):
+    # NOTE(josh): the five 64-bit lanes are kept in a single integer, with
+    # each 32-bit word of a record digest widened to 64 bits so that the lanes
+    # are added with one integer addition. A lane can't carry into it's
+    # neighbor unless there are more than 2^32 records.
+    self.total = 0
+    self.count = 0
+
+  def add(self, record):
+    digest = hashlib.sha1(record).digest()
+    self.total += int.from_bytes(
+        digest[0:4] + PAD32 + digest[4:8] + PAD32 + digest[8:12] + PAD32
+        + digest[12:16] + PAD32 + digest[16:20], "little")
+    self.count += 1
+
+  def hexdigest(self):
+    lanes = [
+        (self.total >> (64 * lane)) & LANE_MASK for lane in range(NUM_LANES)]
+    return hashlib.sha1(
+        struct.pack("<6Q", *(lanes + [self.count]))).hexdigest()
+
+
+def open_image(sopath):
+  """Return a read-only memory map of the file at `sopath`."""
+  with io.open(sopath, "rb") as infile:
+    return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def get_api(sopath):
+  """Return the sorted list of records exported by the shared object."""
+  image = open_image(sopath)
+  try:
+    return sorted(iter_exports(image))
+  finally:
+    image.close()
+
+
+def get_apid(sopath, api_version=3):
+  """Return the API digest of the shared object at `sopath`."""
+  if api_version not in API_VERSIONS:
+    raise ValueError(
+        "API version {} can't be computed in-process".format(api_version))
+
+  if api_version == 2:
+    sha = hashlib.sha1()
+    for record in get_api(sopath):
+      sha.update(record + b"\n")
+    return "v2-" + sha.hexdigest()
+
+  image = open_image(sopath)
+  try:
+    accumulator = MultisetHash()
+    for record in iter_exports(image):
+      accumulator.add(record)
+  finally:
+    image.close()
+  return "v3-" + accumulator.hexdigest()
+
+
+class Digester(object):
+  """
+  In-process stand-in for `apidigest.LinkhashCoprocess`, used when linkhash
+  isn't installed.
+  """
+
+  def __init__(self, api_version):
+    self.api_version = api_version
+
+  def get_apid(self, sopath):
+    try:
+      return get_apid(sopath, self.api_version)
+    except (IOError, OSError, ValueError, struct.error):
+      return None
+
+  def dump_api(self, sopath):
+    try:
+      return b"".join(record + b"\n" for record in get_api(sopath))
+    except struct.error as ex:
+      raise ValueError(str(ex))
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
@@ -0,0 +1,179 @@
+"""
+Read and write the ELF notes of shared objects which linkcache relies on: the
+GNU build-id, by which API digests are memoized, and the API digest itself,
+which `--embed-apid` adds to a shared object (with objcopy) so that it
+survives being copied or installed without it's sidecar.
+
+NOTE(josh): this module may be imported by linkcache on a cache hit (when a
+shared object input has changed and has no sidecar) so, like linkcache, it
+doesn't import anything heavy.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+PT_NOTE = 4
+SHT_NOTE = 7
+NT_GNU_BUILD_ID = 3
+
+# Section and note in which the API digest is embedded into a shared object
+APID_NOTE_SECTION = b".note.linkhash.apid"
+APID_NOTE_NAME = b"linkhash\x00"
+NT_LINKHASH_APID = 1
+
+
+def read_build_id(path):
+  """
+  Return the GNU build-id (the NT_GNU_BUILD_ID note) of the ELF file at
+  `path` as a hex string, or None if it doesn't have one. Only the ELF
+  header, the program headers and the note segments are read.
+  """
+  import binascii
+
+  try:
+    with open(path, "rb") as infile:
+      ehdr = infile.read(64)
+      if ehdr[:4] != ELF_MAGIC or len(ehdr) < 52:
+        return None
+      endian = "<" if ehdr[5:6] == b"\x01" else ">"
+      # NOTE(josh): the formats below decode only (p_type, p_offset,
+      # p_filesz, p_align) from each program header
+      if ehdr[4:5] == b"\x02":
+        # ELFCLASS64
+        phoff, = struct.unpack_from(endian + "Q", ehdr, 32)
+        phentsize, phnum = struct.unpack_from(endian + "HH", ehdr, 54)
+        phdr_format = endian + "I4xQ16xQ8xQ"
+      else:
+        phoff, = struct.unpack_from(endian + "I", ehdr, 28)
+        phentsize, phnum = struct.unpack_from(endian + "HH", ehdr, 42)
+        phdr_format = endian + "II8xI8xI"
+      infile.seek(phoff)
+      phdrs = infile.read(phentsize * phnum)
+
+      for idx in range(phnum):
+        p_type, offset, filesz, align = struct.unpack_from(
+            phdr_format, phdrs, idx * phentsize)
+        if p_type != PT_NOTE:
+          continue
+        infile.seek(offset)
+        build_id = find_note(
+            infile.read(filesz), endian, 8 if align == 8 else 4,
+            b"GNU\x00", NT_GNU_BUILD_ID)
+        if build_id is not None:
+          return binascii.hexlify(build_id).decode("utf-8")
+  except (IOError, OSError, struct.error):
+    pass
+  return None
+
+
+def find_note(notes, endian, align, name, notetype):
+  """
+  Return the descriptor of the note with the given owner `name` (bytes,
+  including the null terminator) and type in the content of a note section or
+  segment, or None.
+  """
+
+  def pad(size):
+    return (size + align - 1) & ~(align - 1)
+
+  offset = 0
+  while offset + 12 <= len(notes):
+    namesz, descsz, thistype = struct.unpack_from(endian + "III", notes, offset)
+    nameoff = offset + 12
+    descoff = nameoff + pad(namesz)
+    if thistype == notetype and notes[nameoff:nameoff + namesz] == name:
+      return notes[descoff:descoff + descsz]
+    offset = descoff + pad(descsz)
+  return None
+
+
+def make_note(endian, name, notetype, desc):
+  """Return the content of a note section with a single note."""
+
+  def pad(content):
+    return content + b"\x00" * (-len(content) % 4)
+
+  return (struct.pack(endian + "III", len(name), len(desc), notetype)
+          + pad(name) + pad(desc))
+
+
+def read_embedded_apid(path):
+  """
+  Return the API digest embedded (by `embed_apid()`) in the shared object at
+  `path`, or None if there isn't one. Only the ELF header, section headers,
+  section name table and the note itself are read.
+  """
+  try:
+    with open(path, "rb") as infile:
+      ehdr = infile.read(64)
+      if ehdr[:4] != ELF_MAGIC or len(ehdr) < 52:
+        return None
+      endian = "<" if ehdr[5:6] == b"\x01" else ">"
+      # NOTE(josh): the formats below decode only (sh_name, sh_type,
+      # sh_offset, sh_size) from each section header
+      if ehdr[4:5] == b"\x02":
+        # ELFCLASS64
+        shoff, = struct.unpack_from(endian + "Q", ehdr, 40)
+        shentsize, shnum, shstrndx = struct.unpack_from(
+            endian + "HHH", ehdr, 58)
+        shdr_format = endian + "II16xQQ"
+      else:
+        shoff, = struct.unpack_from(endian + "I", ehdr, 32)
+        shentsize, shnum, shstrndx = struct.unpack_from(
+            endian + "HHH", ehdr, 46)
+        shdr_format = endian + "II8xII"
+      if not shoff or shstrndx >= shnum:
+        return None
+      infile.seek(shoff)
+      content = infile.read(shentsize * shnum)
+      shdrs = [
+          struct.unpack_from(shdr_format, content, idx * shentsize)
+          for idx in range(shnum)]
+
+      _, _, strtab_offset, strtab_size = shdrs[shstrndx]
+      infile.seek(strtab_offset)
+      strtab = infile.read(strtab_size)
+
+      for sh_name, sh_type, offset, size in shdrs:
+        if sh_type != SHT_NOTE:
+          continue
+        if strtab[sh_name:strtab.find(b"\x00", sh_name)] != APID_NOTE_SECTION:
+          continue
+        infile.seek(offset)
+        desc = find_note(
+            infile.read(size), endian, 4, APID_NOTE_NAME, NT_LINKHASH_APID)
+        if desc is not None:
+          return desc.decode("utf-8")
+  except (IOError, OSError, struct.error, UnicodeDecodeError):
+    pass
+  return None
+
+
+def embed_apid(objcopy, outpath, apid):
+  """
+  Add (or replace) a note section containing the API digest `apid` in the
+  shared object at `outpath`, using `objcopy`. Return true on success.
+  """
+  import subprocess
+
+  notepath = "{}.{}.apidnote".format(outpath, os.getpid())
+  section = APID_NOTE_SECTION.decode("utf-8")
+  try:
+    with open(outpath, "rb") as infile:
+      ident = infile.read(16)
+    endian = "<" if ident[5:6] == b"\x01" else ">"
+    with open(notepath, "wb") as outfile:
+      outfile.write(make_note(
+          endian, APID_NOTE_NAME, NT_LINKHASH_APID, apid.encode("utf-8")))
+    subprocess.check_call([
+        objcopy, "--remove-section", section, "--add-section",
+        "{}={}".format(section, notepath), outpath])
+    return True
+  except (subprocess.CalledProcessError, IOError, OSError):
+    return False
+  finally:
+    if os.path.exists(notepath):
+      os.unlink(notepath)
@@ -0,0 +1,296 @@
+"""
+Predict, without running anything, the decision that linkcache would make for
+every output in a build tree and explain each miss. The prediction is made
+against the current environment, so run this from the same environment as the
+build.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+from concurrent import futures
+
+from linkhash import action
+from linkhash import apidigest
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+
+def find_cacheinfos(builddir):
+  """Return the path of every cacheinfo sidecar under `builddir`."""
+  out = []
+  stack = [builddir]
+  while stack:
+    dirpath = stack.pop()
+    try:
+      entries = list(os.scandir(dirpath))
+    except OSError:
+      continue
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False):
+        stack.append(entry.path)
+      elif entry.name.endswith(".cacheinfo"):
+        out.append(entry.path)
+  return out
+
+
+def get_link_cwd(cacheinfopath, outfile, recorded_cwd):
+  """
+  Return the working directory of the link which produced `cacheinfopath`.
+  If the output was specified relative to the working directory then we can
+  infer the working directory from where the sidecar is, which is correct even
+  if the build tree has been moved since the link was executed.
+  """
+  suffix = os.sep + os.path.normpath(outfile) + ".cacheinfo"
+  if not os.path.isabs(outfile) and cacheinfopath.endswith(suffix):
+    return cacheinfopath[:-len(suffix)]
+  return recorded_cwd
+
+
+class ExplainContext(linkcache.Context):
+  """
+  A `linkcache.Context` which shares the memo of `linkcache.get_execspec()`
+  with the contexts of every other output of the tree.
+  """
+
+  def __init__(self, subcommand, options, cwd, statcache, memo):
+    super(ExplainContext, self).__init__(subcommand, options, cwd, statcache)
+    self.memo = memo
+
+  def compute_execspec(self):
+    return linkcache.get_execspec(
+        self.subcommand, self.options, self.cwd, memo=self.memo)
+
+
+def diff_execspec(recorded, current):
+  """
+  Return a list of human readable strings describing how the `current`
+  execspec differs from the `recorded` one.
+  """
+  out = []
+  if recorded.get("version") != current.get("version"):
+    out.append("execspec version {} -> {}".format(
+        recorded.get("version"), current.get("version")))
+
+  if recorded.get("cwd") != current.get("cwd"):
+    out.append("cwd {} -> {}".format(recorded.get("cwd"), current.get("cwd")))
+
+  old_argv = recorded.get("argv", [])
+  new_argv = current.get("argv", [])
+  if old_argv != new_argv:
+    removed = [arg for arg in old_argv if arg not in new_argv]
+    added = [arg for arg in new_argv if arg not in old_argv]
+    if not (removed or added):
+      out.append("argv reordered")
+    out.extend("argv - {}".format(arg) for arg in removed)
+    out.extend("argv + {}".format(arg) for arg in added)
+
+  old_env = recorded.get("env", {})
+  new_env = current.get("env", {})
+  for key in sorted(set(old_env).union(new_env)):
+    if old_env.get(key) != new_env.get(key):
+      out.append("env {}: {!r} -> {!r}".format(
+          key, old_env.get(key), new_env.get(key)))
+
+  old_toolchain = recorded.get("toolchain", {})
+  new_toolchain = current.get("toolchain", {})
+  for role in sorted(set(old_toolchain).union(new_toolchain)):
+    if old_toolchain.get(role) != new_toolchain.get(role):
+      out.append("toolchain {}: {} -> {}".format(
+          role, old_toolchain.get(role), new_toolchain.get(role)))
+  return out
+
+
+def diff_api(ctx, options):
+  """
+  For an "api-changed" miss, return a list of human readable strings
+  describing the change in symbols of the blocking input.
+  """
+  old_apid = ctx.cacheinfo.get("input_apids", {}).get(ctx.blocker)
+  new_apid = ctx.get_input_apid(ctx.blocker)
+  if old_apid is None or new_apid is None:
+    return ["API digest at time of link was not recorded"]
+
+  old_api = apidigest.read_api_snapshot(options, old_apid)
+  new_api = apidigest.read_api_snapshot(options, new_apid)
+  if old_api is None or new_api is None:
+    return ["API digest {} -> {}, no snapshot available".format(
+        old_apid, new_apid)]
+
+  out = []
+  out.extend("- " + symbol for symbol in sorted(old_api - new_api))
+  out.extend("+ " + symbol for symbol in sorted(new_api - old_api))
+  if not out:
+    out.append("API digest {} -> {}, symbols unchanged".format(
+        old_apid, new_apid))
+  return out
+
+
+def get_action_context(args, cwd, statcache):
+  """
+  Return the `action.ActionContext` of the `linkcache exec` invocation
+  `args`, which wrote an `<output>.<name>.cacheinfo`, or None if it isn't
+  one.
+  """
+  if args.subcommand[0] != "exec":
+    return None
+  try:
+    exec_args = action.get_argparser().parse_args(args.subcommand[1:])
+    command, inputs, outputs = action.get_declaration(exec_args, cwd)
+  except (IOError, OSError, ValueError):
+    return None
+  if not command or not outputs:
+    return None
+  return action.ActionContext(
+      command, inputs, outputs, args, cwd, statcache, name=exec_args.name)
+
+
+def evaluate(builddir, cacheinfopath, statcache, options, memo=None):
+  """
+  Evaluate the cache decision for the output of one cacheinfo sidecar and
+  return a dictionary describing the result. `statcache` and `memo` may be
+  shared by the evaluation of every output.
+  """
+  outpath = os.path.relpath(cacheinfopath[:-len(".cacheinfo")], builddir)
+  result = {
+      "output": outpath,
+      "decision": "unknown",
+      "reason": None,
+      "blocker": None,
+      "details": [],
+  }
+
+  try:
+    with io.open(cacheinfopath, "r", encoding="utf-8") as infile:
+      cacheinfo = json.load(infile)
+    invocation = cacheinfo["invocation"]
+  except (IOError, OSError, ValueError, KeyError, TypeError):
+    result["reason"] = "no-invocation"
+    result["details"].append(
+        "cacheinfo does not record the link command, it was written by an"
+        " older version of linkcache")
+    return result
+
+  args = linkcache.fast_parse_args(invocation["argv"])
+  if args is None:
+    result["reason"] = "bad-invocation"
+    return result
+  # NOTE(josh): a bypass isn't a decision about the output, the question is
+  # whether the cache would have been hit.
+  args.no_bypass = True
+
+  if args.subcommand[0] in linkcache.TOOLS:
+    ctx = get_action_context(args, invocation["cwd"], statcache)
+    if ctx is None:
+      result["reason"] = "bad-invocation"
+      return result
+    result["output"] = os.path.relpath(
+        os.path.join(ctx.cwd, ctx.get_output()), builddir)
+    result["action"] = ctx.name
+  else:
+    outfile = linkcache.Context(args.subcommand).get_output()
+    cwd = get_link_cwd(cacheinfopath, outfile or "", invocation["cwd"])
+    ctx = ExplainContext(args.subcommand, args, cwd, statcache, memo)
+  if ctx.cache_hit():
+    result["decision"] = "hit"
+    return result
+
+  result["decision"] = "miss"
+  result["reason"] = ctx.miss_reason
+  result["blocker"] = ctx.blocker
+  if ctx.miss_reason == "command-changed":
+    result["details"] = diff_execspec(ctx.cacheinfo, ctx.execspec)
+  elif ctx.miss_reason == "api-changed":
+    result["details"] = diff_api(ctx, options)
+  return result
+
+
+def format_table(results, max_details, outfile):
+  headers = ("DECISION", "REASON", "OUTPUT", "BLOCKING INPUT")
+  rows = [
+      (result["decision"], result["reason"] or "", result["output"],
+       result["blocker"] or "") for result in results]
+  widths = [
+      max([len(header)] + [len(row[idx]) for row in rows])
+      for idx, header in enumerate(headers)]
+  fmt = "  ".join("{:<%d}" % width for width in widths[:-1]) + "  {}"
+
+  outfile.write(fmt.format(*headers).rstrip() + "\n")
+  for result, row in zip(results, rows):
+    outfile.write(fmt.format(*row).rstrip() + "\n")
+    details = result["details"]
+    for line in details[:max_details]:
+      outfile.write("    " + line + "\n")
+    if len(details) > max_details:
+      outfile.write("    ... and {} more\n".format(len(details) - max_details))
+
+
+def get_summary(results):
+  summary = {"outputs": len(results)}
+  for result in results:
+    summary[result["decision"]] = summary.get(result["decision"], 0) + 1
+  return summary
+
+
+def setup_argparser(argparser):
+  argparser.add_argument(
+      "builddir", help="Root of the build tree to inspect")
+  argparser.add_argument(
+      "--json", action="store_true",
+      help="Write a machine readable report instead of a table")
+  argparser.add_argument(
+      "-j", "--jobs", type=int, default=32,
+      help="Number of outputs to evaluate concurrently")
+  argparser.add_argument(
+      "--all", action="store_true",
+      help="Include hits in the table, not just misses")
+  argparser.add_argument(
+      "--max-details", type=int, default=20,
+      help="Maximum number of detail lines to print for each miss")
+
+
+def main(argv, options=None):
+  argparser = argparse.ArgumentParser(
+      prog="linkcache explain", description=__doc__)
+  setup_argparser(argparser)
+  args = argparser.parse_args(argv)
+
+  builddir = os.path.abspath(args.builddir)
+  cacheinfos = find_cacheinfos(builddir)
+  statcache = linkcache.StatCache()
+  memo = {}
+
+  with futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+    results = list(pool.map(
+        lambda cacheinfopath: evaluate(
+            builddir, cacheinfopath, statcache, options, memo),
+        cacheinfos))
+
+  results.sort(key=lambda result: (result["decision"], result["output"]))
+  summary = get_summary(results)
+
+  if args.json:
+    json.dump(
+        {"summary": summary, "outputs": results}, sys.stdout, indent=2,
+        sort_keys=True)
+    sys.stdout.write("\n")
+    return 0
+
+  if not args.all:
+    results = [result for result in results if result["decision"] != "hit"]
+  format_table(results, args.max_details, sys.stdout)
+  sys.stdout.write("\n{} outputs: {} hit, {} miss, {} unknown\n".format(
+      summary["outputs"], summary.get("hit", 0), summary.get("miss", 0),
+      summary.get("unknown", 0)))
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+"""
+Read the inputs named by a GNU ld script. A library given to the linker may be
+a linker script rather than an archive or shared object (e.g. glibc's
+libc.so), in which case the files it names are the real inputs of the link,
+and linkcache checks them in it's place.
+
+NOTE(josh): this module is imported by linkcache on a cache hit whose inputs
+include a linker script, so it only imports what the interpreter has already
+loaded, just like linkcache.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+
+
+def tokenize(content):
+  """Split the content of a linker script into words and parentheses."""
+  while "/*" in content:
+    head, _, tail = content.partition("/*")
+    content = head + " " + tail.partition("*/")[2]
+  for char in "(),":
+    content = content.replace(char, " {} ".format(char))
+  return [token for token in content.split() if token != ","]
+
+
+def parse(content):
+  """
+  Return the list of files named by the INPUT, GROUP and AS_NEEDED commands
+  of a GNU ld script. `-lfoo` entries are returned as is.
+  """
+  out = []
+  tokens = tokenize(content)
+  depth = 0
+  collect_depth = None
+  for idx, token in enumerate(tokens):
+    if token == "(":
+      depth += 1
+      continue
+    if token == ")":
+      depth -= 1
+      if collect_depth is not None and depth < collect_depth:
+        collect_depth = None
+      continue
+    next_token = tokens[idx + 1] if idx + 1 < len(tokens) else None
+    if next_token == "(":
+      if token in ("INPUT", "GROUP", "AS_NEEDED"):
+        if collect_depth is None:
+          collect_depth = depth + 1
+      continue
+    if collect_depth is not None:
+      out.append(token)
+  return out
+
+
+def resolve_input(scriptpath, name):
+  """
+  Return the path of the file named `name` in the linker script at
+  `scriptpath`, or None if it can't be found. Relative names and `-l`
+  references are searched for in the directory containing the script.
+  """
+  scriptdir = os.path.dirname(scriptpath)
+  if name.startswith("-l"):
+    for candidate in ("lib{}.so".format(name[2:]), "lib{}.a".format(name[2:])):
+      candidate = os.path.join(scriptdir, candidate)
+      if os.path.exists(candidate):
+        return candidate
+    return None
+
+  if name.startswith("="):
+    # Relative to the sysroot
+    name = name[1:]
+  if os.path.isabs(name):
+    return name
+  candidate = os.path.join(scriptdir, name)
+  if os.path.exists(candidate):
+    return candidate
+  return name
+
+
+def read_inputs(path):
+  """
+  Return a list of `(name, resolved)` for each input named by the linker
+  script at `path`, where `resolved` is it's path, or None if it can't be
+  found (see `resolve_input()`).
+  """
+  try:
+    with io.open(path, "r", encoding="utf-8", errors="replace") as infile:
+      names = parse(infile.read())
+  except (IOError, OSError):
+    names = []
+  return [(name, resolve_input(path, name)) for name in names]
@@ -8,165 +8,1002 @@ skipped and the output is touched instead.
 
 from __future__ import print_function, unicode_literals
 
-import argparse
-import collections
-import hashlib
 import io
-import json
-import logging
 import os
-import pathlib
-import subprocess
 import sys
 
-logger = logging.getLogger(__name__)
+# NOTE(josh): linkcache is executed for every link step in the build, and on
+# a no-op build nearly every execution is a cache hit. Python startup is a
+# significant fraction of the cost of a hit so module-level imports are
+# restricted to what is already loaded by the interpreter at startup.
+# Everything else (argparse, logging, subprocess, ...) is imported within the
+# functions that need them, which generally means only on a miss, or when
+# debug logging is enabled.
 
+# Version of the execspec layout. It is included in the hash so that a change
+# to the way the spec is computed never compares equal to an old cacheinfo.
+EXECSPEC_VERSION = 4
+
+# Environment variables which are included in the execspec, unless they are
+# denied. Entries may be glob patterns.
 # See: http://man7.org/linux/man-pages/man1/ld.1.html#ENVIRONMENT
 KEEPENV = [
     "COLLECT_NO_DEMANGLE",
     "GNUTARGET",
     "LDEMULATION",
+    "LD_*",
+]
+
+# Environment variables which are excluded from the execspec by default. These
+# tend to differ between machines and checkouts but rarely affect the result of
+# the link. Use `--env-allow` to include them anyway.
+DENYENV = [
+    "LD_LIBRARY_PATH",
     "PATH",
 ]
 
+# Prefixes of the arguments which may be matched by a built-in argument rule
+# (see `linkhash.argrules`). A command with none of them is canonical already,
+# so a hit doesn't need to load the rules. test_argrules verifies that every
+# pattern of an enabled rule begins with one of these.
+ARG_RULE_PREFIXES = (
+    "-W", "-X", "-fPIC", "-fansi-", "-fcolor-", "-fdiagnostics-",
+    "-fmessage-length=", "-fno-", "-ftime-", "-p", "-rdynamic", "-t", "-v",
+    "-w", "--color-", "--error-limit=", "--no-color-", "--print-memory-usage",
+    "--stats", "--time-trace", "--trace", "--verbose",
+)
 
-def get_execspec(subcommand):
-  env = dict(os.environ)
+LOG_LEVELS = {
+    "debug": 10,
+    "info": 20,
+    "warning": 30,
+    "error": 40,
+}
 
-  # Remove environment variables that we know don't affect the link process
-  env = collections.OrderedDict()
-  for key, value in dict(os.environ).items():
-    if key.startswith("LD_"):
-      env[key] = value
-      continue
 
-    if key in KEEPENV:
-      env[key] = value
+class LazyLogger(object):
+  """
+  Stand-in for a `logging.Logger` which doesn't import or configure the
+  logging module until a message is emitted at or above the configured level.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.level = LOG_LEVELS["warning"]
+    self._logger = None
+
+  def set_level(self, level):
+    self.level = LOG_LEVELS.get(level, level)
+    if self._logger is not None:
+      self._logger.root.setLevel(self.level)
+
+  def get_logger(self):
+    if self._logger is None:
+      import logging
+      logging.basicConfig()
+      logging.getLogger().setLevel(self.level)
+      self._logger = logging.getLogger(self.name)
+    return self._logger
+
+  def log(self, level, msg, *args, **kwargs):
+    if level >= self.level:
+      self.get_logger().log(level, msg, *args, **kwargs)
+
+  def debug(self, msg, *args, **kwargs):
+    self.log(LOG_LEVELS["debug"], msg, *args, **kwargs)
+
+  def info(self, msg, *args, **kwargs):
+    self.log(LOG_LEVELS["info"], msg, *args, **kwargs)
+
+  def warning(self, msg, *args, **kwargs):
+    self.log(LOG_LEVELS["warning"], msg, *args, **kwargs)
+
+  def error(self, msg, *args, **kwargs):
+    self.log(LOG_LEVELS["error"], msg, *args, **kwargs)
+
+
+logger = LazyLogger(__name__)
+
+
+def get_path_prefixes(options, cwd=None):
+  """
+  Return a list of `(prefix, placeholder)` pairs for the directories which
+  are rewritten into placeholders before the execspec is hashed. Longer
+  prefixes come first so that a build root nested within the source root is
+  matched as the build root.
+  """
+  prefixes = []
+  if options is None:
+    return prefixes
+
+  if options.build_root:
+    prefixes.append((options.build_root, "${BUILD_ROOT}"))
+  if options.source_root:
+    prefixes.append((options.source_root, "${SOURCE_ROOT}"))
+  for spec in options.path_prefix:
+    name, _, prefix = spec.partition("=")
+    if not (name and prefix):
+      logger.warning("Ignoring malformed --path-prefix %s", spec)
       continue
+    prefixes.append((prefix, "${" + name + "}"))
+
+  out = []
+  for prefix, placeholder in prefixes:
+    if cwd is not None:
+      prefix = os.path.join(cwd, prefix)
+    prefix = os.path.normpath(os.path.abspath(prefix))
+    if prefix != "/":
+      out.append((prefix, placeholder))
+  out.sort(key=lambda pair: len(pair[0]), reverse=True)
+  return out
+
+
+def get_path_normalizer(prefixes):
+  """
+  Return a function which rewrites any occurrence of one of the `prefixes`
+  (e.g. `-L/home/user/build/lib` or `-Wl,-rpath,/home/user/build/lib`) into
+  it's placeholder. A prefix only matches where a path may start: at the
+  start of the string, after a single letter flag (`-L`, `-I`, ...), or
+  after a list separator or `=`. It must be followed by a path separator, a
+  list separator, or the end of the string.
+  """
+  if not prefixes:
+    return lambda text: text
 
-  spec = collections.OrderedDict()
-  spec["argv"] = subcommand
-  spec["cwd"] = os.getcwd()
-  spec["env"] = env
+  import re
+  placeholders = dict(prefixes)
+  # NOTE(josh): without the lookbehind, `/x/a/build/z.o` would be rewritten
+  # as `/x${BUILD_ROOT}/z.o` for the build root `/a/build`
+  pattern = re.compile(
+      r"(?:^|(?<=[\s=,:;])|(?<=^-[A-Za-z]))"
+      + "(" + "|".join(re.escape(prefix) for prefix, _ in prefixes) + ")"
+      + "(?=[/:,;=]|$)")
+  return lambda text: pattern.sub(
+      lambda match: placeholders[match.group(1)], text)
+
+
+def get_env_filter(options, memo=None):
+  """
+  Return a function which returns true if the given environment variable name
+  should be included in the execspec. If `memo` is a dictionary (see
+  `get_execspec()`) the patterns are compiled into a single regex, which is
+  memoized in it.
+  """
+  allow = list(KEEPENV)
+  deny = list(DENYENV)
+  if options is not None:
+    allow += options.env_allow
+    deny = [pattern for pattern in deny if pattern not in options.env_allow]
+    deny += options.env_deny
+
+  if memo is None:
+    from fnmatch import fnmatchcase
+
+    def keep(key):
+      if any(fnmatchcase(key, pattern) for pattern in deny):
+        return False
+      return any(fnmatchcase(key, pattern) for pattern in allow)
+
+    return keep
+
+  # NOTE(josh): a single link filters the environment once, so compiling the
+  # patterns only pays off for `linkcache explain`, which filters it for every
+  # output in the tree.
+  key = ("env_filter", tuple(allow), tuple(deny))
+  if key in memo:
+    return memo[key]
+
+  import re
+  from fnmatch import translate
+
+  def compile_patterns(patterns):
+    if not patterns:
+      return lambda key: None
+    return re.compile(
+        "|".join("(?:{})".format(translate(pattern))
+                 for pattern in patterns)).match
+
+  is_denied = compile_patterns(deny)
+  is_allowed = compile_patterns(allow)
+
+  def keep_compiled(key):
+    if is_denied(key):
+      return False
+    return bool(is_allowed(key))
+
+  memo[key] = keep_compiled
+  return keep_compiled
+
+
+def get_spechash(spec):
+  """
+  Return the digest of an execspec, computed over a canonical (sorted keys,
+  no whitespace) serialization.
+  """
+  import hashlib
+  import json
+
+  specstr = json.dumps(
+      spec, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+  return hashlib.sha1(specstr.encode("utf-8")).hexdigest()
+
+
+def may_canonicalize(args, options):
+  """
+  Return true if the argument rules (see `linkhash.argrules`) may change any
+  of `args`. Rules from --arg-rules may match anything, otherwise only
+  arguments which begin with one of `ARG_RULE_PREFIXES` are candidates.
+  """
+  if options is not None and options.arg_rules:
+    return True
+  return any(arg.startswith(ARG_RULE_PREFIXES) for arg in args)
 
-  hashstr = hashlib.sha1(json.dumps(spec, indent=2).encode("utf-8")).hexdigest()
-  spec["hash"] = hashstr
+
+def get_execspec(subcommand, options=None, cwd=None, canonicalize=True,
+                 memo=None, toolchain=None, toolchain_ids=None):
+  """
+  Return the execspec of `subcommand`: it's arguments, working directory and
+  environment, normalized, and their hash. The arguments of a link command
+  are canonicalized (see `linkhash.argrules`) unless `canonicalize` is false.
+
+  The toolchain fingerprint is `toolchain` if it is given (e.g. recorded in
+  the cacheinfo, see `Context.get_recorded_toolchain()`), otherwise it is
+  computed, and the identity of the binaries it was computed from is added to
+  `toolchain_ids` if it is a dictionary.
+
+  If `memo` is a dictionary, the filtered environment and the toolchain
+  fingerprint, which are the same for many links, are memoized in it. It may
+  be shared by any number of calls (e.g. for every output of a build tree,
+  by `linkcache explain`) so long as the environment doesn't change.
+  """
+  prefixes = get_path_prefixes(options, cwd)
+  normalize = get_path_normalizer(prefixes)
+
+  envkey = ("env", tuple(prefixes))
+  if options is not None:
+    envkey += (tuple(options.env_allow), tuple(options.env_deny))
+  env = None if memo is None else memo.get(envkey)
+  if env is None:
+    # Remove environment variables that we know don't affect the link process
+    keep = get_env_filter(options, memo)
+    env = {}
+    for key, value in os.environ.items():
+      if keep(key):
+        env[key] = normalize(value)
+    if memo is not None:
+      memo[envkey] = env
+
+  spec = {}
+  spec["version"] = EXECSPEC_VERSION
+  # NOTE(josh): the program itself is never subject to the argument rules
+  argv = [normalize(arg) for arg in subcommand]
+  if canonicalize and may_canonicalize(argv[1:], options):
+    try:
+      argrules = import_linkhash_module("argrules")
+    except ImportError:
+      # NOTE(josh): linkcache may be installed on it's own, without the
+      # package, in which case the arguments are hashed verbatim.
+      logger.debug("linkhash.argrules isn't installed, not canonicalizing")
+    else:
+      argv = argv[:1] + argrules.get_normalizer(options)(argv[1:])
+  spec["argv"] = argv
+  spec["cwd"] = normalize(os.path.abspath(cwd) if cwd else os.getcwd())
+  spec["env"] = dict(env)
+  if options is None or not options.no_toolchain_fingerprint:
+    if toolchain is None:
+      toolchain = get_toolchain_fingerprint(
+          subcommand, options, cwd, memo, toolchain_ids)
+    spec["toolchain"] = dict(toolchain)
+  spec["hash"] = get_spechash(spec)
 
   return spec
 
 
+def get_toolchain_fingerprint(subcommand, options, cwd=None, memo=None,
+                              ids=None):
+  """
+  Return the fingerprints of the binaries which execute `subcommand` (see
+  `linkhash.toolchain`), memoized in `toolchain/fingerprints.json` of the
+  cache directory, and in `memo` if it is a dictionary (see `get_execspec()`).
+  If `ids` is a dictionary, the identity of each binary is added to it, by
+  it's real path.
+  """
+  try:
+    toolchain = import_linkhash_module("toolchain")
+  except ImportError:
+    # NOTE(josh): linkcache may be installed on it's own, without the
+    # package, in which case the toolchain isn't part of the cache key.
+    logger.debug("linkhash.toolchain isn't installed, not fingerprinting")
+    return {}
+  if memo is not None:
+    key = ("toolchain", toolchain.get_fingerprint_key(subcommand, cwd))
+    if key not in memo:
+      memo_ids = {}
+      memo[key] = (get_toolchain_fingerprint(
+          subcommand, options, cwd, ids=memo_ids), memo_ids)
+    fingerprint, memo_ids = memo[key]
+    if ids is not None:
+      ids.update(memo_ids)
+    return dict(fingerprint)
+
+  tablepath = os.path.join(
+      get_cachedir(options), "toolchain", "fingerprints.json")
+  table = toolchain.FingerprintTable(tablepath)
+  fingerprint = toolchain.get_fingerprint(subcommand, table, cwd)
+  if ids is not None:
+    ids.update(table.ids)
+  for path in table.hashed:
+    logger.debug("Fingerprinted toolchain binary %s", path)
+  if table.changed:
+    try:
+      if not os.path.isdir(os.path.dirname(tablepath)):
+        os.makedirs(os.path.dirname(tablepath))
+      write_atomic(tablepath, table.serialize() + b"\n")
+    except OSError:
+      logger.warning("failed to memoize toolchain fingerprints in %s",
+                     tablepath)
+  return fingerprint
+
+
+_LINKHASH_PATH = []
+
+
 def find_linkhash():
-  for prefix in os.environ.get("PATH", "").split(":"):
-    fullpath = os.path.join(prefix, "linkhash")
+  """
+  Return the path to the `linkhash` program, or None if it can't be found.
+  The result is memoized, and this is only called on a cache miss, so the
+  `$PATH` scan is not paid for by cache hits.
+  """
+  if _LINKHASH_PATH:
+    return _LINKHASH_PATH[0]
+
+  candidates = [
+      os.path.join(prefix, "linkhash")
+      for prefix in os.environ.get("PATH", "").split(":")]
+  candidates.append(
+      os.path.join(os.path.dirname(os.path.realpath(__file__)), "linkhash"))
+
+  found = None
+  for fullpath in candidates:
     if os.path.isfile(fullpath) and os.access(fullpath, os.X_OK):
-      return fullpath
+      found = fullpath
+      break
+
+  _LINKHASH_PATH.append(found)
+  return found
+
 
-  prefix = os.path.dirname(os.path.realpath(__file__))
-  fullpath = os.path.join(prefix, "linkhash")
-  if os.path.isfile(fullpath) and os.access(fullpath, os.X_OK):
-    return fullpath
+def get_file_id(statbuf):
+  """
+  Return a value which changes whenever the file is replaced or modified.
+  """
+  return (statbuf.st_ino, statbuf.st_mtime_ns)
 
-  return None
+
+# Linker scripts are only recognized among inputs smaller than this. Real
+# shared objects and archives are larger, and so are never read on a hit.
+MAX_LDSCRIPT_SIZE = 4096
+
+ELF_MAGIC = b"\x7fELF"
+AR_MAGIC = b"!<arch>\n"
+ET_DYN = 3
+
+# Memoized results of `get_input_kind()` and `get_ldscript_inputs()`, keyed
+# by path and stat fingerprint so that a modified file is re-examined.
+_INPUT_KINDS = {}
+_LDSCRIPT_INPUTS = {}
+
+
+def get_stat_key(path, statbuf):
+  return (path, statbuf.st_ino, statbuf.st_size, statbuf.st_mtime_ns)
+
+
+def is_library_name(path):
+  """
+  Return true if the basename of `path` looks like a library, including
+  versioned shared objects (e.g. libfoo.so.1.2.3).
+  """
+  basename = os.path.basename(path)
+  return (basename.endswith((".so", ".a")) or ".so." in basename)
+
+
+def get_input_kind(path, statbuf):
+  """
+  Return the kind of the link input at `path` based on it's content:
+
+    * "shared": an ELF shared object (e_type == ET_DYN)
+    * "elf": any other ELF file (e.g. an object file)
+    * "archive": a static library
+    * "ldscript": a GNU ld script (e.g. glibc's libc.so)
+    * "other": anything else
+  """
+  key = get_stat_key(path, statbuf)
+  try:
+    return _INPUT_KINDS[key]
+  except KeyError:
+    pass
+
+  try:
+    with open(path, "rb") as infile:
+      header = infile.read(18)
+  except (IOError, OSError):
+    header = b""
+
+  if header[:4] == ELF_MAGIC and len(header) == 18:
+    byteorder = "little" if header[5:6] == b"\x01" else "big"
+    e_type = int.from_bytes(header[16:18], byteorder)
+    kind = "shared" if e_type == ET_DYN else "elf"
+  elif header[:8] == AR_MAGIC:
+    kind = "archive"
+  elif statbuf.st_size < MAX_LDSCRIPT_SIZE and is_library_name(path):
+    kind = "ldscript"
+  else:
+    kind = "other"
+  _INPUT_KINDS[key] = kind
+  return kind
+
+
+def get_ldscript_inputs(path, statbuf):
+  """
+  Return the paths of the inputs named by the linker script at `path`. See
+  `linkhash.ldscript`.
+  """
+  key = get_stat_key(path, statbuf)
+  try:
+    return _LDSCRIPT_INPUTS[key]
+  except KeyError:
+    pass
+
+  ldscript = import_linkhash_module("ldscript")
+  out = []
+  for name, resolved in ldscript.read_inputs(path):
+    if resolved is None:
+      logger.debug("Can't resolve %s referenced by %s", name, path)
+      continue
+    out.append(resolved)
+  _LDSCRIPT_INPUTS[key] = out
+  return out
+
+
+# Filesystem types (as listed in /proc/mounts) for which each stat is a round
+# trip to a server, and for which inputs are therefore probed concurrently.
+NETWORK_FSTYPES = [
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "fuse.ceph",
+    "fuse.glusterfs",
+    "fuse.sshfs",
+    "glusterfs",
+    "gpfs",
+    "lustre",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+]
+
+# Number of threads used to probe inputs on a network filesystem
+DEFAULT_PROBE_THREADS = 16
+
+# Links with fewer inputs than this are always probed sequentially, since
+# starting the pool would cost more than it saves.
+MIN_PARALLEL_PROBES = 8
+
+
+def get_fstype(path):
+  """
+  Return the type of the filesystem containing `path` according to
+  /proc/mounts, or None if it can't be determined.
+  """
+  path = os.path.realpath(path)
+  best = ("", None)
+  try:
+    with io.open("/proc/mounts", "r", encoding="utf-8") as infile:
+      for line in infile:
+        parts = line.split()
+        if len(parts) < 3:
+          continue
+        # NOTE(josh): whitespace in mount points is octal-escaped
+        mountpoint = parts[1].replace("\\040", " ").replace("\\011", "\t")
+        if mountpoint != "/" and not (
+            path == mountpoint or path.startswith(mountpoint + "/")):
+          continue
+        if len(mountpoint) >= len(best[0]):
+          best = (mountpoint, parts[2])
+  except (IOError, OSError):
+    return None
+  return best[1]
+
+
+# Maximum nesting of linker scripts which name other linker scripts
+MAX_LDSCRIPT_DEPTH = 4
+
+# Number of inputs for which the miss history of an output is retained
+MAX_HISTORY = 32
+
+# The costs of linking and of checking an output are re-measured in one out of
+# this many invocations, even while the cache is bypassed: once an output has
+# been bypassed this many times less one, the next invocation checks it. See
+# `Context.should_bypass()`.
+BYPASS_RESAMPLE = 16
+
+# A hit re-measures the cost of checking an output once it's cacheinfo hasn't
+# been written for this many seconds. Hits aren't counted, since that would
+# mean writing the cacheinfo on every hit.
+COST_RESAMPLE_AGE = 3600
+
+# Weight of a new measurement in the moving average of a cost
+COST_SMOOTHING = 0.3
+
+# Files which are modified whenever a package is installed, upgraded or removed
+# by the system package manager.
+PACKAGE_DB_PATHS = [
+    "/var/lib/dpkg/status",
+    "/var/lib/rpm/rpmdb.sqlite",
+    "/var/lib/rpm/Packages",
+    "/var/lib/pacman/local",
+    "/lib/apk/db/installed",
+]
+
+_IMMUTABLE_FINGERPRINTS = {}
+
+
+def get_immutable_fingerprint(prefixes):
+  """
+  Return a string which changes whenever the system package database or the
+  listing of one of the immutable `prefixes` changes. Inputs under those
+  prefixes are only skipped if this matches the value recorded when the
+  output was linked. The result is memoized for the life of the process.
+  """
+  try:
+    return _IMMUTABLE_FINGERPRINTS[prefixes]
+  except KeyError:
+    pass
+
+  parts = []
+  for path in PACKAGE_DB_PATHS + list(prefixes):
+    result = stat_or_none(path)
+    if result is not None:
+      parts.append("{}:{}:{}".format(path, result.st_mtime_ns, result.st_size))
+  _IMMUTABLE_FINGERPRINTS[prefixes] = fingerprint = ";".join(parts)
+  return fingerprint
+
+
+def stat_or_none(path):
+  try:
+    return os.stat(path)
+  except OSError:
+    return None
+
+
+class StatCache(object):
+  """
+  Memoizing wrapper around `os.stat()`. An instance may be shared by many
+  `Context` objects (and threads) when evaluating many links in one process,
+  in which case each input is only stat-ed once.
+
+  If `nthreads` is greater than one then `prefetch()` issues stats
+  concurrently from a pool of that many threads. If it is None, then a pool
+  is used only if the working directory is on a network filesystem.
+  """
+
+  def __init__(self, nthreads=0):
+    self.cache = {}
+    self.nthreads = nthreads
+
+  def stat(self, path):
+    """Return the stat result for `path`, or None if it does not exist."""
+    try:
+      return self.cache[path]
+    except KeyError:
+      pass
+
+    result = stat_or_none(path)
+    self.cache[path] = result
+    return result
+
+  def get_nthreads(self):
+    if self.nthreads is None:
+      fstype = get_fstype(os.getcwd())
+      if fstype in NETWORK_FSTYPES:
+        logger.debug("Probing concurrently on %s filesystem", fstype)
+        self.nthreads = DEFAULT_PROBE_THREADS
+      else:
+        self.nthreads = 0
+    return self.nthreads
+
+  def prefetch(self, paths, is_miss=None):
+    """
+    Stat all of `paths` concurrently and store the results. Duplicate and
+    already-cached paths are skipped. If `is_miss(path, result)` returns true
+    for any result, then outstanding stats are abandoned and this returns
+    immediately, since the caller has no use for them. Does nothing if this
+    cache is not configured for concurrency.
+    """
+    todo = []
+    seen = set()
+    for path in paths:
+      if path in seen or path in self.cache:
+        continue
+      seen.add(path)
+      todo.append(path)
+
+    if len(todo) < MIN_PARALLEL_PROBES:
+      return
+    nthreads = self.get_nthreads()
+    if nthreads < 2:
+      return
+
+    from concurrent import futures
+    pool = futures.ThreadPoolExecutor(max_workers=min(nthreads, len(todo)))
+    pending = {}
+    try:
+      for path in todo:
+        pending[pool.submit(stat_or_none, path)] = path
+      for future in futures.as_completed(pending):
+        path = pending[future]
+        self.cache[path] = result = future.result()
+        if is_miss is not None and is_miss(path, result):
+          logger.debug("Probe found a miss, abandoning remaining probes")
+          break
+    finally:
+      # NOTE(josh): `shutdown(cancel_futures=True)` requires python 3.9, so
+      # the stats which haven't started are cancelled one at a time.
+      for future in pending:
+        future.cancel()
+      pool.shutdown(wait=False)
+
+  def forget(self, match):
+    """Drop the cached result of every path for which `match(path)` is true."""
+    for path in [path for path in self.cache if match(path)]:
+      del self.cache[path]
+
+  def clear(self):
+    self.cache.clear()
 
 
 class Context(object):
-  def __init__(self, subcommand):
+  def __init__(self, subcommand, options=None, cwd=None, statcache=None):
     self.subcommand = subcommand
-    self.execspec = get_execspec(subcommand)
+    self.options = options
+    # Working directory of the link command. If None, the link command is
+    # executed in the current working directory of this process.
+    self.cwd = cwd
+    if statcache is None:
+      statcache = StatCache(
+          None if options is None else options.probe_threads)
+    self.statcache = statcache
+    self.immutable_prefixes = tuple(
+        os.path.join(os.path.normpath(prefix), "")
+        for prefix in (options.immutable_prefix if options else []))
     self.outfile = None
+    self.cacheinfo = None
+    self.cacheinfo_id = None
+    # If `cache_hit()` returns false, a short string identifying the reason,
+    # and the input (if any) which was responsible.
+    self.miss_reason = None
+    self.blocker = None
+    # Peak resident memory of the linker, if it was executed
+    self.peak_rss = None
+    # CPU seconds spent linking, and checking every input, by this invocation
+    self.link_time = None
+    self.check_time = None
+    # Wall-clock seconds spent linking, if the linker was executed
+    self.link_wall_time = None
+    # With --watch, the reply of the watcher to our synchronization request
+    # (empty if there is no watcher) and the number of bytes of journal read
+    # to check this output, or None if the journal couldn't be used.
+    self.watch = None
+    self.journal_tail = None
+    # Identity of the binaries of the toolchain fingerprint of the execspec,
+    # by real path, and whether the fingerprint recorded in the cacheinfo may
+    # be reused.
+    self.toolchain_ids = None
+    self.reuse_toolchain = True
+    self._execspec = None
+    self._accel = None
+    self._accel_evaluated = False
+
+  @property
+  def execspec(self):
+    # NOTE(josh): computing the execspec is deferred until it is needed so
+    # that commands which are trivially a miss (e.g. the output doesn't yet
+    # exist) don't pay for it twice.
+    if self._execspec is None:
+      self._execspec = self.compute_execspec()
+    return self._execspec
+
+  def compute_execspec(self):
+    toolchain = self.get_recorded_toolchain()
+    return get_execspec(
+        self.subcommand, self.options, self.cwd, toolchain=toolchain,
+        toolchain_ids=self.toolchain_ids)
+
+  def get_recorded_toolchain(self):
+    """
+    Return the toolchain fingerprint recorded in the cacheinfo if `$PATH` and
+    every binary it was computed from are unchanged, so that a hit doesn't
+    pay for fingerprinting the toolchain. Otherwise return None, and reset
+    `toolchain_ids` to collect the identities of the binaries when the
+    fingerprint is computed.
+    """
+    self.toolchain_ids = {}
+    if not self.reuse_toolchain or self.cacheinfo is None:
+      return None
+    recorded = self.cacheinfo.get("toolchain_ids")
+    toolchain = self.cacheinfo.get("toolchain")
+    if (not isinstance(recorded, dict) or not isinstance(toolchain, dict)
+        or recorded.get("path") != os.environ.get("PATH", "")):
+      return None
+    binaries = recorded.get("binaries")
+    if not isinstance(binaries, dict) or not binaries:
+      return None
+    for path, binary_id in binaries.items():
+      # NOTE(josh): the identity is that of `toolchain.get_binary_id()`,
+      # which isn't imported here so that a hit doesn't pay for it.
+      statbuf = self.statcache.stat(path)
+      if statbuf is None or binary_id != [
+          statbuf.st_ino, statbuf.st_size, statbuf.st_mtime_ns]:
+        logger.debug("Toolchain binary has changed %s", path)
+        return None
+    self.toolchain_ids = dict(binaries)
+    return toolchain
+
+  def recompute_execspec(self):
+    """
+    Compute the execspec again, with a fresh toolchain fingerprint. Called on
+    a miss before the link starts, so that the cacheinfo records the
+    toolchain as it was when the link started.
+    """
+    self.reuse_toolchain = False
+    self._execspec = self.compute_execspec()
 
   def get_cacheinfopath(self):
     return self.outfile + ".cacheinfo"
 
   def get_apidpath(self):
-    return self.outfile + ".apid"
+    return os.path.realpath(self.resolve(self.outfile)) + ".apid"
 
-  def cache_hit(self):
-    subcommand = self.subcommand
+  def resolve(self, path):
+    """Return `path` such that it is relative to our working directory."""
+    if self.cwd is None:
+      return path
+    return os.path.join(self.cwd, path)
 
+  def cacheinfo_changed(self):
+    """
+    Return true if the cacheinfo sidecar has been replaced or removed since it
+    was read by `cache_hit()`.
+    """
     try:
-      dasho_idx = subcommand.index("-o")
-      self.outfile = outfile = subcommand[dasho_idx + 1]
+      current_id = get_file_id(os.stat(self.resolve(self.get_cacheinfopath())))
+    except OSError:
+      current_id = None
+    return current_id != self.cacheinfo_id
+
+  def get_output(self):
+    """Return the output file of the link command, or None."""
+    try:
+      return self.subcommand[self.subcommand.index("-o") + 1]
     except (IndexError, ValueError):
+      return None
+
+  def get_outputs(self):
+    """Return every output file of the command, which must all exist."""
+    return [self.outfile]
+
+  def get_input_args(self):
+    """Return the arguments of the command which may be input files."""
+    # NOTE(josh): skip the argument that we identified as the output file.
+    # Flags are not input files, and we skip them rather than letting a stat
+    # fail since that is a round trip on a network filesystem.
+    return [
+        arg for arg in self.subcommand
+        if arg is not self.outfile and not arg.startswith("-")]
+
+  def get_probe_args(self):
+    """
+    Return the arguments of the link command which `cache_hit()` needs to
+    check, in the order it should check them. Inputs which caused previous
+    misses of this output (according to the cacheinfo history) come first,
+    most frequent first, since they are the most likely to cause the next
+    one. Inputs under an immutable prefix are omitted unless the system has
+    changed since the last link.
+    """
+    skip_immutable = self.immutable_prefixes and (
+        self.cacheinfo.get("immutable_fingerprint")
+        == get_immutable_fingerprint(self.immutable_prefixes))
+
+    is_unchanged = self.get_journal_filter()
+
+    out = []
+    nunchanged = 0
+    for arg in self.get_input_args():
+      if skip_immutable and arg.startswith(self.immutable_prefixes):
+        continue
+      # NOTE(josh): libraries are always checked, since they may be linker
+      # scripts naming inputs which aren't watched
+      if is_unchanged is not None and not is_library_name(arg) and (
+          is_unchanged(os.path.abspath(self.resolve(arg)))):
+        nunchanged += 1
+        continue
+      out.append(arg)
+    if nunchanged:
+      logger.debug("Skipping %d inputs unchanged according to the journal",
+                   nunchanged)
+
+    blockers = self.cacheinfo.get("history", {}).get("blockers", {})
+    if blockers:
+      out.sort(key=lambda arg: -blockers.get(arg, 0))
+    return out
+
+  def sync_watcher(self):
+    """
+    With --watch, synchronize with the watcher (once) and remember it's
+    position in the journal. This must happen before the inputs are checked
+    or linked, so that any change to them is journaled after the position.
+    """
+    if self.watch is None and self.options is not None and self.options.watch:
+      watchclient = import_linkhash_module("watchclient")
+      self.watch = watchclient.sync_watcher(get_cachedir(self.options)) or {}
+      if not self.watch:
+        logger.debug("No watcher is running, checking every input")
+
+  def get_journal_filter(self):
+    """
+    Return a function which returns true for the absolute path of an input
+    which the journal shows hasn't changed since this output was last
+    checked, or None if the journal can't vouch for any input.
+    """
+    self.journal_tail = None
+    if not self.watch:
+      return None
+    position = self.cacheinfo.get("watch")
+    if not position or position.get("session") != self.watch["session"]:
+      logger.debug("Journal session has changed, checking every input")
+      return None
+    watchclient = import_linkhash_module("watchclient")
+    changed = watchclient.read_journal(
+        os.path.join(get_cachedir(self.options), "watch", "journal"),
+        self.watch["session"], position["offset"], self.watch["offset"])
+    if changed is None:
+      logger.debug("Journal is unreadable, checking every input")
+      return None
+    self.journal_tail = self.watch["offset"] - position["offset"]
+    return watchclient.get_journal_filter(self.watch, changed)
+
+  def get_watch_position(self):
+    """Return the position in the journal to record in the cacheinfo."""
+    if not self.watch:
+      return None
+    return {"session": self.watch["session"], "offset": self.watch["offset"]}
+
+  def get_probe_paths(self, probe_args):
+    """
+    Return the paths which `cache_hit()` may need to stat when checking
+    `probe_args`, in the order it will need them.
+    """
+    out = []
+    for arg in probe_args:
+      out.append(self.resolve(arg))
+      if is_library_name(arg):
+        # NOTE(josh): `check_input()` reads the sidecar of the real file, so
+        # that is the one to prefetch, not one next to a symlink.
+        out.append(self.get_input_apidpath(arg))
+    return out
+
+  def record_miss(self, reason, blocker=None):
+    self.miss_reason = reason
+    self.blocker = blocker
+    return False
+
+  def should_bypass(self, cacheinfo):
+    """
+    Return true if linking this output is expected to take less time than
+    checking whether it needs to be linked. Python startup is paid either way,
+    so the comparison is between the recorded costs of a link and of a full
+    check, assuming (in favor of the cache) that every check is a hit. Costs
+    are CPU time, so that the decision isn't swayed by the load on the host
+    at the time they were measured.
+    """
+    if self.options is None or self.options.no_bypass:
+      return False
+    costs = cacheinfo.get("costs")
+    if not costs or "link" not in costs or "check" not in costs:
+      return False
+    if cacheinfo.get("bypasses", 0) + 1 >= BYPASS_RESAMPLE:
+      # Check (and if necessary link) as usual, so that the costs are
+      # re-measured and the decision can change. The link writes a new
+      # cacheinfo, which restarts the count.
+      return False
+    return costs["link"] < costs["check"]
+
+  def cache_hit(self):
+    import time
+    tstart = time.process_time()
+    subcommand = self.subcommand
+    stat = self.statcache.stat
+    resolve = self.resolve
+    self.cacheinfo = None
+    self.cacheinfo_id = None
+    self.miss_reason = None
+    self.blocker = None
+
+    self.outfile = outfile = self.get_output()
+    if outfile is None:
       # The command doesn't have a "-o" in it anywhere
       logger.debug("Command doesn't have a recognizable output")
-      return False
+      return self.record_miss("no-output-arg")
 
-    try:
-      outfile_mtime = os.path.getmtime(outfile)
-    except OSError:
-      # The output of the command doesn't exist, so we can't reuse it
-      logger.debug("Output of command does not yet exist")
-      return False
+    self.sync_watcher()
+    outfile_mtime = None
+    for output in self.get_outputs():
+      outfile_stat = stat(resolve(output))
+      if outfile_stat is None:
+        # The output of the command doesn't exist, so we can't reuse it
+        logger.debug("Output of command does not yet exist")
+        return self.record_miss("no-output", output)
+      if outfile_mtime is None or outfile_stat.st_mtime < outfile_mtime:
+        outfile_mtime = outfile_stat.st_mtime
 
-    execspec = self.execspec
     cacheinfopath = self.get_cacheinfopath()
 
-    if not os.path.exists(cacheinfopath):
+    # NOTE(josh): the sidecar is opened without first checking that it exists
+    # since it may be removed concurrently by another invocation.
+    try:
+      with io.open(resolve(cacheinfopath), "r", encoding="utf-8") as infile:
+        self.cacheinfo_id = get_file_id(os.fstat(infile.fileno()))
+        content = infile.read()
+    except (IOError, OSError):
       # There is no sidecar metdata written by this script for the given
       # output file, so we can't validate the existing output and we must
       # re-execute the command
       logger.debug("Command output does not have a cacheinfo sidecar")
-      return False
+      return self.record_miss("no-cacheinfo", cacheinfopath)
 
+    import json
     try:
-      with io.open(cacheinfopath, "r", encoding="utf-8") as infile:
-        cacheinfo = json.load(infile)
-    except (OSError, ValueError):
+      self.cacheinfo = cacheinfo = json.loads(content)
+    except ValueError:
       # The sidecare metadata is malformed (possibly a user tried to edit it by
       # hand)
       logger.debug("Command output has malformed cacheinfo sidecar")
-      return False
+      return self.record_miss("malformed-cacheinfo", cacheinfopath)
 
+    if self.should_bypass(cacheinfo):
+      logger.debug("Linking is cheaper than checking, bypassing the cache")
+      return self.record_miss("bypass")
+
+    execspec = self.execspec
     if cacheinfo.get("hash", None) != execspec["hash"]:
       # The command used to create the file has changed, so we can't use the
       # cached output.
       logger.debug("Cacheinfo has changed")
-      return False
+      return self.record_miss("command-changed")
 
-    for arg in subcommand[:]:
-      if arg is self.outfile:
-        # Skip the argument that we identified as the output file
-        continue
+    if self.accel_changed(cacheinfo):
+      logger.debug("Linker acceleration policy has changed")
+      return self.record_miss("accel-changed")
 
-      if not os.path.exists(arg):
-        # If the argument is not a path to a file, then it doesn't contribute
-        # to the evaluation
-        continue
+    def is_miss(path, result):
+      return (result is not None and result.st_mtime >= outfile_mtime
+              and not (path.endswith(".apid") or is_library_name(path)))
 
-      if os.path.getmtime(arg) < outfile_mtime:
-        # The input file is older than the output, it has not been modified
-        # since this command was last executed, so move one
-        continue
+    probe_args = self.get_probe_args()
+    self.statcache.prefetch(self.get_probe_paths(probe_args), is_miss)
 
-      if not arg.endswith(".so"):
-        # The input file is not a shared object. It is either a pure object or
-        # an archive (static library), and it has changed. We can't reuse the
-        # cache because the meat of the output is possibly changed.
-        logger.debug("Input file has changed %s", arg)
+    for arg in probe_args:
+      if not self.check_input(arg, outfile_mtime):
         return False
+    self.check_time = time.process_time() - tstart
 
-      sidecarpath = arg + ".apid"
-      if not os.path.exists(sidecarpath):
-        # The input file is newer than the output, and it is a shared object,
-        # but we do not have an API digest sidecar file (written by this script)
-        # so we must assume it's API has changed and we cannot reuse the cache.
-        logger.debug(
-            "Shared object has changed and there is no API digest: %s", arg)
-        return False
-
-      if os.path.getmtime(sidecarpath) < outfile_mtime:
-        # The input file is newer than the output, but it is a shared object and
-        # it's API has not changed since the last time we linked this output.
-        # Therefore this output does not itself invalidate the cache.
-        logger.debug("Input object is cache OK: %s", arg)
-        continue
-
-      # The input file is newer than the output, it is a shared object, and it's
-      # API has changed since the last time we linked this output. Therefore we
-      # cannot reuse the cache.
-      logger.debug("Shared object API has changed: %s", arg)
-      return False
+    if cacheinfo.get("bypassed"):
+      # The output was last linked by executing the linker directly, which may
+      # not have completed, so it can't be trusted.
+      logger.debug("Output was last linked bypassing the cache")
+      return self.record_miss("bypassed")
 
     # All input files are either:
     #   a) older than the existing output file
@@ -175,80 +1012,1089 @@ class Context(object):
     logger.debug("Using link-cache of %s", outfile)
     return True
 
+  def check_input(self, arg, outfile_mtime, depth=0):
+    """
+    Return true if the input `arg` does not invalidate the output. The
+    inputs named by a linker script are checked recursively.
+    """
+    path = self.resolve(arg)
+    arg_stat = self.statcache.stat(path)
+    if arg_stat is None:
+      # If the argument is not a path to a file, then it doesn't contribute
+      # to the evaluation
+      return True
+
+    if arg_stat.st_size < MAX_LDSCRIPT_SIZE and is_library_name(arg):
+      if get_input_kind(path, arg_stat) == "ldscript":
+        return self.check_ldscript(arg, path, arg_stat, outfile_mtime, depth)
+
+    if arg_stat.st_mtime < outfile_mtime:
+      # The input file is older than the output, it has not been modified
+      # since this command was last executed, so move one
+      return True
+
+    if get_input_kind(path, arg_stat) != "shared":
+      # The input file is not a shared object. It is either a pure object or
+      # an archive (static library), and it has changed. We can't reuse the
+      # cache because the meat of the output is possibly changed.
+      logger.debug("Input file has changed %s", arg)
+      return self.record_miss("input-changed", arg)
+
+    # NOTE(josh): the API digest is kept next to the real file, so that
+    # `libfoo.so -> libfoo.so.1 -> libfoo.so.1.2.3` share a single sidecar.
+    sidecarpath = self.get_input_apidpath(arg)
+    sidecar_stat = self.statcache.stat(sidecarpath)
+    if sidecar_stat is None:
+      # There is no sidecar (e.g. the shared object was copied or installed
+      # without it) but the API digest may be embedded in the shared object
+      # itself, in which case we can compare it to the digest it had when
+      # this output was linked.
+      elfnote = import_linkhash_module("elfnote")
+      embedded_apid = elfnote.read_embedded_apid(path)
+      recorded_apid = self.cacheinfo.get("input_apids", {}).get(arg)
+      if embedded_apid is not None and embedded_apid == recorded_apid:
+        logger.debug("Input object embedded API is cache OK: %s", arg)
+        return True
+      if embedded_apid is not None and recorded_apid is not None:
+        logger.debug("Shared object API has changed: %s", arg)
+        return self.record_miss("api-changed", arg)
+
+      # The input file is newer than the output, and it is a shared object,
+      # but we do not have an API digest sidecar file (written by this script)
+      # so we must assume it's API has changed and we cannot reuse the cache.
+      logger.debug(
+          "Shared object has changed and there is no API digest: %s", arg)
+      return self.record_miss("no-apid", arg)
+
+    if sidecar_stat.st_mtime < outfile_mtime:
+      # The input file is newer than the output, but it is a shared object and
+      # it's API has not changed since the last time we linked this output.
+      # Therefore this output does not itself invalidate the cache.
+      logger.debug("Input object is cache OK: %s", arg)
+      return True
+
+    # The input file is newer than the output, it is a shared object, and it's
+    # API has changed since the last time we linked this output. Therefore we
+    # cannot reuse the cache.
+    logger.debug("Shared object API has changed: %s", arg)
+    return self.record_miss("api-changed", arg)
+
+  def check_ldscript(self, arg, path, arg_stat, outfile_mtime, depth):
+    if arg_stat.st_mtime >= outfile_mtime:
+      # The script itself has changed, so the set of inputs may have changed.
+      logger.debug("Linker script has changed %s", arg)
+      return self.record_miss("input-changed", arg)
+
+    if depth >= MAX_LDSCRIPT_DEPTH:
+      logger.debug("Linker scripts nested too deeply at %s", arg)
+      return self.record_miss("input-changed", arg)
+
+    for member in get_ldscript_inputs(path, arg_stat):
+      if not self.check_input(member, outfile_mtime, depth + 1):
+        return False
+    return True
+
+  def get_input_apidpath(self, arg):
+    """Return the path of the API digest sidecar for input `arg`."""
+    return os.path.realpath(self.resolve(arg)) + ".apid"
+
+  def iter_shared_inputs(self):
+    """
+    Yield each input of the link command which is a shared object, including
+    those named by linker scripts.
+    """
+    queue = self.get_input_args()
+    depth = 0
+    while queue and depth <= MAX_LDSCRIPT_DEPTH:
+      nextqueue = []
+      for arg in queue:
+        path = self.resolve(arg)
+        arg_stat = self.statcache.stat(path)
+        if arg_stat is None:
+          continue
+        kind = get_input_kind(path, arg_stat)
+        if kind == "shared":
+          yield arg
+        elif kind == "ldscript":
+          nextqueue.extend(get_ldscript_inputs(path, arg_stat))
+      queue = nextqueue
+      depth += 1
+
+  def is_shared_output(self):
+    """Return true if the output of the link command is a shared object."""
+    if "-shared" in self.subcommand or self.outfile.endswith(".so"):
+      return True
+    path = self.resolve(self.outfile)
+    outfile_stat = stat_or_none(path)
+    return (outfile_stat is not None
+            and is_library_name(self.outfile)
+            and get_input_kind(path, outfile_stat) == "shared")
+
+  def get_input_apid(self, arg):
+    """
+    Return the current API digest of the shared object input `arg`, from it's
+    sidecar if there is one, otherwise from the digest embedded in it.
+    """
+    apid = read_apid(self.get_input_apidpath(arg))
+    if apid is None:
+      elfnote = import_linkhash_module("elfnote")
+      apid = elfnote.read_embedded_apid(self.resolve(arg))
+    return apid
+
+  def get_input_apids(self):
+    """
+    Return a dictionary mapping each shared object input to the API digest
+    it had at the time of this link.
+    """
+    out = {}
+    for arg in self.iter_shared_inputs():
+      apid = self.get_input_apid(arg)
+      if apid is not None:
+        out[arg] = apid
+    return out
+
+  def get_extra_cacheinfo(self):
+    """Return additional entries to record in the cacheinfo."""
+    return {}
+
+  def get_history(self):
+    """
+    Return the miss history to record in the cacheinfo, updated with the
+    reason for the current miss.
+    """
+    history = {}
+    if self.cacheinfo is not None:
+      history = self.cacheinfo.get("history", {})
+    blockers = dict(history.get("blockers", {}))
+    if self.blocker is not None and self.miss_reason in (
+        "input-changed", "no-apid", "api-changed"):
+      blockers[self.blocker] = blockers.get(self.blocker, 0) + 1
+    if len(blockers) > MAX_HISTORY:
+      keep = sorted(blockers, key=lambda arg: -blockers[arg])[:MAX_HISTORY]
+      blockers = {arg: blockers[arg] for arg in keep}
+    return {
+        "blockers": blockers,
+        "misses": history.get("misses", 0) + 1,
+    }
+
+  def get_costs(self):
+    """
+    Return the costs to record in the cacheinfo: moving averages of the CPU
+    seconds spent linking and checking this output, updated with the
+    measurements of this invocation.
+    """
+    costs = {}
+    if self.cacheinfo is not None:
+      costs = dict(self.cacheinfo.get("costs", {}))
+    for key, sample in (("link", self.link_time), ("check", self.check_time)):
+      if sample is None:
+        continue
+      average = costs.get(key)
+      if average is None:
+        costs[key] = sample
+      else:
+        costs[key] = average + COST_SMOOTHING * (sample - average)
+    return costs
+
+  def needs_cost_sample(self):
+    """
+    Return true if a hit should record the cost of the check it just made,
+    which it does the first time and then once the cacheinfo is
+    `COST_RESAMPLE_AGE` old.
+    """
+    if self.check_time is None or self.cacheinfo is None:
+      return False
+    if "check" not in self.cacheinfo.get("costs", {}):
+      return True
+    if self.cacheinfo_id is None:
+      return False
+    import time
+    age = time.time() - self.cacheinfo_id[1] * 1e-9
+    return age > COST_RESAMPLE_AGE
+
+  def refresh_cacheinfo(self):
+    """
+    Update an existing cacheinfo after a hit: record the immutable fingerprint
+    once the immutable inputs have been verified by a full check, so that
+    subsequent checks may skip them again, and sample the cost of the check.
+    """
+    if self.cacheinfo is None:
+      return
+    cacheinfo = dict(self.cacheinfo)
+    changed = False
+    if self.immutable_prefixes:
+      fingerprint = get_immutable_fingerprint(self.immutable_prefixes)
+      if cacheinfo.get("immutable_fingerprint") != fingerprint:
+        cacheinfo["immutable_fingerprint"] = fingerprint
+        changed = True
+    if "costs" in cacheinfo and self.needs_cost_sample():
+      cacheinfo["costs"] = self.get_costs()
+      changed = True
+    # NOTE(josh): every input was verified against the position we took, so
+    # it may be recorded if the journal couldn't be used, or if a long tail
+    # of it had to be read.
+    position = self.get_watch_position()
+    if position is not None:
+      watchclient = import_linkhash_module("watchclient")
+      if (self.journal_tail is None
+          or self.journal_tail > watchclient.MAX_JOURNAL_TAIL):
+        cacheinfo["watch"] = position
+        changed = True
+    if not changed:
+      return
+    self.replace_cacheinfo(cacheinfo)
+
+  def replace_cacheinfo(self, cacheinfo):
+    """Atomically replace the cacheinfo of the output with `cacheinfo`."""
+    import json
+    specstr = json.dumps(cacheinfo, indent=2, sort_keys=True).encode("utf-8")
+    write_atomic(self.resolve(self.get_cacheinfopath()), specstr + b"\n")
+
   def write_cacheinfo(self):
-    specstr = json.dumps(self.execspec, indent=2).encode("utf-8")
-    with open(self.get_cacheinfopath(), "wb") as outfile:
-      outfile.write(specstr)
-      outfile.write(b"\n")
+    cacheinfo = dict(self.execspec)
+    # NOTE(josh): the following are not part of the hash, they are recorded so
+    # that the link decision can be re-evaluated and explained offline. See
+    # `linkhash.explain`.
+    cacheinfo["invocation"] = {
+        "argv": self.options.argv if self.options else self.subcommand,
+        "cwd": os.path.abspath(self.cwd) if self.cwd else os.getcwd(),
+    }
+    cacheinfo["input_apids"] = self.get_input_apids()
+    cacheinfo["history"] = self.get_history()
+    if self.immutable_prefixes:
+      cacheinfo["immutable_fingerprint"] = get_immutable_fingerprint(
+          self.immutable_prefixes)
+    peak_rss = self.peak_rss
+    if peak_rss is None and self.cacheinfo is not None:
+      peak_rss = self.cacheinfo.get("peak_rss")
+    if peak_rss is not None:
+      cacheinfo["peak_rss"] = peak_rss
+    position = self.get_watch_position()
+    if position is not None:
+      cacheinfo["watch"] = position
+    accel = self.get_accel()
+    if accel is not None:
+      cacheinfo["accel"] = accel
+    if "toolchain" in cacheinfo and self.toolchain_ids:
+      cacheinfo["toolchain_ids"] = {
+          "path": os.environ.get("PATH", ""),
+          "binaries": self.toolchain_ids,
+      }
+    cacheinfo.update(self.get_extra_cacheinfo())
+    # NOTE(josh): the cache of a shared object is never bypassed since the
+    # API digest sidecar, on which the cache of it's dependants rely, can't be
+    # maintained without running after the link.
+    if not self.is_shared_output():
+      cacheinfo["costs"] = self.get_costs()
+    self.replace_cacheinfo(cacheinfo)
+
+  def write_apid(self, linkhash):
+    """
+    Digest the output with `linkhash` (see `linkhash.apidigest`) and update
+    the apid sidecar if the API has changed.
+    """
+    # NOTE(josh): configure logging now so that messages of the apidigest
+    # module honor --log-level
+    logger.get_logger()
+    apidigest = import_linkhash_module("apidigest")
+    apidigest.write_apid(self, linkhash)
 
-  def write_apid(self, linkhash_path):
+  def record_relink(self):
+    """
+    If this link was a miss because the API of an input changed, record the
+    relink in the history of that input. See `linkhash.churn`.
+    """
+    if self.miss_reason != "api-changed":
+      return
+    apid = self.get_input_apid(self.blocker)
+    if apid is None:
+      return
     try:
-      new_apid = subprocess.check_output(
-          ["linkhash", self.outfile],
-          executable=linkhash_path).decode("utf-8").strip()
-    except subprocess.CalledProcessError:
-      logger.warning("failed to linkhash")
+      churn = import_linkhash_module("churn")
+      churn.record_relink(
+          self.options, os.path.realpath(self.resolve(self.blocker)), apid,
+          os.path.realpath(self.resolve(self.outfile)))
+    except (IOError, OSError):
+      logger.warning("failed to record relink caused by %s", self.blocker)
+
+  def record_decision(self, decision):
+    """
+    Append a record of the decision of this invocation ("hit", "miss" or
+    "bypass") to --decision-log, if it is configured. See `linkhash.ninjalog`.
+    """
+    if self.options is None or not self.options.decision_log:
+      return
+    import json
+    import time
+    record = {
+        "output": os.path.abspath(self.resolve(self.outfile)),
+        "decision": decision,
+        "time": time.time(),
+    }
+    if decision != "hit":
+      record["reason"] = self.miss_reason
+    if self.check_time is not None:
+      record["check"] = self.check_time
+    if self.link_wall_time is not None:
+      record["link"] = self.link_wall_time
+    # NOTE(josh): a single write to a file opened for appending, so that the
+    # records of concurrent links aren't interleaved
+    content = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+    try:
+      fd = os.open(self.options.decision_log,
+                   os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        os.write(fd, content)
+      finally:
+        os.close(fd)
+    except OSError:
+      logger.warning(
+          "failed to append to decision log %s", self.options.decision_log)
+
+  def remove_cacheinfo(self):
+    cacheinfopath = self.resolve(self.get_cacheinfopath())
+    if os.path.exists(cacheinfopath):
+      os.unlink(cacheinfopath)
+
+  def remove_sidecars(self):
+    for sidecarpath in (
+        self.resolve(self.get_cacheinfopath()), self.get_apidpath()):
+      if os.path.exists(sidecarpath):
+        os.unlink(sidecarpath)
+
+  def get_lockpath(self):
+    """
+    Return the path of the lockfile of the output. It is kept in the cache
+    directory, keyed by the real path of the output, rather than next to the
+    output where it would be left behind in the build tree.
+    """
+    import hashlib
+    outpath = os.path.realpath(self.resolve(self.outfile))
+    digest = hashlib.sha1(
+        outpath.encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(
+        get_cachedir(self.options), "locks", digest[:2], digest)
+
+  def lock(self):
+    return OutputLock(self.get_lockpath())
+
+  def exec_bypass(self):
+    """
+    Replace this process with the link command, without checking or
+    maintaining the cache. See `linkhash.bypass`.
+    """
+    bypass = import_linkhash_module("bypass")
+    bypass.exec_bypass(self)
+
+  def get_accel(self):
+    """
+    Return the rewrite of the link command by the linker acceleration policy
+    (see `linkhash.accel`), or None if it doesn't apply. The rewrite is
+    evaluated once, so that the command executed and the one recorded in the
+    cacheinfo are the same.
+    """
+    if self.options is None or not self.options.accelerate or not self.outfile:
+      return None
+    if not self._accel_evaluated:
+      # NOTE(josh): configure logging now so that messages of the accel
+      # module honor --log-level
+      logger.get_logger()
+      accel = import_linkhash_module("accel")
+      self._accel = accel.get_rewrite(
+          self.subcommand, self.outfile, self.options)
+      self._accel_evaluated = True
+    return self._accel
+
+  def accel_changed(self, cacheinfo):
+    """
+    Return true if the acceleration policy would link the output differently
+    than it was last linked. The number of threads doesn't matter.
+    """
+    recorded = cacheinfo.get("accel")
+    current = self.get_accel()
+    if recorded is None or current is None:
+      return recorded is not current
+    return ((recorded.get("linker"), recorded.get("gdb_index"))
+            != (current["linker"], current["gdb_index"]))
+
+  def get_link_command(self, lto_cache=True):
+    """
+    Return the command to execute on a miss: the link command, rewritten by
+    the acceleration policy, and with the options of the managed ThinLTO
+    cache if it is a ThinLTO link (unless `lto_cache` is false, e.g. for a
+    link executed on another host). See `linkhash.accel` and
+    `linkhash.ltocache`.
+    """
+    command = self.subcommand
+    accel = self.get_accel()
+    if accel is not None:
+      command = command + accel["args"]
+    if (not lto_cache or self.options is None or self.options.no_lto_cache
+        or "-flto=thin" not in self.subcommand):
+      return command
+    # NOTE(josh): configure logging now so that messages of the ltocache
+    # module honor --log-level
+    logger.get_logger()
+    ltocache = import_linkhash_module("ltocache")
+    return command + ltocache.get_cache_args(self.subcommand, self.options)
+
+  def dispatch_link(self):
+    """
+    With --remote-worker, execute the link on a remote worker. Return the
+    exit status, or None if the link must be executed locally. See
+    `linkhash.remote`.
+    """
+    if self.options is None or not self.options.remote_worker:
+      return None
+    # NOTE(josh): configure logging now so that messages of the remote
+    # module honor --log-level
+    logger.get_logger()
+    remote = import_linkhash_module("remote")
+    return remote.dispatch(self, self.get_link_command(lto_cache=False))
+
+  def get_link_memory(self):
+    """
+    Return the number of bytes of memory that the link is expected to need:
+    the peak recorded the last time it was executed, with some margin, or
+    `--link-memory` if it hasn't been.
+    """
+    peak_rss = None
+    if self.cacheinfo is not None:
+      peak_rss = self.cacheinfo.get("peak_rss")
+    if peak_rss:
+      return int(peak_rss * PEAK_RSS_MARGIN)
+    return self.options.link_memory
+
+  def admit_link(self):
+    """
+    Return a context manager which, with `--throttle`, blocks until the host
+    has the memory to run the link and holds it until exit, along with a
+    jobserver token for each extra linker thread. See `linkhash.throttle`.
+    """
+    if not self.options.throttle:
+      return NoAdmission()
+    # NOTE(josh): configure logging now so that messages of the throttle
+    # module honor --log-level
+    logger.get_logger()
+    throttle = import_linkhash_module("throttle")
+    accel = self.get_accel()
+    threads = 1 if accel is None else accel["threads"]
+    jobserver = None
+    if threads > 1:
+      jobserver = throttle.JobserverTokens.from_environ()
+    return throttle.Admission(
+        os.path.join(get_cachedir(self.options), "throttle"),
+        self.get_link_memory(), target=self.outfile,
+        max_links=self.options.max_links, jobserver=jobserver,
+        threads=threads)
+
+  def limit_threads(self, threads):
+    """
+    Limit the linker rewritten by the acceleration policy to `threads`
+    threads (e.g. the job slots it was admitted with), if it isn't None.
+    """
+    if threads is None or self.get_accel() is None:
       return
+    accel = import_linkhash_module("accel")
+    self._accel = accel.limit_threads(self._accel, threads)
+
+
+def read_apid(apidpath):
+  """Return the API digest stored in an apid sidecar, or None."""
+  try:
+    with io.open(apidpath, "r", encoding="utf-8") as infile:
+      return infile.read().strip()
+  except (IOError, OSError):
+    return None
+
+
+def get_cachedir(options=None):
+  """
+  Return the directory where linkcache keeps state which is not specific to
+  one output (e.g. API snapshots).
+  """
+  if options is not None and options.cache_dir:
+    return options.cache_dir
+  if os.environ.get("LINKCACHE_DIR"):
+    return os.environ["LINKCACHE_DIR"]
+  cachehome = os.environ.get("XDG_CACHE_HOME")
+  if not cachehome:
+    cachehome = os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(cachehome, "linkhash")
+
+
+# API model version used if `--api-version` isn't given. This is the default
+# of linkhash itself (kDefaultApiVersion in linkhash.cc).
+DEFAULT_API_VERSION = 2
+
 
-    apidpath = self.get_apidpath()
-    if os.path.exists(apidpath):
-      with io.open(apidpath, "r", encoding="utf-8") as infile:
-        old_apid = infile.read().strip()
-      if old_apid == new_apid:
-        # The shared-object API has not changed. No need to update the apid
-        # file.
-        return
-    with io.open(apidpath, "w", encoding="utf-8") as outfile:
-      outfile.write(new_apid)
-      outfile.write("\n")
+def get_api_version(options):
+  """Return the version of the API model selected by `options`."""
+  if options is not None and options.api_version is not None:
+    return options.api_version
+  return DEFAULT_API_VERSION
+
+
+def get_linkhash_args(options):
+  """Return the arguments to pass to every execution of linkhash."""
+  return ["--api-version", str(get_api_version(options))]
+
+
+def write_atomic(filepath, content):
+  """
+  Write `content` (bytes) to `filepath` such that readers observe either the
+  old file or the new file, but never a partially written one. The content is
+  written to a temporary file in the same directory which is then renamed
+  over the destination.
+  """
+  tmppath = "{}.{}.tmp".format(filepath, os.getpid())
+  fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    with os.fdopen(fd, "wb") as outfile:
+      outfile.write(content)
+    os.replace(tmppath, filepath)
+  except:
+    if os.path.exists(tmppath):
+      os.unlink(tmppath)
+    raise
+
+
+# Memory expected of a link which hasn't been executed before, and the margin
+# added to the recorded peak of one which has. See `Context.admit_link()`.
+DEFAULT_LINK_MEMORY = 1 << 30
+PEAK_RSS_MARGIN = 1.25
+
+SIZE_SUFFIXES = {
+    "": 1,
+    "K": 1 << 10,
+    "M": 1 << 20,
+    "G": 1 << 30,
+    "T": 1 << 40,
+}
+
+
+def parse_size(value):
+  """
+  Return the number of bytes in a size such as "512M" or "2G". Raises
+  ValueError if it's not a size.
+  """
+  value = value.strip().upper()
+  if value.endswith("B"):
+    value = value[:-1]
+  suffix = value[-1:] if value[-1:] in SIZE_SUFFIXES else ""
+  return int(float(value[:len(value) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+
+
+def get_exit_status(status):
+  """
+  Return the exit status of a child process from it's wait status (e.g. of
+  `os.wait4()`), as `subprocess` reports it: negative the signal which
+  terminated it, if any.
+  """
+  if os.WIFEXITED(status):
+    return os.WEXITSTATUS(status)
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return status
+
+
+def get_children_peak_rss():
+  """
+  Return the peak resident memory, in bytes, of the largest child process of
+  this one that has exited. After a link this is the linker itself, since
+  the compiler driver is much smaller.
+  """
+  import resource
+  # NOTE(josh): ru_maxrss is in kilobytes on linux
+  return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def get_children_cpu_time():
+  """
+  Return the CPU seconds spent by the child processes of this one that have
+  exited.
+  """
+  times = os.times()
+  return times.children_user + times.children_system
+
+
+class NoAdmission(object):
+  """Stand-in for `throttle.Admission` when throttling is disabled."""
+
+  threads = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    pass
+
+
+class OutputLock(object):
+  """
+  Exclusive advisory lock (`flock`) on the lockfile of a link output (see
+  `Context.get_lockpath()`). Held while the output and it's sidecars are
+  being replaced so that overlapping builds of the same tree don't race each
+  other.
+  """
+
+  def __init__(self, lockpath):
+    self.lockpath = lockpath
+    self.fd = None
+
+  def __enter__(self):
+    import fcntl
+    # NOTE(josh): the directory may be created concurrently by another
+    # invocation
+    os.makedirs(os.path.dirname(self.lockpath), exist_ok=True)
+    self.fd = os.open(self.lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+      logger.debug("Waiting for lock on %s", self.lockpath)
+      fcntl.flock(self.fd, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    import fcntl
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+    os.close(self.fd)
+    self.fd = None
+
+
+# Flags accepted ahead of the wrapped command. Each entry is the list of
+# option strings and the keyword arguments for `add_argument()`. This table
+# drives both `setup_argparser()` and the argparse-free `parse_args()` used
+# on the common path.
+OPTIONS = [
+    (["--log-level"], dict(
+        default="warning", choices=["debug", "info", "warning", "error"])),
+    (["--build-root"], dict(
+        default=None,
+        help="Root of the build tree. Occurrences within the link command are"
+             " replaced by a placeholder before hashing, so that the cache"
+             " survives moving or cloning the build tree")),
+    (["--source-root"], dict(
+        default=None,
+        help="Root of the source tree, replaced by a placeholder just like"
+             " --build-root")),
+    (["--path-prefix"], dict(
+        action="append", default=[], metavar="NAME=PATH",
+        help="Additional directory to replace with the placeholder ${NAME}"
+             " before hashing. May be specified multiple times")),
+    (["--env-allow"], dict(
+        action="append", default=[], metavar="PATTERN",
+        help="Include environment variables matching this glob pattern in the"
+             " cache key. May be specified multiple times")),
+    (["--env-deny"], dict(
+        action="append", default=[], metavar="PATTERN",
+        help="Exclude environment variables matching this glob pattern from"
+             " the cache key. Takes precedence over --env-allow. May be"
+             " specified multiple times")),
+    (["--arg-rules"], dict(
+        action="append", default=[], metavar="PATH",
+        help="JSON file of rules which canonicalize the link command before"
+             " hashing, amending the built-in rules. May be specified"
+             " multiple times")),
+    (["--probe-threads"], dict(
+        type=int, default=None, metavar="N",
+        help="Number of threads used to stat inputs concurrently. 0 disables."
+             " By default, a pool is used only on network filesystems")),
+    (["--immutable-prefix"], dict(
+        action="append", default=[], metavar="PATH",
+        help="Treat inputs under this directory (e.g. /usr/lib) as unchanging."
+             " They are only checked after the system package database"
+             " changes. May be specified multiple times")),
+    (["--api-version"], dict(
+        type=int, default=None, metavar="N",
+        help="Version of the API model computed by linkhash for shared"
+             " objects. Default: 2, as for linkhash. If linkhash isn't"
+             " installed, versions 2 and 3 are computed in-process, which is"
+             " slower")),
+    (["--embed-apid"], dict(
+        action="store_true",
+        help="After linking a shared object, embed it's API digest in a note"
+             " section so that it survives being copied without the sidecar")),
+    (["--objcopy"], dict(
+        default="objcopy",
+        help="objcopy used to embed API digests")),
+    (["--no-bypass"], dict(
+        action="store_true",
+        help="Always check the cache, even for outputs which take less time"
+             " to link than to check")),
+    (["--throttle"], dict(
+        action="store_true",
+        help="On a miss, hold the linker until the host has the memory to run"
+             " it, given the memory the link needed last time. Each linker"
+             " thread beyond the first takes a token from the GNU make"
+             " jobserver, if there is one and it is free")),
+    (["--max-links"], dict(
+        type=int, default=None, metavar="N",
+        help="With --throttle, the maximum number of links to run at once on"
+             " this host (i.e. sharing --cache-dir)")),
+    (["--link-memory"], dict(
+        type=parse_size, default=DEFAULT_LINK_MEMORY, metavar="SIZE",
+        help="With --throttle, the memory (e.g. 2G) expected of a link which"
+             " hasn't been executed before. Default: 1G")),
+    (["--no-lto-cache"], dict(
+        action="store_true",
+        help="Don't add the options of a managed incremental cache to ThinLTO"
+             " links")),
+    (["--lto-cache-size"], dict(
+        type=parse_size, default=10 << 30, metavar="SIZE",
+        help="Size (e.g. 20G) to which the managed ThinLTO cache is pruned."
+             " Default: 10G")),
+    (["--lto-cache-age"], dict(
+        type=float, default=7.0, metavar="DAYS",
+        help="Entries of the managed ThinLTO cache which haven't been used for"
+             " this many days are pruned. Default: 7")),
+    (["--audit-rate"], dict(
+        type=float, default=0.0, metavar="FRACTION",
+        help="Fraction of cache hits to verify by linking again, in the"
+             " background, and comparing the result with the reused output."
+             " Results are appended to --audit-report")),
+    (["--audit-jobs"], dict(
+        type=int, default=1, metavar="N",
+        help="Maximum number of audits to run at once on this host. A hit"
+             " selected for audit while all are busy is not audited")),
+    (["--audit-report"], dict(
+        default=None, metavar="PATH",
+        help="File to which audit results are appended. Defaults to"
+             " audit/report.jsonl in --cache-dir")),
+    (["--accelerate"], dict(
+        action="store_true",
+        help="On a miss, link with the fastest linker available to the"
+             " compiler driver (mold, lld or gold) using the idle CPUs")),
+    (["--accelerate-gdb-index"], dict(
+        action="store_true",
+        help="With --accelerate, also build a .gdb_index in the output")),
+    (["--accelerate-deny"], dict(
+        action="append", default=[], metavar="GLOB",
+        help="Don't accelerate the links of outputs matching this glob"
+             " (matched against the output as given, and it's file name)."
+             " May be given multiple times")),
+    (["--no-toolchain-fingerprint"], dict(
+        action="store_true",
+        help="Don't include the fingerprints of the driver, linker and LTO"
+             " plugin binaries in the cache key")),
+    (["--remote-worker"], dict(
+        action="append", default=[], metavar="HOST:PORT",
+        help="`linkcache worker` to which misses may be dispatched, as"
+             " host:port or ssh://[user@]host[/path/to/linkcache]. May be"
+             " given multiple times")),
+    (["--remote-timeout"], dict(
+        type=float, default=30.0, metavar="SECONDS",
+        help="Seconds without a response from a worker after which the link"
+             " is executed locally. Default: 30")),
+    (["--decision-log"], dict(
+        default=None, metavar="PATH",
+        help="File to which a record of each decision (hit, miss or bypass)"
+             " is appended, for `linkcache ninjalog`")),
+    (["--watch"], dict(
+        action="store_true",
+        help="Consult the journal of a running `linkcache watch` and only"
+             " check the inputs which it shows may have changed")),
+    (["--cache-dir"], dict(
+        default=None,
+        help="Directory for state shared between outputs. Defaults to"
+             " $LINKCACHE_DIR or $XDG_CACHE_HOME/linkhash")),
+]
 
 
 def setup_argparser(argparser):
-  argparser.add_argument(
-      "--log-level", default="warning",
-      choices=["debug", "info", "warning", "error"])
+  import argparse
+  for flags, kwargs in OPTIONS:
+    argparser.add_argument(*flags, **kwargs)
   argparser.add_argument("subcommand", nargs=argparse.REMAINDER)
 
 
-def main():
-  logging.basicConfig()
-  argparser = argparse.ArgumentParser(description=__doc__)
+TOOLS_EPILOG = """
+In place of a link command, the following tools are available:
+
+  linkcache explain <builddir>  predict the link decision for every output
+                                in a build tree, without running anything
+  linkcache audit <command>     verify that a cache hit is safe by linking
+                                again and comparing the result
+  linkcache churn [report|diff] rank libraries and symbols by the relinks
+                                their changes in API caused
+  linkcache plan --commands <path>
+                                evaluate every link of a build in one
+                                process, executing only the misses
+  linkcache watch <dirs>        journal the changes to the source and build
+                                trees, for use with --watch
+  linkcache ninjalog [builddir] reconstruct the critical path of the last
+                                build from .ninja_log and attribute it's time
+                                to compiling, linking and linkcache
+  linkcache exec --in <path> --out <path> -- <command>
+                                cache any command with declared inputs and
+                                outputs, e.g. strip or objcopy after a link
+  linkcache worker [--listen <host:port>]
+                                execute the links dispatched with
+                                --remote-worker
+"""
+
+
+def get_argparser():
+  import argparse
+  argparser = argparse.ArgumentParser(
+      description=__doc__, epilog=TOOLS_EPILOG,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
   setup_argparser(argparser)
+  return argparser
+
+
+class Options(object):
+  """Parsed command line, with one attribute per entry in `OPTIONS`."""
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
 
+
+def get_default_options():
+  defaults = {}
+  for flags, kwargs in OPTIONS:
+    dest = kwargs.get("dest", flags[0].lstrip("-").replace("-", "_"))
+    if kwargs.get("action") == "store_true":
+      defaults[dest] = False
+    elif kwargs.get("action") == "append":
+      defaults[dest] = list(kwargs.get("default", []))
+    else:
+      defaults[dest] = kwargs.get("default", None)
+  return defaults
+
+
+def fast_parse_args(argv):
+  """
+  Parse the linkcache flags from the front of `argv` without argparse. Returns
+  None if anything unusual is encountered (help requested, an unknown flag, an
+  invalid choice, no command, ...) in which case the caller should defer to
+  argparse, which will generate the appropriate help or error message.
+  """
+  flagmap = {}
+  for flags, kwargs in OPTIONS:
+    for flag in flags:
+      flagmap[flag] = kwargs
+
+  values = get_default_options()
+  idx = 0
+  while idx < len(argv):
+    token = argv[idx]
+    if token == "--":
+      idx += 1
+      break
+    if not token.startswith("-"):
+      break
+
+    flag, eq, value = token.partition("=")
+    kwargs = flagmap.get(flag)
+    if kwargs is None:
+      return None
+    dest = kwargs.get("dest", flag.lstrip("-").replace("-", "_"))
+    action = kwargs.get("action", "store")
+
+    if action == "store_true":
+      if eq:
+        return None
+      values[dest] = True
+      idx += 1
+      continue
+
+    if not eq:
+      if idx + 1 >= len(argv):
+        return None
+      value = argv[idx + 1]
+      idx += 1
+    idx += 1
+
+    if "choices" in kwargs and value not in kwargs["choices"]:
+      return None
+    if "type" in kwargs:
+      try:
+        value = kwargs["type"](value)
+      except ValueError:
+        return None
+
+    if action == "append":
+      values[dest].append(value)
+    else:
+      values[dest] = value
+
+  values["subcommand"] = argv[idx:]
+  if not values["subcommand"]:
+    return None
+  values["argv"] = list(argv)
+  return Options(**values)
+
+
+def parse_args(argv):
+  if "_ARGCOMPLETE" in os.environ:
+    argparser = get_argparser()
+    try:
+      import argcomplete
+      argcomplete.autocomplete(argparser)
+    except ImportError:
+      pass
+
+  args = fast_parse_args(argv)
+  if args is None:
+    argparser = get_argparser()
+    args = argparser.parse_args(argv)
+    if not args.subcommand:
+      argparser.error("no link command was provided")
+    args.argv = list(argv)
+  return args
+
+
+# Subcommands of linkcache which are tools rather than a link command to wrap,
+# mapped to the module implementing them.
+TOOLS = {
+    "audit": "audit",
+    "churn": "churn",
+    "exec": "action",
+    "explain": "explain",
+    "ninjalog": "ninjalog",
+    "plan": "plan",
+    "watch": "watch",
+    "worker": "remote",
+}
+
+
+def import_linkhash_module(name):
+  """
+  Import and return `linkhash.<name>`. Tools that aren't needed to evaluate
+  a single link live in separate modules so that their code isn't compiled on
+  every invocation. The package is next to this script in the source tree,
+  and under `<prefix>/share/linkhash` when installed.
+  """
+  modname = "linkhash." + name
+  if modname not in sys.modules:
+    prefix = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    for candidate in (prefix, os.path.join(prefix, "share", "linkhash")):
+      if os.path.exists(os.path.join(candidate, "linkhash", "__init__.py")):
+        if candidate not in sys.path:
+          sys.path.append(candidate)
+        break
+  # NOTE(josh): `argrules` is imported on every invocation, so this uses
+  # __import__ rather than importlib, which isn't loaded at startup. It is
+  # called even if the module is in `sys.modules` since, if another thread is
+  # still executing it, __import__ waits for it to finish.
+  __import__(modname)
+  return sys.modules[modname]
+
+
+def should_audit(options):
+  """Return true if this cache hit is selected for audit."""
+  if options.audit_rate <= 0:
+    return False
+  sample = int.from_bytes(os.urandom(4), "little")
+  return sample < options.audit_rate * (1 << 32)
+
+
+def spawn_audit(options):
+  """
+  Start `linkcache audit` for the link command in the background, detached
+  from the build: in it's own session and without our standard streams, so
+  that the build (e.g. ninja waiting on our output pipe) doesn't wait for it.
+  """
+  import subprocess
+  prefix = options.argv[:len(options.argv) - len(options.subcommand)]
   try:
-    import argcomplete
-    argcomplete.autocomplete(argparser)
-  except ImportError:
-    pass
+    subprocess.Popen(
+        [sys.executable, os.path.realpath(__file__)] + prefix + ["audit"]
+        + options.subcommand,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True)
+  except OSError:
+    logger.warning("failed to start audit of %s", options.subcommand)
 
-  args = argparser.parse_args()
-  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
 
-  linkhash_path = find_linkhash()
-  if linkhash_path is None:
-    os.execvp(args.subcommand[0], args.subcommand)
-    sys.exit(1)
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+
+  args = parse_args(argv)
+  logger.set_level(args.log_level)
 
-  ctx = Context(args.subcommand)
+  if args.subcommand[0] in TOOLS:
+    module = import_linkhash_module(TOOLS[args.subcommand[0]])
+    return module.main(args.subcommand[1:], args)
+
+  ctx = Context(args.subcommand, args)
   if ctx.cache_hit():
     logger.debug("Cache hit, touching %s", ctx.outfile)
-    pathlib.Path(ctx.outfile).touch()
-    sys.exit(0)
-  else:
-    logger.debug("Cache miss, executing subcommand")
-    result = subprocess.call(args.subcommand)
+    os.utime(ctx.outfile, None)
+    ctx.refresh_cacheinfo()
+    ctx.record_decision("hit")
+    if should_audit(args):
+      spawn_audit(args)
+    return 0
+
+  if ctx.miss_reason == "bypass":
+    ctx.record_decision("bypass")
+    ctx.exec_bypass()
+    return 1
+
+  # NOTE(josh): configure logging now so that messages of the apidigest
+  # module honor --log-level
+  logger.get_logger()
+  apidigest = import_linkhash_module("apidigest")
+  linkhash = apidigest.get_digester(find_linkhash(), args)
+  if linkhash is None:
+    # NOTE(josh): we can't maintain the sidecars without a digester, so make
+    # sure that whatever we have won't be trusted by a later invocation.
     if ctx.outfile:
-      if result == 0:
-        ctx.write_cacheinfo()
-        if ctx.outfile.endswith(".so"):
-          ctx.write_apid(linkhash_path)
-      else:
-        if os.path.exists(ctx.get_cacheinfopath()):
-          os.unlink(ctx.get_cacheinfopath())
-        if os.path.exists(ctx.get_apidpath()):
-          os.unlink(ctx.get_apidpath())
-    sys.exit(result)
+      ctx.remove_sidecars()
+    os.execvp(args.subcommand[0], args.subcommand)
+    return 1
+
+  import subprocess
+  import time
+  if not ctx.outfile:
+    logger.debug("Cache miss, executing subcommand")
+    return subprocess.call(args.subcommand)
+
+  with ctx.lock() as lock:
+    if ctx.cacheinfo_changed():
+      ctx.statcache.clear()
+      recheck = ctx.cache_hit()
+    else:
+      recheck = False
+    if recheck:
+      # Another process completed the same link between our evaluation of
+      # the cache and acquiring the lock
+      logger.debug("Cache hit, touching %s", ctx.outfile)
+      os.utime(ctx.outfile, None)
+      ctx.record_decision("hit")
+      return 0
+
+    # NOTE(josh): the cacheinfo is removed before the linker starts writing
+    # the output so that if we are killed part way through, the partial
+    # output isn't mistaken for a valid one. The execspec is computed first,
+    # so that it records the toolchain as it was when the link started.
+    ctx.recompute_execspec()
+    ctx.remove_cacheinfo()
+    result = ctx.dispatch_link()
+    if result is None:
+      with ctx.admit_link() as admission:
+        ctx.limit_threads(admission.threads)
+        logger.debug("Cache miss, executing subcommand")
+        tstart = get_children_cpu_time()
+        twall = time.time()
+        result = subprocess.call(ctx.get_link_command())
+        ctx.link_wall_time = time.time() - twall
+        ctx.link_time = get_children_cpu_time() - tstart
+      ctx.peak_rss = get_children_peak_rss()
+    if result == 0:
+      if ctx.is_shared_output():
+        with linkhash:
+          ctx.write_apid(linkhash)
+      ctx.write_cacheinfo()
+      ctx.record_relink()
+    else:
+      ctx.remove_sidecars()
+  ctx.record_decision("miss")
+  return result
 
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
@@ -10,7 +10,15 @@ endfunction()
 
 function(activate_linkcache)
   set(_args_VERBOSITY "info")
-  cmake_parse_arguments(_args "" "LOG_LEVEL" "" ${ARGN})
+  set(_one_value_args LOG_LEVEL PROBE_THREADS API_VERSION MAX_LINKS
+                      LINK_MEMORY AUDIT_RATE AUDIT_JOBS LTO_CACHE_SIZE
+                      LTO_CACHE_AGE DECISION_LOG REMOTE_TIMEOUT)
+  set(_multi_value_args PATH_PREFIX ENV_ALLOW ENV_DENY IMMUTABLE_PREFIX
+                        ARG_RULES ACCELERATE_DENY REMOTE_WORKERS)
+  set(_flags RELOCATABLE EMBED_APID THROTTLE NO_BYPASS WATCH NO_LTO_CACHE
+             ACCELERATE ACCELERATE_GDB_INDEX NO_TOOLCHAIN_FINGERPRINT)
+  cmake_parse_arguments(_args "${_flags}" "${_one_value_args}"
+                        "${_multi_value_args}" ${ARGN})
 
   set(_linkcache_path "${linkhash_BINDIR}/linkcache")
   if(NOT EXISTS ${_linkcache_path})
@@ -32,6 +40,123 @@ function(activate_linkcache)
     set(_suffix " --log-level ${_args_LOG_LEVEL}")
   endif()
 
+  if(DEFINED _args_PROBE_THREADS)
+    set(_suffix "${_suffix} --probe-threads ${_args_PROBE_THREADS}")
+  endif()
+
+  if(_args_API_VERSION)
+    set(_suffix "${_suffix} --api-version ${_args_API_VERSION}")
+  endif()
+
+  if(_args_EMBED_APID)
+    set(_suffix "${_suffix} --embed-apid")
+    if(CMAKE_OBJCOPY)
+      set(_suffix "${_suffix} --objcopy ${CMAKE_OBJCOPY}")
+    endif()
+  endif()
+
+  if(_args_NO_BYPASS)
+    set(_suffix "${_suffix} --no-bypass")
+  endif()
+
+  if(_args_WATCH)
+    set(_suffix "${_suffix} --watch")
+  endif()
+
+  if(_args_NO_TOOLCHAIN_FINGERPRINT)
+    set(_suffix "${_suffix} --no-toolchain-fingerprint")
+  endif()
+
+  if(_args_THROTTLE)
+    set(_suffix "${_suffix} --throttle")
+    if(_args_MAX_LINKS)
+      set(_suffix "${_suffix} --max-links ${_args_MAX_LINKS}")
+    endif()
+    if(_args_LINK_MEMORY)
+      set(_suffix "${_suffix} --link-memory ${_args_LINK_MEMORY}")
+    endif()
+  elseif(_args_MAX_LINKS OR _args_LINK_MEMORY)
+    _error("MAX_LINKS and LINK_MEMORY require THROTTLE")
+  endif()
+
+  if(_args_AUDIT_RATE)
+    set(_suffix "${_suffix} --audit-rate ${_args_AUDIT_RATE}")
+  endif()
+
+  if(_args_AUDIT_JOBS)
+    set(_suffix "${_suffix} --audit-jobs ${_args_AUDIT_JOBS}")
+  endif()
+
+  if(_args_NO_LTO_CACHE)
+    set(_suffix "${_suffix} --no-lto-cache")
+    if(_args_LTO_CACHE_SIZE OR _args_LTO_CACHE_AGE)
+      _error("LTO_CACHE_SIZE and LTO_CACHE_AGE conflict with NO_LTO_CACHE")
+    endif()
+  endif()
+
+  if(_args_LTO_CACHE_SIZE)
+    set(_suffix "${_suffix} --lto-cache-size ${_args_LTO_CACHE_SIZE}")
+  endif()
+
+  if(_args_LTO_CACHE_AGE)
+    set(_suffix "${_suffix} --lto-cache-age ${_args_LTO_CACHE_AGE}")
+  endif()
+
+  if(_args_ACCELERATE)
+    set(_suffix "${_suffix} --accelerate")
+    if(_args_ACCELERATE_GDB_INDEX)
+      set(_suffix "${_suffix} --accelerate-gdb-index")
+    endif()
+    foreach(_pattern ${_args_ACCELERATE_DENY})
+      set(_suffix "${_suffix} --accelerate-deny ${_pattern}")
+    endforeach()
+  elseif(_args_ACCELERATE_GDB_INDEX OR _args_ACCELERATE_DENY)
+    _error("ACCELERATE_GDB_INDEX and ACCELERATE_DENY require ACCELERATE")
+  endif()
+
+  if(_args_DECISION_LOG)
+    set(_suffix "${_suffix} --decision-log ${_args_DECISION_LOG}")
+  endif()
+
+  foreach(_worker ${_args_REMOTE_WORKERS})
+    set(_suffix "${_suffix} --remote-worker ${_worker}")
+  endforeach()
+  if(_args_REMOTE_TIMEOUT)
+    if(NOT _args_REMOTE_WORKERS)
+      _error("REMOTE_TIMEOUT requires REMOTE_WORKERS")
+    endif()
+    set(_suffix "${_suffix} --remote-timeout ${_args_REMOTE_TIMEOUT}")
+  endif()
+
+  if(_args_RELOCATABLE)
+    set(_suffix "${_suffix} --build-root ${CMAKE_BINARY_DIR}")
+    set(_suffix "${_suffix} --source-root ${CMAKE_SOURCE_DIR}")
+  endif()
+
+  foreach(_path_prefix ${_args_PATH_PREFIX})
+    if(NOT "${_path_prefix}" MATCHES "^[A-Za-z_][A-Za-z0-9_]*=")
+      _error("PATH_PREFIX must be of the form NAME=PATH, got:"
+             " ${_path_prefix}")
+    endif()
+    set(_suffix "${_suffix} --path-prefix ${_path_prefix}")
+  endforeach()
+
+  foreach(_pattern ${_args_ENV_ALLOW})
+    set(_suffix "${_suffix} --env-allow ${_pattern}")
+  endforeach()
+
+  foreach(_pattern ${_args_ENV_DENY})
+    set(_suffix "${_suffix} --env-deny ${_pattern}")
+  endforeach()
+
+  foreach(_immutable_prefix ${_args_IMMUTABLE_PREFIX})
+    set(_suffix "${_suffix} --immutable-prefix ${_immutable_prefix}")
+  endforeach()
+
+  foreach(_arg_rules ${_args_ARG_RULES})
+    set(_suffix "${_suffix} --arg-rules ${_arg_rules}")
+  endforeach()
+
   set(_prefix)
   get_property(_preexisting_launcher GLOBAL PROPERTY RULE_LAUNCH_LINK)
   if(_preexisting_launcher)
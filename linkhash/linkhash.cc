@@ -8,12 +8,16 @@
 
 #include <algorithm>
 #include <cerrno>
+#include <cstdio>
 #include <cstring>
+#include <iomanip>
+#include <iostream>
+#include <map>
+#include <sstream>
 #include <string>
 #include <vector>
 
 #include <fmt/format.h>
-#include <loki/ScopeGuard.h>
 #include <openssl/sha.h>
 
 #include "argue/argue.h"
@@ -21,7 +25,92 @@
 #include "tangent/util/stdio_filebuf.h"
 
 #define LINKHASH_VERSION \
-  { 0, 1, 0, "dev", 1 }
+  { 0, 2, 0, "dev", 1 }
+
+// Version of the API model which is hashed. Version 1 includes every GLOBAL
+// or WEAK entry of the first symbol table in the file. Version 2 includes only
+// the symbols which are actually exported: defined, externally visible entries
+// of .dynsym along with their symbol version, type and (for data) size.
+// Version 3 includes the same symbols as version 2, but combines the digest of
+// each symbol with an order-independent accumulator, so that it can be
+// computed in a single pass without materializing or sorting the symbol
+// list. The digest of version 2 and later is prefixed with the version so
+// that digests of different models are never equal.
+const int kDefaultApiVersion = 2;
+const int kMaxApiVersion = 3;
+
+#ifndef SHT_GNU_verdef
+#define SHT_GNU_verdef 0x6ffffffd
+#endif
+
+#ifndef SHT_GNU_versym
+#define SHT_GNU_versym 0x6fffffff
+#endif
+
+#ifndef STB_GNU_UNIQUE
+#define STB_GNU_UNIQUE 10
+#endif
+
+#ifndef STT_COMMON
+#define STT_COMMON 5
+#endif
+
+#ifndef STT_TLS
+#define STT_TLS 6
+#endif
+
+#ifndef STT_GNU_IFUNC
+#define STT_GNU_IFUNC 10
+#endif
+
+#ifndef STV_INTERNAL
+#define STV_INTERNAL 1
+#endif
+
+#ifndef STV_HIDDEN
+#define STV_HIDDEN 2
+#endif
+
+#ifndef VER_FLG_BASE
+#define VER_FLG_BASE 0x1
+#endif
+
+// Visibility is stored in the low two bits of st_other
+const unsigned char kVisibilityMask = 0x3;
+
+// Bit of a .gnu.version entry indicating that the version is not the default
+// version of the symbol (i.e. `foo@VER` rather than `foo@@VER`)
+const uint16_t kVersymHidden = 0x8000;
+
+// The GNU version definition structures have the same layout for both ELF
+// classes.
+struct Verdef {
+  uint16_t vd_version;
+  uint16_t vd_flags;
+  uint16_t vd_ndx;
+  uint16_t vd_cnt;
+  uint32_t vd_hash;
+  uint32_t vd_aux;
+  uint32_t vd_next;
+};
+
+struct Verdaux {
+  uint32_t vda_name;
+  uint32_t vda_next;
+};
+
+// Note header, which is also the same for both ELF classes
+struct Nhdr {
+  uint32_t n_namesz;
+  uint32_t n_descsz;
+  uint32_t n_type;
+};
+
+// Section and note in which `linkcache --embed-apid` embeds the API digest of
+// a shared object
+const char kApidNoteSection[] = ".note.linkhash.apid";
+const char kApidNoteName[] = "linkhash";
+const uint32_t kNtLinkhashApid = 1;
 
 template <class Traits>
 std::vector<std::string> get_api_from_section(ElfFile<Traits> elf_file,
@@ -52,15 +141,300 @@ std::vector<std::string> get_api_from_section(ElfFile<Traits> elf_file,
   return output;
 }
 
+// Return a map from version index to version name for each of the versions
+// defined in the SHT_GNU_verdef section `shdr`.
 template <class Traits>
-std::vector<std::string> get_api_from_image(char* image) {
-  ElfFile<Traits> elf_file{image};
+std::map<uint16_t, std::string> get_version_names(
+    ElfFile<Traits> elf_file, typename Traits::Shdr* shdr) {
+  typename Traits::Shdr* string_scn = elf_file.get_section(shdr->sh_link);
+  char* string_data = elf_file.get_section_data(string_scn->sh_offset);
 
+  std::map<uint16_t, std::string> output{};
+  char* verdef_ptr = elf_file.get_section_data(shdr->sh_offset);
+  char* section_end = verdef_ptr + shdr->sh_size;
+  while (verdef_ptr < section_end) {
+    Verdef* verdef = reinterpret_cast<Verdef*>(verdef_ptr);
+    if (!(verdef->vd_flags & VER_FLG_BASE) && verdef->vd_cnt > 0) {
+      // The first auxiliary entry is the name of the version, any others are
+      // the names of it's parents.
+      Verdaux* verdaux =
+          reinterpret_cast<Verdaux*>(verdef_ptr + verdef->vd_aux);
+      output[verdef->vd_ndx] = &string_data[verdaux->vda_name];
+    }
+    if (verdef->vd_next == 0) {
+      break;
+    }
+    verdef_ptr += verdef->vd_next;
+  }
+  return output;
+}
+
+const char* get_type_name(unsigned char type) {
+  switch (type) {
+    case STT_NOTYPE:
+      return "NOTYPE";
+    case STT_OBJECT:
+      return "OBJECT";
+    case STT_FUNC:
+      return "FUNC";
+    case STT_COMMON:
+      return "COMMON";
+    case STT_TLS:
+      return "TLS";
+    case STT_GNU_IFUNC:
+      return "IFUNC";
+    default:
+      return nullptr;
+  }
+}
+
+// Fields of one exported symbol. Each field points into the mapped image (or
+// at a string constant), so visiting a record requires no allocation.
+struct ExportRecord {
+  const char* bind;
+  const char* type;
+  const char* name;
+  const char* version_sep;  // "@", "@@", or "" if unversioned
+  const char* version;      // "" if unversioned
+  bool has_size;
+  uint64_t size;
+};
+
+// Format `record` as `BIND,TYPE,name[@[@]VERSION][,size]`. This is the
+// canonical serialization which is hashed by versions 2 and 3 of the API
+// model. Return the number of characters written, not including the null
+// terminator, or -1 if `bufsize` is too small.
+int format_record(const ExportRecord& record, char* buf, size_t bufsize) {
+  int count = 0;
+  if (record.has_size) {
+    count = snprintf(buf, bufsize, "%s,%s,%s%s%s,%llu", record.bind,
+                     record.type, record.name, record.version_sep,
+                     record.version,
+                     static_cast<unsigned long long>(record.size));
+  } else {
+    count = snprintf(buf, bufsize, "%s,%s,%s%s%s", record.bind, record.type,
+                     record.name, record.version_sep, record.version);
+  }
+  if (count < 0 || static_cast<size_t>(count) >= bufsize) {
+    return -1;
+  }
+  return count;
+}
+
+std::string format_record(const ExportRecord& record) {
+  std::string output = fmt::format("{},{},{}{}{}", record.bind, record.type,
+                                   record.name, record.version_sep,
+                                   record.version);
+  if (record.has_size) {
+    output += fmt::format(",{}", record.size);
+  }
+  return output;
+}
+
+// Call `callback(record)` for each symbol exported by the symbol table
+// `shdr`. Undefined symbols (i.e. imports) and hidden or internal symbols are
+// not part of the API and are omitted. Protected symbols are still exported,
+// so they are kept. `versym_shdr` is the SHT_GNU_versym section matching
+// `shdr`, or nullptr if there is none.
+template <class Traits, class Callback>
+void for_each_export_in_section(
+    ElfFile<Traits> elf_file, typename Traits::Shdr* shdr,
+    typename Traits::Shdr* versym_shdr,
+    const std::map<uint16_t, std::string>& version_names,
+    Callback&& callback) {
+  typename Traits::Shdr* string_scn = elf_file.get_section(shdr->sh_link);
+  char* string_data = elf_file.get_section_data(string_scn->sh_offset);
+
+  uint16_t* versyms = nullptr;
+  if (versym_shdr) {
+    versyms = reinterpret_cast<uint16_t*>(
+        elf_file.get_section_data(versym_shdr->sh_offset));
+  }
+
+  char* section_data = elf_file.get_section_data(shdr->sh_offset);
+  size_t nsyms = shdr->sh_size / shdr->sh_entsize;
+  for (size_t idx = 0; idx < nsyms; idx++) {
+    typename Traits::Sym* sym = reinterpret_cast<typename Traits::Sym*>(
+        &section_data[idx * shdr->sh_entsize]);
+    if (sym->st_shndx == SHN_UNDEF) {
+      continue;
+    }
+    switch (sym->st_other & kVisibilityMask) {
+      case STV_INTERNAL:
+      case STV_HIDDEN:
+        continue;
+      default:
+        break;
+    }
+
+    ExportRecord record{};
+    switch (Traits::st_bind(sym->st_info)) {
+      case STB_GLOBAL:
+        record.bind = "GLOBAL";
+        break;
+      case STB_WEAK:
+        record.bind = "WEAK";
+        break;
+      case STB_GNU_UNIQUE:
+        record.bind = "UNIQUE";
+        break;
+      default:
+        continue;
+    }
+
+    unsigned char type = ELF_ST_TYPE(sym->st_info);
+    record.type = get_type_name(type);
+    if (!record.type) {
+      continue;
+    }
+
+    record.name = &string_data[sym->st_name];
+    record.version_sep = "";
+    record.version = "";
+    if (versyms) {
+      uint16_t versym = versyms[idx];
+      auto iter = version_names.find(versym & ~kVersymHidden);
+      if (iter != version_names.end()) {
+        record.version_sep = (versym & kVersymHidden) ? "@" : "@@";
+        record.version = iter->second.c_str();
+      }
+    }
+
+    // NOTE(josh): the size of a function is not part of it's interface, but
+    // the size of a data object is: it is baked into copy relocations in the
+    // consumer.
+    if (type == STT_OBJECT || type == STT_TLS || type == STT_COMMON) {
+      record.has_size = true;
+      record.size = sym->st_size;
+    }
+    callback(record);
+  }
+}
+
+// Call `callback(record)` for each symbol exported by the shared object.
+template <class Traits, class Callback>
+void for_each_export(ElfFile<Traits> elf_file, Callback&& callback) {
+  // Section indices, zero if not present
+  int symtab_idx = 0;
+  int dynsym_idx = 0;
+  int versym_idx = 0;
+  int verdef_idx = 0;
+
+  int idx = 0;
+  for (auto& shdr : elf_file.iter_shdr()) {
+    switch (shdr.sh_type) {
+      case SHT_SYMTAB:
+        symtab_idx = idx;
+        break;
+      case SHT_DYNSYM:
+        dynsym_idx = idx;
+        break;
+      case SHT_GNU_versym:
+        versym_idx = idx;
+        break;
+      case SHT_GNU_verdef:
+        verdef_idx = idx;
+        break;
+      default:
+        break;
+    }
+    idx++;
+  }
+
+  // The dynamic symbol table is exactly the set of symbols visible to the
+  // dynamic linker, and is much smaller than the full symbol table. Only a
+  // shared object without one (which is unusual) falls back to .symtab, in
+  // which case symbol versions aren't available.
+  if (dynsym_idx) {
+    std::map<uint16_t, std::string> version_names{};
+    if (verdef_idx) {
+      version_names =
+          get_version_names(elf_file, elf_file.get_section(verdef_idx));
+    }
+    for_each_export_in_section(
+        elf_file, elf_file.get_section(dynsym_idx),
+        versym_idx ? elf_file.get_section(versym_idx) : nullptr,
+        version_names, callback);
+    return;
+  }
+  if (symtab_idx) {
+    for_each_export_in_section(elf_file, elf_file.get_section(symtab_idx),
+                               nullptr, {}, callback);
+    return;
+  }
+
+  throw std::runtime_error("Shared object contains no symbol table section");
+}
+
+// Order-independent accumulator of record digests (a multiset hash). The
+// SHA1 of each record is split into five little-endian 32-bit words which are
+// added, lane-wise and modulo 2^64, into the accumulator. Addition commutes, so
+// the result doesn't depend on the order of the symbol table, and unlike XOR a
+// duplicated record doesn't cancel itself out. The final digest is the SHA1
+// of the lanes and the number of records, each as a little-endian 64-bit
+// integer.
+class MultisetHash {
+ public:
+  static const int kNumLanes = SHA_DIGEST_LENGTH / 4;
+
+  void add(const char* data, size_t size) {
+    unsigned char digest[SHA_DIGEST_LENGTH];
+    SHA1(reinterpret_cast<const unsigned char*>(data), size, digest);
+    for (int lane = 0; lane < kNumLanes; lane++) {
+      lanes_[lane] += read_le32(&digest[4 * lane]);
+    }
+    count_++;
+  }
+
+  void finish(unsigned char digest[SHA_DIGEST_LENGTH]) const {
+    unsigned char buf[8 * (kNumLanes + 1)];
+    for (int lane = 0; lane < kNumLanes; lane++) {
+      write_le64(lanes_[lane], &buf[8 * lane]);
+    }
+    write_le64(count_, &buf[8 * kNumLanes]);
+    SHA1(buf, sizeof(buf), digest);
+  }
+
+ private:
+  static uint32_t read_le32(const unsigned char* data) {
+    return static_cast<uint32_t>(data[0]) |
+           (static_cast<uint32_t>(data[1]) << 8) |
+           (static_cast<uint32_t>(data[2]) << 16) |
+           (static_cast<uint32_t>(data[3]) << 24);
+  }
+
+  static void write_le64(uint64_t value, unsigned char* data) {
+    for (int idx = 0; idx < 8; idx++) {
+      data[idx] = static_cast<unsigned char>(value >> (8 * idx));
+    }
+  }
+
+  uint64_t lanes_[kNumLanes]{};
+  uint64_t count_{0};
+};
+
+// Throw if the image is not a shared object
+template <class Traits>
+void check_shared_object(ElfFile<Traits> elf_file) {
   if (elf_file.get_header()->e_type != ET_DYN) {
     throw std::runtime_error(
         fmt::format("Input file is not a shared object ({}), e_type={}", ET_DYN,
                     elf_file.get_header()->e_type));
   }
+}
+
+template <class Traits>
+std::vector<std::string> get_api_from_image(char* image, int api_version) {
+  ElfFile<Traits> elf_file{image};
+  check_shared_object(elf_file);
+
+  if (api_version >= 2) {
+    std::vector<std::string> output{};
+    for_each_export(elf_file, [&output](const ExportRecord& record) {
+      output.push_back(format_record(record));
+    });
+    return output;
+  }
 
   for (auto& shdr : elf_file.iter_shdr()) {
     switch (shdr.sh_type) {
@@ -75,49 +449,272 @@ std::vector<std::string> get_api_from_image(char* image) {
   throw std::runtime_error("Shared object contains no symbol table section");
 }
 
-std::vector<std::string> get_api(const std::string filepath) {
-  int fd = open(filepath.c_str(), O_RDONLY);
-  if (fd == -1) {
-    throw std::runtime_error(fmt::format("Failed to open {} for reading: {}",
-                                         filepath, strerror(errno)));
+// Compute the version 3 (streaming) digest of the image. Records are hashed
+// as they are visited, directly from the mapped string table, so memory use
+// does not depend on the number of symbols and nothing is sorted.
+template <class Traits>
+void get_streaming_digest_from_image(char* image,
+                                     unsigned char digest[SHA_DIGEST_LENGTH]) {
+  ElfFile<Traits> elf_file{image};
+  check_shared_object(elf_file);
+
+  MultisetHash accumulator{};
+  char buf[1024];
+  for_each_export(elf_file, [&accumulator, &buf](const ExportRecord& record) {
+    int size = format_record(record, buf, sizeof(buf));
+    if (size < 0) {
+      // Pathologically long symbol name
+      std::string entry = format_record(record);
+      accumulator.add(entry.data(), entry.size());
+    } else {
+      accumulator.add(buf, size);
+    }
+  });
+  accumulator.finish(digest);
+}
+
+// Read-only memory map of an ELF file
+class MappedElf {
+ public:
+  explicit MappedElf(const std::string& filepath) {
+    fd_ = open(filepath.c_str(), O_RDONLY);
+    if (fd_ == -1) {
+      throw std::runtime_error(fmt::format("Failed to open {} for reading: {}",
+                                           filepath, strerror(errno)));
+    }
+
+    struct stat statbuf {};
+    int err = fstat(fd_, &statbuf);
+    if (err) {
+      close(fd_);
+      throw std::runtime_error(
+          fmt::format("Failed to stat {} for size", filepath));
+    }
+    size_ = statbuf.st_size;
+
+    void* mem = mmap(nullptr, size_, PROT_READ, MAP_SHARED, fd_, /*offset=*/0);
+    if (mem == MAP_FAILED || size_ < EI_NIDENT) {
+      if (mem != MAP_FAILED) {
+        munmap(mem, size_);
+      }
+      close(fd_);
+      throw std::runtime_error(fmt::format("Can't map the file {}", filepath));
+    }
+    image_ = static_cast<char*>(mem);
+
+    if (std::memcmp(image_, ELFMAG, 4) != 0) {
+      munmap(image_, size_);
+      close(fd_);
+      throw std::runtime_error(
+          fmt::format("File {} has wrong magic", filepath));
+    }
   }
-  Loki::ScopeGuard _close = Loki::MakeGuard(close, fd);
 
-  struct stat statbuf {};
-  int err = fstat(fd, &statbuf);
-  if (err) {
-    throw std::runtime_error(
-        fmt::format("Failed to stat {} for size", filepath));
+  ~MappedElf() {
+    munmap(image_, size_);
+    close(fd_);
+  }
+
+  MappedElf(const MappedElf&) = delete;
+  MappedElf& operator=(const MappedElf&) = delete;
+
+  char* image() const {
+    return image_;
+  }
+
+  size_t size() const {
+    return size_;
+  }
+
+  ElfClass elf_class() const {
+    return static_cast<ElfClass>(image_[EI_CLASS]);
+  }
+
+ private:
+  int fd_{-1};
+  size_t size_{0};
+  char* image_{nullptr};
+};
+
+size_t align4(size_t size) {
+  return (size + 3) & ~static_cast<size_t>(3);
+}
+
+// Return the API digest embedded in the image by `linkcache --embed-apid`, or
+// an empty string if there is none. Only the section headers, the section
+// name table and the note itself are touched.
+template <class Traits>
+std::string get_embedded_digest_from_image(char* image, size_t size) {
+  ElfFile<Traits> elf_file{image};
+  auto* header = elf_file.get_header();
+  if (header->e_shoff == 0 || header->e_shstrndx >= header->e_shnum ||
+      header->e_shoff + header->e_shnum * sizeof(typename Traits::Shdr) >
+          size) {
+    return {};
+  }
+
+  typename Traits::Shdr* names_scn = elf_file.get_section(header->e_shstrndx);
+  char* names = elf_file.get_section_data(names_scn->sh_offset);
+  for (auto& shdr : elf_file.iter_shdr()) {
+    if (shdr.sh_type != SHT_NOTE ||
+        std::strcmp(&names[shdr.sh_name], kApidNoteSection) != 0) {
+      continue;
+    }
+    char* note_ptr = elf_file.get_section_data(shdr.sh_offset);
+    char* section_end = note_ptr + shdr.sh_size;
+    while (note_ptr + sizeof(Nhdr) <= section_end) {
+      Nhdr* nhdr = reinterpret_cast<Nhdr*>(note_ptr);
+      char* name = note_ptr + sizeof(Nhdr);
+      char* desc = name + align4(nhdr->n_namesz);
+      if (desc + nhdr->n_descsz > section_end) {
+        break;
+      }
+      if (nhdr->n_type == kNtLinkhashApid &&
+          nhdr->n_namesz == sizeof(kApidNoteName) &&
+          std::memcmp(name, kApidNoteName, sizeof(kApidNoteName)) == 0) {
+        return std::string(desc, nhdr->n_descsz);
+      }
+      note_ptr = desc + align4(nhdr->n_descsz);
+    }
+  }
+  return {};
+}
+
+std::vector<std::string> get_api(const std::string filepath, int api_version) {
+  MappedElf elf{filepath};
+  switch (elf.elf_class()) {
+    case ELF32:
+      return get_api_from_image<Traits32>(elf.image(), api_version);
+    case ELF64:
+      return get_api_from_image<Traits64>(elf.image(), api_version);
+    default:
+      throw std::runtime_error(
+          fmt::format("Unexpected elf_class: {}", elf.elf_class()));
+  }
+}
+
+// Format a digest as a string, prefixed by the API model version
+std::string format_digest(const unsigned char digest[SHA_DIGEST_LENGTH],
+                          int api_version) {
+  std::stringstream strm{};
+  if (api_version < 2) {
+    // NOTE(josh): version 1 digests are written without zero-padding. This
+    // is preserved so that existing digests remain valid.
+    for (size_t idx = 0; idx < SHA_DIGEST_LENGTH; idx++) {
+      strm << std::hex << static_cast<int>(digest[idx]);
+    }
+  } else {
+    strm << "v" << api_version << "-";
+    for (size_t idx = 0; idx < SHA_DIGEST_LENGTH; idx++) {
+      strm << std::hex << std::setw(2) << std::setfill('0')
+           << static_cast<int>(digest[idx]);
+    }
+  }
+  return strm.str();
+}
+
+// Return the API digest of `api` (which must be sorted) as a string
+std::string get_digest(const std::vector<std::string>& api, int api_version) {
+  SHA_CTX sha_ctx{};
+  SHA1_Init(&sha_ctx);
+  for (const std::string& entry : api) {
+    SHA1_Update(&sha_ctx, entry.data(), entry.size());
+    SHA1_Update(&sha_ctx, "\n", 1);
+  }
+
+  unsigned char digest[SHA_DIGEST_LENGTH];
+  SHA1_Final(digest, &sha_ctx);
+  return format_digest(digest, api_version);
+}
+
+// Return the API digest embedded in the shared object at `filepath` if there
+// is one and it was computed with `api_version`, otherwise an empty string.
+std::string get_embedded_digest(const std::string& filepath, int api_version) {
+  MappedElf elf{filepath};
+  std::string digest{};
+  switch (elf.elf_class()) {
+    case ELF32:
+      digest =
+          get_embedded_digest_from_image<Traits32>(elf.image(), elf.size());
+      break;
+    case ELF64:
+      digest =
+          get_embedded_digest_from_image<Traits64>(elf.image(), elf.size());
+      break;
+    default:
+      return {};
   }
 
-  void* mem =
-      mmap(nullptr, statbuf.st_size, PROT_READ, MAP_SHARED, fd, /*offset=*/0);
-  if (!mem) {
-    throw std::runtime_error(fmt::format("Can't map the file {}", filepath));
+  // NOTE(josh): version 1 digests have no version prefix
+  std::string prefix = fmt::format("v{}-", api_version);
+  bool matches = (api_version < 2)
+                     ? (digest.find('-') == std::string::npos)
+                     : (digest.compare(0, prefix.size(), prefix) == 0);
+  if (!matches) {
+    return {};
+  }
+  return digest;
+}
+
+// Return the API digest of the shared object at `filepath` as a string. If
+// `use_embedded` is true and the shared object has an embedded digest of the
+// same API model, then return that instead of recomputing it.
+std::string get_digest(const std::string& filepath, int api_version,
+                       bool use_embedded) {
+  if (use_embedded) {
+    std::string embedded = get_embedded_digest(filepath, api_version);
+    if (!embedded.empty()) {
+      return embedded;
+    }
   }
-  Loki::ScopeGuard _unmap = Loki::MakeGuard(munmap, mem, statbuf.st_size);
 
-  char* image = static_cast<char*>(mem);
-  if (std::memcmp(image, ELFMAG, 4) != 0) {
-    throw std::runtime_error(fmt::format("File {} has wrong magic", filepath));
+  if (api_version < 3) {
+    std::vector<std::string> api = get_api(filepath, api_version);
+    std::sort(api.begin(), api.end());
+    return get_digest(api, api_version);
   }
 
-  ElfClass elf_class = static_cast<ElfClass>(image[EI_CLASS]);
-  switch (elf_class) {
+  unsigned char digest[SHA_DIGEST_LENGTH];
+  MappedElf elf{filepath};
+  switch (elf.elf_class()) {
     case ELF32:
-      return get_api_from_image<Traits32>(image);
+      get_streaming_digest_from_image<Traits32>(elf.image(), digest);
+      break;
     case ELF64:
-      return get_api_from_image<Traits64>(image);
+      get_streaming_digest_from_image<Traits64>(elf.image(), digest);
+      break;
     default:
       throw std::runtime_error(
-          fmt::format("Unexpected elf_class: {}", elf_class));
+          fmt::format("Unexpected elf_class: {}", elf.elf_class()));
   }
+  return format_digest(digest, api_version);
+}
+
+// Compute the digest of `filepath` and write a `path digest` line to
+// `outstream`. If the digest can't be computed then the digest is written as
+// `-` and the reason is written to stderr. Return true on success.
+bool write_batch_entry(const std::string& filepath, int api_version,
+                       bool use_embedded, std::ostream* outstream) {
+  std::string digest{};
+  try {
+    digest = get_digest(filepath, api_version, use_embedded);
+  } catch (const std::runtime_error& err) {
+    std::cerr << err.what() << "\n";
+    (*outstream) << filepath << " -\n";
+    return false;
+  }
+  (*outstream) << filepath << " " << digest << "\n";
+  return true;
 }
 
 struct ProgramOptions {
-  std::string infilepath;
+  std::vector<std::string> infilepaths;
   std::string outfilepath;
   bool dump_api;
+  bool batch;
+  bool serve;
+  bool ignore_embedded;
+  int api_version;
 };
 
 int main(int argc, char** argv) {
@@ -138,16 +735,40 @@ of externally visable symbols).
   using argue::keywords::default_;
   using argue::keywords::dest;
   using argue::keywords::help;
+  using argue::keywords::nargs;
   // clang-format off
   parser.add_argument(
     "-o", "--outfile", dest=&progopts.outfilepath, default_=std::string("-"),
     help="Path to the file to write. '-' means write to stdout (default)");
   parser.add_argument(
-    "filepath", dest=&progopts.infilepath);
+    "filepath", nargs="*", dest=&progopts.infilepaths,
+    help="Shared object(s) to digest. Exactly one unless --batch is given");
   parser.add_argument(
     "--dump-api", action="store_true", dest=&progopts.dump_api,
     help="If specified, then write out the API specification rather than"
          " it's hash");
+  parser.add_argument(
+    "--api-version", dest=&progopts.api_version,
+    default_=kDefaultApiVersion,
+    help="Version of the API model to compute. Version 1 includes all global"
+         " and weak entries of the first symbol table. Version 2 (default)"
+         " includes only the defined, exported symbols of .dynsym with their"
+         " version, type and size. Version 3 digests the same symbols in a"
+         " single streaming pass, for very large libraries");
+  parser.add_argument(
+    "--batch", action="store_true", dest=&progopts.batch,
+    help="Digest each filepath, or each path read from stdin (one per line)"
+         " if there are none, and write a `path digest` line for each");
+  parser.add_argument(
+    "--serve", action="store_true", dest=&progopts.serve,
+    help="Run as a coprocess: read one path per line from stdin and respond"
+         " with one `path digest` line, flushed immediately, until stdin is"
+         " closed");
+  parser.add_argument(
+    "--ignore-embedded", action="store_true",
+    dest=&progopts.ignore_embedded,
+    help="Always compute the digest from the symbol table, even if one is"
+         " embedded in the shared object");
   // clang-format on
 
   int parse_result = parser.parse_args(argc, argv);
@@ -160,27 +781,82 @@ of externally visable symbols).
       break;
   }
 
-  std::vector<std::string> api;
-  try {
-    api = get_api(progopts.infilepath);
-  } catch (const std::runtime_error& err) {
-    std::cerr << err.what() << "\n";
+  if (progopts.api_version < 1 || progopts.api_version > kMaxApiVersion) {
+    std::cerr << fmt::format("Unsupported --api-version {}, expected 1-{}\n",
+                             progopts.api_version, kMaxApiVersion);
     exit(1);
   }
 
-  std::sort(api.begin(), api.end());
+  bool multi = progopts.batch || progopts.serve;
+  bool use_embedded = !progopts.ignore_embedded;
+  if (multi && progopts.dump_api) {
+    std::cerr << "--dump-api can't be combined with --batch or --serve\n";
+    exit(1);
+  }
+  if (progopts.serve && !progopts.infilepaths.empty()) {
+    std::cerr << "--serve reads paths from stdin, not the command line\n";
+    exit(1);
+  }
+  if (!multi && progopts.infilepaths.size() != 1) {
+    std::cerr << "Expected exactly one filepath, use --batch for more\n";
+    exit(1);
+  }
 
   int outfd{0};
   if (progopts.outfilepath == "-") {
     outfd = dup(STDOUT_FILENO);
   } else {
-    outfd = open(progopts.outfilepath.c_str(), O_WRONLY | O_CREAT, 0655);
+    outfd = open(progopts.outfilepath.c_str(), O_WRONLY | O_CREAT | O_TRUNC,
+                 0655);
   }
 
   __gnu_cxx::stdio_filebuf<char> filebuf{outfd, std::ios::out};
   std::ostream outstream{&filebuf};
 
+  if (progopts.serve) {
+    // NOTE(josh): failures are reported in-band so that the client never
+    // blocks waiting for a response that isn't coming.
+    std::string filepath{};
+    while (std::getline(std::cin, filepath)) {
+      if (filepath.empty()) {
+        continue;
+      }
+      write_batch_entry(filepath, progopts.api_version, use_embedded,
+                        &outstream);
+      outstream.flush();
+    }
+    exit(0);
+  }
+
+  if (progopts.batch) {
+    bool ok = true;
+    if (progopts.infilepaths.empty()) {
+      std::string filepath{};
+      while (std::getline(std::cin, filepath)) {
+        if (!filepath.empty()) {
+          ok &= write_batch_entry(filepath, progopts.api_version,
+                                  use_embedded, &outstream);
+        }
+      }
+    }
+    for (const std::string& filepath : progopts.infilepaths) {
+      ok &= write_batch_entry(filepath, progopts.api_version, use_embedded,
+                              &outstream);
+    }
+    outstream.flush();
+    exit(ok ? 0 : 1);
+  }
+
   if (progopts.dump_api) {
+    std::vector<std::string> api;
+    try {
+      api = get_api(progopts.infilepaths[0], progopts.api_version);
+    } catch (const std::runtime_error& err) {
+      std::cerr << err.what() << "\n";
+      exit(1);
+    }
+
+    std::sort(api.begin(), api.end());
     for (std::string& entry : api) {
       outstream << entry << "\n";
     }
@@ -188,20 +864,15 @@ of externally visable symbols).
     exit(0);
   }
 
-  SHA_CTX sha_ctx{};
-  SHA1_Init(&sha_ctx);
-  for (std::string& entry : api) {
-    SHA1_Update(&sha_ctx, &entry[0], entry.size());
-    SHA1_Update(&sha_ctx, "\n", 1);
-  }
-
-  unsigned char digest[SHA_DIGEST_LENGTH];
-  SHA1_Final(digest, &sha_ctx);
-
-  for (size_t idx = 0; idx < SHA_DIGEST_LENGTH; idx++) {
-    outstream << std::hex << static_cast<int>(digest[idx]);
+  std::string digest{};
+  try {
+    digest = get_digest(progopts.infilepaths[0], progopts.api_version,
+                        use_embedded);
+  } catch (const std::runtime_error& err) {
+    std::cerr << err.what() << "\n";
+    exit(1);
   }
-  outstream << "\n";
+  outstream << digest << "\n";
   outstream.flush();
   exit(0);
 }
@@ -0,0 +1,104 @@
+"""
+Managed cache directory for incremental ThinLTO. A miss of a ThinLTO link
+(`-flto=thin`) repeats the code generation of every module, which can take
+minutes, even when only a few of them changed. LLVM can cache the result of
+each backend job, keyed by the content of the module and everything that
+affects it, but only if the linker is told where. linkcache adds the options
+of that cache to the command it executes on a miss, pointing to `lto/` in the
+cache directory, so that a relink only repeats the code generation of the
+modules which changed.
+
+The options are added to the executed command only, after the execspec is
+computed, so they never affect the cache key. The cache is pruned by the
+linker itself, after each link, according to the policy given with it: entries
+not used for `--lto-cache-age` days are removed, and then the least recently
+used entries until the cache is within `--lto-cache-size`.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import logging
+import os
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# Substrings of the arguments with which a build configures it's own cache,
+# in which case it is left alone
+CACHE_OPTIONS = ["thinlto-cache-dir", "cache-dir=", "cache_path_lto"]
+
+
+def is_thin_lto(subcommand):
+  """Return true if the link command performs ThinLTO."""
+  thin = False
+  for arg in subcommand[1:]:
+    if arg == "-flto=thin":
+      thin = True
+    elif arg.startswith("-flto") or arg == "-fno-lto":
+      # NOTE(josh): the last of the -flto options wins
+      thin = False
+  return thin
+
+
+def uses_lld(subcommand):
+  """Return true if the clang driver is directed to link with lld."""
+  for arg in subcommand[1:]:
+    for prefix in ("-fuse-ld=", "--ld-path="):
+      if arg.startswith(prefix) and "lld" in os.path.basename(
+          arg[len(prefix):]):
+        return True
+  return False
+
+
+def get_cache_dir(options):
+  # NOTE(josh): absolute, since the linker may run in another directory
+  return os.path.abspath(os.path.join(linkcache.get_cachedir(options), "lto"))
+
+
+def get_policy(options):
+  """Return the LLVM cache pruning policy for the limits in `options`."""
+  return "prune_after={}s:cache_size_bytes={}".format(
+      int(options.lto_cache_age * 24 * 3600), options.lto_cache_size)
+
+
+def get_cache_args(subcommand, options):
+  """
+  Return the arguments to append to the link command `subcommand` so that
+  the linker uses the managed ThinLTO cache, or an empty list if it isn't a
+  ThinLTO link, or if the build already configures a cache.
+  """
+  if not is_thin_lto(subcommand):
+    return []
+  # NOTE(josh): only clang's ThinLTO has a cache which is configured through
+  # the linker. GCC's -flto-incremental is too new to inject blindly, since
+  # an older GCC would fail the link.
+  if "clang" not in os.path.basename(subcommand[0]):
+    logger.debug("Not a clang link, no LTO cache for %s", subcommand[0])
+    return []
+  if any(option in arg for arg in subcommand for option in CACHE_OPTIONS):
+    logger.debug("The link command configures it's own LTO cache")
+    return []
+
+  cachedir = get_cache_dir(options)
+  if not os.path.isdir(cachedir):
+    try:
+      os.makedirs(cachedir)
+    except OSError:
+      if not os.path.isdir(cachedir):
+        logger.warning("failed to create LTO cache directory %s", cachedir)
+        return []
+
+  policy = get_policy(options)
+  if uses_lld(subcommand):
+    return [
+        "-Wl,--thinlto-cache-dir=" + cachedir,
+        "-Wl,--thinlto-cache-policy=" + policy,
+    ]
+  # NOTE(josh): the LLVMgold plugin (used with ld.bfd and gold) takes these
+  # options, and lld accepts them as aliases of it's own, so they are used
+  # when the linker isn't known to be lld
+  return [
+      "-Wl,-plugin-opt=cache-dir=" + cachedir,
+      "-Wl,-plugin-opt=cache-policy=" + policy,
+  ]
@@ -0,0 +1,440 @@
+"""
+Reconstruct the critical path of the last build from it's `.ninja_log`, and
+attribute it's time to compiling, linking and linkcache, to tell whether the
+links are on the critical path of the build and what the cache saves.
+
+ninja appends an entry to `.ninja_log` as each edge completes: it's start and
+end time (milliseconds since the build started), the mtime and path of the
+output, and a hash of the command. The entries of every build accumulate in
+one file, and those of the last build are the ones after the end times last
+go backwards. The log is read one line at a time, keeping only the edges of
+the build being read, so logs of millions of entries take a few seconds.
+
+The log doesn't record dependencies, so the critical path is reconstructed
+from the timing alone: starting from the edge which completed last, the
+predecessor of each edge is the one which completed latest before it started.
+That is the chain of edges the build waited on, whether for a dependency or
+for a free job slot.
+
+Links executed by linkcache with `--decision-log` are matched with the record
+of their decision, which splits the duration of the edge between the linker
+and linkcache: a hit is entirely linkcache, a miss is the linker plus the
+overhead of the check. The saving of a hit is estimated as the average
+duration of the linker in the misses of that output in the decision log (or
+the CPU time recorded in it's cacheinfo) less the duration of the hit.
+Without a decision log, links are recognized by the name of their output and
+their time is attributed to linking.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import bisect
+import io
+import json
+import logging
+import os
+import sys
+
+from linkhash import churn
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+COMPILE_SUFFIXES = (".o", ".obj", ".gch", ".pch", ".pcm")
+LINK_SUFFIXES = (".so", ".dylib", ".dll", ".exe")
+
+# Categories to which time is attributed, in the order they are reported
+CATEGORIES = ("compile", "link", "linkcache", "other", "idle")
+
+# Seconds by which a decision record may fall outside of the edge it belongs
+# to, since neither clock is read exactly when the edge starts or ends
+MATCH_SLACK = 2.0
+
+
+class Edge(object):
+  """An edge of the build, i.e. one command and the outputs it wrote."""
+
+  __slots__ = ("start", "end", "outputs", "kind", "decision")
+
+  def __init__(self, start, end, output):
+    # Milliseconds since the start of the build
+    self.start = start
+    self.end = end
+    self.outputs = [output]
+    self.kind = None
+    # The decision record of linkcache for this edge, if there is one
+    self.decision = None
+
+  @property
+  def duration(self):
+    return self.end - self.start
+
+
+def get_output_kind(output):
+  """Return the kind of edge ("compile", "link" or "other") of `output`."""
+  name = os.path.basename(output)
+  if name.endswith(COMPILE_SUFFIXES):
+    return "compile"
+  if name.endswith(LINK_SUFFIXES) or ".so." in name:
+    return "link"
+  # NOTE(josh): executables usually don't have an extension, and ninja
+  # doesn't log phony edges
+  if "." not in name:
+    return "link"
+  return "other"
+
+
+def read_last_build(infile):
+  """
+  Return the edges of the last build in the `.ninja_log` open as `infile`
+  (any version from 4), as a list of `Edge`.
+  """
+  # NOTE(josh): the entries of earlier builds are only split, so that a log
+  # of many builds is mostly skipped
+  entries = []
+  last_end = -1
+  for line in infile:
+    fields = line.split("\t", 4)
+    if len(fields) < 4:
+      continue
+    try:
+      end = int(fields[1])
+    except ValueError:
+      continue
+    if end < last_end:
+      entries = []
+    last_end = end
+    entries.append(fields)
+
+  edges = {}
+  for fields in entries:
+    try:
+      start = int(fields[0])
+    except ValueError:
+      continue
+    end = int(fields[1])
+    output = fields[3].rstrip("\n")
+    # NOTE(josh): an edge with several outputs has an entry for each, with the
+    # same times and command hash. Version 4 doesn't record the hash.
+    key = (start, end, fields[4] if len(fields) > 4 else output)
+    edge = edges.get(key)
+    if edge is None:
+      edges[key] = Edge(start, end, output)
+    else:
+      edge.outputs.append(output)
+  return list(edges.values())
+
+
+def read_decisions(infile, outputs, get_window):
+  """
+  Read the decision log open as `infile`. Attach to each edge the last
+  record of it's output (a key of `outputs`) which falls within the window of
+  time, given by `get_window(edge)`, in which it ran. Return a map from each
+  output to the (count, total seconds) of the linker in it's misses.
+  """
+  linktimes = {}
+  for line in infile:
+    try:
+      record = json.loads(line)
+      edge = outputs.get(record["output"])
+    except (ValueError, KeyError, TypeError):
+      continue
+    if edge is None:
+      continue
+    if record.get("decision") == "miss" and "link" in record:
+      count, total = linktimes.get(record["output"], (0, 0.0))
+      linktimes[record["output"]] = (count + 1, total + record["link"])
+    start, end = get_window(edge)
+    if start - MATCH_SLACK <= record.get("time", 0) <= end + MATCH_SLACK:
+      edge.decision = record
+  return linktimes
+
+
+def get_critical_path(edges):
+  """
+  Return the critical path through `edges`, from the first edge to the one
+  which completed last.
+  """
+  if not edges:
+    return []
+  edges = sorted(edges, key=lambda edge: edge.end)
+  ends = [edge.end for edge in edges]
+  idx = len(edges) - 1
+  path = [edges[idx]]
+  while True:
+    # NOTE(josh): bounded by the index of the current edge, so that an edge
+    # which took no time isn't it's own predecessor
+    idx = bisect.bisect_right(ends, path[-1].start, 0, idx) - 1
+    if idx < 0:
+      break
+    path.append(edges[idx])
+  path.reverse()
+  return path
+
+
+def split_edge(edge):
+  """
+  Return a map from category to the milliseconds of `edge` attributed to
+  it.
+  """
+  duration = edge.duration
+  if edge.kind != "link":
+    return {edge.kind: duration}
+  record = edge.decision
+  if record is None:
+    return {"link": duration}
+  decision = record.get("decision")
+  if decision == "hit":
+    return {"linkcache": duration}
+  if decision == "bypass":
+    overhead = min(duration, int(record.get("check", 0) * 1000))
+    return {"link": duration - overhead, "linkcache": overhead}
+  link = min(duration, int(record.get("link", 0) * 1000))
+  return {"link": link, "linkcache": duration - link}
+
+
+def read_link_cost(outpath):
+  """
+  Return the average CPU seconds of the linker recorded in the cacheinfo of
+  `outpath`, or None.
+  """
+  try:
+    with io.open(outpath + ".cacheinfo", "r", encoding="utf-8") as infile:
+      return json.load(infile)["costs"]["link"]
+  except (IOError, OSError, ValueError, KeyError, TypeError):
+    return None
+
+
+def get_savings(edge, outpath, linktimes):
+  """
+  Return the (estimated milliseconds of the linker, milliseconds saved) for
+  the link `edge`. A hit saves the link less it's own duration, anything else
+  costs the overhead of linkcache. Either may be None if unknown.
+  """
+  record = edge.decision
+  if record is None:
+    return None, None
+  estimate = None
+  if outpath in linktimes:
+    count, total = linktimes[outpath]
+    estimate = int(total * 1000 / count)
+  else:
+    cost = read_link_cost(outpath)
+    if cost is not None:
+      estimate = int(cost * 1000)
+  if record.get("decision") != "hit":
+    return estimate, -split_edge(edge).get("linkcache", 0)
+  if estimate is None:
+    return None, None
+  return estimate, estimate - edge.duration
+
+
+def seconds(milliseconds):
+  return None if milliseconds is None else round(milliseconds / 1000.0, 3)
+
+
+def get_report(logpath, decisionpath, top):
+  """Return the analysis of the last build in `logpath` as a json object."""
+  builddir = os.path.dirname(os.path.realpath(logpath))
+  with io.open(logpath, "r", encoding="utf-8", errors="replace") as infile:
+    edges = read_last_build(infile)
+
+  for edge in edges:
+    edge.kind = get_output_kind(edge.outputs[0])
+
+  # NOTE(josh): the end of the last edge is about when ninja last wrote the
+  # log, which maps the times of the log onto the clock of the records
+  build_end = max(edge.end for edge in edges) if edges else 0
+  log_mtime = os.stat(logpath).st_mtime
+
+  def get_window(edge):
+    return (log_mtime - (build_end - edge.start) / 1000.0,
+            log_mtime - (build_end - edge.end) / 1000.0)
+
+  linktimes = {}
+  if decisionpath is not None and os.path.exists(decisionpath):
+    outputs = {}
+    for edge in edges:
+      for output in edge.outputs:
+        outputs[os.path.normpath(os.path.join(builddir, output))] = edge
+    with io.open(decisionpath, "r", encoding="utf-8",
+                 errors="replace") as infile:
+      linktimes = read_decisions(infile, outputs, get_window)
+  elif decisionpath is not None:
+    logger.warning("Decision log %s doesn't exist", decisionpath)
+  for edge in edges:
+    if edge.decision is not None:
+      edge.kind = "link"
+
+  path = get_critical_path(edges)
+  critical = set(id(edge) for edge in path)
+  critical_totals = dict.fromkeys(CATEGORIES, 0)
+  previous_end = 0
+  for edge in path:
+    critical_totals["idle"] += max(0, edge.start - previous_end)
+    previous_end = edge.end
+    for category, milliseconds in split_edge(edge).items():
+      critical_totals[category] += milliseconds
+
+  build_totals = dict.fromkeys(CATEGORIES[:-1], 0)
+  counts = dict.fromkeys(("hit", "miss", "bypass", "unknown"), 0)
+  overhead = 0
+  saved = 0
+  saved_critical = 0
+  targets = []
+  for edge in edges:
+    split = split_edge(edge)
+    for category, milliseconds in split.items():
+      build_totals[category] += milliseconds
+    if edge.kind != "link":
+      continue
+    decision = "unknown"
+    if edge.decision is not None:
+      decision = edge.decision.get("decision", "unknown")
+    counts[decision] = counts.get(decision, 0) + 1
+    overhead += split.get("linkcache", 0)
+    outpath = os.path.normpath(os.path.join(builddir, edge.outputs[0]))
+    estimate, edge_saved = get_savings(edge, outpath, linktimes)
+    if edge_saved is not None:
+      saved += edge_saved
+      if id(edge) in critical:
+        saved_critical += edge_saved
+    targets.append({
+        "output": edge.outputs[0],
+        "decision": decision,
+        "duration": seconds(edge.duration),
+        "linkcache": seconds(split.get("linkcache", 0)),
+        "link_estimate": seconds(estimate),
+        "saved": seconds(edge_saved),
+        "critical": id(edge) in critical,
+    })
+  targets.sort(key=lambda target: (
+      -(target["saved"] or 0), -target["duration"], target["output"]))
+
+  return {
+      "log": logpath,
+      "decision_log": decisionpath,
+      "edges": len(edges),
+      "wall": seconds(build_end),
+      "jobs": seconds(sum(edge.duration for edge in edges)),
+      "build": {
+          category: seconds(milliseconds)
+          for category, milliseconds in build_totals.items()},
+      "critical_path": {
+          "duration": seconds(path[-1].end if path else 0),
+          "attribution": {
+              category: seconds(milliseconds)
+              for category, milliseconds in critical_totals.items()},
+          "steps": [{
+              "start": seconds(edge.start),
+              "end": seconds(edge.end),
+              "kind": edge.kind,
+              "decision": (
+                  edge.decision.get("decision")
+                  if edge.decision is not None else None),
+              "output": edge.outputs[0],
+          } for edge in path],
+      },
+      "links": dict(
+          counts, overhead=seconds(overhead), saved=seconds(saved),
+          saved_on_critical_path=seconds(saved_critical)),
+      "targets": targets[:top],
+  }
+
+
+def format_seconds(value):
+  return "-" if value is None else "{:.3f}s".format(value)
+
+
+def write_text(report, outfile):
+  outfile.write(
+      "Last build: {} edges in {}, {} of jobs\n".format(
+          report["edges"], format_seconds(report["wall"]),
+          format_seconds(report["jobs"])))
+  outfile.write("Critical path: {} through {} edges\n\n".format(
+      format_seconds(report["critical_path"]["duration"]),
+      len(report["critical_path"]["steps"])))
+
+  attribution = report["critical_path"]["attribution"]
+  churn.format_rows(
+      ("", "CRITICAL PATH", "WHOLE BUILD"),
+      [(category, format_seconds(attribution[category]),
+        format_seconds(report["build"].get(category)))
+       for category in CATEGORIES], outfile)
+
+  links = report["links"]
+  outfile.write(
+      "\nLinks: {} hit, {} miss, {} bypass, {} unknown\n".format(
+          links["hit"], links["miss"], links["bypass"], links["unknown"]))
+  outfile.write(
+      "Overhead {}, estimated saving {} ({} on the critical path)\n\n".format(
+          format_seconds(links["overhead"]), format_seconds(links["saved"]),
+          format_seconds(links["saved_on_critical_path"])))
+
+  churn.format_rows(
+      ("SAVED", "DURATION", "LINKCACHE", "DECISION", "CRITICAL", "OUTPUT"),
+      [(format_seconds(target["saved"]), format_seconds(target["duration"]),
+        format_seconds(target["linkcache"]), target["decision"],
+        "yes" if target["critical"] else "", target["output"])
+       for target in report["targets"]], outfile)
+
+  outfile.write("\n")
+  churn.format_rows(
+      ("START", "END", "KIND", "DECISION", "OUTPUT"),
+      [(format_seconds(step["start"]), format_seconds(step["end"]),
+        step["kind"], step["decision"] or "", step["output"])
+       for step in report["critical_path"]["steps"]], outfile)
+
+
+def setup_argparser(argparser):
+  argparser.add_argument(
+      "path", nargs="?", default=".",
+      help="Build directory, or path of the .ninja_log. Default: the current"
+           " directory")
+  argparser.add_argument(
+      "--decision-log", metavar="PATH",
+      help="Decision log written by linkcache. Default: the --decision-log of"
+           " linkcache, if any")
+  argparser.add_argument(
+      "--top", type=int, default=20,
+      help="Number of links to report, by estimated saving")
+  argparser.add_argument(
+      "--json", action="store_true",
+      help="Write a machine readable report instead of tables")
+
+
+def main(argv, options=None):
+  argparser = argparse.ArgumentParser(
+      prog="linkcache ninjalog", description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  setup_argparser(argparser)
+  args = argparser.parse_args(argv)
+  if options is not None:
+    linkcache.logger.set_level(options.log_level)
+  linkcache.logger.get_logger()
+
+  logpath = args.path
+  if os.path.isdir(logpath):
+    logpath = os.path.join(logpath, ".ninja_log")
+  decisionpath = args.decision_log
+  if decisionpath is None and options is not None:
+    decisionpath = options.decision_log
+
+  try:
+    report = get_report(logpath, decisionpath, args.top)
+  except (IOError, OSError) as ex:
+    logger.error("Failed to read %s: %s", logpath, ex)
+    return 1
+
+  if args.json:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+  else:
+    write_text(report, sys.stdout)
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,652 @@
+"""
+Evaluate and execute every link of a build in one process. Each invocation of
+linkcache sees a single link command, so the hundreds of links of a build each
+pay for python startup, stat the same system libraries and parse their own
+sidecars. Given the link commands of the whole build, this instead evaluates
+them in dependency order sharing one cache of stat results and API digests,
+and executes only the misses, several at once.
+
+A consumer is only evaluated once the links that produce it's inputs have
+completed, so when a library is relinked and it's fresh API digest is
+unchanged, the consumer is found to be a hit without spawning anything, and so
+on downstream.
+
+The link commands are read from the output of `ninja -t commands` or, for
+any CMake generator, located with the CMake file API. Only links executed
+through linkcache (e.g. enabled by `activate_linkcache()`) are considered,
+and other commands (e.g. compiles) are ignored, so run this once the objects
+are up to date.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import glob
+import heapq
+import io
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+from concurrent import futures
+
+from linkhash import apidigest
+from linkhash import explain
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+LINKCACHE_NAMES = ("linkcache", "linkcache.py")
+
+# Decisions other than "hit" that a link may end with, in the order they are
+# summarized
+DECISIONS = ("linked", "failed", "skipped", "miss", "pending", "unknown")
+
+# Target types of the CMake file API which are produced by a link
+LINKED_TARGET_TYPES = ("EXECUTABLE", "SHARED_LIBRARY", "MODULE_LIBRARY")
+
+
+def get_name_stem(outpath):
+  """
+  Return the prefix shared by the basename of `outpath` and the names of the
+  files which change when it is linked: it's sidecars and, for a versioned
+  shared object (e.g. libfoo.so.1.2), the symlinks to it (e.g. libfoo.so).
+  """
+  basename = os.path.basename(outpath)
+  idx = basename.find(".so.")
+  if idx >= 0:
+    return basename[:idx + len(".so")]
+  return basename
+
+
+def get_link_keys(outpath):
+  """
+  Return the paths by which the consumers of a link output may name it.
+  """
+  out = [outpath]
+  stem = get_name_stem(outpath)
+  if stem != os.path.basename(outpath):
+    out.append(os.path.join(os.path.dirname(outpath), stem))
+  return out
+
+
+def iter_input_keys(subcommand, cwd):
+  """
+  Yield the normalized path of each input of the link command which may be
+  the output of another link: shared objects named directly, or found for a
+  `-l` flag in a `-L` directory.
+  """
+  libdirs = []
+  libnames = []
+  idx = 0
+  while idx < len(subcommand):
+    arg = subcommand[idx]
+    if arg in ("-L", "-l") and idx + 1 < len(subcommand):
+      idx += 1
+      arg += subcommand[idx]
+    if arg.startswith("-L"):
+      libdirs.append(os.path.normpath(os.path.join(cwd, arg[2:])))
+    elif arg.startswith("-l"):
+      libnames.append(arg[2:])
+    elif not arg.startswith("-") and linkcache.is_library_name(arg):
+      yield os.path.normpath(os.path.join(cwd, arg))
+    idx += 1
+
+  for name in libnames:
+    for libdir in libdirs:
+      yield os.path.join(libdir, "lib{}.so".format(name))
+
+
+class Link(object):
+  """One link command of the plan, and the outcome of it."""
+
+  def __init__(self, index, options, cwd, statcache, shell=None, post=None):
+    self.index = index
+    self.options = options
+    self.cwd = cwd
+    self.ctx = linkcache.Context(
+        options.subcommand, options, cwd=cwd, statcache=statcache)
+    self.outfile = self.ctx.get_output()
+    self.outpath = None
+    if self.outfile is not None:
+      self.outpath = os.path.normpath(os.path.join(cwd, self.outfile))
+    # If not None, the whole command line, which is executed by the shell in
+    # place of the link command on a miss, because it does more than link
+    # (e.g. runs another launcher) in ways we can't replicate.
+    self.shell = shell
+    # If not None, a shell command to run after the link succeeds (e.g. the
+    # creation of symlinks to a versioned shared object).
+    self.post = post
+    # Id of the CMake target, if the link was found with the file API
+    self.target_id = None
+    self.producers = set()
+    self.consumers = []
+    self.lock = None
+    # Links whose outcome determines ours: any link upstream that was
+    # relinked, and the first producer which failed or (without executing)
+    # might be relinked.
+    self.relinked_producers = []
+    self.blocking_producer = None
+    self.result = {
+        "output": self.outpath or " ".join(options.subcommand),
+        "decision": "unknown",
+        "reason": None,
+        "blocker": None,
+        "details": [],
+    }
+
+  def __lt__(self, other):
+    return self.index < other.index
+
+
+def make_link(index, tokens, cwd, statcache, line):
+  """
+  Return a Link for the shell command `line` (already split into `tokens`)
+  executed in `cwd`, or None if it is not a link executed through linkcache.
+  """
+  segments = [[]]
+  for token in tokens:
+    if token == "&&":
+      segments.append([])
+    else:
+      segments[-1].append(token)
+
+  basedir = cwd
+  prologue = True
+  shell = None
+  for segidx, segment in enumerate(segments):
+    if not segment or segment == [":"]:
+      continue
+    if len(segment) == 2 and segment[0] == "cd" and prologue:
+      cwd = os.path.normpath(os.path.join(cwd, segment[1]))
+      continue
+    launcher = [
+        idx for idx, token in enumerate(segment)
+        if os.path.basename(token) in LINKCACHE_NAMES]
+    if not launcher:
+      prologue = False
+      continue
+    idx = launcher[0]
+    options = linkcache.fast_parse_args(segment[idx + 1:])
+    if options is None or options.subcommand[0] in linkcache.TOOLS:
+      return None
+
+    # NOTE(josh): linkcache may only be preceded by the interpreter which runs
+    # it. Anything else (e.g. another launcher, or a command chained ahead of
+    # the link) is left to the shell.
+    interpreter = segment[:idx]
+    if not prologue or len(interpreter) > 1 or (
+        interpreter
+        and not os.path.basename(interpreter[0]).startswith("python")) or any(
+            token in ("||", ";", "|", "&") for token in tokens):
+      shell = "cd {} && {}".format(shlex.quote(basedir), line)
+    post = None
+    epilogue = [
+        seg for seg in segments[segidx + 1:] if seg and seg != [":"]]
+    if epilogue and shell is None:
+      post = " && ".join(
+          " ".join(shlex.quote(token) for token in seg) for seg in epilogue)
+    return Link(index, options, cwd, statcache, shell=shell, post=post)
+  return None
+
+
+def read_ninja_commands(infile, builddir, statcache):
+  """
+  Return a Link for each link executed through linkcache among the commands
+  of `infile` (the output of `ninja -t commands`, one command per line,
+  executed in `builddir`).
+  """
+  out = []
+  for line in infile:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      tokens = shlex.split(line)
+    except ValueError:
+      logger.warning("Ignoring command which can't be parsed: %s", line)
+      continue
+    link = make_link(len(out), tokens, builddir, statcache, line)
+    if link is not None:
+      out.append(link)
+  return out
+
+
+def read_json(filepath):
+  with io.open(filepath, "r", encoding="utf-8") as infile:
+    return json.load(infile)
+
+
+def read_file_api(builddir, statcache, config=None):
+  """
+  Return a Link for each linked target of the CMake file API reply in
+  `builddir`, and a dictionary mapping the id of each such target to the ids
+  of the targets it depends on. The file API doesn't include the link command
+  itself, so it is taken from the cacheinfo of the last link of each target.
+  Targets which haven't yet been linked through linkcache are skipped.
+  """
+  replydir = os.path.join(builddir, ".cmake", "api", "v1", "reply")
+  indices = sorted(glob.glob(os.path.join(replydir, "index-*.json")))
+  if not indices:
+    raise ValueError(
+        "No CMake file API reply in {}. Create an empty file at"
+        " .cmake/api/v1/query/codemodel-v2 and re-run cmake".format(builddir))
+
+  codemodel = None
+  for obj in read_json(indices[-1]).get("objects", []):
+    if obj.get("kind") == "codemodel" and obj["version"]["major"] == 2:
+      codemodel = read_json(os.path.join(replydir, obj["jsonFile"]))
+  if codemodel is None:
+    raise ValueError("The CMake file API reply doesn't include a codemodel")
+
+  configs = codemodel["configurations"]
+  if config is not None:
+    configs = [cfg for cfg in configs if cfg["name"] == config]
+    if not configs:
+      raise ValueError("No configuration named {}".format(config))
+
+  out = []
+  dependencies = {}
+  for entry in configs[0]["targets"]:
+    target = read_json(os.path.join(replydir, entry["jsonFile"]))
+    if target["type"] not in LINKED_TARGET_TYPES:
+      continue
+    for artifact in target.get("artifacts", []):
+      cacheinfopath = os.path.join(builddir, artifact["path"]) + ".cacheinfo"
+      try:
+        invocation = read_json(cacheinfopath)["invocation"]
+      except (IOError, OSError, ValueError, KeyError, TypeError):
+        continue
+      options = linkcache.fast_parse_args(invocation["argv"])
+      if options is None:
+        continue
+      outfile = linkcache.Context(options.subcommand).get_output() or ""
+      cwd = explain.get_link_cwd(cacheinfopath, outfile, invocation["cwd"])
+      link = Link(len(out), options, cwd, statcache)
+      link.target_id = target["id"]
+      out.append(link)
+      dependencies[target["id"]] = [
+          dep["id"] for dep in target.get("dependencies", [])]
+      break
+    else:
+      logger.debug("Target %s hasn't been linked by linkcache", target["name"])
+  return out, dependencies
+
+
+def connect(links, dependencies=None):
+  """
+  Record, for each link, the links which produce it's inputs, either as found
+  in it's command or as given by `dependencies` (a dictionary mapping target id
+  to the ids of it's dependencies).
+  """
+  producers = {}
+  for link in links:
+    if link.outpath is None:
+      continue
+    for key in get_link_keys(link.outpath):
+      producers.setdefault(key, link)
+
+  by_target = {
+      link.target_id: link for link in links if link.target_id is not None}
+
+  for link in links:
+    found = set(
+        producers.get(key) for key in iter_input_keys(
+            link.options.subcommand, link.cwd))
+    if dependencies and link.target_id is not None:
+      found.update(
+          by_target.get(dep) for dep in dependencies.get(link.target_id, []))
+    found.discard(None)
+    found.discard(link)
+    link.producers = found
+    for producer in found:
+      producer.consumers.append(link)
+
+
+class DigestCache(object):
+  """
+  Digesters (see `apidigest.get_digester()`) shared by every link of the plan,
+  one for each API model, memoizing the digest of each file.
+  """
+
+  def __init__(self):
+    self.digesters = {}
+    self.memo = {}
+
+  def get(self, options):
+    key = tuple(linkcache.get_linkhash_args(options))
+    if key not in self.digesters:
+      digester = apidigest.get_digester(linkcache.find_linkhash(), options)
+      if digester is not None:
+        digester = MemoizingDigester(digester, key, self.memo)
+      self.digesters[key] = digester
+    return self.digesters[key]
+
+  def close(self):
+    for digester in self.digesters.values():
+      if digester is not None:
+        digester.close()
+    self.digesters.clear()
+
+
+class MemoizingDigester(object):
+  """Wraps a digester such that each version of a file is digested once."""
+
+  def __init__(self, digester, key, memo):
+    self.digester = digester
+    self.key = key
+    self.memo = memo
+
+  def get_apid(self, sopath):
+    try:
+      statbuf = os.stat(sopath)
+    except OSError:
+      return None
+    memokey = (self.key, linkcache.get_file_id(statbuf), statbuf.st_size,
+               statbuf.st_mtime_ns)
+    if memokey not in self.memo:
+      self.memo[memokey] = self.digester.get_apid(sopath)
+    return self.memo[memokey]
+
+  def dump_api(self, sopath):
+    return self.digester.dump_api(sopath)
+
+  def close(self):
+    self.digester.close()
+
+
+def execute(link):
+  """
+  Execute the link command (or it's whole command line) and return a tuple of
+  the exit status and the resource usage of the process.
+  """
+  if link.shell is not None:
+    proc = subprocess.Popen(link.shell, shell=True, cwd=link.cwd)
+  else:
+    proc = subprocess.Popen(link.ctx.get_link_command(), cwd=link.cwd)
+  # NOTE(josh): wait4() rather than wait() so that the memory and CPU time of
+  # this linker are measured apart from the others running at the same time.
+  _, status, rusage = os.wait4(proc.pid, 0)
+  proc.returncode = linkcache.get_exit_status(status)
+  if proc.returncode == 0 and link.post is not None:
+    return subprocess.call(link.post, shell=True, cwd=link.cwd), rusage
+  return proc.returncode, rusage
+
+
+class Planner(object):
+  """Evaluates the links of a plan in dependency order, executing misses."""
+
+  def __init__(self, links, jobs, dry_run=False):
+    self.links = links
+    self.jobs = jobs
+    self.dry_run = dry_run
+    self.digests = DigestCache()
+
+  def forget(self, link):
+    """Drop cached stats of the files changed by executing `link`."""
+    stem = get_name_stem(link.outpath)
+    link.ctx.statcache.forget(
+        lambda path: os.path.basename(path).startswith(stem))
+
+  def hit(self, link):
+    ctx = link.ctx
+    logger.debug("Cache hit, touching %s", link.outpath)
+    os.utime(ctx.resolve(ctx.outfile), None)
+    ctx.refresh_cacheinfo()
+    link.result["decision"] = "hit"
+    if link.relinked_producers:
+      link.result["reason"] = "cascaded"
+      link.result["details"] = [
+          "{} was relinked without a change in API".format(producer.outpath)
+          for producer in link.relinked_producers]
+
+  def evaluate(self, link):
+    """
+    Decide whether `link` is a hit. Return true if it must be executed, in
+    which case the output lock is held.
+    """
+    ctx = link.ctx
+    if link.blocking_producer is not None:
+      producer = link.blocking_producer
+      if producer.result["decision"] in ("miss", "pending"):
+        link.result["decision"] = "pending"
+        link.result["reason"] = "producer-miss"
+      else:
+        link.result["decision"] = "skipped"
+        link.result["reason"] = "producer-failed"
+      link.result["blocker"] = producer.outpath
+      return False
+
+    if ctx.cache_hit():
+      self.hit(link)
+      return False
+
+    link.result["reason"] = ctx.miss_reason
+    link.result["blocker"] = ctx.blocker
+    if self.dry_run or ctx.outfile is None:
+      link.result["decision"] = "miss"
+      return False
+    if link.shell is not None:
+      # NOTE(josh): linkcache, within the command line, takes the lock
+      return True
+
+    link.lock = ctx.lock()
+    link.lock.__enter__()
+    if ctx.cacheinfo_changed():
+      # Another process completed the same link since we evaluated it
+      self.forget(link)
+      if ctx.cache_hit():
+        self.release_lock(link)
+        self.hit(link)
+        return False
+    # NOTE(josh): fingerprint the toolchain before it runs, see linkcache
+    ctx.recompute_execspec()
+    ctx.remove_cacheinfo()
+    return True
+
+  def release_lock(self, link):
+    if link.lock is not None:
+      link.lock.__exit__(None, None, None)
+      link.lock = None
+
+  def complete(self, link, returncode, rusage):
+    """Maintain the sidecars of `link` after executing it."""
+    ctx = link.ctx
+    try:
+      if link.shell is not None:
+        # NOTE(josh): linkcache, within the command line, maintained the
+        # sidecars.
+        pass
+      elif returncode != 0:
+        ctx.remove_sidecars()
+      else:
+        ctx.peak_rss = rusage.ru_maxrss * 1024
+        ctx.link_time = rusage.ru_utime + rusage.ru_stime
+        digester = self.digests.get(link.options)
+        if digester is None:
+          # NOTE(josh): we can't maintain the sidecars without linkhash, so
+          # make sure that whatever we have won't be trusted later.
+          ctx.remove_sidecars()
+        else:
+          if ctx.is_shared_output():
+            ctx.write_apid(digester)
+          ctx.write_cacheinfo()
+          ctx.record_relink()
+    finally:
+      self.release_lock(link)
+      self.forget(link)
+
+    if returncode == 0:
+      link.result["decision"] = "linked"
+    else:
+      link.result["decision"] = "failed"
+      link.result["details"] = ["exited with status {}".format(returncode)]
+
+  def release(self, link, ready):
+    """Make the consumers of `link` ready once all their producers are."""
+    decision = link.result["decision"]
+    for consumer in link.consumers:
+      if decision == "linked":
+        consumer.relinked_producers.append(link)
+      elif decision == "hit":
+        # NOTE(josh): a hit which follows a relink upstream is itself a result
+        # of that relink, and so are the hits which follow it.
+        consumer.relinked_producers.extend(
+            producer for producer in link.relinked_producers
+            if producer not in consumer.relinked_producers)
+      elif decision in ("miss", "pending", "failed", "skipped"):
+        if consumer.blocking_producer is None:
+          consumer.blocking_producer = link
+      consumer.producers.discard(link)
+      if not consumer.producers:
+        heapq.heappush(ready, consumer)
+
+  def run(self):
+    # NOTE(josh): links in a cycle (which a build can't have, but an
+    # approximate graph might) are made ready in the order they were given.
+    ready = [link for link in self.links if not link.producers]
+    heapq.heapify(ready)
+    started = set()
+    done = set()
+    running = {}
+    pool = futures.ThreadPoolExecutor(max_workers=max(1, self.jobs))
+    try:
+      while len(done) < len(self.links):
+        while ready:
+          link = heapq.heappop(ready)
+          if link in started:
+            continue
+          started.add(link)
+          if self.evaluate(link):
+            logger.info("Linking %s (%s)", link.outpath, link.ctx.miss_reason)
+            running[pool.submit(execute, link)] = link
+          else:
+            done.add(link)
+            self.release(link, ready)
+
+        if running:
+          finished, _ = futures.wait(
+              running, return_when=futures.FIRST_COMPLETED)
+          for future in finished:
+            link = running.pop(future)
+            try:
+              returncode, rusage = future.result()
+            except OSError as ex:
+              returncode, rusage = 127, None
+              logger.error("Failed to execute %s: %s", link.outpath, ex)
+            self.complete(link, returncode, rusage)
+            done.add(link)
+            self.release(link, ready)
+        elif len(done) < len(self.links):
+          remaining = [link for link in self.links if link not in started]
+          logger.warning(
+              "Dependency cycle among %d links", len(remaining))
+          heapq.heappush(ready, min(remaining))
+    finally:
+      pool.shutdown(wait=True)
+      self.digests.close()
+    return [link.result for link in self.links]
+
+
+def get_summary(results):
+  summary = explain.get_summary(results)
+  summary["cascaded"] = sum(
+      1 for result in results if result["reason"] == "cascaded")
+  return summary
+
+
+def setup_argparser(argparser):
+  source = argparser.add_mutually_exclusive_group(required=True)
+  source.add_argument(
+      "--commands", metavar="PATH",
+      help="File containing the output of `ninja -t commands`, or - to read"
+           " it from stdin")
+  source.add_argument(
+      "--file-api", metavar="BUILDDIR",
+      help="Build tree configured by CMake with a codemodel-v2 file API"
+           " query")
+  argparser.add_argument(
+      "-C", "--directory", default=os.getcwd(),
+      help="Directory in which the commands are executed, i.e. the build"
+           " directory. Default: the current directory")
+  argparser.add_argument(
+      "--config", default=None,
+      help="With --file-api, the configuration to plan for multi-config"
+           " generators. Default: the first")
+  argparser.add_argument(
+      "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+      help="Number of links to execute concurrently")
+  argparser.add_argument(
+      "-n", "--dry-run", action="store_true",
+      help="Only evaluate the links, don't execute any")
+  argparser.add_argument(
+      "--json", action="store_true",
+      help="Write a machine readable report instead of a table")
+  argparser.add_argument(
+      "--all", action="store_true",
+      help="Include hits in the table, not just links which were executed")
+  argparser.add_argument(
+      "--max-details", type=int, default=20,
+      help="Maximum number of detail lines to print for each link")
+
+
+def main(argv, options=None):
+  argparser = argparse.ArgumentParser(
+      prog="linkcache plan", description=__doc__)
+  setup_argparser(argparser)
+  args = argparser.parse_args(argv)
+  # NOTE(josh): configure logging now so that messages of this module, and of
+  # the contexts we evaluate, honor --log-level
+  if options is not None:
+    linkcache.logger.set_level(options.log_level)
+  linkcache.logger.get_logger()
+
+  statcache = linkcache.StatCache()
+  dependencies = None
+  try:
+    if args.file_api is not None:
+      links, dependencies = read_file_api(
+          os.path.abspath(args.file_api), statcache, args.config)
+    elif args.commands == "-":
+      links = read_ninja_commands(
+          sys.stdin, os.path.abspath(args.directory), statcache)
+    else:
+      with io.open(args.commands, "r", encoding="utf-8") as infile:
+        links = read_ninja_commands(
+            infile, os.path.abspath(args.directory), statcache)
+  except (IOError, OSError, ValueError, KeyError) as ex:
+    logger.error("Failed to read the link commands: %s", ex)
+    return 1
+
+  for link in links:
+    # NOTE(josh): a check costs far less here than in it's own process, so
+    # outputs which are cheaper to link than to check by linkcache alone are
+    # still checked.
+    link.options.no_bypass = True
+  connect(links, dependencies)
+  results = Planner(links, args.jobs, args.dry_run).run()
+  summary = get_summary(results)
+
+  if args.json:
+    json.dump(
+        {"summary": summary, "outputs": results}, sys.stdout, indent=2,
+        sort_keys=True)
+    sys.stdout.write("\n")
+  else:
+    if not args.all:
+      results = [result for result in results if result["decision"] != "hit"]
+    explain.format_table(results, args.max_details, sys.stdout)
+    counts = [
+        "{} {}".format(summary[decision], decision) for decision in DECISIONS
+        if summary.get(decision)]
+    sys.stdout.write("\n{} outputs: {} hit ({} cascaded){}\n".format(
+        summary["outputs"], summary.get("hit", 0), summary["cascaded"],
+        "".join(", " + count for count in counts)))
+  return 1 if summary.get("failed") or summary.get("skipped") else 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
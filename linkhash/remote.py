@@ -0,0 +1,892 @@
+"""
+Execute the links which miss on remote workers. With `--remote-worker`, the
+link is dispatched to the worker which can start it soonest, and is executed
+locally if no worker can take it, the worker stops responding for
+`--remote-timeout` seconds, or the link fails remotely (so that any error
+reported is that of the local link).
+
+A worker is started with `linkcache worker`, either as a TCP server:
+
+  linkcache worker --listen 0.0.0.0:7823 --jobs 32
+
+and used with `--remote-worker buildhost:7823`, or over ssh, in which case
+each link starts a worker which serves it on it's stdin and stdout:
+
+  linkcache --remote-worker ssh://user@buildhost/opt/linkhash/bin/linkcache
+
+Files are shipped content-addressed: the client offers the sha256 of each
+input and only uploads those which the worker doesn't have in it's blob
+store. Digests are memoized by the client in `remote/digests.json` of the
+cache directory, keyed by the identity of each file, so unchanged inputs
+aren't read again. The worker links in a sandbox where each directory of
+`--build-root`, `--source-root` and `--path-prefix` (or the working
+directory, if none of them contain it) is mapped to a directory of it's own,
+and the output is streamed back and replaced atomically.
+
+A worker only executes a compiler driver or linker whose toolchain it
+reported to the client (so not a program shipped with the inputs), and
+rejects a link with an argument naming a path outside of the sandbox (e.g.
+`-o /anywhere`), or one which makes the driver or linker search for programs
+or load plugins (e.g. `-B<dir>`, `-fuse-ld=<path>` or `-plugin`), which
+could be shipped with the inputs; such a link is executed locally. Shipped
+files are never executable. The worker doesn't authenticate it's clients, so
+a TCP worker must only listen on a trusted network.
+
+Only inputs within those directories are shipped: the files named on the
+command line, the libraries found for `-l` in `-L` directories, and the
+inputs named by linker scripts. Anything else (the system libraries) must be
+the same on the worker. A link is only dispatched to a worker which resolves
+the same toolchain (see `linkhash.toolchain`), and workers are ranked by the
+time to upload the inputs they lack plus the time they are expected to queue
+the link behind the ones they are already running.
+
+The protocol is a sequence of messages, each a json header prefixed by it's
+length as a 4 byte big-endian integer, followed by the number of raw bytes
+given by the "size" of the header:
+
+  -> {"op": "status", "argv": [...], "blobs": [...]}
+  <- {"running": N, "slots": N, "missing": [...], "toolchain": {...}}
+  -> {"op": "put", "digest": D, "size": N} + content   (for each missing blob)
+  <- {"ok": true}
+  -> {"op": "link", "argv": [...], "cwd": ..., "roots": [...], "files": [...],
+      "outputs": [...]}
+  <- {"op": "running"}                                 (every HEARTBEAT seconds)
+  <- {"op": "result", "status": N, "cpu": S, "peak_rss": N, "stdout": ...,
+      "stderr": ..., "outputs": N}
+  <- {"op": "output", "path": ..., "mode": N, "size": N} + content
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from linkhash import linkcache
+from linkhash import toolchain
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 7823
+
+# Seconds to wait for a connection to a worker
+CONNECT_TIMEOUT = 5.0
+
+# Seconds between the messages a worker sends while a link is running, so that
+# the client can tell a long link from a worker which stopped responding
+HEARTBEAT = 2.0
+
+# Seconds between checks of whether a link has exited, on the worker
+POLL_INTERVAL = 0.05
+
+# Estimated rate (bytes per second) at which inputs are uploaded to a worker,
+# and time (seconds) of a link which has never been measured, used to rank
+# workers
+TRANSFER_RATE = 50 << 20
+DEFAULT_LINK_ESTIMATE = 10.0
+
+# Size of the chunks in which files are streamed
+CHUNK_SIZE = 1 << 20
+
+# Largest json header accepted
+MAX_HEADER_SIZE = 64 << 20
+
+# Arguments of a compiler driver which make it search for programs or load
+# plugins other than those of it's toolchain. Any `-B<prefix>` does too (e.g.
+# the `ld` it searches for in `-B<dir>`), as does `-fuse-ld=<path>`.
+DRIVER_SEARCH_FLAGS = (
+    "--ld-path=", "-specs=", "--specs=", "--gcc-toolchain=", "-gcc-toolchain",
+    "-fplugin")
+
+# Arguments of a linker which load plugins
+LINKER_PLUGIN_FLAGS = ("-plugin", "--plugin")
+
+# The `-B` flags of a linker, which (unlike those of a driver) don't search
+# for anything
+LINKER_B_FLAGS = frozenset([
+    "-Bdynamic", "-Bstatic", "-Bshareable", "-Bgroup", "-Bsymbolic",
+    "-Bsymbolic-functions", "-Bno-symbolic", "-Bsymbolic-non-weak-functions",
+    "-Bsymbolic-non-weak"])
+
+
+class ProtocolError(Exception):
+  pass
+
+
+class Channel(object):
+  """Framed messages (see the module documentation) over a pair of streams."""
+
+  def __init__(self, reader, writer, name, closer=None):
+    self.reader = reader
+    self.writer = writer
+    self.name = name
+    self.closer = closer
+
+  def send(self, header):
+    self.write_header(dict(header, size=0))
+    self.writer.flush()
+
+  def send_file(self, header, path):
+    """Send `header` followed by the content of the file at `path`."""
+    with io.open(path, "rb") as infile:
+      header = dict(header, size=os.fstat(infile.fileno()).st_size)
+      self.write_header(header)
+      remaining = header["size"]
+      while remaining > 0:
+        chunk = infile.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+          raise ProtocolError("{} changed while it was sent".format(path))
+        self.writer.write(chunk)
+        remaining -= len(chunk)
+    self.writer.flush()
+
+  def write_header(self, header):
+    content = json.dumps(header, sort_keys=True).encode("utf-8")
+    self.writer.write(struct.pack(">I", len(content)) + content)
+
+  def read_exactly(self, size):
+    content = self.reader.read(size)
+    if content is None or len(content) != size:
+      raise ProtocolError("connection to {} was closed".format(self.name))
+    return content
+
+  def recv(self):
+    """Return the header of the next message."""
+    (size,) = struct.unpack(">I", self.read_exactly(4))
+    if size > MAX_HEADER_SIZE:
+      raise ProtocolError("message of {} bytes from {}".format(size, self.name))
+    try:
+      header = json.loads(self.read_exactly(size).decode("utf-8"))
+    except ValueError:
+      raise ProtocolError("malformed message from {}".format(self.name))
+    if not isinstance(header, dict):
+      raise ProtocolError("malformed message from {}".format(self.name))
+    return header
+
+  def recv_to_file(self, header, outfile):
+    """
+    Stream the payload of `header` to the file object `outfile` and return
+    it's sha256.
+    """
+    digest = hashlib.sha256()
+    remaining = header.get("size", 0)
+    while remaining > 0:
+      chunk = self.read_exactly(min(CHUNK_SIZE, remaining))
+      digest.update(chunk)
+      outfile.write(chunk)
+      remaining -= len(chunk)
+    return digest.hexdigest()
+
+  def request(self, header):
+    self.send(header)
+    reply = self.recv()
+    if "error" in reply:
+      raise ProtocolError("{}: {}".format(self.name, reply["error"]))
+    return reply
+
+  def close(self):
+    if self.closer is not None:
+      self.closer()
+
+
+def parse_address(spec):
+  """Return the (host, port) of a worker address `host[:port]`."""
+  host, _, port = spec.rpartition(":")
+  if not host or not port.isdigit():
+    return spec, DEFAULT_PORT
+  return host.strip("[]"), int(port)
+
+
+def connect(spec, timeout):
+  """
+  Return a `Channel` to the worker `spec` (`host[:port]` or
+  `ssh://[user@]host[/path/to/linkcache]`), or None if it can't be reached.
+  Reads time out after `timeout` seconds.
+  """
+  try:
+    if spec.startswith("ssh://"):
+      host, sep, path = spec[len("ssh://"):].partition("/")
+      program = sep + path if path else "linkcache"
+      # NOTE(josh): the worker is given one end of a socket pair as it's
+      # stdin and stdout, so that reads from it can time out
+      sock, peer = socket.socketpair()
+      proc = subprocess.Popen(
+          ["ssh", "-o", "BatchMode=yes", "-o",
+           "ConnectTimeout={}".format(int(CONNECT_TIMEOUT)), host, program,
+           "worker", "--stdio"],
+          stdin=peer, stdout=peer)
+      peer.close()
+
+      def closer():
+        sock.close()
+        try:
+          proc.wait(timeout=CONNECT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+          proc.kill()
+          proc.wait()
+    else:
+      sock = socket.create_connection(parse_address(spec), CONNECT_TIMEOUT)
+      closer = sock.close
+    sock.settimeout(timeout)
+  except (OSError, ValueError) as ex:
+    logger.warning("Can't reach worker %s: %s", spec, ex)
+    return None
+  return Channel(
+      sock.makefile("rb"), sock.makefile("wb"), spec, closer=closer)
+
+
+# ---------------------------------------------------------------------------
+# Client
+# ---------------------------------------------------------------------------
+
+
+def get_roots(ctx):
+  """
+  Return the `(prefix, placeholder)` pairs of the directories which are
+  mapped into the sandbox of a worker. See `linkcache.get_path_prefixes()`.
+  """
+  roots = linkcache.get_path_prefixes(ctx.options, ctx.cwd)
+  cwd = os.path.abspath(ctx.cwd or os.getcwd())
+  if not any(is_within(cwd, prefix) for prefix, _ in roots):
+    roots.append((cwd, "${CWD}"))
+  return roots
+
+
+def is_within(path, prefix):
+  return path == prefix or path.startswith(os.path.join(prefix, ""))
+
+
+def get_arg_paths(arg):
+  """
+  Return the paths named by the link argument `arg` which may be outside of
+  the working directory: absolute paths, and relative paths with a `..`
+  component. A path may be the argument itself, the value of an option
+  (`--opt=/path`, `-L/path`, `@/path`), or an item of a list
+  (`-Wl,-rpath,/path`).
+  """
+  out = []
+  for piece in arg.replace("=", ",").split(","):
+    if piece.startswith("@"):
+      piece = piece[1:]
+    elif piece.startswith("-") and not piece.startswith("--"):
+      piece = piece[2:]
+    if os.path.isabs(piece) or ".." in piece.split(os.sep):
+      out.append(piece)
+  return out
+
+
+def find_libraries(command, resolve):
+  """
+  Return the paths of the libraries which the `-l` arguments of `command`
+  name, found in it's `-L` directories.
+  """
+  linker_args = command[1:]
+  if toolchain.is_driver(command[0]):
+    linker_args = linker_args + toolchain.get_linker_args(command[1:])
+  searchdirs = []
+  names = []
+  static = False
+  for idx, arg in enumerate(linker_args):
+    if arg == "-L" and idx + 1 < len(linker_args):
+      searchdirs.append(linker_args[idx + 1])
+    elif arg.startswith("-L"):
+      searchdirs.append(arg[2:])
+    elif arg in ("-static", "-Bstatic"):
+      static = True
+    elif arg in ("-Bdynamic", "-call_shared"):
+      static = False
+    elif arg.startswith("-l") and len(arg) > 2:
+      names.append((arg[2:], static))
+
+  out = []
+  for name, static in names:
+    if name.startswith(":"):
+      candidates = [name[1:]]
+    elif static:
+      candidates = ["lib{}.a".format(name)]
+    else:
+      candidates = ["lib{}.so".format(name), "lib{}.a".format(name)]
+    for searchdir in searchdirs:
+      found = [os.path.join(searchdir, candidate) for candidate in candidates
+               if os.path.exists(resolve(os.path.join(searchdir, candidate)))]
+      if found:
+        out.append(found[0])
+        break
+  return out
+
+
+def find_search_arg(argv):
+  """
+  Return the first argument of the link command `argv` which makes the
+  driver or linker execute or load a program other than those of it's
+  toolchain (see `DRIVER_SEARCH_FLAGS`), or None.
+  """
+  is_driver = toolchain.is_driver(argv[0])
+  for arg in argv[1:]:
+    if arg.startswith("-B"):
+      if is_driver or arg not in LINKER_B_FLAGS:
+        return arg
+    elif arg.startswith("-fuse-ld=") and os.sep in arg:
+      return arg
+    elif is_driver and arg.startswith(DRIVER_SEARCH_FLAGS):
+      return arg
+    # NOTE(josh): the value of a `-Xlinker` is checked as an argument of it's
+    # own, and the flags of a `-Wl,` one by one
+    pieces = arg.split(",")[1:] if arg.startswith("-Wl,") else [arg]
+    if any(piece.startswith(LINKER_PLUGIN_FLAGS) for piece in pieces):
+      return arg
+  return None
+
+
+def get_files(ctx, command, roots):
+  """
+  Return the absolute paths of the existing inputs of `command` which are
+  within the `roots`, including the inputs named by linker scripts.
+  """
+  queue = list(ctx.get_input_args()) + find_libraries(command, ctx.resolve)
+  queue = [os.path.abspath(ctx.resolve(path)) for path in queue]
+  out = []
+  seen = set()
+  while queue:
+    path = queue.pop(0)
+    if path in seen:
+      continue
+    seen.add(path)
+    if not any(is_within(path, prefix) for prefix, _ in roots):
+      continue
+    statbuf = linkcache.stat_or_none(path)
+    if statbuf is None or not os.path.isfile(path):
+      continue
+    out.append(path)
+    if linkcache.get_input_kind(path, statbuf) == "ldscript":
+      queue.extend(
+          os.path.abspath(name)
+          for name in linkcache.get_ldscript_inputs(path, statbuf))
+  return out
+
+
+def get_score(status, missing_bytes, link_estimate):
+  """
+  Return the estimated seconds until a worker with `status` could complete a
+  link, given the bytes of inputs it lacks. Lower is better.
+  """
+  slots = max(1, status.get("slots", 1))
+  queued = max(0, status.get("running", 0) + 1 - slots)
+  return (missing_bytes / float(TRANSFER_RATE)
+          + link_estimate * queued / float(slots))
+
+
+def choose_worker(candidates, sizes, link_estimate):
+  """
+  Return the candidate (a tuple of the worker's channel and status) which is
+  expected to complete the link soonest, preferring the least loaded worker
+  among equals.
+  """
+  def rank(candidate):
+    _, status = candidate
+    missing_bytes = sum(sizes.get(digest, 0) for digest in status["missing"])
+    load = status.get("running", 0) / float(max(1, status.get("slots", 1)))
+    return (get_score(status, missing_bytes, link_estimate), load)
+
+  return min(candidates, key=rank)
+
+
+def get_link_estimate(ctx):
+  costs = (ctx.cacheinfo or {}).get("costs", {})
+  return costs.get("link", DEFAULT_LINK_ESTIMATE)
+
+
+def get_digest_table(options):
+  return toolchain.FingerprintTable(os.path.join(
+      linkcache.get_cachedir(options), "remote", "digests.json"))
+
+
+def save_table(table):
+  if not table.changed:
+    return
+  try:
+    if not os.path.isdir(os.path.dirname(table.path)):
+      os.makedirs(os.path.dirname(table.path))
+    linkcache.write_atomic(table.path, table.serialize() + b"\n")
+  except OSError:
+    logger.warning("failed to memoize input digests in %s", table.path)
+
+
+def receive_outputs(channel, reply, outputs):
+  """
+  Receive the outputs which follow the `reply` of a link into temporary files
+  next to the `outputs` (a map of the paths in the request to local paths),
+  and return the list of (temporary path, local path).
+  """
+  received = []
+  try:
+    for _ in range(reply.get("outputs", 0)):
+      header = channel.recv()
+      if header.get("op") != "output" or header.get("path") not in outputs:
+        raise ProtocolError("unexpected message from {}".format(channel.name))
+      outpath = outputs[header["path"]]
+      fd, temppath = tempfile.mkstemp(
+          dir=os.path.dirname(outpath) or ".",
+          prefix=os.path.basename(outpath) + ".remote-")
+      received.append((temppath, outpath))
+      with os.fdopen(fd, "wb") as outfile:
+        channel.recv_to_file(header, outfile)
+      os.chmod(temppath, header.get("mode", 0o644) & 0o7777)
+  except:
+    for temppath, _ in received:
+      os.unlink(temppath)
+    raise
+  return received
+
+
+def dispatch(ctx, command):
+  """
+  Execute the link `command` of `ctx` on the best worker of
+  `--remote-worker`. Return the exit status, or None if the link must be
+  executed locally.
+  """
+  search_arg = find_search_arg(command)
+  if search_arg is not None:
+    logger.debug("%s may execute a program shipped to the worker",
+                 search_arg)
+    return None
+
+  options = ctx.options
+  roots = get_roots(ctx)
+  normalize = linkcache.get_path_normalizer(roots)
+  outputs = {}
+  for output in ctx.get_outputs():
+    outpath = os.path.abspath(ctx.resolve(output))
+    if not any(is_within(outpath, prefix) for prefix, _ in roots):
+      logger.debug("%s is outside of the directories mapped to the worker",
+                   output)
+      return None
+    outputs[normalize(outpath)] = outpath
+
+  expect = linkcache.get_toolchain_fingerprint(command, options, ctx.cwd)
+  if not expect:
+    logger.debug("Toolchain of the link can't be fingerprinted")
+    return None
+
+  table = get_digest_table(options)
+  files = []
+  sources = {}
+  sizes = {}
+  for path in get_files(ctx, command, roots):
+    digest = table.get_digest(path)
+    if digest is None:
+      continue
+    statbuf = os.stat(path)
+    files.append([normalize(path), digest, statbuf.st_mode & 0o7777])
+    sources[digest] = path
+    sizes[digest] = statbuf.st_size
+  save_table(table)
+
+  argv = [normalize(arg) for arg in command]
+  for arg in argv[1:]:
+    if any(os.path.isabs(path) for path in get_arg_paths(arg)):
+      logger.debug("%s names a path outside of the directories mapped to the"
+                   " worker", arg)
+      return None
+  candidates = []
+  for spec in options.remote_worker:
+    channel = connect(spec, options.remote_timeout)
+    if channel is None:
+      continue
+    try:
+      status = channel.request(
+          {"op": "status", "argv": argv, "blobs": sorted(sources)})
+    except (OSError, ProtocolError) as ex:
+      logger.warning("Worker %s didn't respond: %s", spec, ex)
+      channel.close()
+      continue
+    if status.get("toolchain") != expect:
+      logger.info("Worker %s has a different toolchain", spec)
+      channel.close()
+      continue
+    candidates.append((channel, status))
+  if not candidates:
+    logger.debug("No worker can execute the link")
+    return None
+
+  channel, status = choose_worker(candidates, sizes, get_link_estimate(ctx))
+  for other, _ in candidates:
+    if other is not channel:
+      other.close()
+
+  twall = time.time()
+  received = []
+  try:
+    for digest in status["missing"]:
+      if digest in sources:
+        channel.send_file({"op": "put", "digest": digest}, sources[digest])
+        if "error" in channel.recv():
+          raise ProtocolError("{} rejected {}".format(
+              channel.name, sources[digest]))
+    logger.debug("Uploaded %d of %d inputs to %s", len(status["missing"]),
+                 len(files), channel.name)
+
+    channel.send({
+        "op": "link",
+        "argv": argv,
+        "cwd": normalize(os.path.abspath(ctx.cwd or os.getcwd())),
+        "roots": [placeholder for _, placeholder in roots],
+        "files": files,
+        "outputs": sorted(outputs),
+    })
+    while True:
+      reply = channel.recv()
+      if reply.get("op") != "running":
+        break
+    if reply.get("op") != "result":
+      raise ProtocolError(reply.get("error", "unexpected reply"))
+    received = receive_outputs(channel, reply, outputs)
+  except (OSError, ProtocolError) as ex:
+    logger.warning("Remote link on %s failed (%s), linking locally",
+                   channel.name, ex)
+    return None
+  finally:
+    channel.close()
+
+  if reply["status"] != 0:
+    logger.info("Link failed on %s, linking locally", channel.name)
+    for temppath, _ in received:
+      os.unlink(temppath)
+    return None
+
+  for temppath, outpath in received:
+    os.rename(temppath, outpath)
+  for stream, key in ((sys.stdout, "stdout"), (sys.stderr, "stderr")):
+    text = reply.get(key, "")
+    for prefix, placeholder in roots:
+      text = text.replace(placeholder, prefix)
+    stream.write(text)
+  ctx.link_wall_time = time.time() - twall
+  ctx.link_time = reply.get("cpu")
+  ctx.peak_rss = reply.get("peak_rss")
+  logger.debug("Linked remotely on %s", channel.name)
+  return 0
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+
+
+class Worker(object):
+  """The blob store and job slots of a worker, shared by it's connections."""
+
+  def __init__(self, workdir, slots, options):
+    self.workdir = workdir
+    self.slots = slots
+    self.options = options
+    self.running = 0
+    self.lock = threading.Lock()
+    self.semaphore = threading.Semaphore(slots)
+    for subdir in ("blobs", "jobs"):
+      if not os.path.isdir(os.path.join(workdir, subdir)):
+        os.makedirs(os.path.join(workdir, subdir))
+
+  def get_blobpath(self, digest):
+    if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+      raise ProtocolError("invalid digest {!r}".format(digest))
+    return os.path.join(self.workdir, "blobs", digest[:2], digest[2:])
+
+  def status(self, request):
+    # NOTE(josh): the sandbox doesn't exist yet, so the placeholders are left
+    # in place. A program within the sandbox can't be fingerprinted, and a
+    # link which runs one isn't dispatched.
+    missing = [digest for digest in request.get("blobs", [])
+               if not os.path.exists(self.get_blobpath(digest))]
+    with self.lock:
+      running = self.running
+    return {
+        "running": running,
+        "slots": self.slots,
+        "missing": missing,
+        "toolchain": linkcache.get_toolchain_fingerprint(
+            request["argv"], self.options),
+    }
+
+  def put(self, channel, header):
+    blobpath = self.get_blobpath(header.get("digest", ""))
+    blobdir = os.path.dirname(blobpath)
+    if not os.path.isdir(blobdir):
+      os.makedirs(blobdir, exist_ok=True)
+    fd, temppath = tempfile.mkstemp(dir=blobdir)
+    try:
+      with os.fdopen(fd, "wb") as outfile:
+        digest = channel.recv_to_file(header, outfile)
+      if digest != header["digest"]:
+        os.unlink(temppath)
+        return {"error": "content doesn't match digest {}".format(digest)}
+      os.rename(temppath, blobpath)
+    except:
+      if os.path.exists(temppath):
+        os.unlink(temppath)
+      raise
+    return {"ok": True}
+
+  def check_program(self, argv, toolchains):
+    """
+    Raise ProtocolError unless the program of `argv` is a compiler driver or
+    linker whose toolchain (`toolchains`, by program) was reported to the
+    client by `status()`, it is still the same, and no argument makes it
+    search for other programs (see `find_search_arg()`).
+    """
+    program = argv[0]
+    if not (toolchain.is_driver(program) or toolchain.is_linker(program)):
+      raise ProtocolError(
+          "program {!r} isn't a compiler driver or linker".format(program))
+    if os.sep in program and not os.path.isabs(program):
+      # NOTE(josh): this would be fingerprinted relative to the working
+      # directory of the worker, but executed in the sandbox
+      raise ProtocolError("program {!r} is relative".format(program))
+    search_arg = find_search_arg(argv)
+    if search_arg is not None:
+      raise ProtocolError(
+          "argument {!r} may execute a shipped program".format(search_arg))
+    expect = toolchains.get(program)
+    if not expect or "program" not in expect:
+      raise ProtocolError(
+          "program {!r} wasn't fingerprinted".format(program))
+    if linkcache.get_toolchain_fingerprint(argv, self.options) != expect:
+      raise ProtocolError(
+          "toolchain of {!r} isn't the one reported".format(program))
+
+  def link(self, channel, request, toolchains):
+    """
+    Execute a link request in a sandbox, and send the result. `toolchains`
+    are those reported to the client, see `check_program()`.
+    """
+    self.check_program(request["argv"], toolchains)
+    with self.semaphore:
+      with self.lock:
+        self.running += 1
+      jobdir = tempfile.mkdtemp(dir=os.path.join(self.workdir, "jobs"))
+      try:
+        self.execute(channel, request, jobdir)
+      finally:
+        shutil.rmtree(jobdir, ignore_errors=True)
+        with self.lock:
+          self.running -= 1
+
+  def execute(self, channel, request, jobdir):
+    # Map each placeholder to a directory of the sandbox
+    roots = request.get("roots", [])
+    mapping = [(placeholder, os.path.join(jobdir, str(idx)))
+               for idx, placeholder in enumerate(roots)]
+
+    def localize(text):
+      for placeholder, path in mapping:
+        text = text.replace(placeholder, path)
+      return text
+
+    def check_within(local, path):
+      if not any(is_within(local, root) for _, root in mapping):
+        raise ProtocolError("path {!r} is outside of the sandbox".format(path))
+      return local
+
+    def sandbox_path(path):
+      return check_within(os.path.normpath(localize(path)), path)
+
+    cwd = sandbox_path(request["cwd"])
+    argv = [localize(arg) for arg in request["argv"]]
+    for arg, local_arg in zip(request["argv"][1:], argv[1:]):
+      for path in get_arg_paths(local_arg):
+        check_within(os.path.normpath(os.path.join(cwd, path)), arg)
+
+    for _, path in mapping:
+      os.makedirs(path)
+    for path, digest, mode in request.get("files", []):
+      local = sandbox_path(path)
+      if not os.path.isdir(os.path.dirname(local)):
+        os.makedirs(os.path.dirname(local))
+      try:
+        os.link(self.get_blobpath(digest), local)
+      except OSError:
+        shutil.copyfile(self.get_blobpath(digest), local)
+      # NOTE(josh): nothing shipped by the client may be executed
+      os.chmod(local, mode & 0o666)
+    outputs = [(path, sandbox_path(path)) for path in request["outputs"]]
+    for _, local in outputs:
+      if not os.path.isdir(os.path.dirname(local)):
+        os.makedirs(os.path.dirname(local))
+    if not os.path.isdir(cwd):
+      os.makedirs(cwd)
+
+    with tempfile.TemporaryFile() as stdout, \
+        tempfile.TemporaryFile() as stderr:
+      try:
+        proc = subprocess.Popen(
+            argv, cwd=cwd, stdin=subprocess.DEVNULL, stdout=stdout,
+            stderr=stderr)
+      except OSError as ex:
+        channel.send({"op": "result", "status": 127, "stderr": str(ex),
+                      "outputs": 0})
+        return
+      tbeat = time.time()
+      # NOTE(josh): wait4() rather than wait() so that the resource usage of
+      # this link is measured apart from the others running at the same time
+      while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+          break
+        if time.time() - tbeat > HEARTBEAT:
+          channel.send({"op": "running"})
+          tbeat = time.time()
+        time.sleep(POLL_INTERVAL)
+      proc.returncode = linkcache.get_exit_status(status)
+      stdout.seek(0)
+      stderr.seek(0)
+      # NOTE(josh): the output of the linker (and of the sandbox paths it
+      # names) is reported in terms of the paths of the client
+      reverse = [(path, placeholder) for placeholder, path in mapping]
+      text = [stream.read().decode("utf-8", "replace")
+              for stream in (stdout, stderr)]
+      for path, placeholder in reverse:
+        text = [content.replace(path, placeholder) for content in text]
+
+    succeeded = proc.returncode == 0 and all(
+        os.path.isfile(local) for _, local in outputs)
+    channel.send({
+        "op": "result",
+        "status": proc.returncode if proc.returncode else int(not succeeded),
+        "cpu": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss": rusage.ru_maxrss * 1024,
+        "stdout": text[0],
+        "stderr": text[1],
+        "outputs": len(outputs) if succeeded else 0,
+    })
+    if succeeded:
+      for path, local in outputs:
+        channel.send_file({
+            "op": "output",
+            "path": path,
+            "mode": os.stat(local).st_mode & 0o7777,
+        }, local)
+
+  def serve(self, channel):
+    """Serve the requests of one client until it disconnects."""
+    # The toolchain reported to the client for each program. Links may only
+    # execute those programs, see `check_program()`.
+    toolchains = {}
+    while True:
+      try:
+        request = channel.recv()
+      except ProtocolError:
+        return
+      try:
+        op = request.get("op")
+        if op == "status":
+          reply = self.status(request)
+          toolchains[request["argv"][0]] = reply["toolchain"]
+          channel.send(reply)
+        elif op == "put":
+          channel.send(self.put(channel, request))
+        elif op == "link":
+          self.link(channel, request, toolchains)
+        else:
+          channel.send({"error": "unknown request {!r}".format(op)})
+      except (KeyError, TypeError, ValueError, ProtocolError) as ex:
+        logger.warning("Rejected request from %s: %s", channel.name, ex)
+        channel.send({"error": "rejected request: {}".format(ex)})
+        return
+
+
+def serve_tcp(worker, address):
+  """Serve the clients which connect to `address`, until interrupted."""
+  listener = socket.socket(socket.AF_INET6 if ":" in address[0]
+                           else socket.AF_INET, socket.SOCK_STREAM)
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind(address)
+  listener.listen(64)
+  # NOTE(josh): the address is printed so that a worker listening on port 0
+  # can be found
+  print("Listening on {}:{}".format(*listener.getsockname()[:2]))
+  sys.stdout.flush()
+
+  def handle(conn, peer):
+    channel = Channel(conn.makefile("rb"), conn.makefile("wb"),
+                      "{}:{}".format(*peer[:2]))
+    try:
+      worker.serve(channel)
+    except (IOError, OSError) as ex:
+      logger.debug("Connection to %s failed: %s", channel.name, ex)
+    finally:
+      conn.close()
+
+  try:
+    while True:
+      conn, peer = listener.accept()
+      thread = threading.Thread(target=handle, args=(conn, peer))
+      thread.daemon = True
+      thread.start()
+  finally:
+    listener.close()
+
+
+def setup_argparser(argparser):
+  argparser.add_argument(
+      "--listen", default="127.0.0.1:{}".format(DEFAULT_PORT),
+      metavar="HOST:PORT",
+      help="Address on which to accept clients, which aren't authenticated,"
+           " so it must only be reachable from a trusted network."
+           " Default: %(default)s")
+  argparser.add_argument(
+      "--stdio", action="store_true",
+      help="Serve a single client on stdin and stdout (used over ssh)")
+  argparser.add_argument(
+      "--jobs", type=int, default=os.cpu_count() or 1,
+      help="Number of links to execute at once. Default: the number of CPUs")
+  argparser.add_argument(
+      "--work-dir",
+      help="Directory of the blob store and sandboxes. Default: `worker` in"
+           " the cache directory")
+
+
+def main(argv, options=None):
+  argparser = argparse.ArgumentParser(
+      prog="linkcache worker", description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  setup_argparser(argparser)
+  args = argparser.parse_args(argv)
+  if options is None:
+    options = linkcache.Options(**linkcache.get_default_options())
+  linkcache.logger.set_level(options.log_level)
+  linkcache.logger.get_logger()
+
+  workdir = args.work_dir or os.path.join(
+      linkcache.get_cachedir(options), "worker")
+  worker = Worker(os.path.abspath(workdir), max(1, args.jobs), options)
+  if args.stdio:
+    # NOTE(josh): stdout carries the protocol, so nothing else may be
+    # printed to it
+    channel = Channel(sys.stdin.buffer, sys.stdout.buffer, "stdio")
+    worker.serve(channel)
+    return 0
+
+  try:
+    serve_tcp(worker, parse_address(args.listen))
+  except KeyboardInterrupt:
+    pass
+  except OSError as ex:
+    logger.error("Can't listen on %s: %s", args.listen, ex)
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,296 @@
+"""
+Verify the linker acceleration policy of `linkcache --accelerate`. A miss
+through a compiler driver should be linked with the fastest linker the driver
+can run, detected once, and the choice should be recorded in the cacheinfo so
+that a hit requires the policy to make the same choice. Links which choose
+their own linker, or which are denied, should be left alone. If the system
+compiler can run gold, lld or mold then a real link is also checked.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import accel
+from linkhash import linkcache
+from linkhash import toolchain
+
+logger = logging.getLogger(__name__)
+
+# A compiler driver which records it's arguments, one json list per line. It
+# can run the linkers listed in the file `linkers`, and otherwise writes it's
+# output.
+FAKE_DRIVER = """\
+#!{python}
+import json
+import sys
+with open({logpath!r}, "a") as logfile:
+  logfile.write(json.dumps(sys.argv[1:]) + "\\n")
+if "-Wl,--version" in sys.argv:
+  with open({linkerspath!r}) as infile:
+    linkers = infile.read().split()
+  sys.exit(0 if sys.argv[1][len("-fuse-ld="):] in linkers else 1)
+with open(sys.argv[sys.argv.index("-o") + 1], "w") as outfile:
+  outfile.write("linked\\n")
+"""
+
+CHANGED_MESSAGE = "Linker acceleration policy has changed"
+
+
+def check_unit():
+  for program, expect in (
+      ("gcc", True), ("/usr/bin/cc", True), ("clang++-17", True),
+      ("x86_64-linux-gnu-g++-12", True), ("ld", False), ("ld.lld", False),
+      ("mold", False)):
+    if toolchain.is_driver(program) != expect:
+      raise AssertionError("Expected is_driver({}) to be {}".format(
+          program, expect))
+
+  options = linkcache.Options(accelerate_deny=["test_*", "lib/fragile.so"])
+  for outfile, expect in (
+      ("bin/test_foo", True), ("lib/fragile.so", True), ("bin/foo", False)):
+    if accel.is_denied(outfile, options) != expect:
+      raise AssertionError("Expected is_denied({}) to be {}".format(
+          outfile, expect))
+
+
+class Fixture(object):
+  """A fake compiler driver, the linkers it can run, and it's inputs."""
+
+  def __init__(self, args, tmpdir):
+    self.args = args
+    self.tmpdir = tmpdir
+    self.driverpath = os.path.join(tmpdir, "bin", "gcc")
+    self.logpath = os.path.join(tmpdir, "gcc.log")
+    self.linkerspath = os.path.join(tmpdir, "linkers")
+    os.makedirs(os.path.dirname(self.driverpath))
+    with io.open(self.driverpath, "w", encoding="utf-8") as outfile:
+      outfile.write(FAKE_DRIVER.format(
+          python=sys.executable, logpath=self.logpath,
+          linkerspath=self.linkerspath))
+    os.chmod(self.driverpath, 0o755)
+
+    past = time.time() - 100
+    with open(os.path.join(tmpdir, "main.o"), "w"):
+      pass
+    os.utime(os.path.join(tmpdir, "main.o"), (past, past))
+
+  def set_linkers(self, *linkers):
+    with io.open(self.linkerspath, "w", encoding="utf-8") as outfile:
+      outfile.write(" ".join(linkers) + "\n")
+
+  def read_log(self):
+    if not os.path.exists(self.logpath):
+      return []
+    with io.open(self.logpath, "r", encoding="utf-8") as infile:
+      return [json.loads(line) for line in infile]
+
+  def link(self, flags, extra_args=(), outfile="prog"):
+    """
+    Link through linkcache. Return the log of linkcache, the arguments which
+    linkcache added to the command when the driver linked (None if it
+    didn't) and the number of linkers the driver was asked about.
+    """
+    before = len(self.read_log())
+    command = ["main.o"] + list(extra_args) + ["-o", outfile]
+    proc = subprocess.Popen(
+        [sys.executable, self.args.linkcache, "--log-level", "debug",
+         "--no-bypass", "--api-version", "3",
+         "--cache-dir", os.path.join(self.tmpdir, "cache")] + list(flags)
+        + [self.driverpath] + command,
+        cwd=self.tmpdir, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    stderr = stderr.decode("utf-8")
+    if proc.returncode != 0:
+      raise AssertionError(
+          "linkcache exited with non-zero status:\n" + stderr)
+    calls = self.read_log()[before:]
+    probes = [call for call in calls if "-Wl,--version" in call]
+    links = [call for call in calls if "-Wl,--version" not in call]
+    if not links:
+      return stderr, None, len(probes)
+    if links[-1][:len(command)] != command:
+      raise AssertionError("Expected {} to start with {}".format(
+          links[-1], command))
+    return stderr, links[-1][len(command):], len(probes)
+
+  def read_accel(self, outfile="prog"):
+    with io.open(os.path.join(self.tmpdir, outfile + ".cacheinfo"), "r",
+                 encoding="utf-8") as infile:
+      return json.load(infile).get("accel")
+
+
+def expect_link(result, linker, what):
+  """
+  Verify that `result` of `Fixture.link()` is a miss, linked with `linker`
+  (or without a rewrite if None). Return the arguments added to the link.
+  """
+  log, added, _ = result
+  if added is None:
+    raise AssertionError("Expected {} to be a miss, got:\n{}".format(
+        what, log))
+  if linker is None and added:
+    raise AssertionError(
+        "Expected {} not to be rewritten, got {}".format(what, added))
+  if linker is not None and added[:1] != ["-fuse-ld=" + linker]:
+    raise AssertionError(
+        "Expected {} to be linked with {}, got {}".format(what, linker, added))
+  return added
+
+
+def expect_hit(result, what):
+  log, args, _ = result
+  if args is not None or "Using link-cache" not in log:
+    raise AssertionError("Expected {} to be a hit, got:\n{}".format(
+        what, log))
+
+
+def check_policy(args, tmpdir):
+  fixture = Fixture(args, tmpdir)
+  fixture.set_linkers("lld", "gold")
+
+  result = fixture.link(["--accelerate"])
+  linkargs = expect_link(result, "lld", "the first accelerated link")
+  if not any(arg.startswith("-Wl,--threads=") for arg in linkargs):
+    raise AssertionError(
+        "Expected the number of threads to be set, got {}".format(linkargs))
+  if result[2] != len(accel.LINKERS):
+    raise AssertionError("Expected each linker to be detected, got {}".format(
+        result[2]))
+  recorded = fixture.read_accel()
+  if recorded is None or recorded["linker"] != "lld" or (
+      recorded["args"] != linkargs):
+    raise AssertionError(
+        "Expected the rewrite {} to be recorded, got {}".format(
+            linkargs, recorded))
+
+  result = fixture.link(["--accelerate"])
+  expect_hit(result, "the second accelerated link")
+  if result[2]:
+    raise AssertionError("Expected the detection to be cached")
+
+  result = fixture.link([])
+  expect_link(result, None, "a link without --accelerate")
+  if CHANGED_MESSAGE not in result[0]:
+    raise AssertionError(
+        "Expected '{}' after disabling the policy, got:\n{}".format(
+            CHANGED_MESSAGE, result[0]))
+  if fixture.read_accel() is not None:
+    raise AssertionError("Expected the cacheinfo to record no rewrite")
+  expect_hit(fixture.link([]), "the second link without --accelerate")
+
+  linkargs = expect_link(
+      fixture.link(["--accelerate", "--accelerate-gdb-index"]), "lld",
+      "a link with --accelerate-gdb-index")
+  if "-Wl,--gdb-index" not in linkargs:
+    raise AssertionError("Expected a gdb index, got {}".format(linkargs))
+
+  result = fixture.link(["--accelerate", "--accelerate-deny", "pr*"])
+  expect_link(result, None, "a denied link")
+  if CHANGED_MESSAGE not in result[0]:
+    raise AssertionError(
+        "Expected '{}' after denying the output, got:\n{}".format(
+            CHANGED_MESSAGE, result[0]))
+
+  expect_link(
+      fixture.link(["--accelerate"], ["-fuse-ld=bfd"], "own"), None,
+      "a link which chooses it's own linker")
+
+  # NOTE(josh): a change to the driver invalidates the detection
+  fixture.set_linkers("mold", "lld")
+  future = time.time() + 10
+  os.utime(fixture.driverpath, (future, future))
+  result = fixture.link(["--accelerate"])
+  linkargs = expect_link(result, "mold", "a link after mold is installed")
+  if not result[2]:
+    raise AssertionError("Expected the linkers to be detected again")
+  if not any(arg.startswith("-Wl,--thread-count=") for arg in linkargs):
+    raise AssertionError(
+        "Expected the number of threads to be set, got {}".format(linkargs))
+
+
+def read_sections(path):
+  output = subprocess.check_output(["readelf", "-S", "-W", path])
+  return output.decode("utf-8")
+
+
+def check_real_link(args, tmpdir):
+  """Link a program with the system compiler, if it can run a fast linker."""
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.cache_dir = os.path.join(tmpdir, "cache")
+  linkers = accel.detect_linkers(args.compiler, options)
+  if not linkers:
+    logger.info("%s can't run a fast linker, skipping the real link",
+                args.compiler)
+    return
+
+  with io.open(os.path.join(tmpdir, "real.c"), "w",
+               encoding="utf-8") as outfile:
+    outfile.write("int main(void) { return 0; }\n")
+  subprocess.check_call(
+      [args.compiler, "-g", "-c", "-o", "real.o", "real.c"], cwd=tmpdir)
+  subprocess.check_call(
+      [sys.executable, args.linkcache, "--log-level", args.log_level,
+       "--no-bypass", "--api-version", "3", "--cache-dir", options.cache_dir,
+       "--accelerate", "--accelerate-gdb-index", args.compiler, "-g",
+       "real.o", "-o", "real"], cwd=tmpdir)
+  sections = read_sections(os.path.join(tmpdir, "real"))
+  if ".gdb_index" not in sections:
+    raise AssertionError(
+        "Expected {} to build a .gdb_index, got:\n{}".format(
+            linkers[0], sections))
+  if linkers[0] == "gold" and ".note.gnu.gold-version" not in sections:
+    raise AssertionError("Expected the output to be linked by gold")
+  subprocess.check_call([os.path.join(tmpdir, "real")])
+
+
+def runtest(tmpdir, args):
+  check_unit()
+  check_policy(args, tmpdir)
+  check_real_link(args, tmpdir)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used for the real link")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Verify the memo of API digests keyed by build-id. The memo of the default API
+model is the memo of the version it resolves to, a digest memoized for one
+version is never used for another, and a memoized digest is used instead of
+digesting the shared object again. With --embed-apid the digest should be
+embedded in the shared object by objcopy, and read back from it when the
+sidecar is lost. Without objcopy the link should still get it's sidecar.
+"""
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from linkhash import apidigest
+from linkhash import elfapi
+from linkhash import elfnote
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_SOURCE = "int foo(void) { return 0; }\n"
+
+
+class NoDigester(object):
+  """Digester for a link whose API digest must come from the memo."""
+
+  def get_apid(self, sopath):
+    raise AssertionError(
+        "Expected the memoized digest of {} to be used".format(sopath))
+
+  def dump_api(self, sopath):
+    return b""
+
+
+def write_library(tmpdir, compiler):
+  """Compile and link libfoo.so with a build-id. Return the link command."""
+  srcpath = os.path.join(tmpdir, "foo.c")
+  with io.open(srcpath, "w", encoding="utf-8") as outfile:
+    outfile.write(LIBRARY_SOURCE)
+  command = [compiler, "-shared", "-fPIC", "-Wl,--build-id", "-o",
+             "libfoo.so", "foo.c"]
+  subprocess.check_call(command, cwd=tmpdir)
+  return command
+
+
+def get_options(tmpdir, api_version):
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.cache_dir = os.path.join(tmpdir, "cache")
+  options.api_version = api_version
+  return options
+
+
+def write_apid(tmpdir, command, api_version, digester, objcopy=None):
+  """
+  Write the API digest sidecar of libfoo.so, as linkcache does after linking
+  it, and return the digest. If `objcopy` is given the digest is also
+  embedded with it.
+  """
+  apidpath = os.path.join(tmpdir, "libfoo.so.apid")
+  if os.path.exists(apidpath):
+    os.remove(apidpath)
+  options = get_options(tmpdir, api_version)
+  if objcopy is not None:
+    options.embed_apid = True
+    options.objcopy = objcopy
+  ctx = linkcache.Context(command, options, cwd=tmpdir)
+  ctx.outfile = "libfoo.so"
+  ctx.write_apid(digester)
+  return linkcache.read_apid(apidpath)
+
+
+def write_memo(memopath, apid):
+  if not os.path.isdir(os.path.dirname(memopath)):
+    os.makedirs(os.path.dirname(memopath))
+  with io.open(memopath, "w", encoding="utf-8") as outfile:
+    outfile.write(apid + "\n")
+
+
+def check_build_id_memo(tmpdir, args):
+  command = write_library(tmpdir, args.compiler)
+  sopath = os.path.join(tmpdir, "libfoo.so")
+  build_id = elfnote.read_build_id(sopath)
+  if build_id is None:
+    raise AssertionError("Expected {} to have a build-id".format(sopath))
+
+  def get_memopath(api_version):
+    return apidigest.get_build_id_memo_path(
+        get_options(tmpdir, api_version), build_id)
+
+  if get_memopath(None) != get_memopath(linkcache.DEFAULT_API_VERSION):
+    raise AssertionError(
+        "Expected the default API model to share the memo of version {},"
+        " got {} and {}".format(
+            linkcache.DEFAULT_API_VERSION, get_memopath(None),
+            get_memopath(linkcache.DEFAULT_API_VERSION)))
+  if get_memopath(2) == get_memopath(3):
+    raise AssertionError("Expected each API model to have it's own memo")
+  if linkcache.get_linkhash_args(None) != [
+      "--api-version", str(linkcache.DEFAULT_API_VERSION)]:
+    raise AssertionError(
+        "Expected linkhash to be told the default API model, got {}".format(
+            linkcache.get_linkhash_args(None)))
+
+  # A digest is memoized when it is computed
+  v3 = write_apid(tmpdir, command, 3, elfapi.Digester(3))
+  if v3 != elfapi.get_apid(sopath, 3):
+    raise AssertionError(
+        "Expected the v3 digest {}, got {}".format(
+            elfapi.get_apid(sopath, 3), v3))
+  if linkcache.read_apid(get_memopath(3)) != v3:
+    raise AssertionError("Expected the v3 digest to be memoized")
+
+  # ... and used instead of digesting the library again
+  sentinel = "v3-" + "0" * 40
+  write_memo(get_memopath(3), sentinel)
+  apid = write_apid(tmpdir, command, 3, NoDigester())
+  if apid != sentinel:
+    raise AssertionError(
+        "Expected the memoized digest {}, got {}".format(sentinel, apid))
+
+  # The v3 memo isn't used for version 2
+  v2 = write_apid(tmpdir, command, 2, elfapi.Digester(2))
+  if v2 != elfapi.get_apid(sopath, 2):
+    raise AssertionError(
+        "Expected the v2 digest {}, got {}".format(
+            elfapi.get_apid(sopath, 2), v2))
+
+  # ... but the v2 memo is used when the version isn't given
+  apid = write_apid(tmpdir, command, None, NoDigester())
+  if apid != v2:
+    raise AssertionError(
+        "Expected the memoized v2 digest {} for the default API model, got {}"
+        .format(v2, apid))
+
+
+def read_file(filepath):
+  with open(filepath, "rb") as infile:
+    return infile.read()
+
+
+def check_embed(tmpdir, args):
+  command = write_library(tmpdir, args.compiler)
+  sopath = os.path.join(tmpdir, "libfoo.so")
+  apid = write_apid(tmpdir, command, 3, elfapi.Digester(3), objcopy="objcopy")
+  if apid is None:
+    raise AssertionError("Expected a sidecar next to the embedded digest")
+  embedded = elfnote.read_embedded_apid(sopath)
+  if embedded != apid:
+    raise AssertionError(
+        "Expected the embedded digest {}, got {}".format(apid, embedded))
+  if elfapi.get_apid(sopath, 3) != apid:
+    raise AssertionError("Expected the note not to change the API digest")
+
+  # A consumer which has lost the sidecar reads the embedded digest
+  os.remove(os.path.join(tmpdir, "libfoo.so.apid"))
+  consumer = ["cc", "main.o", "libfoo.so", "-o", "prog"]
+  ctx = linkcache.Context(consumer, get_options(tmpdir, 3), cwd=tmpdir)
+  if ctx.get_input_apid("libfoo.so") != apid:
+    raise AssertionError(
+        "Expected the embedded digest to be used without a sidecar, got {}"
+        .format(ctx.get_input_apid("libfoo.so")))
+
+  # Embedding again replaces the note rather than adding a second one
+  apid = write_apid(tmpdir, command, 2, elfapi.Digester(2), objcopy="objcopy")
+  if elfnote.read_embedded_apid(sopath) != apid:
+    raise AssertionError(
+        "Expected the embedded digest to be replaced by {}, got {}".format(
+            apid, elfnote.read_embedded_apid(sopath)))
+
+  # Without objcopy the shared object is left as it is, and it still gets
+  # it's sidecar.
+  command = write_library(tmpdir, args.compiler)
+  content = read_file(sopath)
+  emptydir = os.path.join(tmpdir, "empty")
+  os.makedirs(emptydir)
+  environ = dict(os.environ)
+  os.environ["PATH"] = emptydir
+  try:
+    apid = write_apid(
+        tmpdir, command, 3, elfapi.Digester(3), objcopy="objcopy")
+  finally:
+    os.environ.clear()
+    os.environ.update(environ)
+  if apid != elfapi.get_apid(sopath, 3):
+    raise AssertionError(
+        "Expected the sidecar to be written without objcopy, got {}".format(
+            apid))
+  if read_file(sopath) != content:
+    raise AssertionError("Expected the shared object to be left unchanged")
+  if elfnote.read_embedded_apid(sopath) is not None:
+    raise AssertionError("Expected no embedded digest without objcopy")
+
+
+def runtest(tmpdir, args):
+  for name, check in (
+      ("memo", check_build_id_memo),
+      ("embed", check_embed)):
+    subdir = os.path.join(tmpdir, name)
+    os.makedirs(subdir)
+    check(subdir, args)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to build the shared object")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,333 @@
+"""
+Verify the rules which canonicalize link commands before hashing, against a
+corpus of link lines as generated by CMake, meson and the gcc driver. Cosmetic
+changes to each line (verbosity, diagnostics, warnings, the order of global
+flags) should hash the same, while changes to the order of inputs, libraries
+and positional flags should not. Rules from a file should take precedence
+over, enable and disable the built-in rules.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from linkhash import argrules
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# Link lines, split into arguments
+CORPUS = {
+    # CMake, Unix Makefiles, gcc, an executable
+    "cmake-gcc-executable": [
+        "/usr/bin/c++", "-O2", "-g", "-DNDEBUG", "-Wall", "-Wextra",
+        "-fdiagnostics-color=always", "-rdynamic",
+        "CMakeFiles/prog.dir/main.cc.o", "CMakeFiles/prog.dir/args.cc.o",
+        "-o", "prog", "-Wl,-rpath,/build/lib:/build/util", "lib/libfoo.so",
+        "util/libutil.a", "-lpthread", "-ldl",
+    ],
+    # CMake, Ninja, gcc, a shared library with a hardened set of flags
+    "cmake-gcc-shared": [
+        "/usr/bin/c++", "-fPIC", "-O2", "-Wall", "-pthread",
+        "-Wl,--gc-sections", "-Wl,-z,relro", "-Wl,-z,now", "-Wl,--build-id",
+        "-shared", "-Wl,-soname,libfoo.so.1", "-o", "lib/libfoo.so.1.2.3",
+        "CMakeFiles/foo.dir/foo.cc.o", "CMakeFiles/foo.dir/bar.cc.o",
+        "-Wl,--as-needed", "-L/build/lib", "-L/opt/deps/lib",
+        "-Wl,-rpath,/build/lib", "-lbar", "-Wl,--no-as-needed", "-lm",
+    ],
+    # clang with lld, colors and a time trace
+    "clang-lld": [
+        "/usr/bin/clang++", "-fuse-ld=lld", "-fcolor-diagnostics",
+        "-ftime-trace", "-Wl,--color-diagnostics", "-Wl,--icf=all",
+        "-Wl,--gc-sections", "-o", "bin/tool", "obj/tool.o", "obj/cli.o",
+        "-Wl,--start-group", "lib/liba.a", "lib/libb.a", "-Wl,--end-group",
+        "-Wl,-Bstatic", "-lz", "-Wl,-Bdynamic", "-lc++",
+    ],
+    # meson, gcc, with a linker map and -Xlinker pairs
+    "meson-gcc": [
+        "cc", "-o", "src/app", "src/app.p/main.c.o", "src/app.p/io.c.o",
+        "-Wl,--as-needed", "-Wl,--no-undefined", "-Wl,-O1",
+        "-Xlinker", "-rpath", "-Xlinker", "$ORIGIN/../lib",
+        "-Wl,--start-group", "src/libcore.a", "-lm", "-Wl,--end-group",
+        "-Wl,-Map,src/app.map",
+    ],
+    # ld executed directly, as collect2 does
+    "ld-direct": [
+        "/usr/bin/ld", "--hash-style=gnu", "-m", "elf_x86_64",
+        "-dynamic-linker", "/lib64/ld-linux-x86-64.so.2", "-pie",
+        "-o", "a.out", "/usr/lib/x86_64-linux-gnu/Scrt1.o",
+        "/usr/lib/gcc/x86_64-linux-gnu/12/crtbeginS.o",
+        "-L/usr/lib/gcc/x86_64-linux-gnu/12", "-L/usr/lib/x86_64-linux-gnu",
+        "main.o", "-lgcc", "--push-state", "--as-needed", "-lgcc_s",
+        "--pop-state", "-lc", "/usr/lib/gcc/x86_64-linux-gnu/12/crtendS.o",
+    ],
+}
+
+
+def insert_after(argv, anchor, *args):
+  idx = argv.index(anchor) + 1
+  return argv[:idx] + list(args) + argv[idx:]
+
+
+def swap(argv, first, second):
+  out = list(argv)
+  idx, jdx = out.index(first), out.index(second)
+  out[idx], out[jdx] = out[jdx], out[idx]
+  return out
+
+
+def move_to_end(argv, arg):
+  return [item for item in argv if item != arg] + [arg]
+
+
+def remove(argv, *args):
+  return [item for item in argv if item not in args]
+
+
+# Changes to a link line which shouldn't affect the output, as functions of
+# the line
+EQUIVALENT = {
+    "cmake-gcc-executable": [
+        lambda argv: insert_after(argv, "-g", "-v"),
+        lambda argv: insert_after(argv, "-g", "-Wl,--verbose", "-pipe"),
+        lambda argv: remove(argv, "-Wall", "-Wextra"),
+        lambda argv: insert_after(argv, "-Wextra", "-Wno-unused", "-Werror"),
+        lambda argv: remove(argv, "-fdiagnostics-color=always"),
+        lambda argv: insert_after(argv, "-g", "-Xlinker", "--stats"),
+        lambda argv: insert_after(argv, "-g", "-ftime-report"),
+    ],
+    "cmake-gcc-shared": [
+        lambda argv: swap(argv, "-Wl,-z,relro", "-Wl,-z,now"),
+        lambda argv: swap(argv, "-pthread", "-Wl,--build-id"),
+        lambda argv: insert_after(argv, "-Wall", "-fdiagnostics-color=never"),
+        lambda argv: insert_after(argv, "-Wall", "-fmessage-length=0"),
+    ],
+    "clang-lld": [
+        lambda argv: remove(
+            argv, "-fcolor-diagnostics", "-ftime-trace",
+            "-Wl,--color-diagnostics"),
+        lambda argv: swap(argv, "-Wl,--icf=all", "-Wl,--gc-sections"),
+        lambda argv: insert_after(argv, "-fuse-ld=lld", "-Wl,--error-limit=0"),
+    ],
+    "meson-gcc": [
+        lambda argv: swap(argv, "-Wl,--no-undefined", "-Wl,-O1"),
+        lambda argv: insert_after(argv, "cc", "-Wl,--print-memory-usage"),
+    ],
+    "ld-direct": [
+        lambda argv: insert_after(argv, "-pie", "--verbose", "--stats"),
+        lambda argv: insert_after(argv, "-pie", "-t"),
+    ],
+}
+
+# Changes to a link line which may affect the output
+DISTINCT = {
+    "cmake-gcc-executable": [
+        lambda argv: swap(
+            argv, "CMakeFiles/prog.dir/main.cc.o",
+            "CMakeFiles/prog.dir/args.cc.o"),
+        lambda argv: swap(argv, "lib/libfoo.so", "util/libutil.a"),
+        lambda argv: swap(argv, "-lpthread", "-ldl"),
+        lambda argv: remove(argv, "-rdynamic"),
+        lambda argv: swap(argv, "-O2", "-g"),
+    ],
+    "cmake-gcc-shared": [
+        lambda argv: move_to_end(argv, "-Wl,--as-needed"),
+        lambda argv: swap(argv, "-L/build/lib", "-L/opt/deps/lib"),
+        lambda argv: remove(argv, "-Wl,-z,now"),
+        # The flags are no longer consecutive, so may not be sorted
+        lambda argv: swap(argv, "-fPIC", "-Wl,--build-id"),
+    ],
+    "clang-lld": [
+        lambda argv: move_to_end(argv, "-Wl,--start-group"),
+        lambda argv: swap(argv, "lib/liba.a", "-Wl,--end-group"),
+        lambda argv: swap(argv, "-Wl,-Bstatic", "-Wl,-Bdynamic"),
+        lambda argv: swap(argv, "-lz", "-lc++"),
+    ],
+    "meson-gcc": [
+        lambda argv: swap(argv, "-rpath", "$ORIGIN/../lib"),
+        lambda argv: swap(argv, "src/libcore.a", "-lm"),
+        lambda argv: remove(argv, "-Wl,-Map,src/app.map"),
+    ],
+    "ld-direct": [
+        lambda argv: swap(argv, "--as-needed", "-lgcc_s"),
+        lambda argv: swap(argv, "-lgcc", "-lc"),
+        lambda argv: swap(
+            argv, "-L/usr/lib/gcc/x86_64-linux-gnu/12",
+            "-L/usr/lib/x86_64-linux-gnu"),
+    ],
+}
+
+
+def get_hash(argv, options):
+  return linkcache.get_execspec(argv, options, cwd="/build")["hash"]
+
+
+def check_corpus(options):
+  normalize = argrules.get_normalizer(options)
+  for name, argv in sorted(CORPUS.items()):
+    canonical = argv[:1] + normalize(argv[1:])
+    if argv[:1] + normalize(canonical[1:]) != canonical:
+      raise AssertionError(
+          "Normalizing {} isn't idempotent: {}".format(name, canonical))
+    expect = get_hash(argv, options)
+    for idx, change in enumerate(EQUIVALENT[name]):
+      changed = change(argv)
+      if changed == argv:
+        raise AssertionError("Equivalent change {} to {} is a no-op".format(
+            idx, name))
+      if get_hash(changed, options) != expect:
+        raise AssertionError(
+            "Expected equivalent change {} to {} to hash the same:\n{}\n{}"
+            .format(idx, name, canonical,
+                    changed[:1] + normalize(changed[1:])))
+    for idx, change in enumerate(DISTINCT[name]):
+      changed = change(argv)
+      if changed == argv:
+        raise AssertionError("Distinct change {} to {} is a no-op".format(
+            idx, name))
+      if get_hash(changed, options) == expect:
+        raise AssertionError(
+            "Expected distinct change {} to {} to hash differently: {}"
+            .format(idx, name, changed))
+
+
+def check_canonical(options):
+  """Spot check the canonical form of a line."""
+  normalize = argrules.get_normalizer(options)
+  actual = normalize(CORPUS["cmake-gcc-shared"][1:])
+  expect = [
+      "-fPIC", "-O2", "-Wl,--build-id", "-Wl,--gc-sections", "-Wl,-z,now",
+      "-Wl,-z,relro", "-pthread", "-shared", "-Wl,-soname,libfoo.so.1", "-o",
+      "lib/libfoo.so.1.2.3", "CMakeFiles/foo.dir/foo.cc.o",
+      "CMakeFiles/foo.dir/bar.cc.o", "-Wl,--as-needed", "-L/build/lib",
+      "-L/opt/deps/lib", "-Wl,-rpath,/build/lib", "-lbar",
+      "-Wl,--no-as-needed", "-lm",
+  ]
+  if actual != expect:
+    raise AssertionError("Expected canonical form:\n{}\ngot:\n{}".format(
+        expect, actual))
+
+  # The value of a flag is never matched on it's own
+  actual = normalize(["-Xlinker", "-v", "-o", "-Wall", "-Wall", "main.o"])
+  if actual != ["-o", "-Wall", "main.o"]:
+    raise AssertionError(
+        "Expected flags and their values to be matched together, got {}"
+        .format(actual))
+
+
+def check_candidates():
+  """
+  Verify that every argument an enabled built-in rule may match is a
+  candidate of linkcache's prefix check, which skips loading the rules for a
+  command with none.
+  """
+  for name, _, patterns, enabled in argrules.ARG_RULES:
+    if not enabled:
+      continue
+    for pattern in patterns:
+      literal = pattern
+      for char in "*?[":
+        literal = literal.partition(char)[0]
+      if not linkcache.may_canonicalize([literal], None):
+        raise AssertionError(
+            "Pattern {} of rule {} isn't covered by ARG_RULE_PREFIXES".format(
+                pattern, name))
+  for prefix in linkcache.ARG_RULE_PREFIXES:
+    if " " in prefix:
+      raise AssertionError(
+          "Prefix {} would not match the flag of a flag and value".format(
+              prefix))
+
+  argv = ["-o", "prog", "main.o", "libfoo.a", "-L/build/lib", "-lm"]
+  if linkcache.may_canonicalize(argv, None):
+    raise AssertionError(
+        "Expected {} not to be a candidate of the rules".format(argv))
+
+
+def check_user_rules(tmpdir):
+  rulespath = os.path.join(tmpdir, "rules.json")
+  with io.open(rulespath, "w", encoding="utf-8") as outfile:
+    json.dump({
+        "rules": [
+            {"name": "cref", "action": "drop", "patterns": ["-Wl,--cref"]},
+            {"name": "maps", "action": "drop", "patterns": ["-Wl,-Map,*.map"]},
+            # Takes precedence over the built-in rule, which drops it
+            {"name": "werror", "action": "keep", "patterns": ["-Werror"]},
+            {"name": "malformed", "action": "shuffle", "patterns": ["-g"]},
+            {"name": "invalid", "action": "drop", "patterns": "-g"},
+        ],
+        "enable": ["library-dirs"],
+        "disable": ["verbose"],
+    }, outfile)
+
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.arg_rules = [rulespath]
+  names = [name for name, _, _ in argrules.load_rules([rulespath])]
+  if "malformed" in names or "invalid" in names:
+    raise AssertionError("Expected malformed rules to be ignored")
+
+  argv = CORPUS["cmake-gcc-shared"]
+  for change, equal in (
+      (lambda argv: swap(argv, "-L/build/lib", "-L/opt/deps/lib"), True),
+      (lambda argv: insert_after(argv, "-O2", "-Wl,--cref"), True),
+      (lambda argv: insert_after(argv, "-O2", "-Wl,-Map,libfoo.map"), True),
+      (lambda argv: insert_after(argv, "-O2", "-Wl,-Map,libfoo.txt"), False),
+      (lambda argv: insert_after(argv, "-O2", "-v"), False),
+      (lambda argv: insert_after(argv, "-O2", "-Werror"), False),
+      (lambda argv: insert_after(argv, "-O2", "-Wextra"), True),
+  ):
+    changed = change(argv)
+    if (get_hash(changed, options) == get_hash(argv, options)) != equal:
+      raise AssertionError(
+          "Expected {} to hash {} with user rules".format(
+              changed, "the same" if equal else "differently"))
+
+  options.arg_rules = [os.path.join(tmpdir, "missing.json")]
+  if get_hash(argv, options) != get_hash(argv, None):
+    raise AssertionError("Expected a missing rules file to be ignored")
+
+
+def runtest(tmpdir, args):
+  options = linkcache.Options(**linkcache.get_default_options())
+  check_corpus(options)
+  check_canonical(options)
+  check_candidates()
+  check_user_rules(tmpdir)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Verify the audit of cache hits. A hit of a real link should match when
+linked again, even with a random build-id, and a hit which is unsafe (an input
+changed without it's timestamp changing) should be reported as a mismatch
+along with the state of the inputs. An audit started by `--audit-rate` runs
+in the background and doesn't delay the hit.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+MAIN_SOURCE = """\
+int main(int argc, char** argv) {{
+  return {};
+}}
+"""
+
+
+def compile_object(args, tmpdir, value):
+  """
+  Compile main.o returning `value`, and make it older than any output so that
+  a change to it's content alone doesn't invalidate the cache.
+  """
+  srcpath = os.path.join(tmpdir, "main.c")
+  with io.open(srcpath, "w", encoding="utf-8") as outfile:
+    outfile.write(MAIN_SOURCE.format(value))
+  objpath = os.path.join(tmpdir, "main.o")
+  subprocess.check_call([args.compiler, "-c", "-o", objpath, srcpath])
+  past = time.time() - 100
+  os.utime(objpath, (past, past))
+
+
+def read_report(reportpath):
+  if not os.path.exists(reportpath):
+    return []
+  with io.open(reportpath, "r", encoding="utf-8") as infile:
+    return [json.loads(line) for line in infile if line.strip()]
+
+
+def run_linkcache(args, tmpdir, argv):
+  subprocess.check_call(
+      [sys.executable, args.linkcache, "--no-bypass", "--api-version", "3",
+       "--audit-report", os.path.join(tmpdir, "report.jsonl")] + argv,
+      cwd=tmpdir)
+
+
+def audit_once(args, tmpdir, command):
+  """
+  Audit `command` in the foreground and return the report entry.
+  """
+  reportpath = os.path.join(tmpdir, "report.jsonl")
+  nentries = len(read_report(reportpath))
+  proc = subprocess.Popen(
+      [sys.executable, args.linkcache, "--no-bypass", "--api-version", "3",
+       "--audit-report", reportpath, "audit"] + command,
+      cwd=tmpdir, stderr=subprocess.PIPE)
+  proc.communicate()
+  entries = read_report(reportpath)
+  if len(entries) != nentries + 1:
+    raise AssertionError(
+        "Expected the audit of {} to append one report entry".format(
+            command[-1]))
+  return entries[-1]
+
+
+def runtest(tmpdir, args):
+  compile_object(args, tmpdir, 0)
+  reportpath = os.path.join(tmpdir, "report.jsonl")
+
+  for name, flags in (
+      ("prog", []), ("prog-uuid", ["-Wl,--build-id=uuid"])):
+    command = [args.compiler] + flags + ["main.o", "-o", name]
+    run_linkcache(args, tmpdir, command)
+    entry = audit_once(args, tmpdir, command)
+    logger.info("Audit of %s: %s", name, entry["result"])
+    if entry["result"] != "match":
+      raise AssertionError(
+          "Expected the audit of {} to match, got {}: {}".format(
+              name, entry["result"], entry.get("details")))
+
+  # Change the content of the input without changing it's timestamp. The hit
+  # is now unsafe and the audit should say so.
+  compile_object(args, tmpdir, 1)
+  command = [args.compiler, "main.o", "-o", "prog"]
+  entry = audit_once(args, tmpdir, command)
+  logger.info(
+      "Audit of prog with a changed input: %s %s", entry["result"],
+      entry.get("details"))
+  if entry["result"] != "mismatch":
+    raise AssertionError(
+        "Expected the audit of an unsafe hit to mismatch, got {}".format(
+            entry["result"]))
+  if [state["input"] for state in entry.get("inputs", [])] != ["main.o"]:
+    raise AssertionError(
+        "Expected the mismatch to report the state of main.o, got {}".format(
+            entry.get("inputs")))
+
+  # A hit with --audit-rate 1 should audit in the background
+  compile_object(args, tmpdir, 0)
+  nentries = len(read_report(reportpath))
+  tstart = time.time()
+  run_linkcache(args, tmpdir, ["--audit-rate", "1"] + command)
+  hit_time = time.time() - tstart
+  while len(read_report(reportpath)) == nentries:
+    if time.time() - tstart > args.timeout:
+      raise AssertionError(
+          "The background audit didn't report within {}s".format(args.timeout))
+    time.sleep(0.05)
+  entry = read_report(reportpath)[-1]
+  logger.info(
+      "Hit took %.1fms, background audit: %s", hit_time * 1000.0,
+      entry["result"])
+  if entry["result"] != "match":
+    raise AssertionError(
+        "Expected the background audit to match, got {}".format(
+            entry["result"]))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to compile and link the test program")
+  argparser.add_argument(
+      "--timeout", type=float, default=30.0,
+      help="Seconds to wait for the background audit")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,245 @@
+"""
+Verify that `linkhash --batch` (with paths given as arguments or on stdin) and
+`linkhash --serve` (directly and through `apidigest.LinkhashCoprocess`)
+produce exactly the digests of digesting each shared object on it's own.
+Inputs which can't be digested (a file which isn't ELF, a missing file and an
+unreadable file) should be reported as `path -` without disturbing the digests
+of the inputs which follow them. linkcache should digest with linkhash when it
+is installed, and compute the same digests in-process when it isn't.
+"""
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from linkhash import apidigest
+from linkhash import elfapi
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# Number of good shared objects to digest
+NLIBS = 4
+
+
+def write_library(tmpdir, idx, compiler):
+  """Compile and link a shared object with `idx + 1` functions."""
+  srcpath = os.path.join(tmpdir, "lib{}.c".format(idx))
+  with io.open(srcpath, "w", encoding="utf-8") as outfile:
+    for fn in range(idx + 1):
+      outfile.write("int fn_{0}_{1}(void) {{ return {1}; }}\n".format(
+          idx, fn))
+  sopath = os.path.join(tmpdir, "lib{}.so".format(idx))
+  subprocess.check_call(
+      [compiler, "-shared", "-fPIC", "-o", sopath, srcpath])
+  return sopath
+
+
+def write_bad_inputs(tmpdir):
+  """Return a list of paths which linkhash can't digest."""
+  out = []
+  textpath = os.path.join(tmpdir, "libtext.so")
+  with io.open(textpath, "w", encoding="utf-8") as outfile:
+    outfile.write("not an ELF file\n")
+  out.append(textpath)
+  out.append(os.path.join(tmpdir, "libmissing.so"))
+
+  lockedpath = os.path.join(tmpdir, "liblocked.so")
+  shutil.copyfile(os.path.join(tmpdir, "lib0.so"), lockedpath)
+  os.chmod(lockedpath, 0)
+  if os.access(lockedpath, os.R_OK):
+    # e.g. running as root
+    logger.info("Can't make a file unreadable, skipping %s", lockedpath)
+  else:
+    out.append(lockedpath)
+  return out
+
+
+def get_single_digests(args, api_version, paths):
+  """
+  Return a dictionary mapping each of `paths` to it's digest, computed by a
+  separate execution of linkhash, or to None if linkhash fails.
+  """
+  out = {}
+  for path in paths:
+    proc = subprocess.Popen(
+        [args.linkhash, "--api-version", str(api_version), path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    out[path] = stdout.decode("utf-8").strip() if proc.returncode == 0 else None
+  return out
+
+
+def parse_entries(stdout):
+  """Return a list of `(path, digest)` from `path digest` lines."""
+  out = []
+  for line in stdout.decode("utf-8").splitlines():
+    path, _, digest = line.rpartition(" ")
+    out.append((path, None if digest == "-" else digest))
+  return out
+
+
+def check_entries(what, expect, entries):
+  if entries != expect:
+    raise AssertionError(
+        "{} doesn't match single digests:\n  expected {}\n  got {}".format(
+            what, expect, entries))
+
+
+def check_batch(args, api_version, paths, expect):
+  ok = all(digest is not None for _, digest in expect)
+  command = [args.linkhash, "--batch", "--api-version", str(api_version)]
+  for what, argv, stdin in (
+      ("--batch with arguments", command + paths, b""),
+      ("--batch from stdin", command,
+       "".join(path + "\n\n" for path in paths).encode("utf-8"))):
+    proc = subprocess.Popen(
+        argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stdout, _ = proc.communicate(stdin)
+    check_entries(what, expect, parse_entries(stdout))
+    if (proc.returncode == 0) != ok:
+      raise AssertionError(
+          "Expected {} to exit with {} status, got {}".format(
+              what, "zero" if ok else "non-zero", proc.returncode))
+
+
+def check_serve(args, api_version, paths, expect):
+  proc = subprocess.Popen(
+      [args.linkhash, "--serve", "--api-version", str(api_version)],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  entries = []
+  try:
+    # NOTE(josh): each response is read before the next request is written,
+    # as the coprocess client does, so this would hang if a response was
+    # buffered or missing.
+    for path in paths:
+      proc.stdin.write((path + "\n").encode("utf-8"))
+      proc.stdin.flush()
+      entries.extend(parse_entries(proc.stdout.readline()))
+  finally:
+    proc.stdin.close()
+    proc.stdout.close()
+    proc.stderr.close()
+    returncode = proc.wait()
+  check_entries("--serve", expect, entries)
+  if returncode != 0:
+    raise AssertionError(
+        "Expected --serve to exit with zero status, got {}".format(returncode))
+
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.api_version = api_version
+  with apidigest.LinkhashCoprocess(args.linkhash, options) as coprocess:
+    entries = [(path, coprocess.get_apid(path)) for path in paths]
+    proc = coprocess.proc
+  check_entries("LinkhashCoprocess", expect, entries)
+  if proc is None or proc.returncode != 0:
+    raise AssertionError(
+        "Expected the coprocess to be started once and exit cleanly")
+
+
+def check_digester(args, api_version, paths, expect):
+  """
+  The digester used by linkcache is the linkhash coprocess. Only if linkhash
+  isn't installed are digests computed in-process, and they must match.
+  """
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.api_version = api_version
+  with apidigest.get_digester(args.linkhash, options) as digester:
+    if not isinstance(digester, apidigest.LinkhashCoprocess):
+      raise AssertionError(
+          "Expected linkhash to be used for version {}, got {}".format(
+              api_version, digester))
+
+  digester = apidigest.get_digester(None, options)
+  if api_version not in elfapi.API_VERSIONS:
+    if digester is not None:
+      raise AssertionError(
+          "Expected no digester for version {} without linkhash".format(
+              api_version))
+    return
+  with digester:
+    entries = [(path, digester.get_apid(path)) for path in paths]
+  check_entries("In-process digests", expect, entries)
+
+
+def runtest(tmpdir, args):
+  libs = [write_library(tmpdir, idx, args.compiler) for idx in range(NLIBS)]
+  bad = write_bad_inputs(tmpdir)
+  # Each bad input is followed by a good one
+  paths = []
+  for idx, path in enumerate(libs):
+    paths.append(path)
+    if idx < len(bad):
+      paths.append(bad[idx])
+
+  for api_version in args.api_version:
+    single = get_single_digests(args, api_version, paths)
+    for path in libs:
+      if single[path] is None:
+        raise AssertionError("linkhash failed to digest {}".format(path))
+    for path in bad:
+      if single[path] is not None:
+        raise AssertionError(
+            "Expected linkhash to fail on {}, got {}".format(
+                path, single[path]))
+    if len(set(single[path] for path in libs)) != len(libs):
+      raise AssertionError("Expected distinct digests, got {}".format(single))
+
+    # A batch of only good inputs succeeds, and one with bad inputs fails
+    check_batch(
+        args, api_version, libs, [(path, single[path]) for path in libs])
+    expect = [(path, single[path]) for path in paths]
+    check_batch(args, api_version, paths, expect)
+    check_serve(args, api_version, paths, expect)
+    check_digester(args, api_version, paths, expect)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkhash", required=True,
+      help="Path to the linkhash binary")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to build the shared objects")
+  argparser.add_argument(
+      "--api-version", type=int, action="append", default=None,
+      help="API model version to test, may be specified multiple times."
+           " Default: 1, 2 and 3")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+  if not args.api_version:
+    args.api_version = [1, 2, 3]
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Verify the cost-aware bypass of linkcache. An output which links faster than
+linkcache can check it's many inputs should be linked directly most of the
+time, and checked again once it has been bypassed `BYPASS_RESAMPLE - 1`
+times in a row. An output which is slow to link,
+a shared object, or any output with `--no-bypass`, should never be bypassed.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# A linker which writes it's output (the last argument) after spending the
+# given amount of CPU time
+FAKE_LINKER = """\
+#!{python}
+import sys
+import time
+while time.process_time() < {cputime}:
+  pass
+with open(sys.argv[-1], "w") as outfile:
+  outfile.write("linked\\n")
+"""
+
+BYPASS_MESSAGE = "bypassing the cache"
+
+
+def write_program(filepath, content):
+  with io.open(filepath, "w", encoding="utf-8") as outfile:
+    outfile.write(content)
+  os.chmod(filepath, 0o755)
+
+
+def setup_fixture(tmpdir, ninputs):
+  """Create the fake linkers and the inputs. Return the list of inputs."""
+  bindir = os.path.join(tmpdir, "bin")
+  os.makedirs(bindir)
+  for name, cputime in (("fastld", 0), ("slowld", 0.5)):
+    write_program(
+        os.path.join(bindir, name),
+        FAKE_LINKER.format(python=sys.executable, cputime=cputime))
+
+  past = time.time() - 100
+  inputs = []
+  for idx in range(ninputs):
+    objpath = "obj{:05d}.o".format(idx)
+    with open(os.path.join(tmpdir, objpath), "w"):
+      pass
+    os.utime(os.path.join(tmpdir, objpath), (past, past))
+    inputs.append(objpath)
+  return inputs
+
+
+def run_link(args, tmpdir, command, flags=()):
+  """
+  Execute `command` through linkcache. Return true if linkcache bypassed the
+  cache.
+  """
+  proc = subprocess.Popen(
+      [sys.executable, args.linkcache, "--log-level", "debug",
+       "--api-version", "3"] + list(flags)
+      + [os.path.join(tmpdir, "bin", command[0])] + command[1:],
+      cwd=tmpdir, stderr=subprocess.PIPE)
+  _, stderr = proc.communicate()
+  stderr = stderr.decode("utf-8")
+  if proc.returncode != 0:
+    raise AssertionError(
+        "linkcache exited with non-zero status:\n" + stderr)
+  return BYPASS_MESSAGE in stderr
+
+
+def read_cacheinfo(tmpdir, outfile):
+  with io.open(os.path.join(tmpdir, outfile + ".cacheinfo"), "r",
+               encoding="utf-8") as infile:
+    return json.load(infile)
+
+
+def read_costs(tmpdir, outfile):
+  return read_cacheinfo(tmpdir, outfile).get("costs")
+
+
+def check_resample(args, tmpdir, command):
+  """
+  The bypasses of `command` are counted, and the invocation following the
+  last of `BYPASS_RESAMPLE - 1` checks the cache, which restarts the count.
+  """
+  outfile = command[-1]
+  before = read_cacheinfo(tmpdir, outfile).get("bypasses", 0)
+  if not run_link(args, tmpdir, command):
+    raise AssertionError("Expected {} to be bypassed".format(outfile))
+  count = read_cacheinfo(tmpdir, outfile).get("bypasses", 0)
+  if count != before + 1:
+    raise AssertionError(
+        "Expected the bypass to be counted, got {} after {}".format(
+            count, before))
+
+  cacheinfo = read_cacheinfo(tmpdir, outfile)
+  cacheinfo["bypasses"] = linkcache.BYPASS_RESAMPLE - 1
+  with io.open(os.path.join(tmpdir, outfile + ".cacheinfo"), "w",
+               encoding="utf-8") as stream:
+    stream.write(json.dumps(cacheinfo))
+  # NOTE(josh): the check is a miss, since the output was last linked
+  # bypassing the cache, so the link writes a new cacheinfo.
+  run_link(args, tmpdir, command)
+  cacheinfo = read_cacheinfo(tmpdir, outfile)
+  if cacheinfo.get("bypassed") or "bypasses" in cacheinfo:
+    raise AssertionError(
+        "Expected {} to be checked, and the count restarted, after {}"
+        " bypasses".format(outfile, linkcache.BYPASS_RESAMPLE - 1))
+
+
+def count_bypasses(args, tmpdir, command, flags=()):
+  """
+  Link `command` `args.repeat` times (after once to record the cost of the
+  link and once more to record the cost of a check). Return the number of
+  times the cache was bypassed.
+  """
+  run_link(args, tmpdir, command, flags)
+  run_link(args, tmpdir, command, flags)
+  logger.info("%s costs: %s", command[-1], read_costs(tmpdir, command[-1]))
+  return sum(
+      run_link(args, tmpdir, command, flags) for _ in range(args.repeat))
+
+
+def runtest(tmpdir, args):
+  inputs = setup_fixture(tmpdir, args.ninputs)
+
+  bypasses = count_bypasses(args, tmpdir, ["fastld"] + inputs + ["-o", "fast"])
+  logger.info("Fast link bypassed %d of %d times", bypasses, args.repeat)
+  if bypasses < args.repeat // 2:
+    raise AssertionError(
+        "Expected the link which is faster than the check to be bypassed at"
+        " least {} of {} times, but it was bypassed {} times".format(
+            args.repeat // 2, args.repeat, bypasses))
+  check_resample(args, tmpdir, ["fastld"] + inputs + ["-o", "fast"])
+
+  for name, command, flags in (
+      ("slow", ["slowld"] + inputs + ["-o", "slow"], ()),
+      ("shared", ["fastld", "-shared"] + inputs + ["-o", "libfast.so"], ()),
+      ("no-bypass", ["fastld"] + inputs + ["-o", "fast2"], ["--no-bypass"])):
+    bypasses = count_bypasses(args, tmpdir, command, flags)
+    if bypasses:
+      raise AssertionError(
+          "The {} link was bypassed {} times".format(name, bypasses))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--ninputs", type=int, default=5000,
+      help="Number of object files in each link")
+  argparser.add_argument(
+      "--repeat", type=int, default=8,
+      help="Number of times to evaluate each link")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
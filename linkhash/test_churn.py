@@ -0,0 +1,186 @@
+"""
+Verify the API history kept for `linkcache churn`. A history replayed from
+it's keyframes and deltas should reproduce every snapshot. A library whose API
+changes twice, each time relinking it's consumer, should be ranked with two
+changes and two relinks, the symbols which were added and removed should be
+attributed those relinks, and `linkcache churn diff` should show them.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from linkhash import churn
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+MAIN_SOURCE = "int foo(void);\nint main(void) { return foo(); }\n"
+
+
+def check_replay(tmpdir):
+  """
+  Record many random changes to one library and verify that each snapshot is
+  reconstructed, and that keyframes are written at the expected interval.
+  """
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.cache_dir = os.path.join(tmpdir, "replay")
+  rng = random.Random(42)
+  universe = ["GLOBAL,sym{}".format(idx) for idx in range(64)]
+  expect = []
+  nchanges = 2 * churn.KEYFRAME_INTERVAL + 3
+  for idx in range(nchanges):
+    symbols = set(rng.sample(universe, 32))
+    churn.record_change(options, "/lib/libx.so", "v3-{:04d}".format(idx),
+                        symbols)
+    expect.append(symbols)
+
+  entries = churn.read_history(churn.get_history_path(options, "/lib/libx.so"))
+  actual = [state for _, state in churn.replay(entries)]
+  if actual != expect:
+    raise AssertionError("Replayed snapshots don't match those recorded")
+  keyframes = [
+      idx for idx, entry in enumerate(entries) if "symbols" in entry]
+  expect_keyframes = list(range(0, nchanges, churn.KEYFRAME_INTERVAL))
+  if keyframes != expect_keyframes:
+    raise AssertionError("Expected keyframes at {}, found them at {}".format(
+        expect_keyframes, keyframes))
+
+
+def link(args, tmpdir, env, command):
+  subprocess.check_call(
+      [sys.executable, args.linkcache, "--api-version", "3"] + command,
+      cwd=tmpdir, env=env)
+
+
+def build(args, tmpdir, env, source):
+  """Compile libfoo from `source`, and link it and prog."""
+  srcpath = os.path.join(tmpdir, "foo.c")
+  with io.open(srcpath, "w", encoding="utf-8") as outfile:
+    outfile.write(source)
+  subprocess.check_call(
+      [args.compiler, "-fPIC", "-c", "-o", "foo.o", "foo.c"], cwd=tmpdir)
+  link(args, tmpdir, env,
+       [args.compiler, "-shared", "foo.o", "-o", "libfoo.so"])
+  link(args, tmpdir, env,
+       [args.compiler, "main.o", "libfoo.so", "-Wl,-rpath," + tmpdir,
+        "-o", "prog"])
+
+
+def run_churn(args, tmpdir, env, argv):
+  return subprocess.check_output(
+      [sys.executable, args.linkcache, "churn"] + argv, cwd=tmpdir,
+      env=env).decode("utf-8")
+
+
+def find_symbol(rows, name):
+  for row in rows:
+    if "," + name + "," in "," + row["symbol"] + ",":
+      return row
+  raise AssertionError("{} isn't among the churned symbols: {}".format(
+      name, [row["symbol"] for row in rows]))
+
+
+def runtest(tmpdir, args):
+  check_replay(tmpdir)
+
+  env = dict(os.environ)
+  env["LINKCACHE_DIR"] = os.path.join(tmpdir, "cache")
+  with io.open(os.path.join(tmpdir, "main.c"), "w", encoding="utf-8") as outf:
+    outf.write(MAIN_SOURCE)
+  subprocess.check_call(
+      [args.compiler, "-c", "-o", "main.o", "main.c"], cwd=tmpdir)
+
+  build(args, tmpdir, env, "int foo(void) { return 0; }\n")
+  build(args, tmpdir, env,
+        "int foo(void) { return 0; }\nint baz(void) { return 1; }\n")
+  build(args, tmpdir, env,
+        "int foo(void) { return 0; }\nint qux(void) { return 2; }\n")
+  # A change which doesn't affect the API
+  build(args, tmpdir, env,
+        "int foo(void) { return 3; }\nint qux(void) { return 2; }\n")
+
+  report = json.loads(run_churn(args, tmpdir, env, ["--json"]))
+  libraries = report["libraries"]
+  if len(libraries) != 1 or not libraries[0]["library"].endswith("libfoo.so"):
+    raise AssertionError(
+        "Expected a history for libfoo.so only, got {}".format(libraries))
+  counts = (
+      libraries[0]["changes"], libraries[0]["relinks"],
+      libraries[0]["consumers"])
+  if counts != (2, 2, 1):
+    raise AssertionError(
+        "Expected libfoo.so to have 2 changes, 2 relinks of 1 consumer, got {}"
+        .format(counts))
+
+  symbols = report["symbols"]
+  for name, expect in (("baz", (2, 2)), ("qux", (1, 1))):
+    row = find_symbol(symbols, name)
+    if (row["changes"], row["relinks"]) != expect:
+      raise AssertionError(
+          "Expected {} to have {} changes and {} relinks, got {}".format(
+              name, expect[0], expect[1], row))
+  if symbols[0] is not find_symbol(symbols, "baz"):
+    raise AssertionError("Expected baz to be ranked first, got {}".format(
+        symbols[0]["symbol"]))
+
+  diff = run_churn(args, tmpdir, env, ["diff", "libfoo.so"]).splitlines()
+  changed = [line for line in diff if line[:2] in ("- ", "+ ")]
+  if len(changed) != 2 or not (
+      changed[0].startswith("- ") and "baz" in changed[0]
+      and changed[1].startswith("+ ") and "qux" in changed[1]):
+    raise AssertionError(
+        "Expected the latest change to remove baz and add qux, got:\n{}"
+        .format("\n".join(diff)))
+
+  diff = run_churn(args, tmpdir, env, ["diff", "libfoo.so", "0", "1"])
+  changed = [line for line in diff.splitlines() if line[:2] in ("- ", "+ ")]
+  if len(changed) != 1 or "baz" not in changed[0]:
+    raise AssertionError(
+        "Expected the first change to add baz, got:\n{}".format(diff))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to compile and link the test program")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+Stress test linkcache with many concurrent invocations on a shared set of
+outputs, as happens when two builds (or a build and an IDE) overlap on the same
+tree. Verify that no invocation observes a partially written sidecar and that
+a link completed by one invocation is reused by all of the others.
+"""
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# A linker which writes it's output in pieces, slowly, and records each
+# execution so that the test can count them.
+FAKE_LINKER = """\
+#!/bin/sh
+out=""
+prev=""
+for arg in "$@"; do
+  if [ "$prev" = "-o" ]; then
+    out="$arg"
+  fi
+  prev="$arg"
+done
+echo "$out" >> "$(dirname "$0")/links.log"
+echo "part1" > "$out"
+sleep 0.05
+echo "part2" >> "$out"
+"""
+
+# A linkhash which speaks the `--serve` protocol, using the checksum of the
+# file as it's digest
+FAKE_LINKHASH = """\
+#!/bin/sh
+if [ "$1" != "--serve" ]; then
+  exit 0
+fi
+while read path; do
+  echo "$path $(cksum < "$path" | cut -d' ' -f1)"
+done
+"""
+
+# Substrings of linkcache debug output which indicate a torn read
+TORN_READ_MESSAGES = [
+    "malformed cacheinfo sidecar",
+]
+
+
+def write_program(filepath, content):
+  with io.open(filepath, "w", encoding="utf-8") as outfile:
+    outfile.write(content)
+  os.chmod(filepath, 0o755)
+
+
+def setup_fixture(tmpdir):
+  """
+  Create the fake toolchain and a handful of inputs. Return a list of link
+  commands, one per output.
+  """
+  bindir = os.path.join(tmpdir, "bin")
+  os.makedirs(bindir)
+  write_program(os.path.join(bindir, "fakeld"), FAKE_LINKER)
+  write_program(os.path.join(bindir, "linkhash"), FAKE_LINKHASH)
+
+  inputs = []
+  for idx in range(8):
+    objpath = os.path.join(tmpdir, "obj{}.o".format(idx))
+    with open(objpath, "w") as outfile:
+      outfile.write("{}\n".format(idx))
+    inputs.append(objpath)
+
+  fakeld = os.path.join(bindir, "fakeld")
+  return [
+      [fakeld, "-shared"] + inputs[:4] + ["-o", "libfoo.so"],
+      [fakeld, "-shared"] + inputs[4:] + ["-o", "libbar.so"],
+      [fakeld] + inputs + ["-o", "prog1"],
+      [fakeld] + inputs[::2] + ["-o", "prog2"],
+  ]
+
+
+def get_linkcounts(tmpdir):
+  """Return a dictionary mapping output name to number of links executed."""
+  logpath = os.path.join(tmpdir, "bin", "links.log")
+  counts = {}
+  if not os.path.exists(logpath):
+    return counts
+  with io.open(logpath, "r", encoding="utf-8") as infile:
+    for line in infile:
+      line = line.strip()
+      counts[line] = counts.get(line, 0) + 1
+  os.unlink(logpath)
+  return counts
+
+
+def run_concurrently(args, tmpdir, commands):
+  """
+  Execute all of `commands` through linkcache concurrently. Raise an
+  AssertionError if any fails or reports a torn read.
+  """
+  env = dict(os.environ)
+  env["PATH"] = os.path.join(tmpdir, "bin") + ":" + env.get("PATH", "")
+  env["LINKCACHE_DIR"] = os.path.join(tmpdir, "cache")
+
+  # NOTE(josh): the fake linker is cheaper than a check, so without
+  # --no-bypass linkcache would (correctly) stop checking and link every time.
+  procs = []
+  for command in commands:
+    procs.append(subprocess.Popen(
+        [sys.executable, args.linkcache, "--log-level", "debug",
+         "--no-bypass"] + command,
+        cwd=tmpdir, env=env, stderr=subprocess.PIPE))
+
+  for proc in procs:
+    _, stderr = proc.communicate()
+    stderr = stderr.decode("utf-8")
+    if proc.returncode != 0:
+      raise AssertionError(
+          "linkcache exited with non-zero status:\n" + stderr)
+    for message in TORN_READ_MESSAGES:
+      if message in stderr:
+        raise AssertionError("Torn read detected:\n" + stderr)
+
+
+def assert_linked_once(tmpdir, commands):
+  counts = get_linkcounts(tmpdir)
+  expected = set(command[-1] for command in commands)
+  for outfile in sorted(expected.union(counts)):
+    count = counts.get(outfile, 0)
+    if count != (1 if outfile in expected else 0):
+      raise AssertionError(
+          "Expected {} to be linked {} times but it was linked {} times"
+          .format(outfile, int(outfile in expected), count))
+
+
+def runtest(tmpdir, args):
+  commands = setup_fixture(tmpdir)
+  njobs = args.nprocs // len(commands)
+
+  # Phase 1: nothing exists yet. Exactly one invocation per output should
+  # link, and all of the others should reuse it.
+  run_concurrently(args, tmpdir, commands * njobs)
+  assert_linked_once(tmpdir, commands)
+  lockfiles = [name for name in os.listdir(tmpdir) if name.endswith(".lock")]
+  if lockfiles:
+    raise AssertionError(
+        "Expected no lockfiles next to the outputs, got {}".format(lockfiles))
+  logger.info("Phase 1 OK: %d concurrent invocations", njobs * len(commands))
+
+  # Phase 2: all outputs up to date. Nothing should link.
+  run_concurrently(args, tmpdir, commands * njobs)
+  counts = get_linkcounts(tmpdir)
+  if counts:
+    raise AssertionError(
+        "Expected only cache hits but some outputs were linked: {}"
+        .format(counts))
+  logger.info("Phase 2 OK: %d concurrent invocations", njobs * len(commands))
+
+  # Phase 3: an input has changed. Each output which depends on it should
+  # relink exactly once.
+  time.sleep(1)
+  changed = os.path.join(tmpdir, "obj0.o")
+  with open(changed, "a") as outfile:
+    outfile.write("changed\n")
+  run_concurrently(args, tmpdir, commands * njobs)
+  assert_linked_once(
+      tmpdir, [command for command in commands if changed in command])
+  logger.info("Phase 3 OK: %d concurrent invocations", njobs * len(commands))
+
+  # Phase 4: two different commands alternate for the same output so that
+  # sidecars are constantly being rewritten while others read them.
+  prog, alternate = commands[2], commands[2][:1] + ["-g"] + commands[2][1:]
+  alternating = [prog, alternate] * (njobs // 2)
+  run_concurrently(args, tmpdir, alternating)
+  get_linkcounts(tmpdir)
+  logger.info("Phase 4 OK: %d concurrent invocations", len(alternating))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", default=os.path.join(
+          os.path.dirname(os.path.realpath(__file__)), "linkcache.py"),
+      help="Path to linkcache script")
+  argparser.add_argument(
+      "--nprocs", type=int, default=200,
+      help="Number of concurrent linkcache invocations per phase")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
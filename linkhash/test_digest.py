@@ -0,0 +1,262 @@
+"""
+Benchmark API digests of a generated shared object with a very large number of
+exported symbols. Verify that the streaming (version 3) digest is independent
+of symbol order, that it is identical when computed in-process and by
+linkhash, and that the in-process computation uses a bounded amount of memory
+regardless of the number of symbols. Also verify the API model itself on a
+small library with versioned, weak, TLS, data, hidden and undefined symbols:
+the records which elfapi extracts, and that linkhash (`--dump-api`) extracts
+exactly the same ones.
+"""
+
+import argparse
+import io
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from linkhash import elfapi
+
+logger = logging.getLogger(__name__)
+
+
+MODEL_SOURCE = """\
+int api_func(void) { return 0; }
+int api_data[4] = {1};
+__thread int api_tls;
+__attribute__((weak)) int api_weak(void) { return 1; }
+__attribute__((visibility("hidden"))) int hidden_func(void) { return 2; }
+__attribute__((visibility("protected"))) int protected_func(void) {
+  return 3;
+}
+int local_func(void) { return 4; }
+extern int undefined_func(void);
+int calls_undefined(void) { return undefined_func(); }
+int compat_v1(void) { return 5; }
+int compat_v2(void) { return 6; }
+__asm__(".symver compat_v1, compat@VERS_1");
+__asm__(".symver compat_v2, compat@@VERS_2");
+"""
+
+MODEL_VERSION_SCRIPT = """\
+VERS_1 {
+  global: api_*; protected_func; hidden_func; calls_undefined; compat;
+  local: *;
+};
+VERS_2 {
+  global: compat;
+} VERS_1;
+"""
+
+# Records which must be extracted from the model library. The linker may add
+# records for the version definitions (e.g. VERS_1@@VERS_1) as well.
+MODEL_API = [
+    "GLOBAL,FUNC,api_func@@VERS_1",
+    "GLOBAL,FUNC,calls_undefined@@VERS_1",
+    "GLOBAL,FUNC,compat@@VERS_2",
+    "GLOBAL,FUNC,compat@VERS_1",
+    "GLOBAL,FUNC,protected_func@@VERS_1",
+    "GLOBAL,OBJECT,api_data@@VERS_1,16",
+    "GLOBAL,TLS,api_tls@@VERS_1,4",
+    "WEAK,FUNC,api_weak@@VERS_1",
+]
+
+# Symbols of the model library which are not part of it's API
+MODEL_EXCLUDED = ["hidden_func", "local_func", "undefined_func"]
+
+
+def write_library(tmpdir, name, symbols, compiler):
+  """
+  Assemble and link a shared object exporting a function for each of
+  `symbols`, in the given order. Return it's path.
+  """
+  asmpath = os.path.join(tmpdir, name + ".s")
+  with io.open(asmpath, "w", encoding="utf-8") as outfile:
+    outfile.write(".text\n")
+    for symbol in symbols:
+      outfile.write(
+          ".globl {0}\n.type {0},@function\n{0}:\n  ret\n".format(symbol))
+    # One data object so that the size field is exercised
+    outfile.write(
+        ".data\n.globl table\n.type table,@object\n.size table,16\n"
+        "table:\n  .zero 16\n")
+    outfile.write(".section .note.GNU-stack,\"\",@progbits\n")
+
+  sopath = os.path.join(tmpdir, name + ".so")
+  subprocess.check_call(
+      [compiler, "-shared", "-nostdlib", "-o", sopath, asmpath])
+  os.unlink(asmpath)
+  return sopath
+
+
+def write_model_library(tmpdir, compiler):
+  """Compile and link the model library. Return it's path."""
+  srcpath = os.path.join(tmpdir, "model.c")
+  with io.open(srcpath, "w", encoding="utf-8") as outfile:
+    outfile.write(MODEL_SOURCE)
+  mappath = os.path.join(tmpdir, "model.map")
+  with io.open(mappath, "w", encoding="utf-8") as outfile:
+    outfile.write(MODEL_VERSION_SCRIPT)
+  sopath = os.path.join(tmpdir, "libmodel.so")
+  subprocess.check_call(
+      [compiler, "-shared", "-fPIC", "-Wl,--version-script=" + mappath,
+       "-o", sopath, srcpath])
+  return sopath
+
+
+def check_model(tmpdir, args):
+  sopath = write_model_library(tmpdir, args.compiler)
+  records = [record.decode("utf-8") for record in elfapi.get_api(sopath)]
+  missing = [record for record in MODEL_API if record not in records]
+  if missing:
+    raise AssertionError(
+        "Expected the API of the model library to include {}, got {}".format(
+            missing, records))
+  for record in records:
+    name = record.split(",")[2].split("@")[0]
+    if name in MODEL_EXCLUDED:
+      raise AssertionError(
+          "Expected {} to be excluded from the API, got {}".format(
+              name, record))
+
+  if not args.linkhash:
+    return
+
+  dump = subprocess.check_output(
+      [args.linkhash, "--api-version", "2", "--dump-api", sopath])
+  dump = dump.decode("utf-8").splitlines()
+  if dump != records:
+    raise AssertionError(
+        "linkhash v2 API of the model library:\n  {}\ndoes not match the"
+        " in-process API:\n  {}".format("\n  ".join(dump),
+                                        "\n  ".join(records)))
+  digest, _ = run_linkhash(args.linkhash, 2, sopath)
+  if digest != elfapi.get_apid(sopath, 2):
+    raise AssertionError(
+        "linkhash v2 digest {} of the model library does not match the"
+        " in-process digest {}".format(digest, elfapi.get_apid(sopath, 2)))
+
+
+def measure(fn, *args):
+  """
+  Return a tuple of (result, seconds) for `fn(*args)`.
+  """
+  tstart = time.time()
+  result = fn(*args)
+  return result, time.time() - tstart
+
+
+def measure_peak(fn, *args):
+  """
+  Return the peak number of bytes allocated by python during `fn(*args)`.
+  This is measured separately from timing since tracing allocations is slow.
+  """
+  tracemalloc.start()
+  fn(*args)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return peak
+
+
+def run_linkhash(linkhash, api_version, sopath):
+  """Return a tuple of (digest, seconds) for linkhash."""
+  tstart = time.time()
+  digest = subprocess.check_output(
+      [linkhash, "--api-version", str(api_version), sopath]).decode("utf-8")
+  return digest.strip(), time.time() - tstart
+
+
+def runtest(tmpdir, args):
+  check_model(tmpdir, args)
+
+  symbols = ["sym_{:07d}".format(idx) for idx in range(args.nsymbols)]
+  tstart = time.time()
+  sopath = write_library(tmpdir, "libbig", symbols, args.compiler)
+  logger.info(
+      "Generated %s with %d symbols in %.1fs (%.1f MiB)", sopath,
+      args.nsymbols, time.time() - tstart,
+      os.path.getsize(sopath) / (1024.0 * 1024.0))
+
+  v3, v3_time = measure(elfapi.get_apid, sopath, 3)
+  v2, v2_time = measure(elfapi.get_apid, sopath, 2)
+  v3_peak = measure_peak(elfapi.get_apid, sopath, 3)
+  logger.info("In-process v2 digest: %.2fs", v2_time)
+  logger.info(
+      "In-process v3 digest: %.2fs, peak %.1f MiB", v3_time,
+      v3_peak / (1024.0 * 1024.0))
+
+  if v3_peak > args.max_peak_mib * 1024 * 1024:
+    raise AssertionError(
+        "Streaming digest allocated {:.1f} MiB, expected at most {:.1f} MiB"
+        .format(v3_peak / (1024.0 * 1024.0), args.max_peak_mib))
+
+  # The same symbols in a different order must have the same digest
+  random.Random(0).shuffle(symbols)
+  shuffled = write_library(tmpdir, "libshuffled", symbols, args.compiler)
+  if elfapi.get_apid(shuffled, 3) != v3:
+    raise AssertionError("Streaming digest depends on symbol order")
+  if elfapi.get_apid(shuffled, 2) != v2:
+    raise AssertionError("Sorted digest depends on symbol order")
+
+  if not args.linkhash:
+    return
+
+  for api_version, expect in ((2, v2), (3, v3)):
+    digest, duration = run_linkhash(args.linkhash, api_version, sopath)
+    logger.info("linkhash v%d digest: %.2fs", api_version, duration)
+    if digest != expect:
+      raise AssertionError(
+          "linkhash v{} digest {} does not match in-process digest {}".format(
+              api_version, digest, expect))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkhash",
+      help="Path to the linkhash binary. If not specified, only the in-process"
+           " digest is tested")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to assemble and link the shared object")
+  argparser.add_argument(
+      "--nsymbols", type=int, default=1000000,
+      help="Number of symbols exported by the generated shared object")
+  argparser.add_argument(
+      "--max-peak-mib", type=float, default=8.0,
+      help="Maximum memory the streaming digest may allocate")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
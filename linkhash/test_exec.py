@@ -0,0 +1,236 @@
+"""
+Verify `linkcache exec`, the cache of arbitrary commands with declared inputs
+and outputs: a command which writes a new output (like `objcopy
+--only-keep-debug`), a command which modifies it's input in place (like
+`strip -g`), and a command declared by a spec file. Each should be skipped,
+and it's outputs touched, until the command or an input changes.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import action
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# A program which records that it ran, then either copies it's first argument
+# to it's second (with a marker appended), or appends a marker to it's only
+# argument, in place.
+FAKE_TOOL = """\
+#!{python}
+import sys
+with open({logpath!r}, "a") as logfile:
+  logfile.write(" ".join(sys.argv[1:]) + "\\n")
+args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+with open(args[0]) as infile:
+  content = infile.read()
+with open(args[-1], "w") as outfile:
+  outfile.write(content + "tool\\n")
+"""
+
+
+class Fixture(object):
+  """A fake post-link tool, and a program for it to process."""
+
+  def __init__(self, args, tmpdir):
+    self.args = args
+    self.tmpdir = tmpdir
+    self.toolpath = os.path.join(tmpdir, "fakeobjcopy")
+    self.logpath = os.path.join(tmpdir, "tool.log")
+    with io.open(self.toolpath, "w", encoding="utf-8") as outfile:
+      outfile.write(FAKE_TOOL.format(
+          python=sys.executable, logpath=self.logpath))
+    os.chmod(self.toolpath, 0o755)
+    self.write("prog", "linked\n", age=100)
+
+  def write(self, name, content, age=0):
+    path = os.path.join(self.tmpdir, name)
+    with io.open(path, "w", encoding="utf-8") as outfile:
+      outfile.write(content)
+    when = time.time() - age
+    os.utime(path, (when, when))
+
+  def count_runs(self):
+    if not os.path.exists(self.logpath):
+      return 0
+    with io.open(self.logpath, "r", encoding="utf-8") as infile:
+      return len(infile.readlines())
+
+  def run(self, argv, expect_run, what):
+    """Execute `linkcache exec` with `argv` and verify whether the tool ran."""
+    before = self.count_runs()
+    proc = subprocess.Popen(
+        [sys.executable, self.args.linkcache, "--log-level", "debug",
+         "--no-bypass", "exec"] + list(argv),
+        cwd=self.tmpdir, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    stderr = stderr.decode("utf-8")
+    if proc.returncode != 0:
+      raise AssertionError(
+          "linkcache exec exited with non-zero status for {}:\n{}".format(
+              what, stderr))
+    ran = self.count_runs() > before
+    if ran != expect_run:
+      raise AssertionError("Expected {} to be a {}, got:\n{}".format(
+          what, "miss" if expect_run else "hit", stderr))
+    return stderr
+
+  def read_cacheinfo(self, name):
+    with io.open(os.path.join(self.tmpdir, name), "r",
+                 encoding="utf-8") as infile:
+      return json.load(infile)
+
+
+def check_new_output(fixture):
+  """A command which writes a new output from an unmodified input."""
+  argv = ["--in", "prog", "--out", "prog.debug", "--",
+          fixture.toolpath, "--only-keep-debug", "prog", "prog.debug"]
+  fixture.run(argv, True, "the first objcopy")
+  cacheinfo = fixture.read_cacheinfo("prog.debug.exec.cacheinfo")
+  if "link" not in cacheinfo.get("costs", {}):
+    raise AssertionError(
+        "Expected the cost of the command to be recorded, got {}".format(
+            cacheinfo))
+
+  debugpath = os.path.join(fixture.tmpdir, "prog.debug")
+  past = time.time() - 50
+  os.utime(debugpath, (past, past))
+  stderr = fixture.run(argv, False, "the second objcopy")
+  if "Using link-cache" not in stderr:
+    raise AssertionError("Expected a hit, got:\n{}".format(stderr))
+  if os.stat(debugpath).st_mtime <= past:
+    raise AssertionError("Expected the output to be touched on a hit")
+
+  fixture.write("prog", "relinked\n")
+  fixture.run(argv, True, "objcopy after a relink")
+  fixture.run(argv, False, "objcopy after the relink was processed")
+
+  changed = argv[:-2] + ["--strip-debug"] + argv[-2:]
+  fixture.run(changed, True, "objcopy with a changed command")
+
+
+def check_in_place(fixture):
+  """A command which modifies it's input in place."""
+  fixture.write("lib.so", "linked\n", age=100)
+  argv = ["--name", "strip", "--in", "lib.so", "--out", "lib.so", "--",
+          fixture.toolpath, "-g", "lib.so"]
+  fixture.run(argv, True, "the first strip")
+  cacheinfo = fixture.read_cacheinfo("lib.so.strip.cacheinfo")
+  if "lib.so" not in cacheinfo.get("fingerprints", {}):
+    raise AssertionError(
+        "Expected the fingerprint of lib.so to be recorded, got {}".format(
+            cacheinfo))
+
+  libpath = os.path.join(fixture.tmpdir, "lib.so")
+  mtime = os.stat(libpath).st_mtime_ns
+  fixture.run(argv, False, "the second strip")
+  if os.stat(libpath).st_mtime_ns != mtime:
+    raise AssertionError("Expected an in-place output not to be touched")
+
+  # A touch doesn't change the content, and the new mtime is recorded so
+  # that the next check doesn't digest the file again
+  os.utime(libpath, None)
+  stderr = fixture.run(argv, False, "strip after a touch")
+  if "was touched" not in stderr:
+    raise AssertionError(
+        "Expected the content of the touched file to be compared, got:\n{}"
+        .format(stderr))
+  stderr = fixture.run(argv, False, "strip after the touch was recorded")
+  if "was touched" in stderr:
+    raise AssertionError(
+        "Expected the mtime of the touched file to be recorded, got:\n{}"
+        .format(stderr))
+
+  # The same size and a new mtime, but different content
+  with io.open(libpath, "r", encoding="utf-8") as infile:
+    content = infile.read()
+  fixture.write("lib.so", content.upper())
+  fixture.run(argv, True, "strip after the content changed")
+
+  fixture.write("lib.so", "relinked\n")
+  fixture.run(argv, True, "strip after a relink")
+  fixture.run(argv, False, "strip after the relink was processed")
+
+
+def check_spec(fixture):
+  """A command declared by a spec file."""
+  specpath = os.path.join(fixture.tmpdir, "objcopy.json")
+  with io.open(specpath, "w", encoding="utf-8") as outfile:
+    json.dump({
+        "inputs": ["prog"],
+        "outputs": ["prog.dbg"],
+        "command": [fixture.toolpath, "prog", "prog.dbg"],
+    }, outfile)
+  fixture.run(["--spec", specpath], True, "the first command of the spec")
+  fixture.run(["--spec", specpath], False, "the second command of the spec")
+
+  os.unlink(os.path.join(fixture.tmpdir, "prog.dbg"))
+  fixture.run(["--spec", specpath], True, "the spec after removing it's output")
+
+
+def check_execspec(tmpdir):
+  """The arguments of a command aren't subject to the link argument rules."""
+  options = linkcache.Options(**linkcache.get_default_options())
+  argv = ["strip", "-w", "-K", "main", "prog"]
+  ctx = action.ActionContext(argv, ["prog"], ["prog"], options, cwd=tmpdir)
+  if ctx.execspec["argv"] != argv:
+    raise AssertionError(
+        "Expected the arguments to be hashed verbatim, got {}".format(
+            ctx.execspec["argv"]))
+  other = action.ActionContext(argv, ["prog"], ["prog.out"], options,
+                               cwd=tmpdir)
+  if other.execspec["hash"] == ctx.execspec["hash"]:
+    raise AssertionError("Expected the declared outputs to be hashed")
+
+
+def runtest(tmpdir, args):
+  check_execspec(tmpdir)
+  fixture = Fixture(args, tmpdir)
+  check_new_output(fixture)
+  check_in_place(fixture)
+  check_spec(fixture)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
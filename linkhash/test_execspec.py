@@ -0,0 +1,213 @@
+"""
+Verify that the execspec is relocatable and that it's environment is filtered
+as configured. The same link in two checkouts at different locations should
+hash the same once the build and source roots are given, while a path which
+only contains a root somewhere in the middle should not be rewritten.
+Environment variables should be included or excluded according to the
+built-in lists, `--env-allow` and `--env-deny`.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+
+def get_options(**kwargs):
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.no_toolchain_fingerprint = True
+  for key, value in kwargs.items():
+    setattr(options, key, value)
+  return options
+
+
+def get_link(root):
+  """Return the link command and working directory of a checkout at `root`."""
+  builddir = os.path.join(root, "build")
+  command = [
+      "/usr/bin/c++", "-O2", "-I{}/src/include".format(root),
+      "CMakeFiles/prog.dir/main.cc.o",
+      "{}/lib/libfoo.so".format(builddir), "-o", "prog",
+      "-L{}/lib".format(builddir),
+      "-Wl,-rpath,{0}/lib:{1}/third_party/lib".format(builddir, root),
+      "-Wl,-rpath-link={}/lib".format(builddir),
+      "-Wl,--version-script={}/src/exports.map".format(root),
+  ]
+  return command, builddir
+
+
+def get_hash(root, relocatable):
+  command, cwd = get_link(root)
+  options = get_options()
+  if relocatable:
+    options.build_root = cwd
+    options.source_root = root
+  return linkcache.get_execspec(command, options, cwd=cwd)["hash"]
+
+
+class Environment(object):
+  """Context manager which replaces variables of `os.environ`."""
+
+  def __init__(self, **kwargs):
+    self.changes = kwargs
+    self.saved = {}
+
+  def __enter__(self):
+    for key, value in self.changes.items():
+      self.saved[key] = os.environ.get(key)
+      if value is None:
+        os.environ.pop(key, None)
+      else:
+        os.environ[key] = value
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    for key, value in self.saved.items():
+      if value is None:
+        os.environ.pop(key, None)
+      else:
+        os.environ[key] = value
+
+
+def check_relocation():
+  if get_hash("/home/alice/proj", False) == get_hash("/srv/ci/proj", False):
+    raise AssertionError(
+        "Expected checkouts at different locations to hash differently"
+        " without --build-root")
+  if get_hash("/home/alice/proj", True) != get_hash("/srv/ci/proj", True):
+    raise AssertionError(
+        "Expected checkouts at different locations to hash the same with"
+        " --build-root and --source-root")
+
+  options = get_options(
+      build_root="/a/build", source_root="/a",
+      path_prefix=["SDK=/opt/sdk"])
+  normalize = linkcache.get_path_normalizer(
+      linkcache.get_path_prefixes(options))
+  for text, expect in (
+      ("/a/build/z.o", "${BUILD_ROOT}/z.o"),
+      ("/a/src/z.c", "${SOURCE_ROOT}/src/z.c"),
+      ("/a/build", "${BUILD_ROOT}"),
+      ("-L/a/build/lib", "-L${BUILD_ROOT}/lib"),
+      ("-Wl,-rpath,/a/build/lib:/opt/sdk/lib",
+       "-Wl,-rpath,${BUILD_ROOT}/lib:${SDK}/lib"),
+      ("--sysroot=/opt/sdk", "--sysroot=${SDK}"),
+      # Not at the start of a path
+      ("/x/a/build/z.o", "/x/a/build/z.o"),
+      ("-fprofile-use=/x/a/build", "-fprofile-use=/x/a/build"),
+      ("-Wl,-rpath,/x/a/build/lib", "-Wl,-rpath,/x/a/build/lib"),
+      ("/opt/sdkextra/lib", "/opt/sdkextra/lib"),
+      ("/a/buildtree/z.o", "${SOURCE_ROOT}/buildtree/z.o")):
+    if normalize(text) != expect:
+      raise AssertionError("Expected {} to be normalized as {}, got {}".format(
+          text, expect, normalize(text)))
+
+  # The same relative layout under unrelated parents is still distinct
+  first = linkcache.get_execspec(
+      ["c++", "/x/a/build/z.o", "-o", "prog"], options, cwd="/a/build")
+  second = linkcache.get_execspec(
+      ["c++", "/y/a/build/z.o", "-o", "prog"], options, cwd="/a/build")
+  if first["hash"] == second["hash"]:
+    raise AssertionError(
+        "Expected inputs outside of the roots to hash differently")
+
+
+def get_env_hash(options, memo=None, **environ):
+  with Environment(**environ):
+    return linkcache.get_execspec(
+        ["c++", "main.o", "-o", "prog"], options, cwd="/a/build", memo=memo)
+
+
+def check_env():
+  defaults = get_options()
+  base = get_env_hash(
+      defaults, LD_LIBRARY_PATH="/one", LD_RUN_PATH="/one", MY_FLAGS="one")
+  if "LD_RUN_PATH" not in base["env"]:
+    raise AssertionError("Expected LD_RUN_PATH to be kept by default")
+  for key in ("LD_LIBRARY_PATH", "PATH", "MY_FLAGS"):
+    if key in base["env"]:
+      raise AssertionError("Expected {} to be dropped by default".format(key))
+
+  for options, changes, same, what in (
+      (defaults, {"LD_LIBRARY_PATH": "/two"}, True,
+       "a denied variable"),
+      (defaults, {"MY_FLAGS": "two"}, True,
+       "a variable which isn't allowed"),
+      (defaults, {"LD_RUN_PATH": "/two"}, False,
+       "a variable allowed by default"),
+      (get_options(env_allow=["LD_LIBRARY_PATH"]),
+       {"LD_LIBRARY_PATH": "/two"}, False,
+       "a denied variable which is allowed again"),
+      (get_options(env_allow=["MY_*"]), {"MY_FLAGS": "two"}, False,
+       "a variable allowed by a pattern"),
+      (get_options(env_deny=["LD_RUN*"]), {"LD_RUN_PATH": "/two"}, True,
+       "a variable denied by a pattern"),
+      (get_options(env_allow=["MY_*"], env_deny=["MY_FLAGS"]),
+       {"MY_FLAGS": "two"}, True,
+       "a variable both allowed and denied")):
+    environ = {
+        "LD_LIBRARY_PATH": "/one", "LD_RUN_PATH": "/one", "MY_FLAGS": "one"}
+    before = get_env_hash(options, **environ)["hash"]
+    environ.update(changes)
+    after = get_env_hash(options, **environ)["hash"]
+    if (before == after) != same:
+      raise AssertionError("Expected a change to {} to {}".format(
+          what, "be ignored" if same else "change the hash"))
+    # The patterns compiled for `linkcache explain` filter the same way
+    if get_env_hash(options, memo={}, **environ)["hash"] != after:
+      raise AssertionError(
+          "Expected the memoized filter to match for {}".format(what))
+
+  # Values are relocated just like arguments
+  relocatable = get_options(build_root="/a/build")
+  first = get_env_hash(relocatable, LD_RUN_PATH="/a/build/lib")
+  relocatable.build_root = "/b/build"
+  second = get_env_hash(relocatable, LD_RUN_PATH="/b/build/lib")
+  if first["env"] != second["env"]:
+    raise AssertionError(
+        "Expected environment values to be relocated, got {} and {}".format(
+            first["env"], second["env"]))
+
+
+def runtest(tmpdir, args):
+  check_relocation()
+  check_env()
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
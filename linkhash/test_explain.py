@@ -0,0 +1,361 @@
+"""
+Exercise `linkcache explain` on a build tree with one output for each reason
+that linkcache might have to relink it, and verify the decision, reason,
+blocking input and details reported for each, in both the table and the
+`--json` report. Also verify that a tree with many outputs (20k by default) is
+explained within a few seconds.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+SOURCES = {
+    "main.c": "int main(void) { return 0; }\n",
+    "extra.c": "int extra(void) { return 0; }\n",
+    "stable.c": "int stable(void) { return %d; }\n",
+    "api.c": "int api_one(void) { return 1; }\n%s",
+}
+
+# Output name, inputs and environment of each link. The comments give the
+# expected decision after the tree is modified by `runtest()`.
+LINKS = [
+    # hit, libstable.so is relinked but it's API doesn't change
+    ("hit", ["main.o", "libstable.so"], {}),
+    # no-output, the output is deleted
+    ("gone", ["main.o"], {}),
+    # input-changed, extra.o is touched
+    ("changed", ["main.o", "extra.o"], {}),
+    # command-changed, LD_RUN_PATH is unset for explain
+    ("envchanged", ["main.o"], {"LD_RUN_PATH": "/one"}),
+    # accel-changed, an acceleration policy is recorded in the cacheinfo
+    ("accel", ["main.o"], {}),
+    # bypassed, the cacheinfo records that the cache was bypassed
+    ("bypassed", ["main.o"], {}),
+    # hit, though the link costs less than a check and the recorded command
+    # doesn't disable the bypass
+    ("cheap", ["main.o"], {}),
+    # api-changed, a symbol is added to libapi.so
+    ("apichanged", ["main.o", "libapi.so"], {}),
+    # no-apid, libcopy.so has no sidecar and is touched
+    ("noapid", ["main.o", "libcopy.so"], {}),
+]
+
+EXPECT = {
+    "hit": ("hit", None, None),
+    "gone": ("miss", "no-output", "gone"),
+    "changed": ("miss", "input-changed", "extra.o"),
+    "envchanged": ("miss", "command-changed", None),
+    "accel": ("miss", "accel-changed", None),
+    "bypassed": ("miss", "bypassed", None),
+    "cheap": ("hit", None, None),
+    "apichanged": ("miss", "api-changed", "libapi.so"),
+    "noapid": ("miss", "no-apid", "libcopy.so"),
+    "copy.o": ("hit", None, None),
+    "extra.copy": ("miss", "input-changed", "extra.o"),
+    "orphan": ("unknown", "no-invocation", None),
+    "garbled": ("unknown", "bad-invocation", None),
+}
+
+
+def write_file(filepath, content):
+  with io.open(filepath, "w", encoding="utf-8") as outfile:
+    outfile.write(content)
+
+
+def make_old(filepath):
+  past = time.time() - 100
+  os.utime(filepath, (past, past))
+
+
+def read_cacheinfo(outpath):
+  with io.open(outpath + ".cacheinfo", "r", encoding="utf-8") as infile:
+    return json.load(infile)
+
+
+def write_cacheinfo(outpath, cacheinfo):
+  write_file(outpath + ".cacheinfo", json.dumps(cacheinfo, indent=2))
+
+
+def get_env(**kwargs):
+  env = dict(os.environ)
+  env.pop("LD_RUN_PATH", None)
+  env.update(kwargs)
+  return env
+
+
+def run_linkcache(args, builddir, argv, env=None):
+  subprocess.check_call(
+      [sys.executable, args.linkcache, "--no-bypass", "--api-version", "3",
+       "--cache-dir", os.path.join(os.path.dirname(builddir), "cache")]
+      + argv, cwd=builddir, env=env or get_env())
+
+
+def run_explain(args, builddir, flags):
+  return subprocess.check_output(
+      [sys.executable, args.linkcache,
+       "--cache-dir", os.path.join(os.path.dirname(builddir), "cache"),
+       "explain", builddir] + flags, env=get_env()).decode("utf-8")
+
+
+def build_shared(args, builddir, name, source):
+  run_linkcache(
+      args, builddir,
+      [args.compiler, "-shared", "-fPIC", "-o", name, source])
+
+
+def setup_tree(args, builddir):
+  """Link every output of `LINKS` and then modify the tree."""
+  write_file(os.path.join(builddir, "main.c"), SOURCES["main.c"])
+  write_file(os.path.join(builddir, "extra.c"), SOURCES["extra.c"])
+  write_file(os.path.join(builddir, "stable.c"), SOURCES["stable.c"] % 1)
+  write_file(os.path.join(builddir, "api.c"), SOURCES["api.c"] % "")
+  for name in ("main", "extra"):
+    subprocess.check_call(
+        [args.compiler, "-c", "-o", name + ".o", name + ".c"], cwd=builddir)
+  build_shared(args, builddir, "libstable.so", "stable.c")
+  build_shared(args, builddir, "libapi.so", "api.c")
+  shutil.copyfile(
+      os.path.join(builddir, "libstable.so"),
+      os.path.join(builddir, "libcopy.so"))
+  for filename in os.listdir(builddir):
+    make_old(os.path.join(builddir, filename))
+
+  for name, inputs, env in LINKS:
+    run_linkcache(
+        args, builddir, [args.compiler, "-o", name] + inputs, get_env(**env))
+
+  # `linkcache exec` sidecars are evaluated as the command they record
+  for source, output in (("main.o", "copy.o"), ("extra.o", "extra.copy")):
+    run_linkcache(
+        args, builddir,
+        ["exec", "--in", source, "--out", output, "--", "cp", source, output])
+
+  os.remove(os.path.join(builddir, "gone"))
+  os.utime(os.path.join(builddir, "extra.o"))
+  os.utime(os.path.join(builddir, "libcopy.so"))
+
+  write_file(os.path.join(builddir, "stable.c"), SOURCES["stable.c"] % 2)
+  build_shared(args, builddir, "libstable.so", "stable.c")
+  write_file(os.path.join(builddir, "api.c"),
+             SOURCES["api.c"] % "int api_two(void) { return 2; }\n")
+  build_shared(args, builddir, "libapi.so", "api.c")
+
+  outpath = os.path.join(builddir, "accel")
+  cacheinfo = read_cacheinfo(outpath)
+  cacheinfo["accel"] = {"linker": "lld", "gdb_index": True, "threads": 4}
+  write_cacheinfo(outpath, cacheinfo)
+
+  outpath = os.path.join(builddir, "bypassed")
+  cacheinfo = read_cacheinfo(outpath)
+  cacheinfo["bypassed"] = True
+  write_cacheinfo(outpath, cacheinfo)
+
+  outpath = os.path.join(builddir, "cheap")
+  cacheinfo = read_cacheinfo(outpath)
+  cacheinfo["costs"] = {"link": 0.001, "check": 1.0}
+  cacheinfo["invocation"]["argv"].remove("--no-bypass")
+  write_cacheinfo(outpath, cacheinfo)
+
+  # Written by an older version of linkcache
+  write_file(os.path.join(builddir, "orphan"), "")
+  write_cacheinfo(os.path.join(builddir, "orphan"), {"hash": "0" * 40})
+
+  # Not a command linkcache would have executed
+  write_file(os.path.join(builddir, "garbled"), "")
+  write_cacheinfo(
+      os.path.join(builddir, "garbled"),
+      {"invocation": {"argv": ["--no-such-flag", "cc"], "cwd": builddir}})
+
+
+def check_report(args, builddir):
+  report = json.loads(run_explain(args, builddir, ["--json"]))
+  results = {
+      result["output"]: result for result in report["outputs"]
+      if not result["output"].startswith("lib")}
+  for output, (decision, reason, blocker) in sorted(EXPECT.items()):
+    result = results.get(output)
+    if result is None:
+      raise AssertionError("Expected a result for {}".format(output))
+    actual = (result["decision"], result["reason"], result["blocker"])
+    if actual != (decision, reason, blocker):
+      raise AssertionError(
+          "Expected {} to be reported as {}, got {}".format(
+              output, (decision, reason, blocker), actual))
+
+  if any(result["output"].endswith(".exec") for result in report["outputs"]):
+    raise AssertionError(
+        "Expected exec sidecars to be reported by their declared output")
+
+  details = results["envchanged"]["details"]
+  if details != ["env LD_RUN_PATH: '/one' -> None"]:
+    raise AssertionError(
+        "Expected the details of envchanged to name LD_RUN_PATH, got {}"
+        .format(details))
+  details = results["apichanged"]["details"]
+  if not any(line.startswith("+ ") and "api_two" in line for line in details):
+    raise AssertionError(
+        "Expected the details of apichanged to include api_two, got {}"
+        .format(details))
+  if any("api_one" in line for line in details):
+    raise AssertionError(
+        "Expected the details of apichanged to omit api_one, got {}"
+        .format(details))
+
+  summary = report["summary"]
+  if summary.get("outputs") != len(report["outputs"]):
+    raise AssertionError("Inconsistent summary {}".format(summary))
+  for decision in ("hit", "miss", "unknown"):
+    count = len([result for result in report["outputs"]
+                 if result["decision"] == decision])
+    if summary.get(decision, 0) != count:
+      raise AssertionError("Expected {} {} in the summary, got {}".format(
+          count, decision, summary))
+  return summary
+
+
+def check_table(args, builddir, summary):
+  lines = run_explain(args, builddir, []).splitlines()
+  # NOTE(josh): every miss has a reason, so the output is the third column
+  rows = {}
+  for line in lines[1:]:
+    parts = line.split()
+    if parts and parts[0] in ("miss", "unknown"):
+      rows[parts[2]] = parts
+    elif parts and parts[0] == "hit":
+      rows[parts[1]] = parts
+  if "hit" in rows:
+    raise AssertionError("Expected hits to be omitted from the table")
+  for output, (decision, reason, _) in EXPECT.items():
+    if decision == "hit":
+      continue
+    if output not in rows or rows[output][:2] != [decision, reason]:
+      raise AssertionError("Expected a table row for {} {}, got {}".format(
+          output, reason, rows.get(output)))
+  if not any(line.strip() == "env LD_RUN_PATH: '/one' -> None"
+             for line in lines):
+    raise AssertionError("Expected the details of envchanged in the table")
+
+  expect = "{} outputs: {} hit, {} miss, {} unknown".format(
+      summary["outputs"], summary.get("hit", 0), summary.get("miss", 0),
+      summary.get("unknown", 0))
+  if lines[-1] != expect:
+    raise AssertionError("Expected the table to end with {!r}, got {!r}"
+                         .format(expect, lines[-1]))
+
+  lines = run_explain(
+      args, builddir, ["--all", "--max-details", "0"]).splitlines()
+  if not any(line.split()[:2] == ["hit", "hit"] for line in lines if line):
+    raise AssertionError("Expected hits to be listed with --all")
+  if any(line.startswith("    ") and "..." not in line for line in lines):
+    raise AssertionError("Expected no details with --max-details 0")
+
+
+def check_scale(args, tmpdir):
+  """
+  Link one output, clone it's cacheinfo for `args.noutputs` outputs and time
+  `linkcache explain` on the result.
+  """
+  builddir = os.path.join(tmpdir, "scale")
+  os.makedirs(builddir)
+  write_file(os.path.join(builddir, "main.c"), SOURCES["main.c"])
+  subprocess.check_call(
+      [args.compiler, "-c", "-o", "main.o", "main.c"], cwd=builddir)
+  make_old(os.path.join(builddir, "main.o"))
+  run_linkcache(args, builddir, [args.compiler, "-o", "prog0", "main.o"])
+
+  template = read_cacheinfo(os.path.join(builddir, "prog0"))
+  for idx in range(1, args.noutputs):
+    name = "prog{}".format(idx)
+    cacheinfo = dict(template)
+    cacheinfo["argv"] = [
+        name if arg == "prog0" else arg for arg in template["argv"]]
+    cacheinfo["invocation"] = dict(
+        template["invocation"], argv=[
+            name if arg == "prog0" else arg
+            for arg in template["invocation"]["argv"]])
+    spec = dict((key, cacheinfo[key]) for key in (
+        "version", "argv", "cwd", "env", "toolchain") if key in cacheinfo)
+    cacheinfo["hash"] = linkcache.get_spechash(spec)
+    outpath = os.path.join(builddir, name)
+    write_file(outpath, "")
+    write_cacheinfo(outpath, cacheinfo)
+
+  tstart = time.time()
+  report = json.loads(run_explain(args, builddir, ["--json"]))
+  duration = time.time() - tstart
+  logger.info("Explained %d outputs in %.1fs", args.noutputs, duration)
+
+  summary = report["summary"]
+  if summary.get("hit") != args.noutputs:
+    raise AssertionError(
+        "Expected {} hits, got {}".format(args.noutputs, summary))
+  if duration > args.max_seconds:
+    raise AssertionError(
+        "Expected {} outputs to be explained in {}s, took {:.1f}s".format(
+            args.noutputs, args.max_seconds, duration))
+
+
+def runtest(tmpdir, args):
+  builddir = os.path.join(tmpdir, "build")
+  os.makedirs(builddir)
+  setup_tree(args, builddir)
+  summary = check_report(args, builddir)
+  check_table(args, builddir, summary)
+  check_scale(args, tmpdir)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to linkcache script")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="C compiler used to build and link the test objects")
+  argparser.add_argument(
+      "--noutputs", type=int, default=20000,
+      help="Number of outputs in the tree whose explanation is timed")
+  argparser.add_argument(
+      "--max-seconds", type=float, default=10.0,
+      help="Maximum time to explain the tree of --noutputs outputs")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
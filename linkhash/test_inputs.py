@@ -0,0 +1,273 @@
+"""
+Verify which inputs `cache_hit()` checks, and in which order. An input under
+an immutable prefix should not be stat-ed at all until the listing of the
+prefix changes, and the input which caused the last miss of an output should
+be checked first. The API digest sidecar of a shared object should be found
+next to the real file, whether the shared object is named through a symlink,
+by it's versioned soname, or by a linker script.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+
+class StatLog(object):
+  """
+  Stand-in for `os.stat` which records, in order, every path under `root`
+  that is stat-ed.
+  """
+
+  def __init__(self, root):
+    self.root = os.path.join(root, "")
+    self.paths = []
+    self.real_stat = os.stat
+
+  def __call__(self, path, *args, **kwargs):
+    path = os.path.join(os.getcwd(), str(path))
+    if path.startswith(self.root):
+      self.paths.append(os.path.relpath(path, self.root))
+    return self.real_stat(path, *args, **kwargs)
+
+  def __enter__(self):
+    os.stat = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    os.stat = self.real_stat
+
+
+def touch(filepath, past=False):
+  with open(filepath, "a"):
+    pass
+  if past:
+    when = time.time() - 100
+    os.utime(filepath, (when, when))
+  else:
+    os.utime(filepath, None)
+
+
+def write_shared(filepath):
+  """Write the ELF header of a shared object, which is all linkcache reads."""
+  with open(filepath, "wb") as outfile:
+    outfile.write(b"\x7fELF\x02\x01\x01" + b"\x00" * 9 + b"\x03\x00")
+
+
+def get_options(flags, command):
+  return linkcache.fast_parse_args(
+      ["--no-toolchain-fingerprint", "--probe-threads", "0"] + flags
+      + command)
+
+
+def link(tmpdir, flags, inputs):
+  """
+  Create `inputs` (relative to `tmpdir`, or absolute), which are older than
+  the output, and the output `prog` along with it's cacheinfo, as if it had
+  just been linked with linkcache `flags`. Return the link command.
+  """
+  for name in inputs:
+    if not os.path.isdir(os.path.dirname(os.path.join(tmpdir, name))):
+      os.makedirs(os.path.dirname(os.path.join(tmpdir, name)))
+    touch(os.path.join(tmpdir, name), past=True)
+  command = ["c++"] + list(inputs) + ["-o", "prog"]
+  touch(os.path.join(tmpdir, "prog"))
+
+  ctx = linkcache.Context(command, get_options(flags, command), cwd=tmpdir)
+  ctx.outfile = "prog"
+  ctx.write_cacheinfo()
+  return command
+
+
+def evaluate(tmpdir, flags, command):
+  """Return the context which evaluated `command`, and the paths it stat-ed."""
+  ctx = linkcache.Context(command, get_options(flags, command), cwd=tmpdir)
+  with StatLog(tmpdir) as statlog:
+    ctx.cache_hit()
+  return ctx, [
+      path for path in statlog.paths if path not in (command[0], "prog")]
+
+
+def check_immutable(tmpdir):
+  sysroot = os.path.join(tmpdir, "sysroot")
+  libc = os.path.join(sysroot, "lib", "libc.a")
+  flags = ["--immutable-prefix", sysroot]
+  command = link(tmpdir, flags, ["main.o", libc])
+  ctx, paths = evaluate(tmpdir, flags, command)
+  if ctx.miss_reason is not None:
+    raise AssertionError("Expected a hit, got {}".format(ctx.miss_reason))
+  if paths != ["main.o"]:
+    raise AssertionError(
+        "Expected only main.o to be checked, got {}".format(paths))
+
+  # A new file under the prefix changes it's listing, so it's inputs are
+  # checked again.
+  touch(os.path.join(sysroot, "libm.a"))
+  touch(libc)
+  linkcache._IMMUTABLE_FINGERPRINTS.clear()
+  ctx, paths = evaluate(tmpdir, flags, command)
+  if (ctx.miss_reason, ctx.blocker) != ("input-changed", libc):
+    raise AssertionError(
+        "Expected a miss on libc.a once the prefix changed, got {} {}".format(
+            ctx.miss_reason, ctx.blocker))
+
+
+def check_history(tmpdir):
+  inputs = ["obj{}.o".format(idx) for idx in range(6)]
+  command = link(tmpdir, [], inputs)
+  ctx, paths = evaluate(tmpdir, [], command)
+  if paths != inputs:
+    raise AssertionError(
+        "Expected the inputs to be checked in order, got {}".format(paths))
+
+  # obj4.o changes, so it is the blocker of the next miss, and the history
+  # written with the next link records it.
+  touch(os.path.join(tmpdir, "obj4.o"))
+  ctx, paths = evaluate(tmpdir, [], command)
+  if (ctx.miss_reason, ctx.blocker) != ("input-changed", "obj4.o"):
+    raise AssertionError("Expected a miss on obj4.o, got {} {}".format(
+        ctx.miss_reason, ctx.blocker))
+  history = ctx.get_history()
+  if history["blockers"] != {"obj4.o": 1}:
+    raise AssertionError(
+        "Expected obj4.o to be recorded as a blocker, got {}".format(history))
+
+  cacheinfopath = os.path.join(tmpdir, "prog.cacheinfo")
+  with io.open(cacheinfopath, "r", encoding="utf-8") as infile:
+    cacheinfo = json.load(infile)
+  cacheinfo["history"] = {"blockers": {"obj4.o": 1, "obj2.o": 3}, "misses": 4}
+  with io.open(cacheinfopath, "w", encoding="utf-8") as outfile:
+    outfile.write(json.dumps(cacheinfo))
+  for name in inputs:
+    touch(os.path.join(tmpdir, name), past=True)
+  touch(os.path.join(tmpdir, "prog"))
+
+  # Most frequent blocker first
+  ctx, paths = evaluate(tmpdir, [], command)
+  expect = ["obj2.o", "obj4.o", "obj0.o", "obj1.o", "obj3.o", "obj5.o"]
+  if paths != expect:
+    raise AssertionError(
+        "Expected the inputs to be checked as {}, got {}".format(
+            expect, paths))
+
+  # The miss is found with a single stat
+  touch(os.path.join(tmpdir, "obj2.o"))
+  ctx, paths = evaluate(tmpdir, [], command)
+  if paths != ["obj2.o"] or ctx.blocker != "obj2.o":
+    raise AssertionError(
+        "Expected only obj2.o to be checked, got {}".format(paths))
+
+
+def check_sidecars(tmpdir):
+  """
+  lib/libfoo.so -> libfoo.so.1 -> libfoo.so.1.2.3, lib/libbar.so.2 named by
+  it's soname, and lib/libgroup.so, a linker script naming libbaz.so.1.
+  """
+  libdir = os.path.join(tmpdir, "lib")
+  os.makedirs(libdir)
+  for name in ("libfoo.so.1.2.3", "libbar.so.2", "libbaz.so.1"):
+    write_shared(os.path.join(libdir, name))
+    touch(os.path.join(libdir, name + ".apid"), past=True)
+  os.symlink("libfoo.so.1.2.3", os.path.join(libdir, "libfoo.so.1"))
+  os.symlink("libfoo.so.1", os.path.join(libdir, "libfoo.so"))
+  with open(os.path.join(libdir, "libgroup.so"), "w") as outfile:
+    outfile.write("/* GNU ld script */\nGROUP ( libbaz.so.1 )\n")
+
+  libs = ["lib/libfoo.so", "lib/libbar.so.2", "lib/libgroup.so"]
+  command = link(tmpdir, [], ["main.o"] + libs)
+
+  ctx = linkcache.Context(command, get_options([], command), cwd=tmpdir)
+  paths = [os.path.relpath(path, tmpdir) for path in ctx.get_probe_paths(libs)]
+  expect = [
+      "lib/libfoo.so", "lib/libfoo.so.1.2.3.apid",
+      "lib/libbar.so.2", "lib/libbar.so.2.apid",
+      "lib/libgroup.so", "lib/libgroup.so.apid"]
+  if paths != expect:
+    raise AssertionError(
+        "Expected the probe paths {}, got {}".format(expect, paths))
+
+  # The shared objects are relinked without a change to their API
+  for name in ("libfoo.so.1.2.3", "libbar.so.2", "libbaz.so.1"):
+    touch(os.path.join(libdir, name))
+  ctx, paths = evaluate(tmpdir, [], command)
+  if ctx.miss_reason is not None:
+    raise AssertionError("Expected a hit, got {} {}".format(
+        ctx.miss_reason, ctx.blocker))
+  for name in ("libfoo.so.1.2.3", "libbar.so.2", "libbaz.so.1"):
+    if "lib/{}.apid".format(name) not in paths:
+      raise AssertionError(
+          "Expected the sidecar of {} to be checked, got {}".format(
+              name, paths))
+  if "lib/libfoo.so.apid" in paths:
+    raise AssertionError("Expected the symlink to be resolved to it's target")
+
+  for name, blocker in (
+      ("libbaz.so.1", os.path.join(libdir, "libbaz.so.1")),
+      ("libbar.so.2", "lib/libbar.so.2"),
+      ("libfoo.so.1.2.3", "lib/libfoo.so")):
+    touch(os.path.join(libdir, name + ".apid"))
+    ctx, paths = evaluate(tmpdir, [], command)
+    if (ctx.miss_reason, ctx.blocker) != ("api-changed", blocker):
+      raise AssertionError(
+          "Expected a change to the API of {} to be a miss on {}, got {} {}"
+          .format(name, blocker, ctx.miss_reason, ctx.blocker))
+    touch(os.path.join(libdir, name + ".apid"), past=True)
+
+  os.remove(os.path.join(libdir, "libbar.so.2.apid"))
+  ctx, paths = evaluate(tmpdir, [], command)
+  if (ctx.miss_reason, ctx.blocker) != ("no-apid", "lib/libbar.so.2"):
+    raise AssertionError(
+        "Expected a miss on libbar.so.2 without it's sidecar, got {} {}"
+        .format(ctx.miss_reason, ctx.blocker))
+
+
+def runtest(tmpdir, args):
+  for name, check in (
+      ("immutable", check_immutable),
+      ("history", check_history),
+      ("sidecars", check_sidecars)):
+    subdir = os.path.join(tmpdir, name)
+    os.makedirs(subdir)
+    check(subdir)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -57,6 +57,22 @@ DEBUG:__main__:Using link-cache of prog
 DEBUG:__main__:Cache hit, touching prog
 """
 
+# Logged when a binary of the toolchain is hashed, which only happens in the
+# first build since the fingerprints are memoized in the cache directory, and
+# recorded in the cacheinfo of each output.
+FINGERPRINT_MESSAGE = "Fingerprinted toolchain binary"
+
+
+def split_fingerprints(content):
+  """
+  Return `content` without the lines which log the fingerprinting of a
+  toolchain binary, and the number of such lines.
+  """
+  lines = content.split("\n")
+  kept = [line for line in lines if FINGERPRINT_MESSAGE not in line]
+  return "\n".join(kept), len(lines) - len(kept)
+
+
 def sortlines(content):
   ninja_prefix = re.compile(r"\[\d+/\d+\] (.*)")
 
@@ -139,8 +155,23 @@ def runtest(tmpdir, args):
   shutil.copyfile(args.linkcache, os.path.join(bindir, "linkcache"))
   os.chmod(os.path.join(bindir, "linkcache"), 0o755)
 
+  # NOTE(josh): the package implementing the tools of linkcache is installed
+  # next to it, as it is by cmake.
+  pkgsrc = os.path.dirname(os.path.realpath(args.linkcache))
+  pkgdst = os.path.join(prefixdir, "share", "linkhash", "linkhash")
+  os.makedirs(pkgdst)
+  for filename in os.listdir(pkgsrc):
+    if (filename.endswith(".py") and not filename.startswith("test_")
+        and filename != "linkcache.py"):
+      shutil.copyfile(
+          os.path.join(pkgsrc, filename), os.path.join(pkgdst, filename))
+
   logdir = os.path.join(tmpdir, "log")
   os.makedirs(logdir)
+  # NOTE(josh): use a cache directory of our own, so that the toolchain is
+  # fingerprinted by the first build regardless of earlier runs
+  env = dict(os.environ)
+  env["LINKCACHE_DIR"] = os.path.join(tmpdir, "cache")
   bindir = os.path.join(tmpdir, "build")
   os.makedirs(bindir)
 
@@ -160,7 +191,8 @@ def runtest(tmpdir, args):
   logpath1 = os.path.join(logdir, "01-ninja.log")
   with open(logpath1 , "wb") as logfile:
     result = subprocess.call(
-        ["ninja", "-j", "1"], cwd=bindir, stdout=logfile, stderr=logfile)
+        ["ninja", "-j", "1"], cwd=bindir, stdout=logfile, stderr=logfile,
+        env=env)
 
   if result != 0:
     with io.open(logpath1, "r", encoding="utf-8") as logfile:
@@ -175,7 +207,8 @@ def runtest(tmpdir, args):
   logpath2 = os.path.join(logdir, "02-ninja.log")
   with open(logpath2, "wb") as logfile:
     result = subprocess.call(
-        ["ninja", "-j", "1"], cwd=bindir, stdout=logfile, stderr=logfile)
+        ["ninja", "-j", "1"], cwd=bindir, stdout=logfile, stderr=logfile,
+        env=env)
 
   if result != 0:
     with io.open(logpath2, "r", encoding="utf-8") as logfile:
@@ -184,9 +217,18 @@ def runtest(tmpdir, args):
         "ninja(2) exited with non-zero status:\n" + logcontent)
 
   with io.open(logpath1, "r", encoding="utf-8") as infile:
-    assert_equal(EXPECT_ONE, infile.read())
+    content, nfingerprints = split_fingerprints(infile.read())
+  assert_equal(EXPECT_ONE, content)
+  if not nfingerprints:
+    raise AssertionError(
+        "Expected the first build to fingerprint the toolchain")
+
   with io.open(logpath2, "r", encoding="utf-8") as infile:
-    assert_equal(EXPECT_TWO, infile.read())
+    content, nfingerprints = split_fingerprints(infile.read())
+  assert_equal(EXPECT_TWO, content)
+  if nfingerprints:
+    raise AssertionError(
+        "Expected the second build to reuse the toolchain fingerprints")
 
 
 def main():
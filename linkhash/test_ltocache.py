@@ -0,0 +1,222 @@
+"""
+Verify that linkcache adds the options of the managed ThinLTO cache to a
+ThinLTO link executed by clang, that the options don't affect the cache key,
+and that they are left out of other links, of a link which configures it's own
+cache, and of every link with `--no-lto-cache`.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import linkcache
+from linkhash import ltocache
+
+logger = logging.getLogger(__name__)
+
+# A compiler driver which records it's arguments, one json list per line, and
+# writes it's output
+FAKE_DRIVER = """\
+#!{python}
+import json
+import sys
+with open({logpath!r}, "a") as logfile:
+  logfile.write(json.dumps(sys.argv[1:]) + "\\n")
+with open(sys.argv[sys.argv.index("-o") + 1], "w") as outfile:
+  outfile.write("linked\\n")
+"""
+
+INPUTS = ["main.o", "foo.o"]
+
+
+def check_unit():
+  """Check the detection of ThinLTO links and lld, and the pruning policy."""
+  for command, expect in (
+      (["clang", "-flto=thin"], True),
+      (["clang", "-flto", "-flto=thin"], True),
+      (["clang", "-flto=thin", "-fno-lto"], False),
+      (["clang", "-flto=thin", "-flto=full"], False),
+      (["clang", "-flto"], False),
+      (["clang", "-O2"], False)):
+    if ltocache.is_thin_lto(command) != expect:
+      raise AssertionError("Expected is_thin_lto({}) to be {}".format(
+          command, expect))
+
+  for command, expect in (
+      (["clang", "-fuse-ld=lld"], True),
+      (["clang", "-fuse-ld=/opt/llvm/bin/ld.lld"], True),
+      (["clang", "--ld-path=/usr/bin/ld.lld"], True),
+      (["clang", "-fuse-ld=gold"], False),
+      (["clang"], False)):
+    if ltocache.uses_lld(command) != expect:
+      raise AssertionError("Expected uses_lld({}) to be {}".format(
+          command, expect))
+
+  options = linkcache.Options(lto_cache_age=1.5, lto_cache_size=1 << 20)
+  policy = ltocache.get_policy(options)
+  if policy != "prune_after=129600s:cache_size_bytes=1048576":
+    raise AssertionError("Unexpected cache policy " + policy)
+
+
+def setup_fixture(tmpdir):
+  bindir = os.path.join(tmpdir, "bin")
+  os.makedirs(bindir)
+  for name in ("clang", "gcc"):
+    driverpath = os.path.join(bindir, name)
+    with io.open(driverpath, "w", encoding="utf-8") as outfile:
+      outfile.write(FAKE_DRIVER.format(
+          python=sys.executable,
+          logpath=os.path.join(tmpdir, name + ".log")))
+    os.chmod(driverpath, 0o755)
+
+  past = time.time() - 100
+  for objpath in INPUTS:
+    with open(os.path.join(tmpdir, objpath), "w"):
+      pass
+    os.utime(os.path.join(tmpdir, objpath), (past, past))
+
+
+def read_driver_log(tmpdir, driver):
+  """Return the list of argument lists with which `driver` was executed."""
+  logpath = os.path.join(tmpdir, driver + ".log")
+  if not os.path.exists(logpath):
+    return []
+  with io.open(logpath, "r", encoding="utf-8") as infile:
+    return [json.loads(line) for line in infile]
+
+
+def run_link(args, tmpdir, command, flags=()):
+  """
+  Execute `command` through linkcache. Return the arguments with which the
+  driver was executed, or None if linkcache used the cache.
+  """
+  before = len(read_driver_log(tmpdir, command[0]))
+  proc = subprocess.Popen(
+      [sys.executable, args.linkcache, "--log-level", "debug",
+       "--no-bypass", "--api-version", "3",
+       "--cache-dir", os.path.join(tmpdir, "cache")] + list(flags)
+      + [os.path.join(tmpdir, "bin", command[0])] + command[1:],
+      cwd=tmpdir, stderr=subprocess.PIPE)
+  _, stderr = proc.communicate()
+  if proc.returncode != 0:
+    raise AssertionError(
+        "linkcache exited with non-zero status:\n" + stderr.decode("utf-8"))
+  executions = read_driver_log(tmpdir, command[0])[before:]
+  if not executions:
+    return None
+  return executions[-1]
+
+
+def get_injected(command, executed):
+  """Return the arguments which linkcache added to `command`."""
+  if executed[:len(command) - 1] != command[1:]:
+    raise AssertionError("Expected {} to start with {}".format(
+        executed, command[1:]))
+  return executed[len(command) - 1:]
+
+
+def check_injection(args, tmpdir):
+  cachedir = os.path.abspath(os.path.join(tmpdir, "cache", "lto"))
+  for command, prefix in (
+      (["clang", "-flto=thin"] + INPUTS + ["-o", "prog"],
+       "-Wl,-plugin-opt=cache-"),
+      (["clang", "-flto=thin", "-fuse-ld=lld"] + INPUTS + ["-o", "prog-lld"],
+       "-Wl,--thinlto-cache-")):
+    executed = run_link(args, tmpdir, command)
+    if executed is None:
+      raise AssertionError("Expected the first link of {} to miss".format(
+          command[-1]))
+    injected = get_injected(command, executed)
+    expect = [
+        prefix + "dir=" + cachedir,
+        prefix + "policy=" + ltocache.get_policy(linkcache.Options(
+            **linkcache.get_default_options()))]
+    if injected != expect:
+      raise AssertionError(
+          "Expected the link of {} to add {}, got {}".format(
+              command[-1], expect, injected))
+    if not os.path.isdir(cachedir):
+      raise AssertionError("The LTO cache directory wasn't created")
+
+    with io.open(os.path.join(tmpdir, command[-1] + ".cacheinfo"), "r",
+                 encoding="utf-8") as infile:
+      argv = json.load(infile)["argv"]
+    if any("cache-" in arg for arg in argv):
+      raise AssertionError(
+          "Expected the cacheinfo to record the command as given, got {}"
+          .format(argv))
+
+    if run_link(args, tmpdir, command) is not None:
+      raise AssertionError(
+          "Expected the second link of {} to use the cache".format(
+              command[-1]))
+
+
+def check_no_injection(args, tmpdir):
+  for name, command, flags in (
+      ("non-LTO", ["clang"] + INPUTS + ["-o", "plain"], ()),
+      ("full LTO", ["clang", "-flto"] + INPUTS + ["-o", "full"], ()),
+      ("gcc", ["gcc", "-flto=thin"] + INPUTS + ["-o", "gcc-prog"], ()),
+      ("own cache",
+       ["clang", "-flto=thin", "-Wl,--thinlto-cache-dir=own"] + INPUTS
+       + ["-o", "own"], ()),
+      ("disabled", ["clang", "-flto=thin"] + INPUTS + ["-o", "disabled"],
+       ["--no-lto-cache"])):
+    executed = run_link(args, tmpdir, command, flags)
+    if executed is None:
+      raise AssertionError("Expected the {} link to miss".format(name))
+    injected = get_injected(command, executed)
+    if injected:
+      raise AssertionError(
+          "Expected nothing to be added to the {} link, got {}".format(
+              name, injected))
+
+
+def runtest(tmpdir, args):
+  check_unit()
+  setup_fixture(tmpdir)
+  check_injection(args, tmpdir)
+  check_no_injection(args, tmpdir)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
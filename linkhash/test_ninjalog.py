@@ -0,0 +1,217 @@
+"""
+Verify `linkcache ninjalog`: the decision records appended by linkcache with
+`--decision-log`, and the analysis of a `.ninja_log` of several builds, of
+which only the last is reported, with it's critical path attributed to
+compiling, linking and linkcache, and the savings of the cache estimated
+from the decision log.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# A linker which writes it's output (the last argument)
+FAKE_LINKER = """\
+#!{python}
+import sys
+with open(sys.argv[-1], "w") as outfile:
+  outfile.write("linked\\n")
+"""
+
+# The .ninja_log of two builds, in the order the edges completed. The first
+# must be ignored. In the second, b.o -> libfoo.so -> prog is the critical
+# path, and gen.h and gen.c are the outputs of one edge.
+NINJA_LOG = """\
+# ninja log v5
+0\t100\t0\ta.o\taaaa
+0\t9000\t0\tprog\t1111
+100\t200\t0\tgen.h\tcccc
+100\t200\t0\tgen.c\tcccc
+200\t400\t0\ttool\tdddd
+0\t1000\t0\ta.o\taaaa
+0\t3000\t0\tb.o\tbbbb
+3000\t3500\t0\tlibfoo.so\teeee
+3600\t6600\t0\tprog\tffff
+"""
+
+# Seconds before the end of the build
+DECISIONS = [
+    # Misses of earlier builds, from which the link of libfoo.so is
+    # estimated to take 3 seconds
+    ("libfoo.so", 1000, {"decision": "miss", "link": 2.0}),
+    ("libfoo.so", 900, {"decision": "miss", "link": 4.0}),
+    ("prog", 900, {"decision": "hit"}),
+    ("libfoo.so", 3.2, {"decision": "hit", "check": 0.1}),
+    ("prog", 0.01, {"decision": "miss", "link": 2.5, "check": 0.1}),
+    # Another build tree
+    ("../other/prog", 0.01, {"decision": "miss", "link": 1.0}),
+]
+
+
+def check_decision_records(args, tmpdir):
+  """Link through linkcache and verify the records of a miss and a hit."""
+  linkerpath = os.path.join(tmpdir, "fakeld")
+  with io.open(linkerpath, "w", encoding="utf-8") as outfile:
+    outfile.write(FAKE_LINKER.format(python=sys.executable))
+  os.chmod(linkerpath, 0o755)
+  past = time.time() - 100
+  with open(os.path.join(tmpdir, "in.o"), "w"):
+    pass
+  os.utime(os.path.join(tmpdir, "in.o"), (past, past))
+
+  logpath = os.path.join(tmpdir, "decisions.jsonl")
+  for _ in range(2):
+    subprocess.check_call(
+        [sys.executable, args.linkcache, "--log-level", args.log_level,
+         "--no-bypass", "--api-version", "3", "--decision-log", logpath,
+         linkerpath, "in.o", "-o", "out"], cwd=tmpdir)
+
+  with io.open(logpath, "r", encoding="utf-8") as infile:
+    records = [json.loads(line) for line in infile]
+  decisions = [record["decision"] for record in records]
+  if decisions != ["miss", "hit"]:
+    raise AssertionError(
+        "Expected a miss then a hit to be recorded, got {}".format(decisions))
+  for record in records:
+    if record["output"] != os.path.join(tmpdir, "out"):
+      raise AssertionError("Unexpected output in {}".format(record))
+  if "link" not in records[0] or "link" in records[1]:
+    raise AssertionError(
+        "Expected the duration of the linker to be recorded for the miss"
+        " only, got {}".format(records))
+
+
+def write_build(tmpdir):
+  """Write the .ninja_log and decision log of a build in `tmpdir`/build."""
+  builddir = os.path.join(tmpdir, "build")
+  os.makedirs(builddir)
+  logpath = os.path.join(builddir, ".ninja_log")
+  with io.open(logpath, "w", encoding="utf-8") as outfile:
+    outfile.write(NINJA_LOG)
+  build_end = time.time() - 60
+  os.utime(logpath, (build_end, build_end))
+
+  decisionpath = os.path.join(tmpdir, "decisions.jsonl")
+  with io.open(decisionpath, "a", encoding="utf-8") as outfile:
+    outfile.write("not json\n")
+    for output, age, record in DECISIONS:
+      record = dict(record)
+      record["output"] = os.path.normpath(os.path.join(builddir, output))
+      record["time"] = build_end - age
+      outfile.write(json.dumps(record) + "\n")
+  return builddir, decisionpath
+
+
+def run_ninjalog(args, builddir, decisionpath, json_output=True):
+  argv = [sys.executable, args.linkcache, "ninjalog", builddir,
+          "--decision-log", decisionpath]
+  if json_output:
+    argv.append("--json")
+  proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+  stdout, _ = proc.communicate()
+  if proc.returncode != 0:
+    raise AssertionError("linkcache ninjalog exited with status {}".format(
+        proc.returncode))
+  if json_output:
+    return json.loads(stdout.decode("utf-8"))
+  return stdout.decode("utf-8")
+
+
+def check_equal(report, path, expect):
+  value = report
+  for key in path:
+    value = value[key]
+  if value != expect:
+    raise AssertionError("Expected {} to be {}, got {}".format(
+        "/".join(str(key) for key in path), expect, value))
+
+
+def check_report(args, builddir, decisionpath):
+  report = run_ninjalog(args, builddir, decisionpath)
+  logger.debug("Report: %s", json.dumps(report, indent=2))
+  check_equal(report, ["edges"], 6)
+  check_equal(report, ["wall"], 6.6)
+  check_equal(
+      report, ["critical_path", "attribution"],
+      {"compile": 3.0, "link": 2.5, "linkcache": 1.0, "other": 0.0,
+       "idle": 0.1})
+  check_equal(
+      report, ["critical_path", "steps"],
+      [{"start": 0.0, "end": 3.0, "kind": "compile", "decision": None,
+        "output": "b.o"},
+       {"start": 3.0, "end": 3.5, "kind": "link", "decision": "hit",
+        "output": "libfoo.so"},
+       {"start": 3.6, "end": 6.6, "kind": "link", "decision": "miss",
+        "output": "prog"}])
+  check_equal(
+      report, ["build"],
+      {"compile": 4.0, "link": 2.7, "linkcache": 1.0, "other": 0.1})
+  check_equal(
+      report, ["links"],
+      {"hit": 1, "miss": 1, "bypass": 0, "unknown": 1, "overhead": 1.0,
+       "saved": 2.0, "saved_on_critical_path": 2.0})
+  check_equal(
+      report, ["targets", 0],
+      {"output": "libfoo.so", "decision": "hit", "duration": 0.5,
+       "linkcache": 0.5, "link_estimate": 3.0, "saved": 2.5,
+       "critical": True})
+  check_equal(report, ["targets", 1, "output"], "tool")
+  check_equal(report, ["targets", 2, "saved"], -0.5)
+
+  text = run_ninjalog(args, builddir, decisionpath, json_output=False)
+  for expect in ("Critical path: 6.600s through 3 edges",
+                 "1 hit, 1 miss, 0 bypass, 1 unknown"):
+    if expect not in text:
+      raise AssertionError(
+          "Expected '{}' in the report, got:\n{}".format(expect, text))
+
+
+def runtest(tmpdir, args):
+  check_decision_records(args, tmpdir)
+  builddir, decisionpath = write_build(tmpdir)
+  check_report(args, builddir, decisionpath)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,288 @@
+"""
+Exercise `linkcache plan` on a small build graph: libfoo.so, libbar.so which
+links libfoo, and prog which links libbar. The link commands are given in
+reverse order, as `ninja -t commands` might list them, and should be executed
+in dependency order. A change to libfoo which doesn't change it's API should
+relink only libfoo, with the decisions for libbar and prog cascading from
+it's fresh digest, and a change to it's API should stop at libbar, whose API
+doesn't change. The links should also be found with the CMake file API.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+SOURCES = {
+    "foo.c": "int foo(void) {{ return {value}; }}\n{extra}",
+    "bar.c": "int foo(void);\nint bar(void) { return foo(); }\n",
+    "main.c": "int bar(void);\nint main(void) { return bar(); }\n",
+}
+
+# A compiler driver which logs the output of each link
+LOGGED_COMPILER = """\
+#!/bin/sh
+prev=""
+for arg in "$@"; do
+  if [ "$prev" = "-o" ]; then
+    echo "$arg" >> "$(dirname "$0")/links.log"
+  fi
+  prev="$arg"
+done
+exec {compiler} "$@"
+"""
+
+LINKS = [
+    ("prog", ["main.o", "libbar.so"]),
+    ("libbar.so", ["-shared", "bar.o", "libfoo.so"]),
+    ("libfoo.so", ["-shared", "foo.o"]),
+]
+
+
+def write_file(filepath, content, mode=None):
+  with io.open(filepath, "w", encoding="utf-8") as outfile:
+    outfile.write(content)
+  if mode is not None:
+    os.chmod(filepath, mode)
+
+
+def compile_source(args, tmpdir, name, **kwargs):
+  """Compile `name` (formatted with `kwargs`) to an object file."""
+  srcpath = os.path.join(tmpdir, name)
+  content = SOURCES[name]
+  if kwargs:
+    content = content.format(**kwargs)
+  write_file(srcpath, content)
+  subprocess.check_call(
+      [args.compiler, "-fPIC", "-c", "-o", srcpath[:-2] + ".o", srcpath])
+
+
+def get_commands(args, tmpdir):
+  """Return the link commands as `ninja -t commands` would print them."""
+  ldcmd = os.path.join(tmpdir, "bin", "ldcmd")
+  lines = [
+      "{} -fPIC -c foo.c -o foo.o".format(args.compiler),
+  ]
+  for output, inputs in LINKS:
+    argv = (
+        [sys.executable, args.linkcache, "--api-version", "3", ldcmd]
+        + inputs + ["-Wl,-rpath," + tmpdir, "-o", output])
+    lines.append(": && {} && :".format(
+        " ".join(shlex.quote(arg) for arg in argv)))
+  return "".join(line + "\n" for line in lines)
+
+
+def read_linked(tmpdir):
+  """Return the list of outputs linked since the last call."""
+  logpath = os.path.join(tmpdir, "bin", "links.log")
+  if not os.path.exists(logpath):
+    return []
+  with io.open(logpath, "r", encoding="utf-8") as infile:
+    out = infile.read().split()
+  os.unlink(logpath)
+  return out
+
+
+def run_plan(args, tmpdir, flags, expect_status=0):
+  """
+  Run `linkcache plan` and return a dictionary mapping output name to the
+  result for it.
+  """
+  proc = subprocess.Popen(
+      [sys.executable, args.linkcache, "plan", "--json", "-C", tmpdir]
+      + flags, cwd=tmpdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  stdout, stderr = proc.communicate()
+  if proc.returncode != expect_status:
+    raise AssertionError(
+        "linkcache plan exited with status {}, expected {}:\n{}{}".format(
+            proc.returncode, expect_status, stdout.decode("utf-8"),
+            stderr.decode("utf-8")))
+  report = json.loads(stdout.decode("utf-8"))
+  return {
+      os.path.basename(result["output"]): result
+      for result in report["outputs"]}
+
+
+def check_decisions(results, expect, what):
+  actual = {
+      name: (result["decision"], result["reason"])
+      for name, result in results.items()}
+  if actual != expect:
+    raise AssertionError(
+        "Expected {} to yield {}, got {}".format(what, expect, actual))
+
+
+def get_prog_status(tmpdir):
+  return subprocess.call([os.path.join(tmpdir, "prog")])
+
+
+def write_file_api(tmpdir):
+  """
+  Write a CMake file API reply describing the three targets, as cmake would
+  for a codemodel-v2 query.
+  """
+  replydir = os.path.join(tmpdir, ".cmake", "api", "v1", "reply")
+  os.makedirs(replydir)
+  targets = [
+      ("foo", "SHARED_LIBRARY", "libfoo.so", []),
+      ("bar", "SHARED_LIBRARY", "libbar.so", ["foo::@1"]),
+      ("prog", "EXECUTABLE", "prog", ["bar::@1"]),
+      ("objs", "OBJECT_LIBRARY", None, []),
+  ]
+  entries = []
+  for name, kind, artifact, deps in targets:
+    target = {
+        "name": name,
+        "id": name + "::@1",
+        "type": kind,
+        "dependencies": [{"id": dep} for dep in deps],
+    }
+    if artifact is not None:
+      target["artifacts"] = [{"path": artifact}]
+    jsonfile = "target-{}.json".format(name)
+    write_file(os.path.join(replydir, jsonfile), json.dumps(target))
+    entries.append({"name": name, "id": target["id"], "jsonFile": jsonfile})
+
+  codemodel = {"configurations": [{"name": "Debug", "targets": entries}]}
+  write_file(
+      os.path.join(replydir, "codemodel-v2.json"), json.dumps(codemodel))
+  index = {"objects": [{
+      "kind": "codemodel", "version": {"major": 2, "minor": 0},
+      "jsonFile": "codemodel-v2.json"}]}
+  write_file(os.path.join(replydir, "index-0.json"), json.dumps(index))
+
+
+def runtest(tmpdir, args):
+  bindir = os.path.join(tmpdir, "bin")
+  os.makedirs(bindir)
+  write_file(
+      os.path.join(bindir, "ldcmd"),
+      LOGGED_COMPILER.format(compiler=args.compiler), 0o755)
+  compile_source(args, tmpdir, "foo.c", value=3, extra="")
+  compile_source(args, tmpdir, "bar.c")
+  compile_source(args, tmpdir, "main.c")
+  write_file(os.path.join(tmpdir, "commands.txt"), get_commands(args, tmpdir))
+  commands = ["--commands", "commands.txt"]
+
+  results = run_plan(args, tmpdir, commands)
+  check_decisions(results, {
+      "libfoo.so": ("linked", "no-output"),
+      "libbar.so": ("linked", "no-output"),
+      "prog": ("linked", "no-output"),
+  }, "the first plan")
+  linked = read_linked(tmpdir)
+  if linked != ["libfoo.so", "libbar.so", "prog"]:
+    raise AssertionError(
+        "Expected links in dependency order, got {}".format(linked))
+
+  results = run_plan(args, tmpdir, commands)
+  check_decisions(results, {
+      "libfoo.so": ("hit", None),
+      "libbar.so": ("hit", None),
+      "prog": ("hit", None),
+  }, "an unchanged build")
+  if read_linked(tmpdir):
+    raise AssertionError("Expected nothing to be linked when unchanged")
+
+  # A change to the implementation of foo
+  compile_source(args, tmpdir, "foo.c", value=4, extra="")
+  results = run_plan(args, tmpdir, ["--dry-run"] + commands)
+  check_decisions(results, {
+      "libfoo.so": ("miss", "input-changed"),
+      "libbar.so": ("pending", "producer-miss"),
+      "prog": ("pending", "producer-miss"),
+  }, "a dry run")
+  if read_linked(tmpdir):
+    raise AssertionError("Expected a dry run not to link anything")
+
+  results = run_plan(args, tmpdir, commands)
+  check_decisions(results, {
+      "libfoo.so": ("linked", "input-changed"),
+      "libbar.so": ("hit", "cascaded"),
+      "prog": ("hit", "cascaded"),
+  }, "a change to the implementation of libfoo")
+  linked = read_linked(tmpdir)
+  if linked != ["libfoo.so"]:
+    raise AssertionError("Expected only libfoo to be linked, got {}".format(
+        linked))
+  if get_prog_status(tmpdir) != 4:
+    raise AssertionError("prog doesn't use the new implementation of foo")
+
+  # A change to the API of foo
+  compile_source(
+      args, tmpdir, "foo.c", value=5, extra="int baz(void) { return 0; }\n")
+  results = run_plan(args, tmpdir, commands)
+  check_decisions(results, {
+      "libfoo.so": ("linked", "input-changed"),
+      "libbar.so": ("linked", "api-changed"),
+      "prog": ("hit", "cascaded"),
+  }, "a change to the API of libfoo")
+  linked = read_linked(tmpdir)
+  if linked != ["libfoo.so", "libbar.so"]:
+    raise AssertionError(
+        "Expected libfoo and libbar to be linked, got {}".format(linked))
+
+  # The same links, found with the CMake file API
+  write_file_api(tmpdir)
+  results = run_plan(args, tmpdir, ["--file-api", tmpdir])
+  check_decisions(results, {
+      "libfoo.so": ("hit", None),
+      "libbar.so": ("hit", None),
+      "prog": ("hit", None),
+  }, "the plan from the file API")
+
+  # A failed link
+  write_file(os.path.join(tmpdir, "foo.o"), "garbage\n")
+  results = run_plan(args, tmpdir, commands, expect_status=1)
+  check_decisions(results, {
+      "libfoo.so": ("failed", "input-changed"),
+      "libbar.so": ("skipped", "producer-failed"),
+      "prog": ("skipped", "producer-failed"),
+  }, "a failed link of libfoo")
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to compile and link the test program")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
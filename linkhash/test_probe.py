@@ -0,0 +1,174 @@
+"""
+Benchmark input probing on a simulated high-latency filesystem. Every stat
+issued by linkcache is delayed (as on NFS, where each stat is a round trip to
+the server) and the time to evaluate a cache hit is compared between
+sequential and concurrent probing. Verify that concurrent probing reaches the
+same decisions, is substantially faster, and abandons outstanding probes once
+a miss is found.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+
+class SlowStat(object):
+  """
+  Stand-in for `os.stat` which adds `latency` seconds to every stat of a path
+  under `root`, and counts them.
+  """
+
+  def __init__(self, root, latency):
+    self.root = root
+    self.latency = latency
+    self.count = 0
+    self.lock = threading.Lock()
+    self.real_stat = os.stat
+
+  def __call__(self, path, *args, **kwargs):
+    if os.path.join(os.getcwd(), str(path)).startswith(self.root):
+      with self.lock:
+        self.count += 1
+      time.sleep(self.latency)
+    return self.real_stat(path, *args, **kwargs)
+
+  def __enter__(self):
+    os.stat = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    os.stat = self.real_stat
+
+
+def setup_fixture(tmpdir, ninputs):
+  """
+  Create `ninputs` object files and an output which is newer than all of
+  them, with a cacheinfo sidecar. Return the link command.
+  """
+  past = time.time() - 100
+  command = ["c++"]
+  for idx in range(ninputs):
+    objpath = os.path.join(tmpdir, "obj{:04d}.o".format(idx))
+    with open(objpath, "w"):
+      pass
+    os.utime(objpath, (past, past))
+    command.append(objpath)
+  outpath = os.path.join(tmpdir, "prog")
+  command += ["-o", outpath]
+  with open(outpath, "w"):
+    pass
+
+  ctx = linkcache.Context(command, linkcache.fast_parse_args(command))
+  ctx.outfile = outpath
+  ctx.write_cacheinfo()
+  return command
+
+
+def evaluate(command, nthreads, latency, tmpdir):
+  """
+  Evaluate the cache for `command` with the given probe concurrency and
+  return a tuple of (hit, seconds, number of stats).
+  """
+  options = linkcache.fast_parse_args(
+      ["--probe-threads", str(nthreads)] + command)
+  with SlowStat(tmpdir, latency) as slowstat:
+    tstart = time.time()
+    hit = linkcache.Context(command, options).cache_hit()
+    duration = time.time() - tstart
+  return hit, duration, slowstat.count
+
+
+def runtest(tmpdir, args):
+  command = setup_fixture(tmpdir, args.ninputs)
+
+  seq_hit, seq_time, seq_count = evaluate(command, 0, args.latency, tmpdir)
+  par_hit, par_time, par_count = evaluate(
+      command, args.threads, args.latency, tmpdir)
+  logger.info(
+      "Hit with %d inputs: sequential %.1fms (%d stats), concurrent %.1fms"
+      " (%d stats), speedup %.1fx", args.ninputs, seq_time * 1000.0,
+      seq_count, par_time * 1000.0, par_count, seq_time / par_time)
+
+  if not (seq_hit and par_hit):
+    raise AssertionError(
+        "Expected a cache hit, got sequential={} concurrent={}".format(
+            seq_hit, par_hit))
+  if seq_time / par_time < args.min_speedup:
+    raise AssertionError(
+        "Concurrent probing was only {:.1f}x faster, expected {:.1f}x".format(
+            seq_time / par_time, args.min_speedup))
+
+  # Make one input newer than the output. Concurrent probing should find the
+  # miss without waiting on the rest of the inputs.
+  changed = command[len(command) // 2]
+  os.utime(changed, None)
+  seq_hit, seq_time, seq_count = evaluate(command, 0, args.latency, tmpdir)
+  par_hit, par_time, par_count = evaluate(
+      command, args.threads, args.latency, tmpdir)
+  logger.info(
+      "Miss with %d inputs: sequential %.1fms (%d stats), concurrent %.1fms"
+      " (%d stats)", args.ninputs, seq_time * 1000.0, seq_count,
+      par_time * 1000.0, par_count)
+
+  if seq_hit or par_hit:
+    raise AssertionError(
+        "Expected a cache miss, got sequential={} concurrent={}".format(
+            seq_hit, par_hit))
+  if par_count >= args.ninputs:
+    raise AssertionError(
+        "Concurrent probing issued {} stats for {} inputs, expected it to stop"
+        " early".format(par_count, args.ninputs))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--ninputs", type=int, default=200,
+      help="Number of object files in the link")
+  argparser.add_argument(
+      "--latency", type=float, default=0.002,
+      help="Simulated latency of each stat, in seconds")
+  argparser.add_argument(
+      "--threads", type=int, default=linkcache.DEFAULT_PROBE_THREADS,
+      help="Number of probe threads")
+  argparser.add_argument(
+      "--min-speedup", type=float, default=4.0,
+      help="Minimum required speedup of concurrent over sequential probing")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,439 @@
+"""
+Verify `linkcache --remote-worker` against local `linkcache worker`
+processes, over TCP and over a stand-in for ssh: a miss should be linked in
+the sandbox of a worker, uploading only the inputs the worker lacks, and the
+output streamed back. The link should
+be executed locally when the only worker has a different toolchain, doesn't
+respond, can't be reached, or fails the link. Workers should be ranked by
+the inputs they lack and their load. A worker should refuse to run a program
+which isn't the toolchain it reported, a link naming a path outside of
+it's sandbox, or one which may run a program shipped by the client (such as
+an `ld` found through `-B`), and shipped files are never executable.
+"""
+
+import argparse
+import hashlib
+import io
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import remote
+
+logger = logging.getLogger(__name__)
+
+# A linker which writes the directory it ran in, followed by the content of
+# it's inputs (including the archives found for `-l`), to it's output.
+FAKE_LINKER = """\
+#!{python}
+# {variant}
+import os
+import sys
+import time
+if os.environ.get("FAKELD_FAIL"):
+  sys.exit("fakeld: failed")
+time.sleep(float(os.environ.get("FAKELD_SLEEP", "0")))
+args = sys.argv[1:]
+outpath = args[args.index("-o") + 1]
+searchdirs = [arg[2:] for arg in args if arg.startswith("-L")]
+content = ["linked in " + os.getcwd()]
+for arg in args:
+  if arg.startswith("-l"):
+    for searchdir in searchdirs:
+      candidate = os.path.join(searchdir, "lib" + arg[2:] + ".a")
+      if os.path.exists(candidate):
+        arg = candidate
+        break
+  elif arg.startswith("-") or arg == outpath:
+    continue
+  if os.access(arg, os.X_OK):
+    print("fakeld: executable input " + arg)
+  with open(arg) as infile:
+    content.append(infile.read())
+with open(outpath, "w") as outfile:
+  outfile.write("\\n".join(content))
+os.chmod(outpath, 0o755)
+print("fakeld: wrote " + os.path.abspath(outpath))
+"""
+
+# An ssh client which runs the remote command locally, with python and it's
+# own cache directory
+FAKE_SSH = """\
+#!{python}
+import os
+import sys
+args = sys.argv[1:]
+while args[0] == "-o":
+  args = args[2:]
+os.environ["LINKCACHE_DIR"] = {cachedir!r}
+os.execv({python!r}, [{python!r}] + args[1:])
+"""
+
+REMOTE_MESSAGE = "Linked remotely on"
+
+
+def check_choose_worker():
+  sizes = {"a": 100 << 20, "b": 1 << 10}
+  candidates = [
+      ("lacks-a", {"running": 0, "slots": 8, "missing": ["a", "b"]}),
+      ("lacks-b", {"running": 0, "slots": 8, "missing": ["b"]}),
+      ("busy", {"running": 16, "slots": 8, "missing": []}),
+  ]
+  choice, _ = remote.choose_worker(candidates, sizes, 10.0)
+  if choice != "lacks-b":
+    raise AssertionError(
+        "Expected the worker lacking the fewest bytes, got {}".format(choice))
+
+  candidates = [
+      ("loaded", {"running": 4, "slots": 8, "missing": []}),
+      ("idle", {"running": 1, "slots": 8, "missing": []}),
+  ]
+  choice, _ = remote.choose_worker(candidates, sizes, 10.0)
+  if choice != "idle":
+    raise AssertionError(
+        "Expected the least loaded worker, got {}".format(choice))
+
+  for spec, expect in (("build:7000", ("build", 7000)),
+                       ("build", ("build", remote.DEFAULT_PORT)),
+                       ("[::1]:7000", ("::1", 7000))):
+    if remote.parse_address(spec) != expect:
+      raise AssertionError("Expected {} to parse as {}, got {}".format(
+          spec, expect, remote.parse_address(spec)))
+
+
+class Fixture(object):
+  """A build tree, the fake linker of the client, and it's workers."""
+
+  def __init__(self, args, tmpdir):
+    self.args = args
+    self.tmpdir = tmpdir
+    self.builddir = os.path.join(tmpdir, "build")
+    self.workers = []
+    os.makedirs(os.path.join(self.builddir, "lib"))
+    os.makedirs(os.path.join(self.builddir, "bin"))
+    self.path = self.write_linker("bin", "client")
+    self.write("main.o", "main v1", age=100)
+    self.write("lib/libfoo.a", "foo v1", age=100)
+
+  def write_linker(self, name, variant):
+    bindir = os.path.join(self.tmpdir, name)
+    os.makedirs(bindir)
+    linkerpath = os.path.join(bindir, "fakeld")
+    with io.open(linkerpath, "w", encoding="utf-8") as outfile:
+      outfile.write(FAKE_LINKER.format(python=sys.executable, variant=variant))
+    os.chmod(linkerpath, 0o755)
+    return bindir + os.pathsep + os.environ.get("PATH", "")
+
+  def write(self, name, content, age=0):
+    path = os.path.join(self.builddir, name)
+    with io.open(path, "w", encoding="utf-8") as outfile:
+      outfile.write(content)
+    when = time.time() - age
+    os.utime(path, (when, when))
+
+  def start_worker(self, name, path=None, env=None):
+    """Start a worker with it's own cache, and return it's address."""
+    workerenv = dict(os.environ, PATH=path or self.path)
+    workerenv.update(env or {})
+    proc = subprocess.Popen(
+        [sys.executable, self.args.linkcache, "--log-level",
+         self.args.log_level, "--cache-dir",
+         os.path.join(self.tmpdir, name, "cache"), "worker",
+         "--listen", "127.0.0.1:0", "--jobs", "2",
+         "--work-dir", os.path.join(self.tmpdir, name, "work")],
+        stdout=subprocess.PIPE, env=workerenv)
+    self.workers.append(proc)
+    line = proc.stdout.readline().decode("utf-8").strip()
+    if not line.startswith("Listening on "):
+      raise AssertionError("Expected the worker to listen, got {!r}".format(
+          line))
+    return line[len("Listening on "):]
+
+  def stop_workers(self):
+    for proc in self.workers:
+      proc.terminate()
+      proc.wait()
+
+  def link(self, workers, what, expect_remote, timeout=10, extra_args=()):
+    """
+    Link bin/prog through linkcache with the `workers`, and verify where it
+    was linked. Return the log of linkcache.
+    """
+    argv = [sys.executable, self.args.linkcache, "--log-level", "debug",
+            "--no-bypass", "--api-version", "3",
+            "--cache-dir", os.path.join(self.tmpdir, "cache"),
+            "--build-root", self.builddir,
+            "--remote-timeout", str(timeout)]
+    for worker in workers:
+      argv.extend(["--remote-worker", worker])
+    proc = subprocess.Popen(
+        argv + ["fakeld", "main.o", "-Llib", "-lfoo", "-o", "bin/prog"]
+        + list(extra_args),
+        cwd=self.builddir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=dict(os.environ, PATH=self.path))
+    stdout, stderr = proc.communicate()
+    stdout = stdout.decode("utf-8")
+    stderr = stderr.decode("utf-8")
+    if proc.returncode != 0:
+      raise AssertionError(
+          "linkcache exited with non-zero status for {}:\n{}".format(
+              what, stderr))
+
+    outpath = os.path.join(self.builddir, "bin", "prog")
+    with io.open(outpath, "r", encoding="utf-8") as infile:
+      content = infile.read()
+    linked_locally = content.startswith("linked in " + self.builddir + "\n")
+    if expect_remote is not None and (
+        (REMOTE_MESSAGE in stderr) != expect_remote
+        or linked_locally == expect_remote):
+      raise AssertionError("Expected {} to be linked {}, got:\n{}".format(
+          what, "remotely" if expect_remote else "locally", stderr))
+    if expect_remote and (
+        "fakeld: wrote {}".format(outpath) not in stdout):
+      raise AssertionError(
+          "Expected the output of the linker with local paths, got {!r}"
+          .format(stdout))
+    if not os.access(outpath, os.X_OK):
+      raise AssertionError("Expected the output to be executable")
+    return stderr, content
+
+
+def expect_log(log, message, what):
+  if message not in log:
+    raise AssertionError("Expected '{}' for {}, got:\n{}".format(
+        message, what, log))
+
+
+def check_dispatch(fixture):
+  worker = fixture.start_worker("worker")
+  log, content = fixture.link([worker], "the first link", True)
+  expect_log(log, "Uploaded 2 of 2 inputs", "the first link")
+  if "main v1" not in content or "foo v1" not in content:
+    raise AssertionError(
+        "Expected the output to contain the inputs, got {!r}".format(content))
+  if os.path.join(fixture.tmpdir, "worker", "work") not in content:
+    raise AssertionError(
+        "Expected the link to run in the sandbox of the worker, got {!r}"
+        .format(content))
+
+  log, _ = fixture.link([worker], "the second link", None)
+  expect_log(log, "Using link-cache", "the second link")
+
+  fixture.write("main.o", "main v2")
+  log, content = fixture.link([worker], "a link after a change", True)
+  expect_log(log, "Uploaded 1 of 2 inputs", "a link after a change")
+  if "main v2" not in content:
+    raise AssertionError("Expected the changed input to be linked")
+  return worker
+
+
+def check_ranking(fixture, worker):
+  other = fixture.start_worker("other")
+  fixture.write("main.o", "main v3")
+  log, _ = fixture.link([other, worker], "a link with two workers", True)
+  expect_log(log, "Uploaded 1 of 2 inputs to {}".format(worker),
+             "a link with two workers")
+
+
+def check_fallback(fixture):
+  path = fixture.write_linker("otherbin", "worker")
+  different = fixture.start_worker("different", path=path)
+  fixture.write("main.o", "main v4")
+  log, _ = fixture.link([different], "a link with another toolchain", False)
+  expect_log(log, "has a different toolchain", "a link with another toolchain")
+
+  failing = fixture.start_worker("failing", env={"FAKELD_FAIL": "1"})
+  fixture.write("main.o", "main v5")
+  log, _ = fixture.link([failing], "a link which fails remotely", False)
+  expect_log(log, "linking locally", "a link which fails remotely")
+
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    hung = "127.0.0.1:{}".format(listener.getsockname()[1])
+    fixture.write("main.o", "main v6")
+    log, _ = fixture.link([hung], "a link with a hung worker", False,
+                          timeout=0.5)
+    expect_log(log, "didn't respond", "a link with a hung worker")
+  finally:
+    listener.close()
+
+  fixture.write("main.o", "main v7")
+  log, _ = fixture.link([hung], "a link with an unreachable worker", False)
+  expect_log(log, "Can't reach worker", "a link with an unreachable worker")
+
+  slow = fixture.start_worker("slow", env={"FAKELD_SLEEP": "3"})
+  fixture.write("main.o", "main v8")
+  fixture.link([slow], "a link longer than the timeout", True,
+               timeout=remote.HEARTBEAT + 0.5)
+
+
+def request_link(worker, argv, status=True, files=(), outputs=()):
+  """
+  Ask the `worker` to link `argv` in a sandbox mapping only the working
+  directory, after asking for it's status if `status` is true. `files` are
+  (placeholder path, local path, mode) to upload and map into the sandbox.
+  Return the reply to the link request, skipping heartbeats.
+  """
+  channel = remote.connect(worker, 5.0)
+  if channel is None:
+    raise AssertionError("Can't reach {}".format(worker))
+  try:
+    if status:
+      channel.request({"op": "status", "argv": argv, "blobs": []})
+    shipped = []
+    for path, localpath, mode in files:
+      with io.open(localpath, "rb") as infile:
+        digest = hashlib.sha256(infile.read()).hexdigest()
+      channel.send_file({"op": "put", "digest": digest}, localpath)
+      channel.recv()
+      shipped.append([path, digest, mode])
+    channel.send({
+        "op": "link", "argv": argv, "cwd": "${CWD}", "roots": ["${CWD}"],
+        "files": shipped, "outputs": list(outputs)})
+    reply = channel.recv()
+    while reply.get("op") == "running":
+      reply = channel.recv()
+    return reply
+  finally:
+    channel.close()
+
+
+def check_rejected(fixture, worker):
+  escape = os.path.join(fixture.tmpdir, "escape")
+  for what, argv, status in (
+      ("a link without status", ["fakeld", "-o", "prog"], False),
+      ("a program which isn't a linker",
+       ["sh", "-c", "touch " + escape], True),
+      ("an absolute output", ["fakeld", "-o", escape], True),
+      ("an absolute output option", ["fakeld", "-o" + escape], True),
+      ("an absolute path in a list", ["fakeld", "-Wl,-o," + escape], True),
+      ("an absolute path in an option", ["fakeld", "--out=" + escape], True),
+      ("an output escaping the sandbox",
+       ["fakeld", "-o", "${CWD}/../../../../escape"], True)):
+    reply = request_link(worker, argv, status)
+    if "rejected request" not in reply.get("error", ""):
+      raise AssertionError("Expected {} to be rejected, got {}".format(
+          what, reply))
+    if os.path.exists(escape):
+      raise AssertionError("{} wrote outside of the sandbox".format(what))
+
+  # A client doesn't dispatch a link which the worker would reject
+  log, _ = fixture.link(
+      [worker], "a link naming an absolute path", False,
+      extra_args=["-Wl,-rpath," + escape])
+  expect_log(log, "outside of the directories mapped to the worker",
+             "a link naming an absolute path")
+
+
+def check_shipped_programs(fixture, worker):
+  """
+  A link shouldn't run a program shipped by the client, e.g. an `ld` found
+  through a `-B` search directory of the upload.
+  """
+  escape = os.path.join(fixture.tmpdir, "escape")
+  attack = os.path.join(fixture.tmpdir, "attack-ld")
+  with io.open(attack, "w", encoding="utf-8") as outfile:
+    outfile.write("#!/bin/sh\ntouch {}\n".format(escape))
+  os.chmod(attack, 0o755)
+  files = [("${CWD}/tools/ld", attack, 0o755)]
+  for what, argv in (
+      ("a -B search directory", ["fakeld", "-B${CWD}/tools/", "-o", "prog"]),
+      ("a linker path", ["fakeld", "-fuse-ld=${CWD}/tools/ld", "-o", "prog"]),
+      ("a linker plugin",
+       ["fakeld", "-Wl,-plugin,${CWD}/tools/ld", "-o", "prog"]),
+      ("a plugin option", ["fakeld", "-plugin", "tools/ld", "-o", "prog"])):
+    reply = request_link(worker, argv, files=files, outputs=["${CWD}/prog"])
+    if "rejected request" not in reply.get("error", ""):
+      raise AssertionError("Expected {} to be rejected, got {}".format(
+          what, reply))
+    if os.path.exists(escape):
+      raise AssertionError("{} ran a shipped program".format(what))
+
+  # Shipped files keep their mode, less the execute bits
+  reply = request_link(
+      worker, ["fakeld", "tools/ld", "-o", "prog"], files=files,
+      outputs=["${CWD}/prog"])
+  if reply.get("status") != 0 or "executable input" in reply["stdout"]:
+    raise AssertionError(
+        "Expected the shipped file not to be executable, got {}".format(reply))
+
+  # A client runs such a link locally
+  log, _ = fixture.link(
+      [worker], "a link with a -B search directory", False,
+      extra_args=["-Btools/"])
+  expect_log(log, "may execute a program shipped to the worker",
+             "a link with a -B search directory")
+
+
+def check_ssh(fixture):
+  sshpath = os.path.join(fixture.tmpdir, "bin", "ssh")
+  with io.open(sshpath, "w", encoding="utf-8") as outfile:
+    outfile.write(FAKE_SSH.format(
+        python=sys.executable,
+        cachedir=os.path.join(fixture.tmpdir, "ssh", "cache")))
+  os.chmod(sshpath, 0o755)
+  worker = "ssh://localhost" + os.path.abspath(fixture.args.linkcache)
+  fixture.write("main.o", "main v9")
+  log, content = fixture.link([worker], "a link over ssh", True)
+  expect_log(log, "Uploaded 2 of 2 inputs", "a link over ssh")
+  if os.path.join(fixture.tmpdir, "ssh", "cache", "worker") not in content:
+    raise AssertionError(
+        "Expected the link to run in the sandbox of the ssh worker, got {!r}"
+        .format(content))
+
+
+def runtest(tmpdir, args):
+  check_choose_worker()
+  fixture = Fixture(args, tmpdir)
+  try:
+    worker = check_dispatch(fixture)
+    check_ranking(fixture, worker)
+    check_rejected(fixture, worker)
+    check_shipped_programs(fixture, worker)
+    check_fallback(fixture)
+    check_ssh(fixture)
+  finally:
+    fixture.stop_workers()
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Measure the cold-start-to-exit cost of a linkcache cache hit and verify that
+it stays within budget. Startup creep (e.g. a new module-level import) shows up
+here long before anyone notices it in their build times.
+"""
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Modules which must not be imported on the cache-hit path
+FORBIDDEN_MODULES = [
+    "argcomplete",
+    "argparse",
+    "logging",
+    "pathlib",
+    "subprocess",
+]
+
+FAKE_LINKER = """\
+#!/bin/sh
+while [ $# -gt 0 ]; do
+  if [ "$1" = "-o" ]; then
+    echo "linked" > "$2"
+  fi
+  shift
+done
+"""
+
+FAKE_LINKHASH = """\
+#!/bin/sh
+while read path; do
+  echo "$path 0"
+done
+"""
+
+
+def write_program(filepath, content):
+  with io.open(filepath, "w", encoding="utf-8") as outfile:
+    outfile.write(content)
+  os.chmod(filepath, 0o755)
+
+
+def setup_fixture(tmpdir, ninputs):
+  """
+  Create a fake link step with `ninputs` object files, and execute it once
+  through linkcache so that the next execution is a cache hit. Return the
+  argv to execute for a cache hit.
+  """
+  bindir = os.path.join(tmpdir, "bin")
+  os.makedirs(bindir)
+  write_program(os.path.join(bindir, "fakeld"), FAKE_LINKER)
+  write_program(os.path.join(bindir, "linkhash"), FAKE_LINKHASH)
+
+  command = [os.path.join(bindir, "fakeld")]
+  for idx in range(ninputs):
+    objpath = os.path.join(tmpdir, "obj{:04d}.o".format(idx))
+    with open(objpath, "w"):
+      pass
+    command.append(objpath)
+  command += ["-o", os.path.join(tmpdir, "prog")]
+  return command
+
+
+def get_env(tmpdir):
+  env = dict(os.environ)
+  env["PATH"] = os.path.join(tmpdir, "bin") + ":" + env.get("PATH", "")
+  env.pop("PYTHONDONTWRITEBYTECODE", None)
+  return env
+
+
+def time_command(argv, env, cwd, nsamples):
+  """Return the median wall time (in seconds) of `nsamples` executions."""
+  samples = []
+  for _ in range(nsamples):
+    tstart = time.time()
+    subprocess.check_call(argv, env=env, cwd=cwd)
+    samples.append(time.time() - tstart)
+  samples.sort()
+  return samples[len(samples) // 2]
+
+
+def parse_importtime(content):
+  """
+  Parse the stderr of `python -X importtime` and return a dictionary mapping
+  top-level module name to it's cumulative import time in microseconds.
+  """
+  out = {}
+  for line in content.splitlines():
+    if not line.startswith("import time:"):
+      continue
+    parts = line[len("import time:"):].split("|")
+    if len(parts) != 3:
+      continue
+    try:
+      cumulative = int(parts[1].strip())
+    except ValueError:
+      continue
+    # NOTE(josh): the name column is separated from the bar by a single space, and
+    # nested imports are indented by two more spaces per level
+    name = parts[2].rstrip()[1:]
+    if name.startswith(" "):
+      # Nested import, it's cost is included in the parent
+      continue
+    out[name.strip()] = cumulative
+  return out
+
+
+def runtest(tmpdir, args):
+  command = setup_fixture(tmpdir, args.ninputs)
+  env = get_env(tmpdir)
+  # NOTE(josh): the fake linker is cheaper than a check, so --no-bypass is
+  # needed for the following executions to be cache hits.
+  linkcache = [sys.executable, args.linkcache, "--no-bypass"]
+
+  subprocess.check_call(linkcache + command, env=env, cwd=tmpdir)
+  if not os.path.exists(os.path.join(tmpdir, "prog.cacheinfo")):
+    raise AssertionError("Priming link did not write a cacheinfo sidecar")
+
+  # Verify that the hit path doesn't import anything it shouldn't
+  proc = subprocess.Popen(
+      [sys.executable, "-X", "importtime", args.linkcache, "--no-bypass"]
+      + command,
+      env=env, cwd=tmpdir, stderr=subprocess.PIPE)
+  _, stderr = proc.communicate()
+  if proc.returncode != 0:
+    raise AssertionError(
+        "linkcache exited with non-zero status:\n" + stderr.decode("utf-8"))
+
+  baseline = subprocess.Popen(
+      [sys.executable, "-X", "importtime", "-c", "pass"],
+      env=env, cwd=tmpdir, stderr=subprocess.PIPE)
+  _, basestderr = baseline.communicate()
+
+  imports = parse_importtime(stderr.decode("utf-8"))
+  baseimports = parse_importtime(basestderr.decode("utf-8"))
+  forbidden = sorted(set(imports).intersection(FORBIDDEN_MODULES))
+  if forbidden:
+    raise AssertionError(
+        "Cache hit imported forbidden modules: {}".format(", ".join(forbidden)))
+
+  extra_imports = {
+      name: micros for name, micros in imports.items()
+      if name not in baseimports}
+  import_ms = sum(extra_imports.values()) / 1000.0
+  logger.info(
+      "Cache hit imports %s costing %.1fms",
+      ", ".join(sorted(extra_imports)), import_ms)
+  if import_ms > args.import_budget_ms:
+    raise AssertionError(
+        "Cache hit spent {:.1f}ms importing {}, budget is {:.1f}ms".format(
+            import_ms, ", ".join(sorted(extra_imports)),
+            args.import_budget_ms))
+
+  # Verify that the end-to-end time of a cache hit, less the time it takes
+  # to start the interpreter, is within budget
+  interp_time = time_command(
+      [sys.executable, "-c", "pass"], env, tmpdir, args.nsamples)
+  hit_time = time_command(linkcache + command, env, tmpdir, args.nsamples)
+  overhead_ms = (hit_time - interp_time) * 1000.0
+  logger.info(
+      "Cache hit takes %.1fms, %.1fms over interpreter startup",
+      hit_time * 1000.0, overhead_ms)
+  if overhead_ms > args.budget_ms:
+    raise AssertionError(
+        "Cache hit takes {:.1f}ms over interpreter startup, budget is"
+        " {:.1f}ms".format(overhead_ms, args.budget_ms))
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", default=os.path.join(
+          os.path.dirname(os.path.realpath(__file__)), "linkcache.py"),
+      help="Path to linkcache script")
+  argparser.add_argument(
+      "--ninputs", type=int, default=100,
+      help="Number of object files in the fake link")
+  argparser.add_argument(
+      "--nsamples", type=int, default=21,
+      help="Number of timed executions")
+  argparser.add_argument(
+      "--budget-ms", type=float, default=40.0,
+      help="Maximum allowed cache-hit time in excess of interpreter startup")
+  argparser.add_argument(
+      "--import-budget-ms", type=float, default=25.0,
+      help="Maximum allowed time spent importing modules on a cache hit")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
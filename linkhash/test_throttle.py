@@ -0,0 +1,328 @@
+"""
+Exercise memory-aware link throttling. Many links are started at once through
+`linkcache --throttle` and the number which overlap is measured, with the
+limit imposed by `--max-links` and by a memory requirement that the host can't
+satisfy twice. Under a GNU make jobserver with no free tokens, as when make
+has handed every slot to a job, links run in the implicit slot of their job
+rather than waiting for a token, and extra linker threads only take tokens
+which are free. Verify also that the peak memory of a link is recorded in it's
+cacheinfo.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from linkhash import accel
+from linkhash import throttle
+
+logger = logging.getLogger(__name__)
+
+# A linker which records the interval during which it ran
+FAKE_LINKER = """\
+#!/bin/sh
+out=""
+prev=""
+for arg in "$@"; do
+  if [ "$prev" = "-o" ]; then
+    out="$arg"
+  fi
+  prev="$arg"
+done
+start=$(date +%s%N)
+sleep 0.2
+echo "$start $(date +%s%N)" >> "$(dirname "$0")/links.log"
+echo "linked" > "$out"
+"""
+
+# A linker which allocates a known amount of memory
+HUNGRY_LINKER = """\
+#!{python}
+import sys
+block = bytearray({size})
+for idx in range(0, len(block), 4096):
+  block[idx] = 1
+with open(sys.argv[sys.argv.index("-o") + 1], "w") as outfile:
+  outfile.write("linked\\n")
+"""
+
+
+def write_program(filepath, content):
+  with io.open(filepath, "w", encoding="utf-8") as outfile:
+    outfile.write(content)
+  os.chmod(filepath, 0o755)
+
+
+def get_max_overlap(tmpdir):
+  """
+  Return the maximum number of links which ran at the same time, according
+  to the log of the fake linker.
+  """
+  logpath = os.path.join(tmpdir, "bin", "links.log")
+  events = []
+  with io.open(logpath, "r", encoding="utf-8") as infile:
+    for line in infile:
+      start, end = line.split()
+      events.append((int(start), 1))
+      events.append((int(end), -1))
+  os.unlink(logpath)
+
+  # NOTE(josh): ends sort before starts at the same instant
+  current = 0
+  out = 0
+  for _, delta in sorted(events):
+    current += delta
+    out = max(out, current)
+  return out
+
+
+# Seconds after which links which haven't finished are taken to be deadlocked
+LINK_TIMEOUT = 60
+
+
+def run_links(args, tmpdir, flags, nlinks, env=None, pass_fds=()):
+  """
+  Link `nlinks` distinct outputs at once, through linkcache with `flags`.
+  Return the maximum number of links which overlapped.
+  """
+  if env is None:
+    env = dict(os.environ)
+  env["LINKCACHE_DIR"] = os.path.join(tmpdir, "cache")
+  fakeld = os.path.join(tmpdir, "bin", "fakeld")
+
+  procs = []
+  for idx in range(nlinks):
+    outpath = os.path.join(tmpdir, "prog{}".format(idx))
+    if os.path.exists(outpath):
+      os.unlink(outpath)
+    procs.append(subprocess.Popen(
+        [sys.executable, args.linkcache, "--api-version", "3", "--throttle"]
+        + flags + [fakeld, "main.o", "-o", outpath],
+        cwd=tmpdir, env=env, stderr=subprocess.PIPE, pass_fds=pass_fds))
+
+  for proc in procs:
+    try:
+      _, stderr = proc.communicate(timeout=LINK_TIMEOUT)
+    except subprocess.TimeoutExpired:
+      for other in procs:
+        if other.poll() is None:
+          other.kill()
+          other.communicate()
+      raise AssertionError(
+          "Links didn't finish within {}s, they are deadlocked".format(
+              LINK_TIMEOUT))
+    if proc.returncode != 0:
+      raise AssertionError(
+          "linkcache exited with non-zero status:\n" + stderr.decode("utf-8"))
+  return get_max_overlap(tmpdir)
+
+
+def check_cgroup(tmpdir):
+  cgroup_root = os.path.join(tmpdir, "cgroup")
+  for relpath, limit, usage in (
+      ("", None, 5000), ("build", "1000", "400"), ("build/ninja", "max", "300")):
+    groupdir = os.path.join(cgroup_root, relpath)
+    if not os.path.isdir(groupdir):
+      os.makedirs(groupdir)
+    if limit is not None:
+      with open(os.path.join(groupdir, "memory.max"), "w") as outfile:
+        outfile.write(limit + "\n")
+    with open(os.path.join(groupdir, "memory.current"), "w") as outfile:
+      outfile.write("{}\n".format(usage))
+
+  available = throttle.get_cgroup_available(cgroup_root, "/build/ninja")
+  if available != 600:
+    raise AssertionError(
+        "Expected 600 bytes available below the cgroup limit, got {}"
+        .format(available))
+  if throttle.get_cgroup_available(cgroup_root, "/") is not None:
+    raise AssertionError("Expected no limit on the root cgroup")
+
+
+def read_tokens(fd):
+  """Return the tokens which are free in the jobserver read from `fd`."""
+  out = b""
+  readable, _, _ = select.select([fd], [], [], 0)
+  while readable:
+    chunk = os.read(fd, 16)
+    if not chunk:
+      break
+    out += chunk
+    readable, _, _ = select.select([fd], [], [], 0)
+  return out
+
+
+def check_jobserver_links(args, tmpdir):
+  """
+  Links under `make -j2`, with the pipe and the fifo jobserver, while the
+  other job holds the only token.
+  """
+  fifopath = os.path.join(tmpdir, "jobserver.fifo")
+  os.mkfifo(fifopath)
+  fifofd = os.open(fifopath, os.O_RDWR | os.O_NONBLOCK)
+  readfd, writefd = os.pipe()
+  try:
+    for what, auth, pass_fds, readfrom in (
+        ("pipe", "{},{}".format(readfd, writefd), (readfd, writefd), readfd),
+        ("fifo", "fifo:" + fifopath, (), fifofd)):
+      env = dict(os.environ)
+      env["MAKEFLAGS"] = " -j2 --jobserver-auth={}".format(auth)
+      overlap = run_links(
+          args, tmpdir, ["--link-memory", "1M"], args.nlinks, env=env,
+          pass_fds=pass_fds)
+      logger.info(
+          "%s jobserver without free tokens: %d links overlapped", what,
+          overlap)
+      tokens = read_tokens(readfrom)
+      if tokens:
+        raise AssertionError(
+            "Expected no tokens to be added to the {} jobserver, found {!r}"
+            .format(what, tokens))
+  finally:
+    for fd in (fifofd, readfd, writefd):
+      os.close(fd)
+
+
+def check_jobserver_threads(tmpdir):
+  """An accelerated link takes only the free tokens, for extra threads."""
+  statedir = os.path.join(tmpdir, "state")
+  fifopath = os.path.join(tmpdir, "threads.fifo")
+  os.mkfifo(fifopath)
+  fifofd = os.open(fifopath, os.O_RDWR | os.O_NONBLOCK)
+  readfd, writefd = os.pipe()
+  try:
+    for what, auth, readfrom, writeto in (
+        ("pipe", "{},{}".format(readfd, writefd), readfd, writefd),
+        ("fifo", "fifo:" + fifopath, fifofd, fifofd)):
+      os.write(writeto, b"abc")
+      environ = {"MAKEFLAGS": "-j4 --jobserver-auth={}".format(auth)}
+      jobserver = throttle.JobserverTokens.from_environ(environ)
+      if jobserver is None:
+        raise AssertionError("Expected the {} jobserver to be found".format(
+            what))
+      with throttle.Admission(
+          statedir, 1, target=what, jobserver=jobserver,
+          threads=6) as admission:
+        if admission.threads != 4:
+          raise AssertionError(
+              "Expected the link to run 4 threads with 3 free tokens of the {}"
+              " jobserver, got {}".format(what, admission.threads))
+        if read_tokens(readfrom):
+          raise AssertionError(
+              "Expected every token of the {} jobserver to be taken".format(
+                  what))
+      tokens = read_tokens(readfrom)
+      if sorted(tokens) != sorted(b"abc"):
+        raise AssertionError(
+            "Expected the tokens of the {} jobserver to be returned, found {!r}"
+            .format(what, tokens))
+  finally:
+    for fd in (fifofd, readfd, writefd):
+      os.close(fd)
+
+  rewrite = {"linker": "lld", "gdb_index": False, "threads": 8,
+             "args": ["-fuse-ld=lld", "-Wl,--threads=8"]}
+  limited = accel.limit_threads(rewrite, 4)
+  if limited["args"] != ["-fuse-ld=lld", "-Wl,--threads=4"]:
+    raise AssertionError(
+        "Expected the linker to be limited to 4 threads, got {}".format(
+            limited["args"]))
+  if accel.limit_threads(rewrite, None) is not rewrite:
+    raise AssertionError("Expected no limit without a jobserver")
+
+
+def check_peak_rss(args, tmpdir):
+  size = 64 << 20
+  hungry = os.path.join(tmpdir, "bin", "hungryld")
+  write_program(hungry, HUNGRY_LINKER.format(python=sys.executable, size=size))
+  subprocess.check_call(
+      [sys.executable, args.linkcache, "--api-version", "3", hungry, "main.o",
+       "-o", "hungry"], cwd=tmpdir)
+  with io.open(os.path.join(tmpdir, "hungry.cacheinfo"), "r",
+               encoding="utf-8") as infile:
+    peak_rss = json.load(infile).get("peak_rss", 0)
+  logger.info("Recorded peak RSS %.1f MiB", peak_rss / (1024.0 * 1024.0))
+  if peak_rss < size:
+    raise AssertionError(
+        "Recorded peak RSS {} is less than the {} bytes allocated by the"
+        " linker".format(peak_rss, size))
+
+
+def runtest(tmpdir, args):
+  bindir = os.path.join(tmpdir, "bin")
+  os.makedirs(bindir)
+  write_program(os.path.join(bindir, "fakeld"), FAKE_LINKER)
+  with open(os.path.join(tmpdir, "main.o"), "w") as outfile:
+    outfile.write("main\n")
+
+  check_cgroup(tmpdir)
+
+  overlap = run_links(args, tmpdir, ["--link-memory", "1M"], args.nlinks)
+  logger.info("Unthrottled: %d links overlapped", overlap)
+  if overlap < 2:
+    raise AssertionError(
+        "Expected links to overlap when memory is plentiful, but they didn't")
+
+  overlap = run_links(
+      args, tmpdir, ["--link-memory", "1M", "--max-links", "2"], args.nlinks)
+  logger.info("--max-links 2: %d links overlapped", overlap)
+  if overlap > 2:
+    raise AssertionError(
+        "{} links overlapped with --max-links 2".format(overlap))
+
+  overlap = run_links(args, tmpdir, ["--link-memory", "1024T"], args.nlinks)
+  logger.info("Exceeding available memory: %d links overlapped", overlap)
+  if overlap != 1:
+    raise AssertionError(
+        "Expected links which can't fit together to be serialized, but {}"
+        " overlapped".format(overlap))
+
+  check_jobserver_links(args, tmpdir)
+  check_jobserver_threads(tmpdir)
+  check_peak_rss(args, tmpdir)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--nlinks", type=int, default=6,
+      help="Number of links to start at once")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
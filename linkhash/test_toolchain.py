@@ -0,0 +1,301 @@
+"""
+Verify that the toolchain of a link is part of it's cache key: a link through
+a compiler driver should be a miss when the driver, the linker it runs, or
+(for an LTO link) it's LTO plugin changes, and a hit when they are only
+touched. Each binary should be hashed once, and the driver asked for it's
+linker once, until they change. A hit should reuse the fingerprint recorded in
+the cacheinfo, without consulting the memo of fingerprints, so long as none
+of the binaries it was computed from has changed.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import toolchain
+
+logger = logging.getLogger(__name__)
+
+# A compiler driver which records the queries it answers, one per line, and
+# otherwise runs the linker, which writes the output.
+FAKE_DRIVER = """\
+#!{python}
+import subprocess
+import sys
+if sys.argv[1].startswith("-print-"):
+  with open({logpath!r}, "a") as logfile:
+    logfile.write(sys.argv[1] + "\\n")
+  if sys.argv[1] == "-print-prog-name=ld":
+    print({linkerpath!r})
+  elif sys.argv[1] == "-print-file-name=liblto_plugin.so":
+    print({pluginpath!r})
+  else:
+    print(sys.argv[1].split("=", 1)[1])
+  sys.exit(0)
+sys.exit(subprocess.call([{linkerpath!r}] + sys.argv[1:]))
+"""
+
+FAKE_LINKER = """\
+#!{python}
+# version {version}
+import sys
+with open(sys.argv[sys.argv.index("-o") + 1], "w") as outfile:
+  outfile.write("linked\\n")
+"""
+
+HASHED_MESSAGE = "Fingerprinted toolchain binary"
+
+
+def check_unit():
+  for args, expect in (
+      ([], "ld"), (["-fuse-ld=lld"], "ld.lld"),
+      (["-fuse-ld=/opt/mold/bin/mold"], "/opt/mold/bin/mold"),
+      (["-fuse-ld=gold", "--ld-path=/opt/ld"], "/opt/ld")):
+    if toolchain.get_linker_name(args) != expect:
+      raise AssertionError("Expected the linker of {} to be {}, got {}".format(
+          args, expect, toolchain.get_linker_name(args)))
+
+  args = ["-Wl,-plugin,/a.so,--gc-sections", "-Xlinker", "--plugin=/b.so",
+          "-o", "out"]
+  plugins = toolchain.get_plugin_args(toolchain.get_linker_args(args))
+  if plugins != ["/a.so", "/b.so"]:
+    raise AssertionError("Expected plugins /a.so and /b.so, got {}".format(
+        plugins))
+
+  for args, expect in (
+      (["-flto=thin"], True), (["-flto", "-fno-lto"], False),
+      (["-O2"], False)):
+    if toolchain.uses_lto(args) != expect:
+      raise AssertionError("Expected uses_lto({}) to be {}".format(
+          args, expect))
+
+
+class Fixture(object):
+  """A fake compiler driver, it's linker and LTO plugin, and an input."""
+
+  def __init__(self, args, tmpdir):
+    self.args = args
+    self.tmpdir = tmpdir
+    self.driverpath = os.path.join(tmpdir, "bin", "gcc")
+    self.linkerpath = os.path.join(tmpdir, "bin", "ld")
+    self.pluginpath = os.path.join(tmpdir, "lib", "liblto_plugin.so")
+    self.logpath = os.path.join(tmpdir, "queries.log")
+    self.cachedir = os.path.join(tmpdir, "cache")
+    os.makedirs(os.path.dirname(self.driverpath))
+    os.makedirs(os.path.dirname(self.pluginpath))
+    with io.open(self.driverpath, "w", encoding="utf-8") as outfile:
+      outfile.write(FAKE_DRIVER.format(
+          python=sys.executable, logpath=self.logpath,
+          linkerpath=self.linkerpath, pluginpath=self.pluginpath))
+    os.chmod(self.driverpath, 0o755)
+    self.set_linker_version(1)
+    self.set_plugin_version(1)
+
+    past = time.time() - 100
+    with open(os.path.join(tmpdir, "main.o"), "w"):
+      pass
+    os.utime(os.path.join(tmpdir, "main.o"), (past, past))
+
+  def set_linker_version(self, version):
+    with io.open(self.linkerpath, "w", encoding="utf-8") as outfile:
+      outfile.write(FAKE_LINKER.format(
+          python=sys.executable, version=version))
+    os.chmod(self.linkerpath, 0o755)
+
+  def set_plugin_version(self, version):
+    with io.open(self.pluginpath, "w", encoding="utf-8") as outfile:
+      outfile.write("plugin version {}\n".format(version))
+
+  def count_queries(self):
+    if not os.path.exists(self.logpath):
+      return 0
+    with io.open(self.logpath, "r", encoding="utf-8") as infile:
+      return len(infile.readlines())
+
+  def link(self, expect_hit, what, extra_args=(), flags=(), outfile="prog"):
+    """
+    Link through linkcache and verify whether it was a hit. Return the log of
+    linkcache and the number of queries made of the driver.
+    """
+    before = self.count_queries()
+    proc = subprocess.Popen(
+        [sys.executable, self.args.linkcache, "--log-level", "debug",
+         "--no-bypass", "--api-version", "3", "--cache-dir", self.cachedir]
+        + list(flags) + [self.driverpath, "main.o"] + list(extra_args)
+        + ["-o", outfile],
+        cwd=self.tmpdir, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    stderr = stderr.decode("utf-8")
+    if proc.returncode != 0:
+      raise AssertionError(
+          "linkcache exited with non-zero status:\n" + stderr)
+    if ("Using link-cache" in stderr) != expect_hit:
+      raise AssertionError("Expected {} to be a {}, got:\n{}".format(
+          what, "hit" if expect_hit else "miss", stderr))
+    return stderr, self.count_queries() - before
+
+  def read_cacheinfo(self, outfile="prog"):
+    with io.open(os.path.join(self.tmpdir, outfile + ".cacheinfo"), "r",
+                 encoding="utf-8") as infile:
+      return json.load(infile)
+
+  def read_toolchain(self, outfile="prog"):
+    return self.read_cacheinfo(outfile).get("toolchain")
+
+
+def check_fingerprint(fixture):
+  log, nqueries = fixture.link(False, "the first link")
+  if nqueries != 2:
+    raise AssertionError(
+        "Expected the driver to be asked for it's linker and plugin, got {}"
+        " queries".format(nqueries))
+  if log.count(HASHED_MESSAGE) != 2:
+    raise AssertionError(
+        "Expected the driver and linker to be hashed, got:\n{}".format(log))
+  recorded = fixture.read_toolchain()
+  if sorted(recorded) != ["linker", "program"]:
+    raise AssertionError(
+        "Expected the driver and linker to be fingerprinted, got {}".format(
+            recorded))
+
+  log, nqueries = fixture.link(True, "the second link")
+  if nqueries or HASHED_MESSAGE in log:
+    raise AssertionError(
+        "Expected the fingerprints to be memoized, got:\n{}".format(log))
+
+  # NOTE(josh): a touched linker is hashed again, but it's the same linker
+  future = time.time() + 10
+  os.utime(fixture.linkerpath, (future, future))
+  log, _ = fixture.link(True, "a link after touching the linker")
+  if log.count(HASHED_MESSAGE) != 1:
+    raise AssertionError(
+        "Expected the touched linker to be hashed again, got:\n{}".format(log))
+
+  fixture.set_linker_version(2)
+  fixture.link(False, "a link after upgrading the linker")
+  if fixture.read_toolchain() == recorded:
+    raise AssertionError("Expected the fingerprint of the linker to change")
+  fixture.link(True, "the second link after upgrading the linker")
+
+  with io.open(fixture.driverpath, "a", encoding="utf-8") as outfile:
+    outfile.write("# upgraded\n")
+  _, nqueries = fixture.link(False, "a link after upgrading the driver")
+  if nqueries != 2:
+    raise AssertionError("Expected the upgraded driver to be asked again")
+
+
+def check_lto_plugin(fixture):
+  fixture.link(False, "the first LTO link", ["-flto"], outfile="lto")
+  if "lto_plugin" not in fixture.read_toolchain("lto"):
+    raise AssertionError("Expected the LTO plugin to be fingerprinted")
+  fixture.link(True, "the second LTO link", ["-flto"], outfile="lto")
+
+  fixture.set_plugin_version(2)
+  fixture.link(True, "a link without LTO after upgrading the plugin")
+  fixture.link(False, "an LTO link after upgrading the plugin", ["-flto"],
+               outfile="lto")
+
+
+def check_disabled(fixture):
+  flags = ["--no-toolchain-fingerprint"]
+  fixture.link(False, "the first link without a fingerprint", flags=flags)
+  if fixture.read_toolchain() is not None:
+    raise AssertionError("Expected no toolchain to be recorded")
+  fixture.set_linker_version(3)
+  fixture.link(True, "a link without a fingerprint after an upgrade",
+               flags=flags)
+
+
+def check_table(fixture):
+  tablepath = os.path.join(fixture.cachedir, "toolchain", "fingerprints.json")
+  with io.open(tablepath, "r", encoding="utf-8") as infile:
+    table = json.load(infile)
+  statbuf = os.stat(fixture.linkerpath)
+  entry = table.get(os.path.realpath(fixture.linkerpath))
+  if entry is None or entry["id"] != toolchain.get_binary_id(statbuf):
+    raise AssertionError(
+        "Expected the linker to be memoized by it's identity, got {}".format(
+            entry))
+
+
+def check_reuse(fixture):
+  fixture.link(False, "the first link to reuse", outfile="reuse")
+  binaries = fixture.read_cacheinfo("reuse")["toolchain_ids"]["binaries"]
+  for path in (fixture.driverpath, fixture.linkerpath):
+    statbuf = os.stat(path)
+    if binaries.get(os.path.realpath(path)) != toolchain.get_binary_id(
+        statbuf):
+      raise AssertionError(
+          "Expected the identity of {} to be recorded, got {}".format(
+              path, binaries))
+
+  tablepath = os.path.join(fixture.cachedir, "toolchain", "fingerprints.json")
+  os.remove(tablepath)
+  log, nqueries = fixture.link(True, "a hit without the memo", outfile="reuse")
+  if os.path.exists(tablepath) or nqueries or HASHED_MESSAGE in log:
+    raise AssertionError(
+        "Expected the recorded fingerprint to be reused, got:\n{}".format(log))
+
+  # NOTE(josh): the changed linker is hashed again, and so is the driver since
+  # the memo is gone
+  future = time.time() + 20
+  os.utime(fixture.linkerpath, (future, future))
+  log, _ = fixture.link(
+      True, "a hit after touching the linker", outfile="reuse")
+  if log.count(HASHED_MESSAGE) != 2 or not os.path.exists(tablepath):
+    raise AssertionError(
+        "Expected the toolchain to be fingerprinted again, got:\n{}".format(
+            log))
+
+
+def runtest(tmpdir, args):
+  check_unit()
+  fixture = Fixture(args, tmpdir)
+  check_fingerprint(fixture)
+  check_lto_plugin(fixture)
+  check_table(fixture)
+  check_reuse(fixture)
+  check_disabled(fixture)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
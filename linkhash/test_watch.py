@@ -0,0 +1,256 @@
+"""
+Exercise `linkcache watch` and `linkcache --watch`. With a watcher running, a
+hit should skip the inputs which the journal shows haven't changed, a change
+to an input should still be a miss, and after the watcher restarts the
+journal can't vouch for anything so every input should be checked. A queue
+overflow should start a new journal session, and a shared object written in
+the watched tree should have it's API digest precomputed.
+"""
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from linkhash import apidigest
+from linkhash import elfnote
+from linkhash import linkcache
+from linkhash import watch
+from linkhash import watchclient
+
+logger = logging.getLogger(__name__)
+
+SOURCES = {
+    "main.c": "int foo(void);\nint main(void) { return foo(); }\n",
+    "foo.c": "int foo(void) {{ return {value}; }}\n",
+}
+
+UNCHANGED_MESSAGE = "unchanged according to the journal"
+
+# NOTE(josh): the compiler driver counts as an input, since it doesn't exist in
+# the watched tree
+ALL_UNCHANGED = "Skipping 3 inputs " + UNCHANGED_MESSAGE
+
+
+class NullInotify(object):
+  """Stand-in for `watch.Inotify` which yields no events."""
+
+  def __init__(self):
+    self.fd = -1
+    self.nwatches = 0
+
+  def add_watch(self, path, mask):
+    self.nwatches += 1
+    return self.nwatches
+
+  def read(self):
+    return b""
+
+
+def check_overflow(tmpdir):
+  """
+  Feed the watcher a queue overflow and verify that it starts a new session,
+  and that a position in the old session is no longer accepted.
+  """
+  statedir = os.path.join(tmpdir, "overflow")
+  os.makedirs(statedir)
+  watcher = watch.Watcher(statedir, [tmpdir], inotify=NullInotify())
+  watcher.start()
+  watcher.record(os.path.join(tmpdir, "a.o"))
+  before = watcher.sync()
+  if watchclient.read_journal(
+      watcher.journalpath, before["session"], before["offset"],
+      before["offset"]) != set():
+    raise AssertionError("Expected the journal to be readable at it's end")
+
+  watcher.process(watch.EVENT_HEADER.pack(-1, watch.IN_Q_OVERFLOW, 0, 0))
+  after = watcher.sync()
+  if after["session"] == before["session"]:
+    raise AssertionError("Expected a queue overflow to start a new session")
+  if watchclient.read_journal(
+      watcher.journalpath, before["session"], before["offset"],
+      before["offset"]) is not None:
+    raise AssertionError(
+        "Expected the position of the old session to be rejected")
+
+
+def write_source(tmpdir, name, **kwargs):
+  with io.open(os.path.join(tmpdir, name), "w", encoding="utf-8") as outfile:
+    outfile.write(SOURCES[name].format(**kwargs) if kwargs else SOURCES[name])
+
+
+def compile_source(args, tmpdir, name, **kwargs):
+  write_source(tmpdir, name, **kwargs)
+  subprocess.check_call(
+      [args.compiler, "-fPIC", "-c", "-o", name[:-2] + ".o", name],
+      cwd=tmpdir)
+
+
+def start_watcher(args, tmpdir, cachedir):
+  proc = subprocess.Popen(
+      [sys.executable, args.linkcache, "--cache-dir", cachedir,
+       "--api-version", "3", "--log-level", args.log_level, "watch",
+       os.path.join(tmpdir, "tree")])
+  sockpath = os.path.join(cachedir, "watch", "sock")
+  deadline = time.time() + 10
+  while watchclient.sync_watcher(cachedir) is None:
+    if proc.poll() is not None or time.time() > deadline:
+      proc.kill()
+      raise AssertionError("Watcher didn't start listening on " + sockpath)
+    time.sleep(0.05)
+  return proc
+
+
+def stop_watcher(proc):
+  proc.send_signal(signal.SIGTERM)
+  if proc.wait() != 0:
+    raise AssertionError("Watcher exited with status {}".format(
+        proc.returncode))
+
+
+def link(args, treedir, cachedir):
+  """Link prog through linkcache and return it's log."""
+  proc = subprocess.Popen(
+      [sys.executable, args.linkcache, "--cache-dir", cachedir, "--watch",
+       "--no-bypass", "--api-version", "3", "--log-level", "debug",
+       args.compiler, "main.o", "foo.o", "-o", "prog"],
+      cwd=treedir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  stdout, _ = proc.communicate()
+  if proc.returncode != 0:
+    raise AssertionError("Link failed:\n" + stdout.decode("utf-8"))
+  return stdout.decode("utf-8")
+
+
+def check_log(log, expect, absent, what):
+  if expect is not None and expect not in log:
+    raise AssertionError(
+        "Expected '{}' from {}, got:\n{}".format(expect, what, log))
+  for message in absent:
+    if message in log:
+      raise AssertionError(
+          "Didn't expect '{}' from {}, got:\n{}".format(message, what, log))
+
+
+def check_digest(args, treedir, cachedir):
+  """
+  Link a shared object without linkcache and wait for the watcher to memoize
+  it's API digest.
+  """
+  subprocess.check_call(
+      [args.compiler, "-shared", "-Wl,--build-id", "-o", "libfoo.so",
+       "foo.o"], cwd=treedir)
+  build_id = elfnote.read_build_id(os.path.join(treedir, "libfoo.so"))
+  if build_id is None:
+    raise AssertionError("libfoo.so doesn't have a build-id")
+  options = linkcache.Options(**linkcache.get_default_options())
+  options.cache_dir = cachedir
+  options.api_version = 3
+  memopath = apidigest.get_build_id_memo_path(options, build_id)
+
+  deadline = time.time() + 10
+  while not os.path.exists(memopath):
+    if time.time() > deadline:
+      raise AssertionError(
+          "The API digest of libfoo.so wasn't precomputed at " + memopath)
+    time.sleep(0.05)
+  expect = apidigest.get_digester(None, options).get_apid(
+      os.path.join(treedir, "libfoo.so"))
+  if linkcache.read_apid(memopath) != expect:
+    raise AssertionError("Precomputed API digest {} != {}".format(
+        linkcache.read_apid(memopath), expect))
+
+
+def runtest(tmpdir, args):
+  check_overflow(tmpdir)
+
+  treedir = os.path.join(tmpdir, "tree")
+  cachedir = os.path.join(tmpdir, "cache")
+  os.makedirs(treedir)
+  compile_source(args, treedir, "main.c")
+  compile_source(args, treedir, "foo.c", value=3)
+
+  proc = start_watcher(args, tmpdir, cachedir)
+  try:
+    log = link(args, treedir, cachedir)
+    check_log(log, None, ["Using link-cache"], "the first link")
+
+    log = link(args, treedir, cachedir)
+    check_log(log, ALL_UNCHANGED, [],
+              "an unchanged build")
+    check_log(log, "Using link-cache", [], "an unchanged build")
+
+    compile_source(args, treedir, "foo.c", value=4)
+    log = link(args, treedir, cachedir)
+    check_log(log, "Input file has changed foo.o", [], "a change to foo.o")
+    check_log(log, "Skipping 2 inputs " + UNCHANGED_MESSAGE, [],
+              "a change to foo.o")
+
+    log = link(args, treedir, cachedir)
+    check_log(log, "Using link-cache", [], "the build after a change")
+
+    check_digest(args, treedir, cachedir)
+  finally:
+    stop_watcher(proc)
+
+  log = link(args, treedir, cachedir)
+  check_log(log, "No watcher is running", [UNCHANGED_MESSAGE],
+            "a build without a watcher")
+  check_log(log, "Using link-cache", [], "a build without a watcher")
+
+  proc = start_watcher(args, tmpdir, cachedir)
+  try:
+    log = link(args, treedir, cachedir)
+    check_log(log, "Journal session has changed", [UNCHANGED_MESSAGE],
+              "the build after a restart")
+    check_log(log, "Using link-cache", [], "the build after a restart")
+
+    log = link(args, treedir, cachedir)
+    check_log(log, ALL_UNCHANGED, [],
+              "the second build after a restart")
+  finally:
+    stop_watcher(proc)
+
+
+def main():
+  logging.basicConfig()
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument(
+      "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+  argparser.add_argument(
+      "--linkcache", required=True,
+      help="Path to the linkcache script under test")
+  argparser.add_argument(
+      "--compiler", default="cc",
+      help="Compiler driver used to compile and link the test program")
+  argparser.add_argument(
+      "--keep-dir", action="store_true",
+      help="don't delete the working tree, even if the test passes")
+  args = argparser.parse_args()
+  logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+  tmpdir = tempfile.mkdtemp(prefix="linkhash-")
+  logger.debug("Working in %s", tmpdir)
+
+  try:
+    runtest(tmpdir, args)
+    if not args.keep_dir:
+      shutil.rmtree(tmpdir)
+    return 0
+  except AssertionError as ex:
+    logger.error(ex.args[0])
+  except:
+    logger.exception("Internal Error:")
+  logger.info(
+      "Working directory was left in place at %s for debugging", tmpdir)
+  return 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
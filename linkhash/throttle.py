@@ -0,0 +1,461 @@
+"""
+Admission control for link commands. Links are often the most memory hungry
+steps of a build, and a build which runs many of them at once can exhaust the
+memory of the host, so the parallelism of the whole build ends up being
+limited for the sake of the links. Instead, linkcache can hold each linker
+until the host has the memory to run it.
+
+Every linkcache sharing a state directory (in practice, every build on the
+host) records the links it is running, and the memory each is expected to
+need, in a ledger guarded by an advisory lock. A link is admitted once the
+memory available to it (`MemAvailable` of /proc/meminfo, and the headroom
+below `memory.max` of each enclosing cgroup) covers it's own expectation plus
+whatever the running links are expected to allocate beyond what they already
+hold. A link is always admitted if no other link is running, so that a link
+which can never fit still makes progress.
+
+If a GNU make jobserver is advertised in MAKEFLAGS then the link runs in the
+job slot that make already holds for it (every job has one implicit slot), so
+it never waits for a token. Each linker thread beyond the first (see
+`linkhash.accel`) takes a token while the link runs, if one is free, and the
+link uses only as many threads as it has slots, so that links share the `-j`
+limit of the top-level make with everything else it is running.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import errno
+import fcntl
+import io
+import json
+import logging
+import os
+import select
+import stat
+import time
+
+logger = logging.getLogger(__name__)
+
+# Interval between attempts to be admitted, growing up to the maximum while
+# the host stays busy
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+
+def parse_meminfo(content):
+  """
+  Return a dictionary mapping each field of /proc/meminfo (`content`) to it's
+  value in bytes.
+  """
+  out = {}
+  for line in content.splitlines():
+    key, _, value = line.partition(":")
+    parts = value.split()
+    if not parts:
+      continue
+    try:
+      amount = int(parts[0])
+    except ValueError:
+      continue
+    if len(parts) > 1 and parts[1] == "kB":
+      amount *= 1024
+    out[key.strip()] = amount
+  return out
+
+
+def get_meminfo_available(meminfo_path="/proc/meminfo"):
+  """
+  Return the number of bytes of memory available to start new processes
+  without swapping, or None if it can't be determined.
+  """
+  try:
+    with io.open(meminfo_path, "r", encoding="utf-8") as infile:
+      meminfo = parse_meminfo(infile.read())
+  except (IOError, OSError):
+    return None
+  if "MemAvailable" in meminfo:
+    return meminfo["MemAvailable"]
+  # NOTE(josh): kernels older than 3.14 don't report MemAvailable
+  if "MemFree" in meminfo:
+    return meminfo["MemFree"] + meminfo.get("Cached", 0)
+  return None
+
+
+def get_cgroup_path(cgroup_path="/proc/self/cgroup"):
+  """
+  Return the path of the (unified, v2) cgroup of this process relative to the
+  cgroup filesystem, or None.
+  """
+  try:
+    with io.open(cgroup_path, "r", encoding="utf-8") as infile:
+      for line in infile:
+        hierarchy, _, path = line.strip().partition("::")
+        if hierarchy == "0":
+          return path
+  except (IOError, OSError):
+    pass
+  return None
+
+
+def read_cgroup_value(path):
+  """
+  Return the integer in the cgroup interface file at `path`, or None if the
+  file doesn't exist or contains "max".
+  """
+  try:
+    with io.open(path, "r", encoding="utf-8") as infile:
+      return int(infile.read().strip())
+  except (IOError, OSError, ValueError):
+    return None
+
+
+def get_cgroup_available(cgroup_root="/sys/fs/cgroup", cgroup=None):
+  """
+  Return the number of bytes that may still be charged to the cgroup of this
+  process before reaching the `memory.max` of it or any of it's ancestors, or
+  None if none of them have a limit.
+  """
+  if cgroup is None:
+    cgroup = get_cgroup_path()
+    if cgroup is None:
+      return None
+
+  out = None
+  relpath = cgroup.strip("/")
+  while True:
+    groupdir = os.path.join(cgroup_root, relpath)
+    limit = read_cgroup_value(os.path.join(groupdir, "memory.max"))
+    if limit is not None:
+      usage = read_cgroup_value(os.path.join(groupdir, "memory.current")) or 0
+      headroom = max(0, limit - usage)
+      out = headroom if out is None else min(out, headroom)
+    if not relpath:
+      break
+    relpath = os.path.dirname(relpath)
+  return out
+
+
+def get_available_memory():
+  """
+  Return the number of bytes available to a new link, or None if it can't be
+  determined.
+  """
+  candidates = [
+      value for value in (get_meminfo_available(), get_cgroup_available())
+      if value is not None]
+  if not candidates:
+    return None
+  return min(candidates)
+
+
+def read_proc_stat(pid):
+  """
+  Return the fields of /proc/<pid>/stat following the command name, or None
+  if the process doesn't exist.
+  """
+  try:
+    with io.open("/proc/{}/stat".format(pid), "rb") as infile:
+      content = infile.read()
+  except (IOError, OSError):
+    return None
+  # NOTE(josh): the command name is in parentheses and may itself contain
+  # spaces or parentheses
+  return content[content.rfind(b")") + 2:].split()
+
+
+def get_start_time(pid):
+  """
+  Return the start time of the process `pid` (in clock ticks since boot), which
+  together with the pid identifies a process even if the pid is reused.
+  """
+  fields = read_proc_stat(pid)
+  if fields is None or len(fields) < 20:
+    return None
+  return int(fields[19])
+
+
+def get_tree_rss(pids):
+  """
+  Return a dictionary mapping each of `pids` to the total resident memory, in
+  bytes, of it's descendants.
+  """
+  children = {}
+  for name in os.listdir("/proc"):
+    if not name.isdigit():
+      continue
+    fields = read_proc_stat(name)
+    if fields is None or len(fields) < 22:
+      continue
+    children.setdefault(int(fields[1]), []).append((int(name), fields))
+
+  pagesize = os.sysconf(str("SC_PAGE_SIZE"))
+  out = {}
+  for pid in pids:
+    total = 0
+    stack = list(children.get(pid, []))
+    while stack:
+      child, fields = stack.pop()
+      total += int(fields[21]) * pagesize
+      stack.extend(children.get(child, []))
+    out[pid] = total
+  return out
+
+
+class Ledger(object):
+  """
+  The links currently running on the host, stored as a json list in
+  `<statedir>/links.json`. Entries are only read or modified while the
+  ledger is locked (as a context manager).
+  """
+
+  def __init__(self, statedir):
+    self.statedir = statedir
+    self.path = os.path.join(statedir, "links.json")
+    self.fd = None
+
+  def __enter__(self):
+    if not os.path.isdir(self.statedir):
+      try:
+        os.makedirs(self.statedir)
+      except OSError as ex:
+        if ex.errno != errno.EEXIST:
+          raise
+    self.fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+    os.close(self.fd)
+    self.fd = None
+
+  def read(self):
+    """
+    Return the entries of links which are still running. Entries of links
+    whose linkcache has exited (e.g. was killed) are dropped.
+    """
+    try:
+      with io.open(self.path, "r", encoding="utf-8") as infile:
+        entries = json.load(infile)
+    except (IOError, OSError, ValueError):
+      return []
+    return [
+        entry for entry in entries
+        if get_start_time(entry["pid"]) == entry["start"]]
+
+  def write(self, entries):
+    temppath = "{}.{}".format(self.path, os.getpid())
+    with io.open(temppath, "w", encoding="utf-8") as outfile:
+      outfile.write(json.dumps(entries, indent=2, sort_keys=True))
+    os.rename(temppath, self.path)
+
+
+def get_jobserver_auth(makeflags):
+  """
+  Return the value of the jobserver option in MAKEFLAGS (e.g. "3,4" or
+  "fifo:/tmp/GMfifo123"), or None. The last occurrence wins, as it does for
+  make.
+  """
+  out = None
+  for flag in makeflags.split():
+    for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+      if flag.startswith(prefix):
+        out = flag[len(prefix):]
+  return out
+
+
+def is_fifo(fd):
+  try:
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+  except OSError:
+    return False
+
+
+class JobserverTokens(object):
+  """
+  Tokens taken from a GNU make jobserver, in addition to the implicit slot of
+  the job. Tokens are only taken if they are free, and are returned by
+  `close()`. See
+  https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+  """
+
+  def __init__(self, readfd, writefd, owned=False):
+    self.readfd = readfd
+    self.writefd = writefd
+    # True if we opened the read descriptor (non-blocking, and not shared
+    # with make) and should close it when done
+    self.owned = owned
+    self.tokens = b""
+
+  @classmethod
+  def from_environ(cls, environ=None):
+    """
+    Return the JobserverTokens of the jobserver advertised in the
+    environment, or None if there isn't one that we can use.
+    """
+    if environ is None:
+      environ = os.environ
+    auth = get_jobserver_auth(environ.get("MAKEFLAGS", ""))
+    if auth is None:
+      return None
+
+    if auth.startswith("fifo:"):
+      try:
+        fd = os.open(auth[len("fifo:"):], os.O_RDWR | os.O_NONBLOCK)
+      except OSError:
+        logger.debug("Jobserver fifo %s can't be opened", auth)
+        return None
+      return cls(fd, fd, owned=True)
+
+    try:
+      readfd, writefd = [int(fd) for fd in auth.split(",")]
+    except ValueError:
+      return None
+    # NOTE(josh): make doesn't pass the jobserver to commands it doesn't
+    # consider recursive, in which case the descriptors may be closed or
+    # reused for something else, so only use them if they are still pipes.
+    if readfd < 0 or not (is_fifo(readfd) and is_fifo(writefd)):
+      logger.debug("Jobserver descriptors %s were not inherited", auth)
+      return None
+    # NOTE(josh): O_NONBLOCK is a property of the open file description,
+    # which the inherited descriptor shares with make, so the pipe is opened
+    # again to get one of our own.
+    try:
+      ownfd = os.open(
+          "/proc/self/fd/{}".format(readfd), os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+      return cls(readfd, writefd)
+    return cls(ownfd, writefd, owned=True)
+
+  def acquire(self, count):
+    """
+    Take up to `count` tokens, without waiting for any which aren't free.
+    Return the number of tokens held.
+    """
+    while len(self.tokens) < count:
+      try:
+        if not self.owned:
+          # NOTE(josh): another job may take the token between the select
+          # and the read, in which case we wait for the next one.
+          readable, _, _ = select.select([self.readfd], [], [], 0)
+          if not readable:
+            break
+        tokens = os.read(self.readfd, count - len(self.tokens))
+      except (IOError, OSError) as ex:
+        if ex.errno == errno.EINTR:
+          continue
+        if ex.errno == errno.EAGAIN:
+          break
+        raise
+      if not tokens:
+        break
+      self.tokens += tokens
+    return len(self.tokens)
+
+  def close(self):
+    """Return the tokens we hold to the jobserver."""
+    try:
+      if self.tokens:
+        os.write(self.writefd, self.tokens)
+      self.tokens = b""
+    finally:
+      if self.owned:
+        os.close(self.readfd)
+        self.owned = False
+
+
+class Admission(object):
+  """
+  Context manager which blocks until a link expected to need `rss` bytes may
+  run on this host, and holds it's place in the ledger until exit. A link
+  which would run `threads` threads takes a token from `jobserver` for each
+  but the first, if it is free, and `self.threads` is then the number of
+  threads it may run (or None if it isn't limited).
+  """
+
+  def __init__(self, statedir, rss, target=None, max_links=None,
+               jobserver=None, threads=1):
+    self.ledger = Ledger(statedir)
+    self.rss = rss
+    self.target = target
+    self.max_links = max_links
+    self.jobserver = jobserver
+    self.want_threads = threads
+    self.threads = None
+    self.entry = None
+
+  def get_outstanding(self, entries):
+    """
+    Return the number of bytes the running links of `entries` are expected
+    to allocate beyond what they already hold.
+    """
+    held = get_tree_rss([entry["pid"] for entry in entries])
+    return sum(
+        max(0, entry["rss"] - held.get(entry["pid"], 0)) for entry in entries)
+
+  def try_admit(self):
+    """Add our entry to the ledger and return true if the link may run."""
+    with self.ledger:
+      entries = self.ledger.read()
+      if entries:
+        if self.max_links and len(entries) >= self.max_links:
+          return False
+        available = get_available_memory()
+        if available is not None:
+          need = self.get_outstanding(entries) + self.rss
+          if need > available:
+            logger.debug(
+                "Waiting to link %s: need %d MiB, %d MiB available",
+                self.target, need >> 20, available >> 20)
+            return False
+
+      pid = os.getpid()
+      self.entry = {
+          "pid": pid,
+          "start": get_start_time(pid),
+          "rss": self.rss,
+          "target": self.target,
+      }
+      self.ledger.write(entries + [self.entry])
+      return True
+
+  def release(self):
+    with self.ledger:
+      pid = os.getpid()
+      self.ledger.write(
+          [entry for entry in self.ledger.read() if entry["pid"] != pid])
+    self.entry = None
+
+  def __enter__(self):
+    try:
+      tstart = time.time()
+      interval = MIN_POLL_INTERVAL
+      while not self.try_admit():
+        time.sleep(interval)
+        interval = min(MAX_POLL_INTERVAL, interval * 2)
+      waited = time.time() - tstart
+      if waited > MIN_POLL_INTERVAL:
+        logger.info("Link of %s was admitted after %.1fs", self.target, waited)
+
+      # NOTE(josh): the link itself runs in the slot make holds for this job.
+      # Waiting for a token for it would deadlock once every slot is held by
+      # a job doing the same, so only extra threads take tokens, and only if
+      # they are free.
+      if self.jobserver is not None:
+        self.threads = 1 + self.jobserver.acquire(self.want_threads - 1)
+        logger.debug(
+            "Link of %s may run %d of %d threads", self.target, self.threads,
+            self.want_threads)
+    except BaseException:
+      self.__exit__(None, None, None)
+      raise
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      if self.entry is not None:
+        self.release()
+    finally:
+      if self.jobserver is not None:
+        self.jobserver.close()
+
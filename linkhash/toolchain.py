@@ -0,0 +1,324 @@
+"""
+Fingerprints of the toolchain which executes a link: the program (usually a
+compiler driver), the linker which the driver runs, and the LTO plugin which
+the linker loads. The fingerprints are part of the execspec, so that an
+upgrade of the toolchain in place (e.g. of binutils by the package manager)
+is a miss rather than a hit on an output of the old toolchain.
+
+A fingerprint is the sha256 of the content of a binary, so it is the same in
+every build tree and on every machine with the same toolchain. Fingerprints
+are memoized in a table, keyed by the path, inode, size and mtime of each
+binary, so that an 80MB linker is read once per install rather than once per
+link. The linker and plugin which a driver runs are found by asking the
+driver (`-print-prog-name`, `-print-file-name`) and memoized in the same
+table until the driver, or `$PATH`, changes.
+
+NOTE(josh): this module is imported on every invocation of linkcache, so it
+only imports what the interpreter has already loaded, just like linkcache.
+Running the driver (and importing subprocess) only happens when the table
+doesn't know the answer.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+
+# Names of compiler drivers, which may be prefixed by a target triple and
+# suffixed by a version (e.g. x86_64-linux-gnu-g++-12)
+DRIVER_NAMES = frozenset(["cc", "c++", "gcc", "g++", "clang", "clang++"])
+
+# Seconds to wait for the driver to answer a query
+QUERY_TIMEOUT = 10
+
+# Size of the reads made when hashing a binary
+CHUNK_SIZE = 1 << 20
+
+
+def is_driver(program):
+  """Return true if `program` is the name or path of a compiler driver."""
+  return any(
+      part in DRIVER_NAMES for part in os.path.basename(program).split("-"))
+
+
+def is_linker(program):
+  """
+  Return true if `program` is the name or path of a linker (e.g. ld, ld.gold,
+  mold or x86_64-linux-gnu-ld).
+  """
+  name = os.path.basename(program).split("-")[-1]
+  return name.split(".")[0].endswith("ld")
+
+
+def find_program(name, cwd=None):
+  """Return the path of the program `name` on `$PATH`, or None."""
+  if os.sep in name:
+    if cwd is not None:
+      name = os.path.join(cwd, name)
+    return name if os.access(name, os.X_OK) else None
+  for prefix in os.environ.get("PATH", "").split(os.pathsep):
+    candidate = os.path.join(prefix, name)
+    if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+      return candidate
+  return None
+
+
+def get_binary_id(statbuf):
+  return [statbuf.st_ino, statbuf.st_size, statbuf.st_mtime_ns]
+
+
+def hash_file(path):
+  """Return the sha256 of the content of the file at `path`."""
+  import hashlib
+  digest = hashlib.sha256()
+  with io.open(path, "rb") as infile:
+    while True:
+      chunk = infile.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def get_linker_args(args):
+  """
+  Return the arguments of a driver command which are passed through to the
+  linker (`-Wl,a,b` and `-Xlinker a`).
+  """
+  out = []
+  idx = 0
+  while idx < len(args):
+    arg = args[idx]
+    if arg.startswith("-Wl,"):
+      out.extend(arg[len("-Wl,"):].split(","))
+    elif arg == "-Xlinker" and idx + 1 < len(args):
+      out.append(args[idx + 1])
+      idx += 1
+    idx += 1
+  return out
+
+
+def get_plugin_args(args):
+  """Return the paths of the plugins which a linker command loads."""
+  out = []
+  for idx, arg in enumerate(args):
+    for flag in ("-plugin", "--plugin"):
+      if arg == flag and idx + 1 < len(args):
+        out.append(args[idx + 1])
+      elif arg.startswith(flag + "="):
+        out.append(arg[len(flag) + 1:])
+  return out
+
+
+def get_linker_name(args):
+  """
+  Return the name (or path) of the linker which a driver runs for the driver
+  arguments `args`.
+  """
+  name = "ld"
+  for arg in args:
+    if arg.startswith("--ld-path="):
+      return arg[len("--ld-path="):]
+    if arg.startswith("-fuse-ld="):
+      choice = arg[len("-fuse-ld="):]
+      name = choice if os.sep in choice else "ld." + choice
+  return name
+
+
+def get_search_args(args):
+  """Return the arguments which change where a driver looks for programs."""
+  out = []
+  for idx, arg in enumerate(args):
+    if arg == "-B" and idx + 1 < len(args):
+      out.extend(args[idx:idx + 2])
+    elif arg.startswith("-B") or arg.startswith("--gcc-toolchain="):
+      out.append(arg)
+  return out
+
+
+def uses_lto(args):
+  lto = False
+  for arg in args:
+    if arg.startswith("-flto"):
+      lto = True
+    elif arg == "-fno-lto":
+      lto = False
+  return lto
+
+
+def query_driver(driverpath, args):
+  """
+  Ask the driver at `driverpath` for the linker and LTO plugin it uses with
+  `args` (see `get_search_args()`). Return a json object with their paths,
+  either of which is None if the driver doesn't know.
+  """
+  import subprocess
+
+  def ask(query):
+    try:
+      stdout = subprocess.check_output(
+          [driverpath] + args + [query], stdin=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL, timeout=QUERY_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+      return None
+    lines = stdout.decode("utf-8", "replace").strip().splitlines()
+    return lines[0] if lines else None
+
+  linker_name = get_linker_name(args)
+  linker = ask("-print-prog-name=" + linker_name)
+  if linker is not None and os.sep not in linker:
+    linker = find_program(linker)
+
+  plugin = None
+  if "clang" in os.path.basename(driverpath):
+    # NOTE(josh): lld implements LTO itself, otherwise clang loads the gold
+    # plugin from it's own installation
+    if "lld" not in linker_name:
+      plugin = os.path.join(
+          os.path.dirname(os.path.dirname(driverpath)), "lib", "LLVMgold.so")
+  else:
+    plugin = ask("-print-file-name=liblto_plugin.so")
+  if plugin is not None and not (
+      os.path.isabs(plugin) and os.path.exists(plugin)):
+    plugin = None
+
+  return {"linker": linker, "lto_plugin": plugin}
+
+
+class FingerprintTable(object):
+  """
+  Persistent memo of the fingerprints of binaries, and of the answers of
+  drivers to `query_driver()`. Entries are replaced when the identity (inode,
+  size and mtime) of the binary changes.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = self.read()
+    self.changed = {}
+    # Paths of the binaries which were hashed, rather than memoized
+    self.hashed = []
+    # Identity of each binary which was looked up, by it's real path
+    self.ids = {}
+
+  def read(self):
+    import json
+    try:
+      with io.open(self.path, "r", encoding="utf-8") as infile:
+        entries = json.load(infile)
+    except (IOError, OSError, ValueError):
+      return {}
+    return entries if isinstance(entries, dict) else {}
+
+  def lookup(self, path):
+    """
+    Return the memo entry of the binary at `path` and it's real path, or
+    (None, None) if the binary doesn't exist. The entry is empty if the
+    binary isn't known, or has changed.
+    """
+    realpath = os.path.realpath(path)
+    try:
+      statbuf = os.stat(realpath)
+    except OSError:
+      return None, None
+    binary_id = get_binary_id(statbuf)
+    self.ids[realpath] = binary_id
+    entry = self.entries.get(realpath)
+    if not isinstance(entry, dict) or entry.get("id") != binary_id:
+      entry = {"id": binary_id}
+      self.entries[realpath] = self.changed[realpath] = entry
+    return entry, realpath
+
+  def get_digest(self, path):
+    """Return the fingerprint of the binary at `path`, or None."""
+    entry, realpath = self.lookup(path)
+    if entry is None:
+      return None
+    if "sha256" not in entry:
+      try:
+        entry["sha256"] = hash_file(realpath)
+      except (IOError, OSError):
+        return None
+      self.changed[realpath] = entry
+      self.hashed.append(realpath)
+    return entry["sha256"]
+
+  def get_driver_tools(self, driverpath, args):
+    """
+    Return the answer of `query_driver()` for the driver at `driverpath` and
+    the driver arguments `args`.
+    """
+    import json
+    entry, realpath = self.lookup(driverpath)
+    if entry is None:
+      return {}
+    search_args = get_search_args(args)
+    key = json.dumps(
+        [get_linker_name(args), os.environ.get("PATH", "")] + search_args)
+    queries = entry.setdefault("queries", {})
+    if key not in queries:
+      queries[key] = query_driver(realpath, search_args)
+      self.changed[realpath] = entry
+    return queries[key]
+
+  def serialize(self):
+    """
+    Return the content of the table, merged with any entries written to it by
+    other processes since it was read.
+    """
+    import json
+    entries = self.read()
+    entries.update(self.changed)
+    return json.dumps(entries, indent=2, sort_keys=True).encode("utf-8")
+
+
+def get_fingerprint_key(subcommand, cwd=None):
+  """
+  Return a string which identifies everything, other than the binaries
+  themselves, on which `get_fingerprint()` of `subcommand` depends. Links with
+  the same key share a fingerprint.
+  """
+  import json
+  program = subcommand[0]
+  args = subcommand[1:]
+  driver = None
+  if is_driver(program):
+    driver = [get_linker_name(args), uses_lto(args)] + get_search_args(args)
+    args = get_linker_args(args)
+  plugins = get_plugin_args(args)
+  return json.dumps([
+      program, cwd if (os.sep in program or plugins) else None,
+      os.environ.get("PATH", ""), driver, plugins])
+
+
+def get_fingerprint(subcommand, table, cwd=None):
+  """
+  Return the fingerprints of the toolchain of `subcommand`, as a json object
+  mapping the role of each binary ("program", "linker", "lto_plugin",
+  "plugins") to it's fingerprint. Binaries which can't be found are omitted.
+  """
+  out = {}
+  program = find_program(subcommand[0], cwd)
+  if program is None:
+    return out
+  out["program"] = table.get_digest(program)
+
+  args = subcommand[1:]
+  if is_driver(program):
+    tools = table.get_driver_tools(program, args)
+    if tools.get("linker"):
+      out["linker"] = table.get_digest(tools["linker"])
+    if tools.get("lto_plugin") and uses_lto(args):
+      out["lto_plugin"] = table.get_digest(tools["lto_plugin"])
+    args = get_linker_args(args)
+
+  plugins = []
+  for path in get_plugin_args(args):
+    if cwd is not None:
+      path = os.path.join(cwd, path)
+    digest = table.get_digest(path)
+    if digest is not None:
+      plugins.append(digest)
+  if plugins:
+    out["plugins"] = plugins
+  return {role: digest for role, digest in out.items() if digest is not None}
@@ -0,0 +1,446 @@
+"""
+Watch the build and source trees with inotify and keep a journal of the paths
+which change, so that linkcache can tell which inputs of a link might have
+changed without stat-ing every one of them. Run it in the background for the
+duration of a build session, with the same --cache-dir as the builds, and
+enable it's use with `linkcache --watch`:
+
+  linkcache watch <source-dir> <build-dir> &
+
+The journal is `watch/journal` in the cache directory: a header line naming
+the session of the watcher, followed by one changed path per line. linkcache
+records it's position in the journal in the cacheinfo of each output, and on
+the next check only inputs which appear in the journal after that position
+need be stat-ed. Positions are only valid within a session, and a new session
+is started whenever the watcher can't vouch for the journal (it restarted, the
+kernel event queue overflowed, a watched directory moved, or the journal grew
+too large), in which case linkcache falls back to stat-ing every input.
+
+Events are delivered asynchronously, so before consulting the journal
+linkcache synchronizes with the watcher over `watch/sock`: the watcher reads
+every event already queued by the kernel (which includes the close of every
+file written by a process that has exited) before it replies with the current
+position.
+
+When a shared object is written (IN_CLOSE_WRITE) the watcher also computes it's
+API digest and memoizes it by build-id, so that it's ready by the time
+linkcache digests the output of the link.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import ctypes
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+from concurrent import futures
+
+from linkhash import apidigest
+from linkhash import elfnote
+from linkhash import linkcache
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    | IN_DONT_FOLLOW)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Start a new session once the journal is larger than this, so that readers
+# don't have to scan an ever growing tail
+MAX_JOURNAL_SIZE = 64 << 20
+
+# Number of threads computing API digests of freshly written shared objects
+DIGEST_THREADS = 2
+
+
+class Inotify(object):
+  """Minimal binding of the inotify system calls of libc, through ctypes."""
+
+  def __init__(self):
+    self.libc = ctypes.CDLL(None, use_errno=True)
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def add_watch(self, path, mask):
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return wd
+
+  def read(self):
+    """Return the bytes of every queued event, or b"" if there are none."""
+    chunks = []
+    while True:
+      try:
+        chunk = os.read(self.fd, 1 << 16)
+      except (IOError, OSError) as ex:
+        if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+      if not chunk:
+        break
+      chunks.append(chunk)
+    return b"".join(chunks)
+
+  def close(self):
+    os.close(self.fd)
+
+
+def iter_events(content):
+  """Yield a tuple of (wd, mask, name) for each event in `content`."""
+  offset = 0
+  while offset + EVENT_HEADER.size <= len(content):
+    wd, mask, _, namelen = EVENT_HEADER.unpack_from(content, offset)
+    offset += EVENT_HEADER.size
+    name = content[offset:offset + namelen].rstrip(b"\x00")
+    offset += namelen
+    yield wd, mask, os.fsdecode(name)
+
+
+def get_statedir(options):
+  return os.path.join(linkcache.get_cachedir(options), "watch")
+
+
+def is_shared_object_name(path):
+  return ".so" in os.path.basename(path) and linkcache.is_library_name(path)
+
+
+class Watcher(object):
+  """
+  Watches `roots` and maintains the journal. `inotify` is an Inotify, or
+  None to defer creating it until `start()`.
+  """
+
+  def __init__(self, statedir, roots, options=None, inotify=None):
+    self.statedir = statedir
+    self.roots = [os.path.abspath(root) for root in roots]
+    self.options = options
+    self.inotify = inotify
+    self.journalpath = os.path.join(statedir, "journal")
+    self.journal = None
+    self.session = None
+    self.dirs = {}
+    # Symlinks found within the roots. Changes to their targets aren't
+    # observed, so linkcache must stat inputs found through them.
+    self.symlinks = set()
+    # Paths written to the journal since the last synchronization. A path
+    # only needs to appear once after any position a reader can hold.
+    self.pending = set()
+    self.digests = None
+    self.digest_pool = None
+
+  def start(self):
+    if self.inotify is None:
+      self.inotify = Inotify()
+    self.new_session("started")
+
+  def new_session(self, reason):
+    """
+    Begin a new journal, invalidating every position held by readers, and
+    (re)establish the watches.
+    """
+    self.session = linkcache.get_spechash({
+        "pid": os.getpid(), "nonce": os.urandom(16).hex()})[:16]
+    logger.info("Starting journal session %s (%s)", self.session, reason)
+    content = "linkcache-journal 1 {}\n".format(self.session).encode("utf-8")
+    linkcache.write_atomic(self.journalpath, content)
+    if self.journal is not None:
+      self.journal.close()
+    self.journal = open(self.journalpath, "ab", buffering=1 << 16)
+    self.pending.clear()
+
+    # NOTE(josh): watches are only added, not removed, since a directory
+    # which is already watched yields the same watch descriptor
+    self.dirs.clear()
+    self.symlinks.clear()
+    for root in self.roots:
+      self.add_tree(root)
+
+  def add_tree(self, dirpath, journal=False):
+    """
+    Watch `dirpath` and every directory below it. If `journal` is true then
+    every path found is also journaled, since it may have been written before
+    the watch was added.
+    """
+    stack = [dirpath]
+    while stack:
+      path = stack.pop()
+      try:
+        wd = self.inotify.add_watch(path, WATCH_MASK)
+      except OSError as ex:
+        if ex.errno in (errno.ENOENT, errno.ENOTDIR):
+          continue
+        raise
+      self.dirs[wd] = path
+      try:
+        entries = list(os.scandir(path))
+      except OSError:
+        continue
+      for entry in entries:
+        if entry.is_symlink():
+          self.symlinks.add(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+          stack.append(entry.path)
+        if journal:
+          self.record(entry.path)
+
+  def record(self, path):
+    if path in self.pending:
+      return
+    self.pending.add(path)
+    self.journal.write(path.encode("utf-8", "surrogateescape") + b"\n")
+
+  def process(self, content):
+    """Process the events in `content`, read from the inotify descriptor."""
+    for wd, mask, name in iter_events(content):
+      if mask & IN_Q_OVERFLOW:
+        self.new_session("event queue overflow")
+        return
+      dirpath = self.dirs.get(wd)
+      if dirpath is None:
+        continue
+      if mask & IN_IGNORED:
+        self.dirs.pop(wd, None)
+        continue
+      if mask & IN_MOVE_SELF and dirpath in self.roots:
+        self.new_session("{} moved".format(dirpath))
+        return
+      if mask & IN_MOVED_FROM and mask & IN_ISDIR:
+        # NOTE(josh): the watches below the directory still name it by it's
+        # old path, so the journal can't be trusted until they are re-added.
+        self.new_session("{} moved".format(os.path.join(dirpath, name)))
+        return
+
+      path = os.path.join(dirpath, name) if name else dirpath
+      self.record(path)
+      if mask & (IN_CREATE | IN_MOVED_TO):
+        if mask & IN_ISDIR:
+          self.add_tree(path, journal=True)
+        elif os.path.islink(path):
+          self.symlinks.add(path)
+      if mask & IN_CLOSE_WRITE and is_shared_object_name(path):
+        self.precompute_digest(path)
+
+  def precompute_digest(self, path):
+    if self.digest_pool is None:
+      return
+    self.digest_pool.submit(memoize_digest, self.digests, self.options, path)
+
+  def sync(self):
+    """
+    Process every queued event and return the reply to a synchronization
+    request: the session, the current position in the journal, and the
+    coverage of the journal.
+    """
+    self.process(self.inotify.read())
+    self.journal.flush()
+    offset = self.journal.tell()
+    if offset > MAX_JOURNAL_SIZE:
+      self.new_session("journal is full")
+      offset = self.journal.tell()
+    self.pending.clear()
+    return {
+        "session": self.session,
+        "offset": offset,
+        "roots": self.roots,
+        "symlinks": sorted(self.symlinks),
+    }
+
+  def serve(self, listener):
+    """Process events and synchronization requests until interrupted."""
+    while True:
+      readable, _, _ = select.select([self.inotify.fd, listener], [], [])
+      if self.inotify.fd in readable:
+        self.process(self.inotify.read())
+      if listener in readable:
+        try:
+          conn, _ = listener.accept()
+        except (IOError, OSError):
+          continue
+        self.reply(conn)
+
+  def reply(self, conn):
+    try:
+      conn.settimeout(1.0)
+      request = b""
+      while not request.endswith(b"\n"):
+        chunk = conn.recv(64)
+        if not chunk:
+          return
+        request += chunk
+      if request.strip() == b"sync":
+        reply = json.dumps(self.sync(), sort_keys=True) + "\n"
+        conn.sendall(reply.encode("utf-8"))
+    except (IOError, OSError, socket.timeout):
+      pass
+    finally:
+      conn.close()
+
+
+def memoize_digest(digests, options, path):
+  """
+  Compute the API digest of the shared object at `path` and memoize it by
+  build-id, unless it is already.
+  """
+  try:
+    build_id = elfnote.read_build_id(path)
+    if build_id is None:
+      return
+    memopath = apidigest.get_build_id_memo_path(options, build_id)
+    if os.path.exists(memopath):
+      return
+    statbuf = os.stat(path)
+    if linkcache.get_input_kind(path, statbuf) != "shared":
+      return
+    apid = digests.get_apid(path)
+    if apid is None:
+      return
+    memodir = os.path.dirname(memopath)
+    if not os.path.isdir(memodir):
+      os.makedirs(memodir)
+    linkcache.write_atomic(memopath, (apid + "\n").encode("utf-8"))
+    logger.debug("Precomputed API digest of %s", path)
+  except (IOError, OSError, ValueError):
+    logger.debug("Failed to precompute API digest of %s", path)
+
+
+class SerialDigester(object):
+  """
+  Wraps a digester which serves one request at a time (the linkhash
+  coprocess) so that it can be shared by the digest threads.
+  """
+
+  def __init__(self, digester):
+    self.digester = digester
+    self.lock = threading.Lock()
+
+  def get_apid(self, sopath):
+    with self.lock:
+      return self.digester.get_apid(sopath)
+
+  def close(self):
+    with self.lock:
+      self.digester.close()
+
+
+def get_digester(options):
+  """
+  Return a digester, safe to share between threads, for the API model of
+  `options`, or None.
+  """
+  linkhash_path = linkcache.find_linkhash()
+  digester = apidigest.get_digester(linkhash_path, options)
+  if digester is not None and linkhash_path is not None:
+    digester = SerialDigester(digester)
+  return digester
+
+
+def setup_argparser(argparser):
+  argparser.add_argument(
+      "roots", nargs="+",
+      help="Directories to watch, e.g. the source and build trees")
+  argparser.add_argument(
+      "--no-digests", action="store_true",
+      help="Don't precompute the API digests of shared objects")
+
+
+def main(argv, options=None):
+  argparser = argparse.ArgumentParser(
+      prog="linkcache watch", description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  setup_argparser(argparser)
+  args = argparser.parse_args(argv)
+  if options is not None:
+    linkcache.logger.set_level(options.log_level)
+  linkcache.logger.get_logger()
+
+  statedir = get_statedir(options)
+  if not os.path.isdir(statedir):
+    os.makedirs(statedir)
+  lockfd = os.open(
+      os.path.join(statedir, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+  try:
+    fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except (IOError, OSError):
+    logger.error("Another watcher is already using %s", statedir)
+    return 1
+
+  sockpath = os.path.join(statedir, "sock")
+  if os.path.exists(sockpath):
+    os.unlink(sockpath)
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  listener.bind(sockpath)
+  listener.listen(64)
+
+  watcher = Watcher(statedir, args.roots, options)
+  if not args.no_digests and options is not None:
+    digester = get_digester(options)
+    if digester is not None:
+      watcher.digests = digester
+      watcher.digest_pool = futures.ThreadPoolExecutor(
+          max_workers=DIGEST_THREADS)
+
+  def terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+  signal.signal(signal.SIGTERM, terminate)
+  try:
+    watcher.start()
+    logger.info("Watching %s", ", ".join(watcher.roots))
+    watcher.serve(listener)
+  except KeyboardInterrupt:
+    pass
+  except OSError as ex:
+    if ex.errno == errno.ENOSPC:
+      logger.error(
+          "Out of inotify watches, see /proc/sys/fs/inotify/max_user_watches")
+    else:
+      logger.error("%s", ex)
+    return 1
+  finally:
+    # NOTE(josh): the socket is removed first so that no reader accepts a
+    # position from a journal which is no longer maintained
+    os.unlink(sockpath)
+    listener.close()
+    if watcher.digest_pool is not None:
+      watcher.digest_pool.shutdown(wait=False)
+      watcher.digests.close()
+    os.close(lockfd)
+  return 0
+
+
+if __name__ == "__main__":
+  logging.basicConfig()
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,89 @@
+"""
+Client of the watcher (see `linkhash.watch`), with which linkcache skips the
+inputs that the journal shows haven't changed since an output was last
+checked.
+
+NOTE(josh): this module is imported by linkcache on every check with --watch,
+so it only imports what it needs to talk to the watcher, and doesn't import
+linkcache (which may be running as a script) or logging.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+
+# Seconds to wait for the watcher to reply before checking every input
+WATCH_TIMEOUT = 2.0
+
+# Bytes of journal a hit may read before it records a newer position
+MAX_JOURNAL_TAIL = 64 << 10
+
+
+def sync_watcher(cachedir):
+  """
+  Ask the watcher of the cache directory `cachedir` to process every pending
+  event and return it's reply: a dictionary with the journal "session", the
+  "offset" of the end of the journal, the watched "roots", and the
+  "symlinks" found within them. Returns None if there is no watcher, or it
+  doesn't reply.
+  """
+  import json
+  import socket
+
+  sockpath = os.path.join(cachedir, "watch", "sock")
+  try:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      conn.settimeout(WATCH_TIMEOUT)
+      conn.connect(sockpath)
+      conn.sendall(b"sync\n")
+      content = b""
+      while not content.endswith(b"\n"):
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+          return None
+        content += chunk
+    finally:
+      conn.close()
+    return json.loads(content.decode("utf-8"))
+  except (IOError, OSError, ValueError):
+    return None
+
+
+def read_journal(journalpath, session, start, end):
+  """
+  Return the set of paths journaled between offsets `start` and `end` of the
+  journal of `session`, or None if the journal is of another session.
+  """
+  try:
+    with open(journalpath, "rb") as infile:
+      header = infile.readline().split()
+      if header[1:] != [b"1", session.encode("utf-8")] or start < infile.tell():
+        return None
+      infile.seek(start)
+      content = infile.read(end - start)
+  except (IOError, OSError):
+    return None
+  if len(content) != end - start:
+    return None
+  return set(content.decode("utf-8", "surrogateescape").splitlines())
+
+
+def get_journal_filter(watch, changed):
+  """
+  Return a function which returns true for the absolute path of an input
+  which is within the roots of the watcher (the reply `watch` of
+  `sync_watcher()`) and isn't in the set of `changed` paths.
+  """
+  roots = tuple(os.path.join(root, "") for root in watch["roots"])
+  # NOTE(josh): changes to the target of a symlink aren't journaled, so
+  # inputs found through one are always checked
+  symlinks = set(watch["symlinks"])
+  symlink_prefixes = tuple(os.path.join(link, "") for link in symlinks)
+
+  def is_unchanged(path):
+    return (path.startswith(roots) and path not in changed
+            and path not in symlinks
+            and not path.startswith(symlink_prefixes))
+
+  return is_unchanged